@@ -1,3 +1,4 @@
+import base64
 import dataclasses
 import ipaddress
 import logging
@@ -60,6 +61,10 @@ class Config:
     TUNNEL_USER: str
     TUNNEL_PW_HASH: str
     TUNNEL_PW_SALT: str
+    TUNNEL_TOKEN_KEY: str | None = None
+    TUNNEL_API_URL: str | None = None
+    TUNNEL_API_USER: str | None = None
+    TUNNEL_API_PASSWORD: str | None = None
 
     def db_url(self) -> URL:
         return URL.create(
@@ -71,6 +76,12 @@ class Config:
             database=self.DB_NAME,
         )
 
+    def tunnel_token_key(self) -> bytes | None:
+        if not self.TUNNEL_TOKEN_KEY:
+            return None
+
+        return base64.b64decode(self.TUNNEL_TOKEN_KEY)
+
     def redis_client(self) -> Redis:
         if (c := getattr(self, "_redis_client", None)) is not None:
             return c
@@ -146,6 +157,10 @@ def _load_config_file(path: Path | str) -> dict[str, Any]:
         _set(res, "TUNNEL_USER", tunnel.get("user"))
         _set(res, "TUNNEL_PW_HASH", tunnel.get("pw_hash"))
         _set(res, "TUNNEL_PW_SALT", tunnel.get("pw_salt"))
+        _set(res, "TUNNEL_TOKEN_KEY", tunnel.get("token_key"))
+        _set(res, "TUNNEL_API_URL", tunnel.get("api_url"))
+        _set(res, "TUNNEL_API_USER", tunnel.get("api_user"))
+        _set(res, "TUNNEL_API_PASSWORD", tunnel.get("api_password"))
 
     if isinstance(probe := cfg.get("probes"), dict):
         _set(res, "LONG_POLLING_INTERVAL", probe.get("polling_interval"), _td)
@@ -201,7 +216,7 @@ def _load_env_config() -> dict[str, Any]:
             continue
 
         t = f.type
-        if t == str:
+        if t == str or t == str | None:
             _set(res, f.name, val)
         elif t == int:
             _set(res, f.name, val, int)
@@ -1,13 +1,37 @@
 import logging
 
-from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+    create_async_engine,
+)
 
 from . import config
+from . import models as dbm
 
 LOGGER = logging.getLogger(__name__)
 
 _ENGINE: AsyncEngine | None = None
 
+# columns added after their tables were first created (create_all only creates
+# missing tables)
+_ADDED_COLUMNS = [
+    (dbm.MoAtToken.__tablename__, "permission_version integer NOT NULL DEFAULT 0"),
+]
+
+
+async def add_missing_columns(conn: AsyncConnection) -> None:
+    """Add columns that tables created by older versions lack.
+
+    Has to run after the tables are created.
+    """
+    for table, column in _ADDED_COLUMNS:
+        await conn.execute(
+            text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}")
+        )
+
 
 def create_sessionmaker():
     global _ENGINE, _SESSION_MAKER
@@ -32,6 +32,7 @@ async def lifespan(app: FastAPI):
         try:
             async with db._ENGINE.begin() as conn:  # type: ignore
                 await conn.run_sync(dbm.Base.metadata.create_all)
+                await db.add_missing_columns(conn)
             break
         except Exception:
             LOGGER.exception("Couldn't connect to database. Retrying in 10s...")
@@ -425,6 +425,9 @@ class MoAtToken(Base):
     allowed_scope: Mapped[MoAtTokenScope] = mapped_column(MoAtTokenScopeType)
     expires: Mapped[Optional[datetime]]
     admin: Mapped[bool] = mapped_column(server_default="FALSE")
+    # incremented whenever the token's permissions change to invalidate signed
+    # session tokens that were issued before
+    permission_version: Mapped[int] = mapped_column(server_default="0")
 
     sim_assoc: Mapped[List[TokenSimAssociation]] = relationship(back_populates="token")
     session_tokens: Mapped[List["SessionToken"]] = relationship(back_populates="token")
@@ -7,7 +7,7 @@ from uuid import UUID
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from sqlalchemy import delete, select
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
@@ -16,6 +16,7 @@ from .. import models as dbm
 from ..auth import get_basic_auth
 from ..db import get_db
 from . import models as pyd
+from . import signed_tokens
 
 LOGGER = logging.getLogger(__name__)
 
@@ -53,7 +54,14 @@ async def generate_session_token(
     if scope not in token.allowed_scope:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
 
-    stoken_value = secrets.token_bytes(32)
+    key = config.get_config().tunnel_token_key()
+
+    if key is not None:
+        identity = probe_id if probe_id is not None else provider_id
+        assert identity is not None
+        stoken_value = signed_tokens.sign(key, scope, token, identity)
+    else:
+        stoken_value = secrets.token_bytes(32)
 
     stoken = dbm.SessionToken(
         value=stoken_value,
@@ -80,11 +88,28 @@ async def generate_tunnel_token(
     return token
 
 
-async def delete_session_token(session: AsyncSession, token: bytes) -> None:
-    await session.execute(
-        delete(dbm.SessionToken).where(dbm.SessionToken.value == token)
+async def delete_session_token(
+    session: AsyncSession, token: bytes
+) -> dbm.MoAtToken | None:
+    """Delete a session token and return the token it was issued for.
+
+    The permission version of the returned token is incremented so that the
+    tunnel server stops trusting the (possibly signed) session token.
+    """
+    stoken = await session.scalar(
+        select(dbm.SessionToken)
+        .options(selectinload(dbm.SessionToken.token))
+        .where(dbm.SessionToken.value == token)
     )
 
+    if stoken is None:
+        return None
+
+    stoken.token.permission_version += 1
+    await session.delete(stoken)
+
+    return stoken.token
+
 
 async def is_valid_token(session: AsyncSession, token_bytes: bytes) -> dbm.MoAtToken:
     tok = await session.scalar(
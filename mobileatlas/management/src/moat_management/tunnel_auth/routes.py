@@ -13,6 +13,7 @@ from ..auth import bearer_token_probe, get_basic_auth_admin
 from ..db import get_db
 from ..resources import get_templates
 from . import models as pyd
+from . import tunnel_api
 from .auth import (
     delete_session_token,
     generate_session_token,
@@ -50,7 +51,11 @@ async def deregister_probe(session: Session, session_token: pyd.Token) -> None:
     LOGGER.debug(f"Deleting probe session token: {session_token}")
 
     async with session.begin():
-        await delete_session_token(session, session_token.root)
+        token = await delete_session_token(session, session_token.root)
+        changed = (token.id, token.permission_version) if token is not None else None
+
+    if changed is not None:
+        await tunnel_api.permission_version_changed(*changed)
 
 
 # TODO: currently SIM card providers have no registration
@@ -77,7 +82,11 @@ async def deregister_provider(session: Session, session_token: pyd.Token):
     LOGGER.debug(f"Deleting provider session token: {session_token}")
 
     async with session.begin():
-        await delete_session_token(session, session_token.root)
+        token = await delete_session_token(session, session_token.root)
+        changed = (token.id, token.permission_version) if token is not None else None
+
+    if changed is not None:
+        await tunnel_api.permission_version_changed(*changed)
 
 
 @router.get("/")
@@ -146,6 +155,11 @@ async def add_sim(
         )
         session.add(assoc)
 
+        token.permission_version += 1
+        changed = (token.id, token.permission_version)
+
+    await tunnel_api.permission_version_changed(*changed)
+
 
 # TODO
 async def remove_sim():
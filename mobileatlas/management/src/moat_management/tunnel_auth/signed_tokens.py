@@ -0,0 +1,41 @@
+import datetime
+import hashlib
+import hmac
+import secrets
+import struct
+from uuid import UUID
+
+from .. import models as dbm
+
+# Layout (network byte order; see moatt_server.auth_handlers.signed_token):
+# version (1) | scope (1) | flags (1) | identity (16) | token_id (8) |
+# permission_version (4) | expires (8; unix time, 0 = never) | nonce (16) |
+# HMAC-SHA256 of the preceding bytes (32)
+VERSION = 1
+FLAG_ADMIN = 1
+_FORMAT = struct.Struct("!BBB16sQIQ16s")
+
+
+def sign(
+    key: bytes,
+    scope: dbm.MoAtTokenScope,
+    token: dbm.MoAtToken,
+    identity: UUID,
+) -> bytes:
+    """Create a session token that the tunnel server can verify without contacting us."""
+    expires = token.expires
+    if expires is not None and expires.tzinfo is None:
+        expires = expires.replace(tzinfo=datetime.timezone.utc)
+
+    msg = _FORMAT.pack(
+        VERSION,
+        scope.value,
+        FLAG_ADMIN if token.admin else 0,
+        identity.bytes,
+        token.id,
+        token.permission_version,
+        int(expires.timestamp()) if expires is not None else 0,
+        secrets.token_bytes(16),
+    )
+
+    return msg + hmac.digest(key, msg, hashlib.sha256)
@@ -0,0 +1,35 @@
+import logging
+
+import httpx
+
+from .. import config
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def permission_version_changed(token_id: int, version: int) -> None:
+    """Tell the tunnel server that session tokens of `token_id` with an older
+    permission version must no longer be trusted."""
+    cfg = config.get_config()
+
+    if not cfg.TUNNEL_API_URL:
+        return
+
+    auth = (
+        httpx.BasicAuth(cfg.TUNNEL_API_USER, cfg.TUNNEL_API_PASSWORD)
+        if cfg.TUNNEL_API_USER is not None and cfg.TUNNEL_API_PASSWORD is not None
+        else None
+    )
+
+    try:
+        async with httpx.AsyncClient(auth=auth, base_url=cfg.TUNNEL_API_URL) as client:
+            res = await client.post(
+                "/auth/invalidate",
+                json={"token_id": token_id, "permission_version": version},
+            )
+            res.raise_for_status()
+    except httpx.HTTPError:
+        LOGGER.exception(
+            "Failed to notify tunnel server about new permissions of token %d.",
+            token_id,
+        )
@@ -0,0 +1,57 @@
+import contextlib
+
+import pytest
+from sqlalchemy import exc
+
+
+class FakeDb:
+    """Stands in for the sessionmaker of the batch writers (`AuditLog`,
+    `SessionLog`) and records the rows they insert."""
+
+    # rows of this SIM are rejected by the fake database
+    BAD_SIM = 666
+
+    def __init__(self):
+        self.rows: list[dict] = []
+        self.unavailable = 0  # number of upcoming writes that fail to connect
+        self.lost: set[int] = set()  # numbers of the writes that lose the connection
+        self.writes = 0
+
+    def session(self) -> "FakeSession":
+        return FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, db: FakeDb):
+        self.db = db
+        self.pending: list[dict] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    @contextlib.asynccontextmanager
+    async def begin(self):
+        self.db.writes += 1
+        if self.db.writes in self.db.lost:
+            raise exc.OperationalError("INSERT", {}, Exception("connection lost"))
+        if self.db.unavailable > 0:
+            self.db.unavailable -= 1
+            raise exc.OperationalError("INSERT", {}, Exception("connection refused"))
+
+        yield
+        self.db.rows += self.pending
+
+    async def execute(self, stmt, rows):
+        if any(r.get("sim_id") == FakeDb.BAD_SIM for r in rows):
+            raise exc.IntegrityError("INSERT", {}, Exception("constraint violated"))
+        # payloads of the APDU log have no SIM
+        if "sim_id" in rows[0]:
+            self.pending += rows
+
+
+@pytest.fixture
+def db() -> FakeDb:
+    return FakeDb()
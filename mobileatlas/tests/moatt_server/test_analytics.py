@@ -0,0 +1,75 @@
+import uuid
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pytest.importorskip("numpy")
+
+from moatt_server.analytics import Analyzer, Grouping  # noqa: E402
+from moatt_server.export.arrow import SCHEMA  # noqa: E402
+
+PROVIDER = uuid.uuid4()
+PROBE = uuid.uuid4()
+
+SELECT_MF = bytes.fromhex("00a40004023f00")
+SELECT_EF = bytes.fromhex("00a40004022fe2")
+# announces two bytes of data but carries only one
+SELECT_TRUNCATED = bytes.fromhex("00a40004027f")
+READ_BINARY = bytes.fromhex("00b000000a")
+OK = bytes.fromhex("9000")
+
+
+def _batch(apdus: list[tuple[str, bytes]]) -> "pa.RecordBatch":
+    n = len(apdus)
+    return pa.record_batch(
+        [
+            pa.array(range(n), pa.int64()),
+            pa.array([1_700_000_000_000_000 + i for i in range(n)], pa.int64()).cast(
+                SCHEMA.field("timestamp").type
+            ),
+            pa.array([PROVIDER.bytes] * n, pa.binary(16)),
+            pa.array([PROBE.bytes] * n, pa.binary(16)),
+            pa.array([1] * n, pa.int32()),
+            pa.nulls(n, pa.string()),
+            pa.nulls(n, pa.string()),
+            pa.array(["Apdu"] * n)
+            .dictionary_encode()
+            .cast(SCHEMA.field("command").type),
+            pa.array([payload for _, payload in apdus], pa.binary()),
+            pa.array([sender for sender, _ in apdus])
+            .dictionary_encode()
+            .cast(SCHEMA.field("sender").type),
+        ],
+        schema=SCHEMA,
+    )
+
+
+def _files(apdus: list[tuple[str, bytes]]) -> dict[str, tuple[int, int, int]]:
+    analyzer = Analyzer(Grouping.Sim)
+    analyzer.add(_batch(apdus))
+
+    files = analyzer.summary().files.to_pydict()
+    return {
+        f: (s, r, u)
+        for f, s, r, u in zip(
+            files["file"], files["select"], files["read"], files["update"]
+        )
+    }
+
+
+def test_truncated_select():
+    apdus = [
+        ("Probe", SELECT_MF),
+        ("Provider", OK),
+        ("Probe", SELECT_EF),
+        ("Provider", OK),
+        # must not read the FID from the next row
+        ("Probe", SELECT_TRUNCATED),
+        ("Provider", bytes.fromhex("6700")),
+        ("Probe", READ_BINARY),
+        ("Provider", bytes(10) + OK),
+        # must not read beyond the end of the payloads
+        ("Probe", SELECT_TRUNCATED),
+    ]
+
+    assert _files(apdus) == {"3F00": (1, 0, 0), "2FE2": (1, 1, 0)}
@@ -0,0 +1,26 @@
+import asyncio
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from moatt_server import apdu_log
+
+
+class FailingConnection:
+    async def get_raw_connection(self):
+        raise ConnectionResetError
+
+
+def test_failed_archive_is_removed():
+    with tempfile.TemporaryDirectory() as d:
+        archive_dir = Path(d) / "archive"
+
+        with pytest.raises(ConnectionResetError):
+            asyncio.run(
+                apdu_log._archive(
+                    FailingConnection(), "apdu_log_20240601", archive_dir  # type: ignore
+                )
+            )
+
+        assert list(archive_dir.iterdir()) == []
@@ -0,0 +1,85 @@
+import asyncio
+import uuid
+from typing import TYPE_CHECKING
+
+from moatt_types.connect import ApduOp, ApduPacket
+
+from moatt_server import models as dbm
+from moatt_server.audit import MAX_ATTEMPTS, AuditLog
+from moatt_server.db import SimId
+
+if TYPE_CHECKING:
+    from conftest import FakeDb
+
+PROVIDER = uuid.uuid4()
+PROBE = uuid.uuid4()
+
+
+def _log(db: "FakeDb", batch_size: int = 8) -> AuditLog:
+    return AuditLog(db.session, batch_size=batch_size, max_buffered=100)  # type: ignore
+
+
+async def _add(log: AuditLog, sims: list[int]) -> None:
+    for i, sim in enumerate(sims):
+        apdu = ApduPacket(ApduOp.Apdu, bytes([i]))
+        await log.log(PROVIDER, PROBE, SimId(sim), apdu, dbm.Sender.Probe)
+
+
+def test_rejected_entry_is_discarded(db: "FakeDb"):
+    async def run():
+        log = _log(db)
+        sims = [1, 2, 3, db.BAD_SIM, 4, 5, 6, 7, 8, 9]
+        await _add(log, sims)
+
+        for _ in range(MAX_ATTEMPTS - 1):
+            assert not await log._write_pending()
+            assert len(log._buf) == len(sims)
+
+        assert await log._write_pending()
+        assert len(log._buf) == 0
+        assert [r["sim_id"] for r in db.rows] == [s for s in sims if s != db.BAD_SIM]
+        # flush() returns although an entry was discarded
+        await asyncio.wait_for(log.flush(), 1)
+
+    asyncio.run(run())
+
+
+def test_unavailable_database_is_retried_indefinitely(db: "FakeDb"):
+    async def run():
+        db.unavailable = 10 * MAX_ATTEMPTS
+        log = _log(db)
+        await _add(log, [1, 2, 3])
+
+        while not await log._write_pending():
+            assert len(log._buf) == 3
+
+        assert [r["sim_id"] for r in db.rows] == [1, 2, 3]
+
+    asyncio.run(run())
+
+
+def test_unavailable_database_while_bisecting(db: "FakeDb"):
+    async def run():
+        log = _log(db)
+        sims = [1, 2, db.BAD_SIM, 3, 4, 5, 6, 7]
+        await _add(log, sims)
+
+        for _ in range(MAX_ATTEMPTS - 1):
+            assert not await log._write_pending()
+
+        # the batch and its first half fail, [1, 2] is written and then the
+        # connection is lost
+        db.lost.add(db.writes + 4)
+        assert not await log._write_pending()
+
+        # entries that were not written are buffered again, in order
+        written = [r["sim_id"] for r in db.rows]
+        assert written + [e["sim_id"] for e in log._buf] == sims
+
+        # the rejected entry is looked for again once the database is back
+        for _ in range(MAX_ATTEMPTS - 1):
+            assert not await log._write_pending()
+        assert await log._write_pending()
+        assert [r["sim_id"] for r in db.rows] == [s for s in sims if s != db.BAD_SIM]
+
+    asyncio.run(run())
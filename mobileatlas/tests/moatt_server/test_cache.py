@@ -0,0 +1,193 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from moatt_server import cache
+from moatt_server.cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+class Loader:
+    """Loader whose calls block until `release` is called."""
+
+    def __init__(self):
+        self.calls = 0
+        self._release: asyncio.Future | None = None
+
+    async def __call__(self) -> str:
+        self.calls += 1
+        self._release = asyncio.get_running_loop().create_future()
+        return await self._release
+
+    async def started(self) -> asyncio.Future:
+        """Wait until the loader was called (by a task of the cache)."""
+        while self._release is None or self._release.done():
+            await asyncio.sleep(0)
+        return self._release
+
+    async def release(self, value: str) -> None:
+        (await self.started()).set_result(value)
+
+    async def fail(self, e: Exception) -> None:
+        (await self.started()).set_exception(e)
+
+
+def _cache(**kwargs) -> TTLCache[str, str]:
+    return TTLCache(kwargs.pop("maxsize", 10), timedelta(seconds=10), **kwargs)
+
+
+def test_expiry(clock: Clock):
+    c = _cache()
+    c.put("a", "1")
+
+    clock.now = 9.9
+    assert c.get("a") == "1"
+    clock.now = 10
+    assert c.get("a") is None
+    assert len(c) == 0
+
+
+def test_negative_ttl(clock: Clock):
+    c = _cache(
+        negative_ttl=timedelta(seconds=1), is_negative=lambda v: v.startswith("deny")
+    )
+    c.put("a", "allow")
+    c.put("b", "deny")
+
+    clock.now = 1
+    assert c.get("a") == "allow"
+    assert c.get("b") is None
+
+    # negative results are not cached at all with a TTL of 0
+    c = _cache(negative_ttl=timedelta(0), is_negative=lambda v: v.startswith("deny"))
+    c.put("b", "deny")
+    assert len(c) == 0
+
+
+def test_lru_eviction(clock: Clock):
+    c = _cache(maxsize=3)
+    for k in "abc":
+        c.put(k, k)
+
+    # lookups mark entries as recently used
+    assert c.get("a") == "a"
+    c.put("d", "d")
+    assert c.get("b") is None
+    assert [c.get(k) for k in "acd"] == ["a", "c", "d"]
+
+    # as do cache hits of get_or_load
+    asyncio.run(c.get_or_load("a", Loader()))
+    c.put("e", "e")
+    assert c.get("c") is None
+    assert len(c) == 3
+
+
+def test_concurrent_loads_are_coalesced(clock: Clock):
+    async def run():
+        c = _cache()
+        loader = Loader()
+
+        waiters = [asyncio.create_task(c.get_or_load("a", loader)) for _ in range(3)]
+        # a different key is loaded separately
+        other_loader = Loader()
+        other = asyncio.create_task(c.get_or_load("b", other_loader))
+        await loader.started()
+        await other_loader.started()
+        assert loader.calls == 1
+
+        await loader.release("1")
+        assert await asyncio.gather(*waiters) == ["1", "1", "1"]
+        assert c.get("a") == "1"
+        assert not other.done()
+
+        # cached now
+        assert await c.get_or_load("a", loader) == "1"
+        assert loader.calls == 1
+
+        other.cancel()
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter(clock: Clock):
+    async def run():
+        c = _cache()
+        loader = Loader()
+
+        first = asyncio.create_task(c.get_or_load("a", loader))
+        second = asyncio.create_task(c.get_or_load("a", loader))
+        await loader.started()
+
+        # the load continues for the remaining waiter
+        first.cancel()
+        await loader.release("1")
+        assert await second == "1"
+        assert first.cancelled()
+        assert c.get("a") == "1"
+
+    asyncio.run(run())
+
+
+def test_failed_load(clock: Clock):
+    async def run():
+        c = _cache()
+        loader = Loader()
+
+        waiters = [asyncio.create_task(c.get_or_load("a", loader)) for _ in range(3)]
+        await loader.fail(ConnectionError("unavailable"))
+
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(r, ConnectionError) for r in results)
+        assert len(c) == 0
+        assert c._inflight == {}
+
+        # the next lookup tries again
+        retry = asyncio.create_task(c.get_or_load("a", loader))
+        await loader.started()
+        assert loader.calls == 2
+        await loader.release("1")
+        assert await retry == "1"
+
+    asyncio.run(run())
+
+
+def test_invalidation_during_load(clock: Clock):
+    async def run():
+        c = _cache()
+        c.put("b", "2")
+        loader = Loader()
+
+        stale = asyncio.create_task(c.get_or_load("a", loader))
+        await loader.started()
+
+        assert c.invalidate(lambda k: k == "b") == 1
+        await loader.release("stale")
+        # the waiter gets the result, but it is not cached
+        assert await stale == "stale"
+        assert c.get("a") is None
+
+        # loads started after the invalidation are cached
+        fresh = asyncio.create_task(c.get_or_load("a", loader))
+        await loader.release("1")
+        assert await fresh == "1"
+        assert c.get("a") == "1"
+
+        assert c.invalidate() == 1
+        assert len(c) == 0
+
+    asyncio.run(run())
@@ -0,0 +1,221 @@
+import asyncio
+import dataclasses
+import uuid
+from datetime import timedelta
+
+import pytest
+from moatt_types.connect import ConnectRequest, ConnectResponse, ConnectStatus, SimId
+
+from moatt_server import config, timers
+from moatt_server.config import Config
+from moatt_server.loadgen.stub_auth import StubAuth
+from moatt_server.sim_directory import SimEntry
+from moatt_server.tunnel import connection_queue
+from moatt_server.tunnel.connection_queue import Queue, QueueEntry
+
+PROVIDER = uuid.uuid4()
+SIM = SimEntry(1, None, None, PROVIDER)
+WAIT = timedelta(seconds=30)
+
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch):
+    monkeypatch.setattr(
+        config,
+        "_CONFIG",
+        Config(
+            DB_USER="",
+            DB_PASSWORD="",
+            DB_NAME="",
+            AUTH_HANDLER=StubAuth(None),
+            MAX_PROBE_WAITTIME=WAIT,
+        ),
+    )
+    # the wheel is bound to the event loop of the test
+    monkeypatch.setattr(timers, "_WHEEL", None)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+    def close(self) -> None:
+        self.closed = True
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+
+def _entry(probe_id: uuid.UUID, **kwargs) -> QueueEntry:
+    return QueueEntry(
+        SIM,
+        probe_id,
+        ConnectRequest(SimId(PROVIDER, SIM.id)),
+        asyncio.StreamReader(),
+        FakeWriter(),  # type: ignore
+        **kwargs,
+    )
+
+
+async def _get_all(q: Queue) -> list[QueueEntry]:
+    return [await q.get() for _ in range(q.qsize())]
+
+
+def test_fair_order():
+    async def run():
+        q = Queue(10)
+        a, b, c = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        a1, a2, a3, b1, b2, c1 = [_entry(p) for p in [a, a, a, b, b, c]]
+
+        for e in [a1, a2, a3, b1, b2, c1]:
+            q.put_nowait(e)
+
+        assert await q.get() is a1
+        # arrives after a1 was served; tagged in the same round as a2 and b2
+        d1 = _entry(uuid.uuid4())
+        q.put_nowait(d1)
+
+        assert await _get_all(q) == [b1, c1, a2, b2, d1, a3]
+
+    asyncio.run(run())
+
+
+def test_priority():
+    async def run():
+        q = Queue(10)
+        probe = uuid.uuid4()
+        low = [_entry(probe) for _ in range(3)]
+        high = _entry(uuid.uuid4(), priority=-1)
+
+        for e in [*low, high]:
+            q.put_nowait(e)
+
+        assert await _get_all(q) == [high, *low]
+
+    asyncio.run(run())
+
+
+def test_requeue():
+    async def run():
+        q = Queue(2)
+        e1, e2 = _entry(uuid.uuid4()), _entry(uuid.uuid4())
+        q.put_nowait(e1)
+        q.put_nowait(e2)
+
+        first = await q.get()
+        q.requeue_nowait(first)
+        assert q.qsize() == 2
+        assert q.full()
+
+        # requeued entries are served before all waiting entries
+        assert await _get_all(q) == [e1, e2]
+
+        # ... or handed to a waiting provider
+        getter = asyncio.create_task(q.get())
+        await asyncio.sleep(0)
+        q.requeue_nowait(e2)
+        assert await getter is e2
+        assert q.empty()
+
+    asyncio.run(run())
+
+
+def test_limits():
+    async def run():
+        q = Queue(3, max_per_probe=2)
+        probe = uuid.uuid4()
+
+        q.put_nowait(_entry(probe))
+        q.put_nowait(_entry(probe))
+        with pytest.raises(asyncio.QueueFull):
+            q.put_nowait(_entry(probe))
+
+        q.put_nowait(_entry(uuid.uuid4()))
+        with pytest.raises(asyncio.QueueFull):
+            q.put_nowait(_entry(uuid.uuid4()))
+
+        await q.get()
+        q.put_nowait(_entry(probe))
+        assert q.qsize() == 3
+
+        # immediate requests only succeed if a provider is waiting
+        with pytest.raises(asyncio.QueueFull):
+            Queue(3).put_nowait(_entry(probe, immediate=True))
+
+    asyncio.run(run())
+
+
+def test_probe_gone():
+    async def run():
+        q = Queue(10)
+        probe = uuid.uuid4()
+        e1, e2, e3 = _entry(probe), _entry(probe), _entry(uuid.uuid4())
+        for e in [e1, e2, e3]:
+            q.put_nowait(e)
+
+        e1.reader.feed_eof()
+        assert e1._watch is not None
+        await asyncio.wait([e1._watch])
+
+        assert q.qsize() == 2
+        assert e1.writer.is_closing()
+        assert not e1.queued
+        # only marked; skipped once it reaches the top of the heap
+        assert len(q._ready) == 3
+
+        assert await _get_all(q) == [e3, e2]
+        assert len(q._ready) == 0
+
+    asyncio.run(run())
+
+
+def test_compaction():
+    async def run():
+        q = Queue(1000)
+        entries = [_entry(uuid.uuid4()) for _ in range(500)]
+        for e in entries:
+            q.put_nowait(e)
+
+        for e in entries[:-10]:
+            assert q.remove(e)
+            assert len(q._ready) <= 2 * q.qsize() + connection_queue._COMPACT_THRESHOLD
+        assert not q.remove(entries[0])
+
+        assert await _get_all(q) == entries[-10:]
+
+    asyncio.run(run())
+
+
+def test_expiry(monkeypatch):
+    async def run():
+        q = Queue(10)
+        e1, e2 = _entry(uuid.uuid4()), _entry(uuid.uuid4())
+        q.put_nowait(e1)
+        monkeypatch.setattr(
+            config,
+            "_CONFIG",
+            dataclasses.replace(config.get_config(), MAX_PROBE_WAITTIME=2 * WAIT),
+        )
+        q.put_nowait(e2)
+
+        assert e1.deadline is not None and e2.deadline is not None
+        wheel = timers.wheel()
+        wheel.advance(e1.deadline + wheel.resolution)
+
+        assert q.qsize() == 1
+        assert e1.writer.closed
+        assert (
+            e1.writer.data == ConnectResponse(ConnectStatus.ProviderTimedOut).encode()
+        )
+
+        assert await q.get() is e2
+        # dequeued entries no longer expire
+        wheel.advance(e2.deadline + wheel.resolution)
+        assert not e2.writer.closed
+        assert len(wheel) == 0
+
+    asyncio.run(run())
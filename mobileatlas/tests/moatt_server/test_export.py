@@ -0,0 +1,220 @@
+import datetime
+import struct
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+import pytest
+from moatt_types.connect import ApduOp
+
+from moatt_server import models as dbm
+from moatt_server.export import pcap
+from moatt_server.export.pcap import PcapEncoder
+
+PROVIDER = uuid.uuid4()
+PROBE = uuid.uuid4()
+OTHER_PROBE = uuid.uuid4()
+START = datetime.datetime(2024, 6, 1, 12, 0, 0, 250, tzinfo=datetime.timezone.utc)
+
+SELECT = bytes.fromhex("00a40004023f00")
+OK = bytes.fromhex("9000")
+
+
+@dataclass
+class LogRow:
+    """Row of the APDU log as returned by the export query."""
+
+    id: int
+    timestamp: datetime.datetime
+    sender: dbm.Sender
+    payload: Optional[bytes]
+    command: ApduOp = ApduOp.Apdu
+    probe_id: uuid.UUID = PROBE
+    provider_id: uuid.UUID = PROVIDER
+    sim_id: int = 1
+    sim_iccid: Optional[str] = "89430000000000000001"
+    sim_imsi: Optional[str] = None
+
+
+def _rows(*entries: tuple) -> list[LogRow]:
+    """Rows logged one millisecond apart."""
+    return [
+        LogRow(i, START + datetime.timedelta(milliseconds=i), *e)
+        for i, e in enumerate(entries)
+    ]
+
+
+def _cmd(payload: bytes = SELECT) -> tuple:
+    return (dbm.Sender.Probe, payload)
+
+
+def _rsp(payload: bytes = OK) -> tuple:
+    return (dbm.Sender.Provider, payload)
+
+
+def _records(data: bytes) -> list[tuple[datetime.datetime, bytes]]:
+    """Timestamps and APDUs of the records of a pcap file without its header."""
+    records = []
+
+    while len(data) > 0:
+        sec, usec, incl_len, orig_len = struct.unpack_from("<IIII", data)
+        assert incl_len == orig_len
+        packet = data[16 : 16 + incl_len]
+        data = data[16 + incl_len :]
+
+        ts = datetime.datetime.fromtimestamp(sec, datetime.timezone.utc)
+        records.append((ts.replace(microsecond=usec), packet[20 + 8 + 16 :]))
+
+    return records
+
+
+def test_pcap_header():
+    header = PcapEncoder().start()
+
+    # little endian magic, version 2.4, snaplen 65535, LINKTYPE_IPV4
+    assert header == bytes.fromhex(
+        "d4c3b2a1" "0200" "0400" "00000000" "00000000" "ffff0000" "e4000000"
+    )
+
+
+def test_pcap_packet():
+    rows = _rows(_cmd(), _rsp())
+    data = PcapEncoder().encode(rows)
+
+    sec, usec, incl_len, orig_len = struct.unpack_from("<IIII", data)
+    # time of the response
+    assert (sec, usec) == (int(rows[1].timestamp.timestamp()), 1250)
+    assert incl_len == orig_len == len(data) - 16 == 20 + 8 + 16 + 9
+
+    ip = data[16:36]
+    assert ip[0] == 0x45
+    assert struct.unpack("!H", ip[2:4])[0] == incl_len
+    assert ip[6:8] == bytes.fromhex("4000")  # don't fragment
+    assert ip[8] == 64 and ip[9] == 17  # TTL, UDP
+    assert ip[12:16] == ip[16:20] == bytes([127, 0, 0, 1])
+    # the one's complement sum of a header with a valid checksum is 0xFFFF
+    s = sum(struct.unpack("!10H", ip))
+    assert (s & 0xFFFF) + (s >> 16) == 0xFFFF
+    assert ip[10:12] == bytes.fromhex("3cb6")
+
+    udp = data[36:44]
+    assert struct.unpack("!HHHH", udp) == (4729, 4729, 8 + 16 + 9, 0)
+
+    gsmtap = data[44:60]
+    # version 2, 4 words, type SIM, sub type APDU
+    assert gsmtap == bytes.fromhex("02040400" "0000" "0000" "00000000" "00000000")
+
+    assert data[60:] == SELECT + OK
+
+
+@pytest.mark.parametrize("split", range(5))
+def test_pcap_pairing_across_batches(split: int):
+    rows = _rows(
+        _cmd(),
+        (dbm.Sender.Probe, OK, ApduOp.Ping),
+        _rsp(),
+        _cmd(SELECT[:5]),
+        _rsp(bytes.fromhex("6a82")),
+    )
+    encoder = PcapEncoder()
+    data = encoder.encode(rows[:split]) + encoder.encode(rows[split:])
+
+    assert _records(data) == [
+        (rows[2].timestamp, SELECT + OK),
+        (rows[4].timestamp, SELECT[:5] + bytes.fromhex("6a82")),
+    ]
+    assert encoder.finish() == b""
+
+
+def test_pcap_sessions_are_paired_separately():
+    rows = _rows(
+        _cmd(),
+        (dbm.Sender.Probe, b"\x01", ApduOp.Apdu, OTHER_PROBE),
+        (dbm.Sender.Provider, b"\x02", ApduOp.Apdu, OTHER_PROBE),
+        _rsp(),
+    )
+
+    assert _records(PcapEncoder().encode(rows)) == [
+        (rows[2].timestamp, b"\x01\x02"),
+        (rows[3].timestamp, SELECT + OK),
+    ]
+
+
+def test_pcap_unanswered_commands():
+    rows = _rows(
+        _cmd(b"\x01"),
+        # a command without a response is written when the next command arrives
+        _cmd(b"\x02"),
+        (dbm.Sender.Probe, None, ApduOp.Reset),
+        # responses without a command are written on their own
+        _rsp(),
+        _cmd(b"\x03"),
+    )
+    other = LogRow(5, START, dbm.Sender.Probe, b"\x04", probe_id=OTHER_PROBE)
+    encoder = PcapEncoder()
+
+    assert _records(encoder.encode(rows + [other])) == [
+        (rows[0].timestamp, b"\x01"),
+        # flushed by the Reset
+        (rows[1].timestamp, b"\x02"),
+        (rows[3].timestamp, OK),
+    ]
+    # remaining commands in the order they were logged
+    assert _records(encoder.finish()) == [
+        (other.timestamp, b"\x04"),
+        (rows[4].timestamp, b"\x03"),
+    ]
+    assert encoder.finish() == b""
+
+
+def test_pcap_oversized_packet():
+    command = bytes(pcap.MAX_PAYLOAD_LEN - 1)
+    rows = _rows(_cmd(command), _rsp())
+
+    # the command and response are written separately if they do not fit into
+    # a single packet
+    assert _records(PcapEncoder().encode(rows)) == [
+        (rows[0].timestamp, command),
+        (rows[1].timestamp, OK),
+    ]
+
+
+def test_arrow_round_trip():
+    pa = pytest.importorskip("pyarrow")
+    from moatt_server.export.arrow import SCHEMA, ArrowEncoder
+
+    rows = _rows(
+        (dbm.Sender.Probe, None, ApduOp.Reset),
+        _cmd(),
+        _rsp(),
+        (dbm.Sender.Provider, bytes(300), ApduOp.Apdu, OTHER_PROBE),
+    )
+    rows[3].sim_iccid = None
+    rows[3].sim_imsi = "232010000000001"
+
+    encoder = ArrowEncoder()
+    data = encoder.start()
+    data += encoder.encode(rows[:2])
+    data += encoder.encode(rows[2:])
+    data += encoder.finish()
+
+    reader = pa.ipc.open_stream(data)
+    assert reader.schema == SCHEMA
+    batches = list(reader)
+    assert [b.num_rows for b in batches] == [2, 2]
+
+    assert pa.Table.from_batches(batches).to_pylist() == [
+        {
+            "id": r.id,
+            "timestamp": r.timestamp,
+            "provider_id": r.provider_id.bytes,
+            "probe_id": r.probe_id.bytes,
+            "sim_id": r.sim_id,
+            "sim_iccid": r.sim_iccid,
+            "sim_imsi": r.sim_imsi,
+            "command": r.command.name,
+            "payload": r.payload,
+            "sender": r.sender.name,
+        }
+        for r in rows
+    ]
@@ -0,0 +1,352 @@
+import asyncio
+import socket
+import uuid
+
+import pytest
+from moatt_clients import mux as client_mux
+from moatt_clients.client import _Client
+from moatt_clients.errors import VersionError
+from moatt_clients.probe_client import MultiplexedProbeClient
+from moatt_clients.streams import RawStream
+from moatt_types.connect import (
+    MuxFrame,
+    PartialInput,
+    Token,
+    VersionRequest,
+    VersionResponse,
+)
+
+from moatt_server import config, timers
+from moatt_server.config import Config
+from moatt_server.loadgen.stub_auth import StubAuth, make_token
+from moatt_server.sim_directory import SimDirectory
+from moatt_server.tunnel import mux as server_mux
+from moatt_server.tunnel.probe_handler import ProbeHandler
+from moatt_server.tunnel.util import read_msg, write_msg
+
+WINDOW = MuxFrame.INITIAL_WINDOW
+TIMEOUT = 5
+
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch):
+    monkeypatch.setattr(
+        config,
+        "_CONFIG",
+        Config(
+            DB_USER="",
+            DB_PASSWORD="",
+            DB_NAME="",
+            AUTH_HANDLER=StubAuth(None),
+            MAX_MUX_STREAMS=2,
+            PING_INTERVAL=None,
+        ),
+    )
+    monkeypatch.setattr(timers, "_WHEEL", None)
+
+
+def _exactly(n: int):
+    """Decoder for `read_message` returning the next `n` bytes."""
+
+    def decode(buf, offset: int) -> tuple[bytes, int]:
+        if len(buf) < offset + n:
+            raise PartialInput(offset + n - len(buf))
+        return bytes(buf[offset : offset + n]), n
+
+    return decode
+
+
+async def _connect(
+    streams: int = 2,
+) -> tuple[server_mux.Mux, asyncio.Task, client_mux.Mux]:
+    """Server and client side of a multiplexed connection over a socket pair.
+
+    The client may open `streams` concurrent streams.
+    """
+    a, b = socket.socketpair()
+    reader, writer = await asyncio.open_connection(sock=a)
+
+    server = server_mux.Mux(reader, writer, "probe")
+    server.allow_streams(streams)
+    run = asyncio.create_task(server.run())
+
+    client = await asyncio.to_thread(client_mux.Mux, RawStream(b))
+    await _until(lambda: client._max_local == streams)
+
+    return server, run, client
+
+
+async def _close(server: server_mux.Mux, run: asyncio.Task, client: client_mux.Mux):
+    client.close()
+    await asyncio.wait_for(run, TIMEOUT)
+    assert server.is_closed()
+
+
+async def _until(condition) -> None:
+    async with asyncio.timeout(TIMEOUT):
+        while not condition():
+            await asyncio.sleep(0.001)
+
+
+def test_concurrent_streams():
+    async def run():
+        server, task, client = await _connect(3)
+
+        streams = [client.open_stream() for _ in range(3)]
+        # interleaved writes of the streams
+        for i in range(4):
+            for n, s in enumerate(streams):
+                await asyncio.to_thread(s.write_all, bytes([n]) * 100)
+
+        accepted = [await server.accept() for _ in streams]
+        assert [s.id for s in accepted] == [1, 3, 5]  # type: ignore
+
+        for n, s in enumerate(accepted):
+            assert await s.readexactly(400) == bytes([n]) * 400  # type: ignore
+            s.write(bytes([n + 10]) * 10)  # type: ignore
+            await s.drain()  # type: ignore
+
+        for n, s in enumerate(streams):
+            data = await asyncio.to_thread(s.read_message, _exactly(10))
+            assert data == bytes([n + 10]) * 10
+
+        await _close(server, task, client)
+
+    asyncio.run(run())
+
+
+def test_server_writer_blocks_on_full_window():
+    async def run():
+        server, task, client = await _connect()
+
+        c = client.open_stream()
+        await asyncio.to_thread(c.write_all, b"open")
+        s = await server.accept()
+        assert s is not None
+        assert await s.readexactly(4) == b"open"
+
+        s.write(bytes(WINDOW + 100))
+        drain = asyncio.create_task(s.drain())
+        await asyncio.sleep(0.1)
+        assert not drain.done()
+        assert s._send_window == 0
+        assert len(s._pending) == 100
+
+        # less than half of the window does not release the writer
+        await asyncio.to_thread(c.read_message, _exactly(WINDOW // 2 - 1))
+        await asyncio.sleep(0.1)
+        assert not drain.done()
+
+        await asyncio.to_thread(c.read_message, _exactly(1))
+        await asyncio.wait_for(drain, TIMEOUT)
+        assert s._send_window == WINDOW // 2 - 100
+
+        await asyncio.to_thread(c.read_message, _exactly(WINDOW // 2 + 100))
+        await _close(server, task, client)
+
+    asyncio.run(run())
+
+
+def test_client_writer_blocks_on_full_window():
+    async def run():
+        server, task, client = await _connect()
+
+        c = client.open_stream()
+        write = asyncio.create_task(asyncio.to_thread(c.write_all, bytes(WINDOW + 1)))
+        s = await server.accept()
+        assert s is not None
+        await asyncio.sleep(0.1)
+        assert not write.done()
+
+        assert await s.readexactly(WINDOW // 2) == bytes(WINDOW // 2)
+        await asyncio.wait_for(write, TIMEOUT)
+        assert await s.readexactly(WINDOW // 2 + 1) == bytes(WINDOW // 2 + 1)
+
+        await _close(server, task, client)
+
+    asyncio.run(run())
+
+
+def test_graceful_close():
+    async def run():
+        server, task, client = await _connect()
+
+        c = client.open_stream()
+        await asyncio.to_thread(c.write_all, b"request")
+        await asyncio.to_thread(c.close)
+
+        s = await server.accept()
+        assert s is not None
+        # data sent before the Close is delivered
+        assert await s.read() == b"request"
+        assert await s.read() == b""
+        assert s.at_eof()
+
+        # the stream stays open in the other direction until both sides closed it
+        assert len(server) == 1
+        s.close()
+        await asyncio.wait_for(s.wait_closed(), TIMEOUT)
+        await _until(lambda: len(client._streams) == 0)
+        assert len(server) == 0
+        assert client._local_open == 0
+
+        await _close(server, task, client)
+
+    asyncio.run(run())
+
+
+def test_reset():
+    async def run():
+        server, task, client = await _connect()
+
+        c = client.open_stream()
+        # ignore the window; the server resets the stream
+        c._send_window = 2 * WINDOW
+        await asyncio.to_thread(c.write_all, bytes(WINDOW + 10))
+
+        s = await server.accept()
+        assert s is not None
+        assert await s.readexactly(MuxFrame.MAX_PAYLOAD_LEN) == bytes(
+            MuxFrame.MAX_PAYLOAD_LEN
+        )
+        with pytest.raises(ConnectionResetError, match="Flow control"):
+            await s.read()
+        assert len(server) == 0
+
+        # unlike a Close, a Reset is an error for the peer
+        with pytest.raises(ConnectionResetError, match="reset by server"):
+            await asyncio.to_thread(c.read_message, _exactly(1))
+        assert len(client._streams) == 0
+        assert client._local_open == 0
+
+        with pytest.raises(ConnectionResetError):
+            s.write(b"late")
+
+        await _close(server, task, client)
+
+    asyncio.run(run())
+
+
+def test_connection_loss_resets_streams():
+    async def run():
+        server, task, client = await _connect()
+
+        c = client.open_stream()
+        await asyncio.to_thread(c.write_all, b"x")
+        s = await server.accept()
+        assert s is not None
+
+        client.close()
+        await asyncio.wait_for(task, TIMEOUT)
+
+        assert await s.read() == b"x"
+        with pytest.raises(ConnectionResetError):
+            await s.read()
+        with pytest.raises(ConnectionResetError):
+            c.read_message(_exactly(1))
+        assert await server.accept() is None
+
+    asyncio.run(run())
+
+
+def test_stream_limit():
+    async def run():
+        a, b = socket.socketpair()
+        reader, writer = await asyncio.open_connection(sock=a)
+        handler = ProbeHandler(config.get_config(), None, SimDirectory())  # type: ignore
+        handle = asyncio.create_task(
+            handler.handle_mux(reader, writer, make_token(uuid.uuid4()))
+        )
+
+        client = await asyncio.to_thread(client_mux.Mux, RawStream(b))
+        await _until(lambda: client._max_local == config.get_config().MAX_MUX_STREAMS)
+
+        # incomplete ConnectRequests keep the sessions waiting
+        streams = [client.open_stream() for _ in range(2)]
+        for s in streams:
+            await asyncio.to_thread(s.write_all, b"\x01")
+
+        with pytest.raises(TimeoutError):
+            await asyncio.to_thread(client.open_stream, 0.1)
+
+        # a client ignoring the limit has its stream reset
+        client._max_local += 1
+        extra = client.open_stream()
+        await asyncio.to_thread(extra.write_all, b"\x01")
+        with pytest.raises(ConnectionResetError):
+            await asyncio.to_thread(extra.read_message, _exactly(1))
+
+        # the remaining sessions are not affected
+        await asyncio.sleep(0.1)
+        assert all(s._error is None for s in streams)
+
+        client.close()
+        await asyncio.wait_for(handle, TIMEOUT)
+
+    asyncio.run(run())
+
+
+class VersionServer:
+    """Answers a VersionRequest like a server supporting `supported`.
+
+    Servers without version negotiation (`supported` is None) close the
+    connection instead.
+    """
+
+    def __init__(self, supported: range | None):
+        self.supported = supported
+        self.chosen: int | None = None
+
+    async def serve(self, sock: socket.socket) -> None:
+        reader, writer = await asyncio.open_connection(sock=sock)
+        req = await read_msg(reader, VersionRequest.decode_from)
+
+        if self.supported is not None:
+            self.chosen = req.choose(self.supported)
+            await write_msg(writer, VersionResponse(self.chosen))
+
+        writer.close()
+        await writer.wait_closed()
+
+
+@pytest.mark.parametrize(
+    "supported,version",
+    [(range(1, 3), 2), (range(1, 2), 1), (None, None)],
+)
+def test_version_fallback(supported: range | None, version: int | None):
+    async def run():
+        a, b = socket.socketpair()
+        server = VersionServer(supported)
+        serve = asyncio.create_task(server.serve(a))
+
+        client = _Client(Token(bytes(16)), "localhost", 0)
+        if version is None:
+            with pytest.raises(VersionError):
+                await asyncio.to_thread(client._negotiate, RawStream(b), 1, 2)
+        else:
+            assert await asyncio.to_thread(client._negotiate, RawStream(b), 1, 2) == (
+                version
+            )
+
+        await serve
+        b.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("supported", [range(1, 2), None])
+def test_multiplexed_client_requires_v2(monkeypatch, supported: range | None):
+    async def run():
+        a, b = socket.socketpair()
+        server = VersionServer(supported)
+        serve = asyncio.create_task(server.serve(a))
+
+        client = MultiplexedProbeClient(Token(bytes(16)), "localhost", 0)
+        monkeypatch.setattr(client, "_open_stream", lambda: RawStream(b))
+        with pytest.raises(VersionError):
+            await asyncio.to_thread(client.connect, None)  # type: ignore
+
+        await serve
+        b.close()
+
+    asyncio.run(run())
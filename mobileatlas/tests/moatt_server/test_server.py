@@ -0,0 +1,161 @@
+import asyncio
+import socket
+import ssl
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+from moatt_clients.errors import AuthError
+from moatt_clients.probe_client import ProbeClient
+from moatt_clients.streams import RawStream
+from moatt_types.connect import AuthStatus, ConnectResponse, ConnectStatus, SimId
+
+from moatt_server import config, timers
+from moatt_server.auth_handler import AuthResult
+from moatt_server.config import Config, ConfigError
+from moatt_server.loadgen.stub_auth import StubAuth, make_token
+from moatt_server.sim_directory import SimDirectory, SimEntry
+from moatt_server.tunnel import connection_queue
+from moatt_server.tunnel.probe_handler import ProbeHandler
+from moatt_server.tunnel.server import Server
+from moatt_server.tunnel.util import write_msg
+from moatt_server.tunnel.workers import WorkerGroup
+
+# owned by the second of two workers
+PROVIDER = uuid.UUID(int=uuid.uuid4().int | 1)
+SIM = SimEntry(1, "89430000000000000001", None, PROVIDER)
+TIMEOUT = 5
+
+
+class RecordingAuth(StubAuth):
+    def __init__(self):
+        super().__init__(None)
+        self.probe_result = AuthResult.Success
+        self.sim_requests = 0
+
+    async def allowed_probe_registration(self, token):
+        return self.probe_result
+
+    async def allowed_sim_request(self, token, provider_id, sim_id):
+        self.sim_requests += 1
+        return AuthResult.Success
+
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch):
+    monkeypatch.setattr(config, "_CONFIG", _config(AUTH_HANDLER=RecordingAuth()))
+    monkeypatch.setattr(timers, "_WHEEL", None)
+    monkeypatch.setattr(connection_queue, "_QUEUES", {})
+
+
+def _config(**kwargs) -> Config:
+    kwargs.setdefault("AUTH_HANDLER", StubAuth(None))
+    return Config(DB_USER="", DB_PASSWORD="", DB_NAME="", **kwargs)
+
+
+def _mtls_context() -> ssl.SSLContext:
+    tls_ctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
+    tls_ctx.verify_mode = ssl.CERT_REQUIRED
+    return tls_ctx
+
+
+def test_quic_requires_opt_in_with_client_certs():
+    server = Server(_config(QUIC_PORT=6666), tls_ctx=_mtls_context())
+
+    with pytest.raises(ConfigError):
+        asyncio.run(server.start())
+
+
+@pytest.mark.parametrize(
+    "config,tls_ctx",
+    [
+        (_config(), _mtls_context()),
+        (_config(QUIC_PORT=6666, QUIC_ALLOW_WITHOUT_CLIENT_CERT=True), _mtls_context()),
+        (_config(QUIC_PORT=6666), None),
+    ],
+)
+def test_quic_allowed(config: Config, tls_ctx: ssl.SSLContext | None):
+    Server(config, tls_ctx=tls_ctx)._check_quic()
+
+
+def _server(workers: WorkerGroup | None = None) -> Server:
+    """Server handling connections passed to `_handle` without listening."""
+    server = Server(config.get_config(), workers=workers)
+    sims = SimDirectory()
+    sims.replace_provider(PROVIDER, [SIM])
+    server._probe_handler = ProbeHandler(config.get_config(), None, sims, workers)  # type: ignore
+    return server
+
+
+async def _serve(server: Server) -> tuple[asyncio.Task, ProbeClient]:
+    """Pipelined probe client connected to `server` over a socket pair."""
+    a, b = socket.socketpair()
+    b.settimeout(TIMEOUT)
+    reader, writer = await asyncio.open_connection(sock=a)
+    task = asyncio.create_task(server._handle(reader, writer))
+
+    client = ProbeClient(make_token(uuid.uuid4()), "localhost", 0, pipelined=True)
+    client._open_stream = lambda: RawStream(b)  # type: ignore
+    return task, client
+
+
+async def _provide() -> None:
+    """Answer the next connection request of the provider's queue."""
+    entry = await connection_queue.get(PROVIDER)
+    await write_msg(entry.writer, ConnectResponse(ConnectStatus.Success))
+
+
+def test_pipelined_handshake():
+    async def run():
+        task, client = await _serve(_server())
+        provide = asyncio.create_task(_provide())
+
+        stream = await asyncio.to_thread(client.connect, SimId(PROVIDER, SIM.id))
+        assert stream is not None
+        await asyncio.wait_for(provide, TIMEOUT)
+        assert config.get_config().AUTH_HANDLER.sim_requests == 1  # type: ignore
+
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_pipelined_handshake_auth_failure():
+    async def run():
+        config.get_config().AUTH_HANDLER.probe_result = AuthResult.Forbidden  # type: ignore
+        task, client = await _serve(_server())
+
+        with pytest.raises(AuthError) as e:
+            await asyncio.to_thread(client.connect, SimId(PROVIDER, SIM.id))
+        assert e.value.status == AuthStatus.Unauthorized
+        await asyncio.wait_for(task, TIMEOUT)
+
+        # the pipelined ConnectRequest was not processed
+        assert config.get_config().AUTH_HANDLER.sim_requests == 0  # type: ignore
+        assert connection_queue._QUEUES == {}
+
+    asyncio.run(run())
+
+
+def test_pipelined_handshake_forwarded():
+    async def run(socket_dir: Path):
+        # the provider's queue is held by the second worker
+        owner = _server(WorkerGroup(1, 2, socket_dir))
+        handoff = await owner._workers.start_server(owner._handle_handoff)  # type: ignore
+
+        task, client = await _serve(_server(WorkerGroup(0, 2, socket_dir)))
+        provide = asyncio.create_task(_provide())
+
+        # the deferred AuthResponse precedes the owner's ConnectResponse
+        stream = await asyncio.to_thread(client.connect, SimId(PROVIDER, SIM.id))
+        assert stream is not None
+        await asyncio.wait_for(provide, TIMEOUT)
+        # the SIM request was authorised by both workers
+        assert config.get_config().AUTH_HANDLER.sim_requests == 2  # type: ignore
+
+        task.cancel()
+        handoff.close()
+
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(run(Path(d)))
@@ -0,0 +1,82 @@
+import asyncio
+import datetime
+import uuid
+from typing import TYPE_CHECKING
+
+from moatt_server.db import SimId
+from moatt_server.tunnel.session_stats import SessionLog, SessionStats
+
+if TYPE_CHECKING:
+    from conftest import FakeDb
+
+PROVIDER = uuid.uuid4()
+PROBE = uuid.uuid4()
+
+
+def _log(db: "FakeDb", **kwargs) -> SessionLog:
+    return SessionLog(db.session, batch_size=4, **kwargs)  # type: ignore
+
+
+def _add(log: SessionLog, sims: list[int]) -> None:
+    for sim in sims:
+        log.add(SessionStats(0).row(PROVIDER, PROBE, SimId(sim)))
+
+
+def test_rows_are_written_in_background(db: "FakeDb"):
+    async def run():
+        log = _log(db, flush_interval=datetime.timedelta(seconds=60))
+        task = asyncio.create_task(log.run())
+
+        # a full batch is written right away
+        _add(log, [1, 2, 3, 4])
+        await asyncio.sleep(0.01)
+        assert [r["sim_id"] for r in db.rows] == [1, 2, 3, 4]
+
+        _add(log, [5])
+        await asyncio.sleep(0.01)
+        assert len(db.rows) == 4
+
+        # the rest is written on shutdown
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert [r["sim_id"] for r in db.rows] == [1, 2, 3, 4, 5]
+
+    asyncio.run(run())
+
+
+def test_unavailable_database_is_retried(db: "FakeDb"):
+    async def run():
+        db.unavailable = 5
+        log = _log(db)
+        _add(log, [1, 2, 3, 4, 5, 6])
+
+        while not await log._write_pending():
+            assert len(log._buf) == 6
+
+        assert [r["sim_id"] for r in db.rows] == [1, 2, 3, 4, 5, 6]
+
+    asyncio.run(run())
+
+
+def test_rejected_row_is_discarded(db: "FakeDb"):
+    async def run():
+        log = _log(db)
+        _add(log, [1, db.BAD_SIM, 2, 3, 4, 5])
+
+        assert await log._write_pending()
+        assert len(log._buf) == 0
+        assert [r["sim_id"] for r in db.rows] == [1, 2, 3, 4, 5]
+
+    asyncio.run(run())
+
+
+def test_full_buffer(db: "FakeDb"):
+    async def run():
+        log = _log(db, max_buffered=4)
+        _add(log, [1, 2, 3, 4, 5])
+
+        assert len(log._buf) == 4
+        assert await log._write_pending()
+        assert [r["sim_id"] for r in db.rows] == [1, 2, 3, 4]
+
+    asyncio.run(run())
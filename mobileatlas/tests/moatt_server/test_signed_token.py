@@ -0,0 +1,257 @@
+import asyncio
+import base64
+import datetime
+import uuid
+
+import httpx
+import pytest
+from moatt_types.connect import Token
+
+from moatt_server.auth_handler import AuthResult, SimIdent
+from moatt_server.auth_handlers.signed_token import Claims, Scope, SignedTokenAuth
+
+# tokens are signed with the management server's implementation
+dbm = pytest.importorskip("moat_management.models")
+signed_tokens = pytest.importorskip("moat_management.tunnel_auth.signed_tokens")
+
+KEY = b"k" * 32
+OLD_KEY = b"o" * 32
+IDENTITY = uuid.uuid4()
+PROVIDER = uuid.uuid4()
+SIM = SimIdent(1, "89430000000000000001", None)
+
+
+class ManagementServer:
+    """Answers the requests of MoatManagementAuth like the management server."""
+
+    def __init__(self):
+        self.requests: list[str] = []
+        self.allowed = True
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/tunnel-auth")
+        self.requests.append(path)
+
+        if path == "/identity":
+            return httpx.Response(200, json=str(IDENTITY))
+        return httpx.Response(200, json=self.allowed)
+
+
+def _auth(server: ManagementServer, keys: list[bytes] = [KEY]) -> SignedTokenAuth:
+    auth = SignedTokenAuth(
+        {
+            "moat-management-auth": {
+                "base_url": "http://management/tunnel-auth",
+                "username": "tunnel",
+                "password": "secret",
+            },
+            "signed-token-auth": {"keys": [base64.b64encode(k).decode() for k in keys]},
+        }
+    )
+    auth._client = httpx.AsyncClient(
+        base_url="http://management/tunnel-auth", transport=httpx.MockTransport(server)
+    )
+    return auth
+
+
+def _token(
+    scope=None,
+    *,
+    token_id: int = 7,
+    permission_version: int = 0,
+    admin: bool = False,
+    expires: datetime.datetime | None = None,
+    key: bytes = KEY,
+) -> Token:
+    token = dbm.MoAtToken(
+        id=token_id,
+        admin=admin,
+        expires=expires,
+        permission_version=permission_version,
+    )
+    return Token(
+        signed_tokens.sign(
+            key,
+            scope if scope is not None else dbm.MoAtTokenScope.Probe,
+            token,
+            IDENTITY,
+        )
+    )
+
+
+def test_claims():
+    expires = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+    scope = dbm.MoAtTokenScope.Probe | dbm.MoAtTokenScope.Provider
+    token = _token(scope, permission_version=3, admin=True, expires=expires)
+
+    assert len(token.as_bytes()) == Claims.LEN
+    assert Claims.parse(token.as_bytes()) == Claims(
+        scope=Scope.Probe | Scope.Provider,
+        admin=True,
+        identity=IDENTITY,
+        token_id=7,
+        permission_version=3,
+        expires=expires,
+    )
+    assert Claims.verify(token.as_bytes(), [OLD_KEY, KEY])
+    assert not Claims.verify(token.as_bytes(), [OLD_KEY])
+
+    # opaque tokens of the management server
+    assert Claims.parse(bytes(Claims.LEN - 1)) is None
+    assert Claims.parse(bytes(Claims.LEN)) is None
+
+
+def test_valid_token():
+    async def run():
+        server = ManagementServer()
+        auth = _auth(server, [OLD_KEY, KEY])
+        token = _token()
+
+        assert await auth.allowed_probe_registration(token) == AuthResult.Success
+        assert await auth.identity(token) == IDENTITY
+        assert await auth.allowed_provider_registration(token) == AuthResult.Forbidden
+        assert server.requests == []
+
+        # signed tokens do not contain the SIM permissions of non-admin tokens
+        assert (
+            await auth.allowed_sim_request(token, PROVIDER, SIM) == AuthResult.Success
+        )
+        assert server.requests == ["/allowed-sim-request"]
+
+        admin = _token(admin=True, token_id=8)
+        assert (
+            await auth.allowed_sim_request(admin, PROVIDER, SIM) == AuthResult.Success
+        )
+        assert server.requests == ["/allowed-sim-request"]
+
+    asyncio.run(run())
+
+
+def test_invalid_mac():
+    async def run():
+        server = ManagementServer()
+        auth = _auth(server)
+
+        forged = bytearray(_token().as_bytes())
+        forged[1] = dbm.MoAtTokenScope.Provider.value
+        for token in [_token(key=OLD_KEY), Token(bytes(forged))]:
+            assert (
+                await auth.allowed_probe_registration(token) == AuthResult.InvalidToken
+            )
+            assert (
+                await auth.allowed_provider_registration(token)
+                == AuthResult.InvalidToken
+            )
+            assert (
+                await auth.allowed_sim_request(token, PROVIDER, SIM)
+                == AuthResult.InvalidToken
+            )
+            assert await auth.identity(token) is None
+
+        assert server.requests == []
+
+    asyncio.run(run())
+
+
+def test_expired_token():
+    async def run():
+        server = ManagementServer()
+        auth = _auth(server)
+        # the management server stores naive UTC timestamps
+        expires = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        token = _token(expires=expires)
+
+        assert Claims.parse(token.as_bytes()).expired()  # type: ignore
+        assert await auth.allowed_probe_registration(token) == AuthResult.ExpiredToken
+        assert (
+            await auth.allowed_sim_request(token, PROVIDER, SIM)
+            == AuthResult.ExpiredToken
+        )
+        assert server.requests == []
+
+    asyncio.run(run())
+
+
+def test_outdated_permission_version():
+    async def run():
+        server = ManagementServer()
+        server.allowed = False
+        auth = _auth(server)
+        auth.update_permission_version(7, 2)
+
+        # issued before the token's permissions changed
+        outdated = _token(permission_version=1, admin=True)
+        assert await auth.allowed_probe_registration(outdated) == AuthResult.Forbidden
+        assert (
+            await auth.allowed_sim_request(outdated, PROVIDER, SIM)
+            == AuthResult.Forbidden
+        )
+        assert await auth.identity(outdated) == IDENTITY
+        assert server.requests == [
+            "/allowed-probe-registration",
+            "/allowed-sim-request",
+            "/identity",
+        ]
+
+        current = _token(permission_version=2)
+        assert await auth.allowed_probe_registration(current) == AuthResult.Success
+        assert len(server.requests) == 3
+
+    asyncio.run(run())
+
+
+def test_newer_permission_version_invalidates_cache():
+    async def run():
+        server = ManagementServer()
+        auth = _auth(server)
+
+        old = _token(permission_version=0)
+        other = _token(token_id=8)
+        for token in [old, other]:
+            assert (
+                await auth.allowed_sim_request(token, PROVIDER, SIM)
+                == AuthResult.Success
+            )
+            # cached
+            assert (
+                await auth.allowed_sim_request(token, PROVIDER, SIM)
+                == AuthResult.Success
+            )
+        assert len(server.requests) == 2
+
+        # the first token with the new version makes the old one outdated
+        server.allowed = False
+        new = _token(permission_version=1)
+        assert await auth.allowed_probe_registration(new) == AuthResult.Success
+        assert len(auth._cache) == 1
+
+        assert (
+            await auth.allowed_sim_request(old, PROVIDER, SIM) == AuthResult.Forbidden
+        )
+        assert (
+            await auth.allowed_sim_request(new, PROVIDER, SIM) == AuthResult.Forbidden
+        )
+        # decisions of other management tokens are kept
+        assert (
+            await auth.allowed_sim_request(other, PROVIDER, SIM) == AuthResult.Success
+        )
+        assert len(server.requests) == 4
+
+        # notifications of older versions are ignored
+        auth.update_permission_version(7, 0)
+        assert (
+            await auth.allowed_sim_request(new, PROVIDER, SIM) == AuthResult.Forbidden
+        )
+        assert len(server.requests) == 4
+
+    asyncio.run(run())
+
+
+def test_token_layouts_match():
+    # the management server has its own copy of the layout
+    assert signed_tokens._FORMAT.format == Claims._FORMAT.format
+    assert signed_tokens.VERSION == Claims.VERSION
+    assert signed_tokens.FLAG_ADMIN == Claims.FLAG_ADMIN
+    assert {s.name: s.value for s in dbm.MoAtTokenScope} == {
+        s.name: s.value for s in Scope
+    }
@@ -0,0 +1,112 @@
+import uuid
+
+from moatt_types.connect import Iccid, Imsi, SimId, SimIndex
+
+from moatt_server.sim_directory import SimDirectory, SimEntry
+
+PROVIDER = uuid.uuid4()
+OTHER = uuid.uuid4()
+
+
+def _sim(id: int, provider_id: uuid.UUID = PROVIDER, imsi: bool = True) -> SimEntry:
+    return SimEntry(
+        id,
+        f"8943{id:016}",
+        f"23201{id:010}" if imsi else None,
+        provider_id,
+    )
+
+
+def _directory() -> SimDirectory:
+    sims = SimDirectory()
+    sims.replace_provider(PROVIDER, [_sim(30), _sim(10), _sim(20, imsi=False)])
+    sims.replace_provider(OTHER, [_sim(40, OTHER)])
+    return sims
+
+
+def test_get():
+    sims = _directory()
+
+    assert len(sims) == 4
+    assert sims.get(SimId(PROVIDER, 10)) == _sim(10)
+    assert sims.get(Iccid(_sim(30).iccid)) == _sim(30)
+    assert sims.get(Imsi(_sim(40).imsi)) == _sim(40, OTHER)
+    # indices refer to the SIMs of a provider ordered by their ID
+    assert [sims.get(SimIndex(PROVIDER, i)) for i in range(3)] == [
+        _sim(10),
+        _sim(20, imsi=False),
+        _sim(30),
+    ]
+
+
+def test_get_missing():
+    sims = _directory()
+
+    assert sims.get(SimId(OTHER, 10)) is None
+    assert sims.get(SimId(uuid.uuid4(), 10)) is None
+    assert sims.get(Iccid(_sim(50).iccid)) is None
+    assert sims.get(Imsi(_sim(20).imsi)) is None
+    assert sims.get(SimIndex(PROVIDER, 3)) is None
+    assert sims.get(SimIndex(uuid.uuid4(), 0)) is None
+
+
+def test_replace_provider():
+    sims = _directory()
+    sims.replace_provider(PROVIDER, [_sim(20), _sim(50)])
+
+    assert len(sims) == 3
+    assert sims.get(SimId(PROVIDER, 10)) is None
+    assert sims.get(Iccid(_sim(30).iccid)) is None
+    assert sims.get(Imsi(_sim(20).imsi)) == _sim(20)
+    assert sims.get(SimIndex(PROVIDER, 1)) == _sim(50)
+    assert sims.get(SimIndex(PROVIDER, 2)) is None
+    assert sims.get(SimId(OTHER, 40)) == _sim(40, OTHER)
+
+
+def test_remove_provider():
+    sims = _directory()
+    sims.remove_provider(PROVIDER)
+    sims.remove_provider(uuid.uuid4())
+
+    assert len(sims) == 1
+    assert sims.get(SimId(PROVIDER, 10)) is None
+    assert sims.get(Iccid(_sim(10).iccid)) is None
+    assert sims.get(Imsi(_sim(10).imsi)) is None
+    assert sims.get(SimIndex(PROVIDER, 0)) is None
+
+    sims.replace_provider(OTHER, [])
+    assert len(sims) == 0
+    assert sims.get(SimIndex(OTHER, 0)) is None
+
+
+def test_moved_sim():
+    sims = _directory()
+    # SIM 10 moved to another provider and the removal was missed
+    moved = _sim(10, OTHER)
+    sims.replace_provider(OTHER, [moved])
+
+    assert sims.get(SimId(PROVIDER, 10)) is None
+    assert sims.get(Iccid(moved.iccid)) == moved
+    assert sims.get(SimIndex(PROVIDER, 0)) == _sim(20, imsi=False)
+
+    # removing the former provider keeps the new registration
+    sims.remove_provider(PROVIDER)
+    assert sims.get(Iccid(moved.iccid)) == moved
+    assert sims.get(Imsi(moved.imsi)) == moved
+
+
+def test_registered():
+    sims = _directory()
+    empty = uuid.uuid4()
+    # providers without SIMs are registered as well
+    sims.replace_provider(empty, [])
+
+    assert sims.registered(PROVIDER)
+    assert sims.registered(empty)
+    assert not sims.registered(uuid.uuid4())
+
+    sims.remove_provider(empty)
+    assert not sims.registered(empty)
+
+    sims.clear()
+    assert not sims.registered(PROVIDER)
@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import uuid
+
+import pytest
+from sqlalchemy.sql import Update
+
+from moatt_server.state import StateStore
+
+PROVIDER = uuid.uuid4()
+OTHER = uuid.uuid4()
+
+
+class FakeSession:
+    """Session returning `ids` for the query of `recover`."""
+
+    def __init__(self, ids: list[uuid.UUID] = []):
+        self.ids = ids
+        self.updates: list[tuple[str, list[uuid.UUID]]] = []
+
+    def __call__(self) -> "FakeSession":
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    @contextlib.asynccontextmanager
+    async def begin(self):
+        yield
+
+    async def scalars(self, stmt):
+        return iter(self.ids)
+
+    async def execute(self, stmt, *_, **__):
+        assert isinstance(stmt, Update)
+        params = stmt.compile().params
+        (ids,) = [v for v in params.values() if isinstance(v, list)]
+        self.updates.append((stmt.table.name, ids))
+
+
+class Store(StateStore):
+    """StateStore whose writes call `on_write` instead of accessing a database."""
+
+    def __init__(self, on_write=None):
+        super().__init__()
+        self.on_write = on_write
+        self.written: list[set[uuid.UUID]] = []
+
+    async def _write(self, session, states) -> None:
+        self.written.append(set(states))
+        if self.on_write is not None:
+            await self.on_write()
+
+
+def test_snapshot():
+    async def run():
+        store = Store()
+        store.provider_available(PROVIDER)
+        store.sim_used(OTHER, 1)
+        store.sim_unused(OTHER, 1)
+
+        await store.snapshot(FakeSession())  # type: ignore
+        assert store.written == [{PROVIDER, OTHER}]
+        # idle providers are forgotten once their state was written
+        assert set(store._providers) == {PROVIDER}
+
+        # connected providers are written every time
+        await store.snapshot(FakeSession())  # type: ignore
+        assert store.written[1] == {PROVIDER}
+
+    asyncio.run(run())
+
+
+def test_failed_snapshot_keeps_state():
+    async def run():
+        async def fail():
+            raise ConnectionError("unavailable")
+
+        store = Store(fail)
+        store.sim_used(PROVIDER, 1)
+        store.sim_unused(PROVIDER, 1)
+
+        with pytest.raises(ConnectionError):
+            await store.snapshot(FakeSession())  # type: ignore
+        assert store._dirty == {PROVIDER}
+        assert PROVIDER in store._providers
+
+        # the next snapshot writes the state again
+        store.on_write = None
+        await store.snapshot(FakeSession())  # type: ignore
+        assert store.written == [{PROVIDER}, {PROVIDER}]
+        assert store._providers == {}
+        assert store._dirty == set()
+
+    asyncio.run(run())
+
+
+def test_state_changed_during_snapshot():
+    async def run():
+        async def reconnect():
+            await asyncio.sleep(0)
+            store.provider_available(PROVIDER)
+            store.provider_unavailable(PROVIDER)
+
+        store = Store(reconnect)
+        for id in [PROVIDER, OTHER]:
+            store.provider_available(id)
+            store.provider_unavailable(id)
+
+        await store.snapshot(FakeSession())  # type: ignore
+        # the provider that changed during the write is kept for the next snapshot
+        assert set(store._providers) == {PROVIDER}
+        assert store._dirty == {PROVIDER}
+
+        store.on_write = None
+        await store.snapshot(FakeSession())  # type: ignore
+        assert store.written[1] == {PROVIDER}
+        assert store._providers == {}
+
+    asyncio.run(run())
+
+
+def test_recover():
+    async def run():
+        local = {PROVIDER, OTHER}
+        remote = uuid.uuid4()
+        store = StateStore(lambda id: id in local)
+
+        session = FakeSession([PROVIDER, remote, OTHER])
+        await store.recover(session)  # type: ignore
+        assert session.updates == [
+            ("providers", [PROVIDER, OTHER]),
+            ("sims", [PROVIDER, OTHER]),
+        ]
+
+        # nothing to do without stale local providers
+        session = FakeSession([remote])
+        await store.recover(session)  # type: ignore
+        assert session.updates == []
+
+    asyncio.run(run())
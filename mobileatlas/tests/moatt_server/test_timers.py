@@ -0,0 +1,168 @@
+import asyncio
+import math
+import random
+
+from moatt_server.timers import LEVELS, SLOTS, Timer, TimerWheel
+
+
+def _wheel() -> TimerWheel:
+    """Wheel driven by calling advance() with a fake clock starting at 0.
+
+    With a resolution of one second, tick n ends at time n.
+    """
+
+    async def create():
+        return TimerWheel(resolution=1)
+
+    wheel = asyncio.run(create())
+    # the loop's clock would make deadlines inexact
+    wheel._start = 0
+    return wheel
+
+
+class Recorder:
+    """Records the tick at which each timer fired."""
+
+    def __init__(self, wheel: TimerWheel):
+        self.wheel = wheel
+        self.fired: dict[str, int] = {}
+
+    def at(self, when: float, name: str) -> Timer:
+        return self.wheel.call_at(when, self.fire, name)
+
+    def fire(self, name: str) -> None:
+        assert name not in self.fired
+        self.fired[name] = self.wheel._now
+
+    def advance(self, now: float) -> None:
+        self.wheel.advance(now)
+
+
+def test_fires_at_deadline():
+    r = Recorder(_wheel())
+    r.at(2.5, "a")
+    r.at(3, "b")
+    r.at(-10, "past")
+
+    r.advance(0.9)
+    assert r.fired == {}
+    r.advance(1)
+    assert r.fired == {"past": 1}
+
+    r.advance(2.9)
+    assert r.fired == {"past": 1}
+    r.advance(3)
+    assert r.fired == {"past": 1, "a": 3, "b": 3}
+    assert len(r.wheel) == 0
+
+
+def test_level_boundaries():
+    r = Recorder(_wheel())
+    ticks = sorted(
+        {SLOTS**level + d for level in range(1, LEVELS) for d in [-1, 0, 1]}
+        | {2 * SLOTS**2 + 5, SLOTS**3 + SLOTS**2 + SLOTS + 1}
+    )
+    for t in ticks:
+        r.at(t, str(t))
+
+    for t in ticks:
+        r.advance(t - 1)
+        assert str(t) not in r.fired
+        r.advance(t)
+        assert r.fired[str(t)] == t
+
+    assert len(r.wheel) == 0
+
+
+def test_random_deadlines():
+    rng = random.Random(0)
+    r = Recorder(_wheel())
+    expected: dict[str, int] = {}
+    timers = {}
+
+    now = 0
+    while now < SLOTS**3 + 2 * SLOTS:
+        # timers are scheduled and cancelled while the wheel is running
+        for _ in range(10):
+            name = str(len(timers))
+            deadline = now + rng.expovariate(1 / SLOTS**2)
+            timers[name] = r.at(deadline, name)
+            expected[name] = max(math.ceil(deadline), now + 1)
+
+        name = str(rng.randrange(max(0, len(timers) - 100), len(timers)))
+        if not timers[name].cancelled():
+            timers[name].cancel()
+            del expected[name]
+
+        now += rng.randrange(1, 3 * SLOTS)
+        r.advance(now)
+
+    r.advance(max(expected.values()))
+    assert r.fired == expected
+    assert len(r.wheel) == 0
+
+
+def test_cancel():
+    r = Recorder(_wheel())
+    a = r.at(10, "a")
+    b = r.at(SLOTS + 10, "b")
+    c = r.at(SLOTS**2 + 10, "c")
+    r.at(SLOTS**2 + 10, "d")
+    assert len(r.wheel) == 4
+
+    a.cancel()
+    assert a.cancelled()
+    assert len(r.wheel) == 3
+
+    # after b and c were cascaded to lower levels
+    r.advance(SLOTS + 1)
+    b.cancel()
+    r.advance(SLOTS**2 + 1)
+    c.cancel()
+    c.cancel()
+    assert len(r.wheel) == 1
+
+    r.advance(SLOTS**2 + 10)
+    assert r.fired == {"d": SLOTS**2 + 10}
+    assert len(r.wheel) == 0
+
+
+def test_beyond_top_level():
+    wheel = _wheel()
+    r = Recorder(wheel)
+    rotation = SLOTS**LEVELS
+    # advancing tick by tick to the end of the first rotation of the top level
+    # takes too long; skip ahead while the wheel is empty
+    wheel._now = rotation - 5
+
+    r.at(rotation + 100, "next")
+    r.at(2 * rotation + 7, "after next")
+    r.at(rotation - 2, "current")
+
+    r.advance(rotation - 3)
+    assert r.fired == {}
+    r.advance(rotation + 99)
+    assert r.fired == {"current": rotation - 2}
+    r.advance(rotation + 100)
+    assert r.fired == {"current": rotation - 2, "next": rotation + 100}
+    assert len(wheel) == 1
+
+
+def test_callbacks():
+    r = Recorder(_wheel())
+
+    def fail():
+        raise RuntimeError
+
+    def reschedule():
+        # deadlines in the past fire on the next tick
+        r.at(0, "rescheduled")
+
+    r.wheel.call_at(1, fail)
+    r.wheel.call_at(1, reschedule)
+    r.at(1, "a")
+
+    r.advance(1)
+    assert r.fired == {"a": 1}
+    r.advance(2)
+    assert r.fired == {"a": 1, "rescheduled": 2}
@@ -0,0 +1,59 @@
+import asyncio
+import socket
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+from moatt_server.tunnel import workers
+from moatt_server.tunnel.workers import WorkerGroup
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    writer.write(await reader.read(100))
+    await writer.drain()
+    writer.close()
+
+
+async def _forward(
+    group: WorkerGroup, provider_id: uuid.UUID
+) -> tuple[asyncio.Task, tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+    """Forward one end of a socket pair; returns the task and the other end."""
+    a, b = socket.socketpair()
+    reader, writer = await asyncio.open_connection(sock=a)
+    task = asyncio.create_task(group.forward(provider_id, b"prefix", reader, writer))
+    return task, await asyncio.open_connection(sock=b)
+
+
+def test_forward_waits_for_owner():
+    async def run(socket_dir: Path):
+        provider_id = uuid.UUID(int=1)
+        group = WorkerGroup(0, 2, socket_dir)
+        owner = WorkerGroup(1, 2, socket_dir)
+        # left over from a previous run
+        owner.socket_path(1).touch()
+
+        task, (reader, _) = await _forward(group, provider_id)
+        await asyncio.sleep(0.1)
+        assert not task.done()
+
+        async with await owner.start_server(_echo):
+            assert await reader.read() == b"prefix"
+            await task
+
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(run(Path(d)))
+
+
+def test_forward_gives_up(monkeypatch):
+    monkeypatch.setattr(workers, "CONNECT_TIMEOUT", 0.1)
+
+    async def run(socket_dir: Path):
+        task, _ = await _forward(WorkerGroup(0, 2, socket_dir), uuid.UUID(int=1))
+
+        with pytest.raises(FileNotFoundError):
+            await task
+
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(run(Path(d)))
@@ -0,0 +1,120 @@
+import uuid
+
+import pytest
+from moatt_types.connect import (
+    ApduOp,
+    ApduPacket,
+    AuthRequest,
+    AuthRequestFlags,
+    AuthResponse,
+    AuthStatus,
+    AuthType,
+    ConnectionRequestFlags,
+    ConnectRequest,
+    ConnectResponse,
+    ConnectStatus,
+    Iccid,
+    Imsi,
+    MuxFrame,
+    MuxFrameType,
+    PartialInput,
+    SimId,
+    SimIndex,
+    Token,
+    VersionRequest,
+    VersionResponse,
+)
+
+PROVIDER = uuid.uuid4()
+
+MESSAGES = [
+    AuthRequest(AuthType.Provider, Token(b"secret")),
+    AuthRequest(AuthType.Probe, Token(bytes(16)), AuthRequestFlags.PIPELINED),
+    AuthResponse(AuthStatus.NotRegistered),
+    ConnectRequest(SimId(PROVIDER, 2**64 - 1)),
+    ConnectRequest(SimIndex(PROVIDER, 3), ConnectionRequestFlags.NO_WAIT),
+    ConnectRequest(Iccid("89430000000000000001")),
+    ConnectRequest(Imsi("23201")),
+    ConnectResponse(ConnectStatus.ProviderTimedOut),
+    ApduPacket(ApduOp.Apdu, bytes(range(64))),
+    ApduPacket(ApduOp.Apdu, bytes(ApduPacket.MAX_PAYLOAD_LEN)),
+    ApduPacket(ApduOp.Reset, b""),
+    ApduPacket(ApduOp.Ping, b"12345678"),
+    ApduPacket.pong(ApduPacket(ApduOp.Ping, b"12345678"), 0.25),
+    VersionRequest(1, 2),
+    VersionResponse(0),
+    MuxFrame(7, MuxFrameType.Data, b"data"),
+    MuxFrame.window_update(0, 2**32 - 1),
+    MuxFrame(2, MuxFrameType.Close),
+]
+
+
+@pytest.mark.parametrize("msg", MESSAGES, ids=lambda m: type(m).__name__)
+def test_round_trip(msg):
+    encoded = msg.encode()
+    decoded = type(msg).decode(encoded)
+
+    assert type(decoded) is type(msg)
+    assert vars(decoded) == vars(msg)
+    assert decoded.encode() == encoded
+
+
+@pytest.mark.parametrize("msg", MESSAGES, ids=lambda m: type(m).__name__)
+@pytest.mark.parametrize("buffer_type", [bytes, bytearray, memoryview])
+def test_decode_from_offset(msg, buffer_type):
+    encoded = msg.encode()
+    buf = buffer_type(b"\xff" * 3 + encoded + encoded)
+
+    first, n = type(msg).decode_from(buf, 3)
+    second, m = type(msg).decode_from(buf, 3 + n)
+
+    assert n == m == len(encoded)
+    assert first.encode() == second.encode() == encoded
+
+
+@pytest.mark.parametrize("msg", MESSAGES, ids=lambda m: type(m).__name__)
+def test_truncated(msg):
+    encoded = msg.encode()
+
+    for i in range(len(encoded)):
+        # readers wait for the missing bytes and try again until decoding succeeds
+        buf = encoded[:i]
+        while True:
+            try:
+                decoded, n = type(msg).decode_from(buf)
+                break
+            except PartialInput as e:
+                assert 0 < e.bytes_missing <= len(encoded) - len(buf)
+                buf = encoded[: len(buf) + e.bytes_missing]
+
+        assert n == len(encoded)
+        assert decoded.encode() == encoded
+
+
+def test_trailing_bytes():
+    with pytest.raises(ValueError):
+        AuthResponse.decode(AuthResponse(AuthStatus.Success).encode() + b"\x00")
+
+
+def test_apdu_payload_too_long():
+    header = ApduPacket(ApduOp.Apdu, b"").encode()[:2]
+
+    # rejected as soon as the header arrived, not once the payload did
+    for plen in [ApduPacket.MAX_PAYLOAD_LEN + 1, 2**32 - 1]:
+        buf = header + plen.to_bytes(4, "big")
+        with pytest.raises(ValueError):
+            ApduPacket.decode_header(buf)
+        with pytest.raises(ValueError):
+            ApduPacket.decode_from(buf)
+
+    with pytest.raises(AssertionError):
+        ApduPacket(ApduOp.Apdu, bytes(ApduPacket.MAX_PAYLOAD_LEN + 1))
+
+
+def test_wrong_version():
+    with pytest.raises(ValueError):
+        ApduPacket.decode(b"\x02" + ApduPacket(ApduOp.Apdu, b"").encode()[1:])
+    with pytest.raises(ValueError):
+        VersionRequest.decode(b"\x01\x01\x02")
+    with pytest.raises(ValueError):
+        VersionRequest.decode(VersionRequest(1, 2).encode()[:1] + b"\x02\x01")
@@ -16,6 +16,10 @@ in rec {
     pydantic
   ];
 
+  quic-dependencies = with python.pkgs; [
+    aioquic
+  ];
+
   packages = rec {
     moatt-clients = python.pkgs.buildPythonPackage {
       pname = pyproject.project.name;
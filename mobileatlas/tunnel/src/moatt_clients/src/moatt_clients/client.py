@@ -1,20 +1,86 @@
 import logging
+import socket
 import ssl
+import threading
+import time
 from typing import Optional
 
-from moatt_clients.errors import AuthError, ProtocolError
+from moatt_clients.errors import AuthError, ProtocolError, VersionError
 from moatt_clients.streams import RawStream
-from moatt_types.connect import AuthRequest, AuthResponse, AuthStatus, AuthType, Token
+from moatt_types.connect import (
+    AuthRequest,
+    AuthRequestFlags,
+    AuthResponse,
+    AuthStatus,
+    AuthType,
+    Token,
+    VersionRequest,
+    VersionResponse,
+)
 
 LOGGER = logging.getLogger(__name__)
 
 
+class SessionCache:
+    """TLS sessions of previous connections, used to resume later connections.
+
+    Resumed connections skip the certificate exchange and verification (an
+    abbreviated handshake). A session can only be resumed with the `SSLContext` it
+    was created with. The ssl module cannot serialize sessions, so the cache only
+    lives as long as the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: dict[tuple, tuple[ssl.SSLContext, ssl.SSLSession]] = {}
+
+    def get(self, ctx: ssl.SSLContext, key: tuple) -> Optional[ssl.SSLSession]:
+        with self._lock:
+            entry = self._sessions.get(key)
+
+        if entry is None or entry[0] is not ctx:
+            return None
+
+        session = entry[1]
+        if time.time() > session.time + session.timeout:
+            return None
+
+        return session
+
+    def put(self, ctx: ssl.SSLContext, key: tuple, session: ssl.SSLSession) -> None:
+        with self._lock:
+            self._sessions[key] = (ctx, session)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+
+
+SESSION_CACHE = SessionCache()
+
+_DEFAULT_TLS_CTX: Optional[ssl.SSLContext] = None
+
+
+def _default_tls_ctx() -> ssl.SSLContext:
+    # shared so that clients without their own context can resume each other's
+    # sessions
+    global _DEFAULT_TLS_CTX
+
+    if _DEFAULT_TLS_CTX is None:
+        _DEFAULT_TLS_CTX = ssl.create_default_context()
+
+    return _DEFAULT_TLS_CTX
+
+
 class _Client:
     """
     Base class for the Provider- and ProbeClient classes.
     Should not be used directly.
     """
 
+    session_cache: Optional[SessionCache] = SESSION_CACHE
+    """TLS sessions used to resume connections (None to disable resumption)."""
+
     def __init__(
         self,
         session_token: Token,
@@ -26,14 +92,77 @@ class _Client:
         self.session_token = session_token
         self.host = host
         self.port = port
-        self.tls_ctx = tls_ctx if tls_ctx is not None else ssl.create_default_context()
+        self.tls_ctx = tls_ctx if tls_ctx is not None else _default_tls_ctx()
         self.server_hostname = server_hostname if server_hostname is not None else host
 
-    def _authenticate(self, auth_type: AuthType, stream: RawStream) -> None:
+    def _open_stream(self) -> RawStream:
+        """Open a new connection to the server, resuming a cached TLS session."""
+        session = None
+        if self.session_cache is not None:
+            session = self.session_cache.get(self.tls_ctx, self._session_key())
+
+        sock = self.tls_ctx.wrap_socket(
+            socket.create_connection((self.host, self.port)),
+            server_hostname=self.server_hostname,
+            session=session,
+        )
+        LOGGER.debug("TLS session resumed: %s", sock.session_reused)
+
+        return RawStream(sock)
+
+    def _session_key(self) -> tuple:
+        return (self.host, self.port, self.server_hostname)
+
+    def _remember_session(self, stream: RawStream) -> None:
+        # TLS 1.3 servers send their tickets after the handshake, so this has to
+        # be called after a message from the server was read
+        session = stream.tls_session()
+        if self.session_cache is not None and session is not None:
+            self.session_cache.put(self.tls_ctx, self._session_key(), session)
+
+    def _negotiate(self, stream: RawStream, min_version: int, max_version: int) -> int:
+        """Negotiate the protocol version. Returns the version chosen by the server.
+
+        Raises
+        ------
+        VersionError
+            If the server does not support any version in the requested range.
+        """
+        LOGGER.debug("Requesting protocol versions %d-%d.", min_version, max_version)
+        stream.write_all(VersionRequest(min_version, max_version).encode())
+
+        try:
+            version_res = stream.read_message(VersionResponse.decode_from)
+        except EOFError:
+            # servers without version negotiation close the connection
+            raise VersionError(0) from None
+
+        if not min_version <= version_res.version <= max_version:
+            raise VersionError(version_res.version)
+
+        return version_res.version
+
+    def _authenticate(
+        self, auth_type: AuthType, stream: RawStream, pipelined: Optional[bytes] = None
+    ) -> None:
+        """Authenticate the connection.
+
+        `pipelined` (an encoded ConnectRequest) is sent in the same flight as the
+        AuthRequest; the server then sends the AuthResponse together with the
+        ConnectResponse, saving a round trip.
+        """
         LOGGER.debug("Sending authorisation message.")
-        stream.write_all(AuthRequest(auth_type, self.session_token).encode())
+        if pipelined is None:
+            stream.write_all(AuthRequest(auth_type, self.session_token).encode())
+        else:
+            stream.write_all(
+                AuthRequest(
+                    auth_type, self.session_token, AuthRequestFlags.PIPELINED
+                ).encode()
+                + pipelined
+            )
         LOGGER.debug("Waiting for authorisation response.")
-        auth_res = stream.read_message(AuthResponse.decode)
+        auth_res = stream.read_message(AuthResponse.decode_from)
 
         if auth_res is None:
             LOGGER.warn("Received malformed message during connection.")
@@ -44,3 +173,5 @@ class _Client:
         if auth_res.status != AuthStatus.Success:
             LOGGER.warn("Authentication failed!")
             raise AuthError(auth_res.status)
+
+        self._remember_session(stream)
@@ -28,3 +28,13 @@ class ProtocolError(Exception):
             if self.msg is not None
             else ""
         )
+
+
+class VersionError(Exception):
+    def __init__(self, version: int):
+        self.version = version
+
+    def __str__(self):
+        if self.version == 0:
+            return "Server does not support any of the requested protocol versions."
+        return f"Server chose unsupported protocol version {self.version}."
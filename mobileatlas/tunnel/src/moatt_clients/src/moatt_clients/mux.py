@@ -0,0 +1,388 @@
+"""Client side of multiplexed (protocol version 2) connections.
+
+A background thread reads the frames of the connection and distributes them to
+the streams. `MuxStream` offers the same interface as `RawStream`, so it can be
+wrapped in an `ApduStream`.
+"""
+
+import collections
+import itertools
+import logging
+import threading
+import time
+from collections.abc import Callable
+from typing import Optional, TypeVar
+
+from moatt_clients.streams import RawStream
+from moatt_types.connect import Buffer, MuxFrame, MuxFrameType, PartialInput
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MuxStream:
+    def __init__(self, mux: "Mux", stream_id: int):
+        self.id = stream_id
+        self._mux = mux
+
+        self._buf = bytearray()
+        self._eof = False
+        self._error: Optional[Exception] = None
+        self._recv_window = MuxFrame.INITIAL_WINDOW
+        self._consumed = 0
+
+        self._send_window = MuxFrame.INITIAL_WINDOW
+        self._closed = False
+
+        # streams are removed once both sides sent a Close (or either a Reset)
+        self._close_received = False
+
+    def getpeername(self):
+        return self._mux.getpeername()
+
+    def write_all(self, buf: bytes) -> None:
+        """Send `buf`, waiting for the peer to open the stream's window if needed.
+
+        Raises
+        ------
+        ConnectionError
+            If the stream or connection was closed.
+        """
+        self._mux._write(self, buf)
+
+    T = TypeVar("T")
+
+    def read_message(self, decoder: Callable[[Buffer, int], tuple[T, int]]) -> T:
+        """Decode a single message from the stream.
+
+        Raises
+        ------
+        EOFError
+            If EOF is reached before a complete message was received.
+        """
+        with self._mux._cond:
+            while True:
+                try:
+                    msg, consumed = decoder(self._buf, 0)
+                    del self._buf[:consumed]
+                    self._credit(consumed)
+                    break
+                except PartialInput:
+                    pass
+
+                if self._error is not None:
+                    raise self._error
+                if self._eof:
+                    raise EOFError
+
+                self._mux._cond.wait()
+
+        # the server may be waiting for a WindowUpdate queued by `_credit`
+        self._mux._send_queued()
+        return msg
+
+    def fill(self) -> bool:
+        """Wait until data is available.
+
+        Returns
+        -------
+        False if the stream reached EOF and no buffered data is left.
+        """
+        with self._mux._cond:
+            while len(self._buf) == 0:
+                if self._error is not None:
+                    raise self._error
+                if self._eof:
+                    return False
+
+                self._mux._cond.wait()
+
+            return True
+
+    def close(self) -> None:
+        self._mux._close_stream(self)
+
+    def _credit(self, n: int) -> None:
+        # called with the lock held
+        self._consumed += n
+        if self._consumed >= MuxFrame.INITIAL_WINDOW // 2 and not self._eof:
+            self._recv_window += self._consumed
+            self._mux._queue(MuxFrame.window_update(self.id, self._consumed))
+            self._consumed = 0
+
+
+class Mux:
+    """Multiplexes streams over an authenticated version 2 connection.
+
+    Clients open streams with odd IDs, the server uses even IDs. Either side may
+    only open as many concurrent streams as the other side allowed.
+    """
+
+    def __init__(self, stream: RawStream):
+        self._stream = stream
+
+        # protects all stream state; `_send_lock` serializes writes to the socket
+        # and is never acquired while holding `_cond`
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._outgoing: collections.deque[MuxFrame] = collections.deque()
+
+        self._streams: dict[int, MuxStream] = {}
+        self._incoming: collections.deque[MuxStream] = collections.deque()
+        self._next_id = 1
+        self._last_peer_id = 0
+        self._local_open = 0
+        self._peer_open = 0
+        self._max_local = 0
+        self._max_peer = 0
+        self._closed = False
+
+        self.rtt: Optional[float] = None
+        self._pings = itertools.count()
+        self._ping: Optional[tuple[bytes, float]] = None
+
+        self._thread = threading.Thread(target=self._run, name="mux", daemon=True)
+        self._thread.start()
+
+    def getpeername(self):
+        return self._stream.getpeername()
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def allow_streams(self, n: int) -> None:
+        """Let the server open `n` more concurrent streams."""
+        with self._cond:
+            self._max_peer += n
+            self._queue(MuxFrame.window_update(MuxFrame.CONTROL_STREAM, n))
+        self._send_queued()
+
+    def ping(self) -> None:
+        """Send a ping; `rtt` is updated once the server answers it.
+
+        Pings sent by the server are answered automatically.
+        """
+        with self._cond:
+            token = next(self._pings).to_bytes(8, "big")
+            self._ping = (token, time.monotonic())
+            self._queue(MuxFrame(MuxFrame.CONTROL_STREAM, MuxFrameType.Ping, token))
+        self._send_queued()
+
+    def open_stream(self, timeout: Optional[float] = None) -> MuxStream:
+        """Open a new stream, waiting until the server allows it.
+
+        Raises
+        ------
+        TimeoutError
+            If the server did not allow another stream within `timeout` seconds.
+        ConnectionError
+            If the connection was closed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self._closed or self._local_open < self._max_local, timeout
+            ):
+                raise TimeoutError
+
+            if self._closed:
+                raise ConnectionResetError("Connection is closed.")
+
+            stream = MuxStream(self, self._next_id)
+            self._next_id += 2
+            self._streams[stream.id] = stream
+            self._local_open += 1
+
+            return stream
+
+    def accept(self, timeout: Optional[float] = None) -> Optional[MuxStream]:
+        """Wait for a stream opened by the server.
+
+        Returns None if the connection was closed or the timeout expired.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._closed or len(self._incoming) > 0, timeout
+            )
+
+            if len(self._incoming) == 0:
+                return None
+
+            return self._incoming.popleft()
+
+    def close(self) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._shutdown()
+
+        self._stream.abort()
+
+    def _run(self) -> None:
+        try:
+            while True:
+                frame = self._stream.read_message(MuxFrame.decode_from)
+
+                with self._cond:
+                    ok = self._dispatch(frame)
+
+                self._send_queued()
+
+                if not ok:
+                    break
+        except (EOFError, OSError, ValueError) as e:
+            with self._cond:
+                if not self._closed:
+                    LOGGER.info(f"Multiplexed connection closed: {e!r}")
+
+        self.close()
+
+    def _dispatch(self, frame: MuxFrame) -> bool:
+        if frame.stream_id == MuxFrame.CONTROL_STREAM:
+            match frame.type:
+                case MuxFrameType.WindowUpdate:
+                    self._max_local += frame.increment()
+                    self._cond.notify_all()
+                case MuxFrameType.Ping:
+                    self._queue(
+                        MuxFrame(
+                            MuxFrame.CONTROL_STREAM, MuxFrameType.Pong, frame.payload
+                        )
+                    )
+                case MuxFrameType.Pong:
+                    if self._ping is not None and frame.payload == self._ping[0]:
+                        self.rtt = time.monotonic() - self._ping[1]
+                        self._ping = None
+                case _:
+                    LOGGER.warning(f"Unexpected frame on control stream: {frame}")
+                    return False
+            return True
+
+        if frame.type in (MuxFrameType.Ping, MuxFrameType.Pong):
+            LOGGER.warning(f"Unexpected frame on stream {frame.stream_id}: {frame}")
+            return False
+
+        stream = self._streams.get(frame.stream_id)
+
+        if stream is None:
+            if (
+                frame.type != MuxFrameType.Data
+                or frame.stream_id % 2 == 1
+                or frame.stream_id <= self._last_peer_id
+            ):
+                return True
+
+            self._last_peer_id = frame.stream_id
+            if self._peer_open >= self._max_peer:
+                self._queue(MuxFrame(frame.stream_id, MuxFrameType.Reset))
+                return True
+
+            stream = MuxStream(self, frame.stream_id)
+            self._streams[stream.id] = stream
+            self._peer_open += 1
+            self._incoming.append(stream)
+
+        match frame.type:
+            case MuxFrameType.Data:
+                if len(frame.payload) > stream._recv_window:
+                    LOGGER.warning("Server exceeded a stream's window.")
+                    self._queue(MuxFrame(stream.id, MuxFrameType.Reset))
+                    self._remove(stream, ConnectionResetError("Flow control error."))
+                else:
+                    stream._recv_window -= len(frame.payload)
+                    if not stream._closed:
+                        stream._buf += frame.payload
+            case MuxFrameType.WindowUpdate:
+                stream._send_window += frame.increment()
+            case MuxFrameType.Close:
+                stream._eof = True
+                stream._close_received = True
+                if stream._closed:
+                    self._remove(stream, ConnectionResetError("Stream is closed."))
+            case MuxFrameType.Reset:
+                self._remove(stream, ConnectionResetError("Stream reset by server."))
+
+        self._cond.notify_all()
+        return True
+
+    def _write(self, stream: MuxStream, buf: bytes) -> None:
+        view = memoryview(buf)
+
+        while len(view) > 0:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: stream._send_window > 0
+                    or stream._error is not None
+                    or stream._closed
+                )
+
+                if stream._error is not None:
+                    raise stream._error
+                if stream._closed:
+                    raise ConnectionError("Stream is closed.")
+
+                n = min(len(view), stream._send_window, MuxFrame.MAX_PAYLOAD_LEN)
+                stream._send_window -= n
+                self._queue(MuxFrame(stream.id, MuxFrameType.Data, bytes(view[:n])))
+                view = view[n:]
+
+            self._send_queued()
+
+    def _close_stream(self, stream: MuxStream) -> None:
+        with self._cond:
+            if stream._closed:
+                return
+
+            stream._closed = True
+            stream._eof = True
+            stream._buf.clear()
+
+            if stream.id in self._streams:
+                self._queue(MuxFrame(stream.id, MuxFrameType.Close))
+                if stream._close_received:
+                    self._remove(stream, ConnectionResetError("Stream is closed."))
+
+        self._send_queued()
+
+    def _remove(self, stream: MuxStream, error: Exception) -> None:
+        if self._streams.pop(stream.id, None) is None:
+            return
+
+        if stream.id % 2 == 1:
+            self._local_open -= 1
+        else:
+            self._peer_open -= 1
+
+        if stream._error is None:
+            stream._error = error
+        self._cond.notify_all()
+
+    def _queue(self, frame: MuxFrame) -> None:
+        # called with the lock held; frames are sent in the order they were queued
+        if not self._closed:
+            self._outgoing.append(frame)
+
+    def _send_queued(self) -> None:
+        with self._send_lock:
+            while True:
+                with self._cond:
+                    if len(self._outgoing) == 0:
+                        return
+                    frames = list(self._outgoing)
+                    self._outgoing.clear()
+
+                try:
+                    self._stream.write_all(b"".join(f.encode() for f in frames))
+                except OSError as e:
+                    LOGGER.info(f"Failed to send frames: {e!r}")
+                    with self._cond:
+                        self._shutdown()
+                    return
+
+    def _shutdown(self) -> None:
+        # called with the lock held
+        self._closed = True
+        self._outgoing.clear()
+
+        for stream in list(self._streams.values()):
+            self._remove(stream, ConnectionResetError("Connection closed."))
+
+        self._cond.notify_all()
@@ -1,12 +1,13 @@
 import logging
-import socket
 import ssl
 from typing import Optional
 
 from moatt_clients.client import ProtocolError, _Client
 from moatt_clients.errors import SimRequestError
+from moatt_clients.mux import Mux, MuxStream
 from moatt_clients.streams import ApduStream, RawStream
 from moatt_types.connect import (
+    MUX_VERSION,
     AuthType,
     ConnectionRequestFlags,
     ConnectRequest,
@@ -33,6 +34,7 @@ class ProbeClient(_Client):
         tls_ctx: Optional[ssl.SSLContext] = None,
         server_hostname: Optional[str] = None,
         no_wait: bool = False,
+        pipelined: bool = False,
     ):
         """
 
@@ -51,11 +53,16 @@ class ProbeClient(_Client):
         no_wait
             Whether the client is willing to wait for the requested SIM card to become
             available.
+        pipelined
+            Send the connection request without waiting for the authorisation
+            response. Saves a round trip but requires a server supporting pipelined
+            handshakes (older servers close the connection).
         """
         super().__init__(
             session_token, host, port, tls_ctx=tls_ctx, server_hostname=server_hostname
         )
         self.no_wait = no_wait
+        self.pipelined = pipelined
 
     def connect(self, sim_id: Imsi | Iccid | SimId | SimIndex) -> ApduStream:
         """Establish a connection with a SIM provider.
@@ -67,12 +74,7 @@ class ProbeClient(_Client):
         """
         logger.debug("Opening connection.")
 
-        stream = RawStream(
-            self.tls_ctx.wrap_socket(
-                socket.create_connection((self.host, self.port)),
-                server_hostname=self.server_hostname,
-            )
-        )
+        stream = self._open_stream()
 
         try:
             apdu_stream = self._connect(stream, sim_id)
@@ -89,18 +91,33 @@ class ProbeClient(_Client):
     def _connect(
         self, stream: RawStream, sim_id: Imsi | Iccid | SimId | SimIndex
     ) -> ApduStream:
-        self._authenticate(AuthType.Probe, stream)
+        if self.pipelined:
+            logger.debug(f"Sending pipelined connection request ({sim_id})")
+            self._authenticate(AuthType.Probe, stream, self._connect_request(sim_id))
+            return self._connect_response(stream, sim_id)
 
-        logger.debug(f"Sending connection request ({sim_id})")
+        self._authenticate(AuthType.Probe, stream)
+        return self._request(stream, sim_id)
 
+    def _connect_request(self, sim_id: Imsi | Iccid | SimId | SimIndex) -> bytes:
         flags = ConnectionRequestFlags.DEFAULT
         if self.no_wait:
             flags |= ConnectionRequestFlags.NO_WAIT
 
-        stream.write_all(ConnectRequest(sim_id, flags=flags).encode())
+        return ConnectRequest(sim_id, flags=flags).encode()
 
+    def _request(
+        self, stream: RawStream | MuxStream, sim_id: Imsi | Iccid | SimId | SimIndex
+    ) -> ApduStream:
+        logger.debug(f"Sending connection request ({sim_id})")
+        stream.write_all(self._connect_request(sim_id))
+        return self._connect_response(stream, sim_id)
+
+    def _connect_response(
+        self, stream: RawStream | MuxStream, sim_id: Imsi | Iccid | SimId | SimIndex
+    ) -> ApduStream:
         logger.debug("Waiting for answer to connection request message.")
-        conn_res = stream.read_message(ConnectResponse.decode)
+        conn_res = stream.read_message(ConnectResponse.decode_from)
 
         if conn_res is None:
             logger.warn("Received malformed message during connection.")
@@ -110,7 +127,62 @@ class ProbeClient(_Client):
             logger.info(f"Requesting SIM {sim_id} failed!")
             raise SimRequestError(conn_res.status, sim_id)
 
-        return ApduStream(stream)
+        return ApduStream(stream)  # type: ignore
+
+
+class MultiplexedProbeClient(ProbeClient):
+    """Probe client running many tunnel sessions over a single connection.
+
+    Requires a server supporting protocol version 2; the first call to `connect`
+    raises a `VersionError` otherwise, in which case `ProbeClient` can be used
+    instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._mux: Optional[Mux] = None
+
+    def connect(self, sim_id: Imsi | Iccid | SimId | SimIndex) -> ApduStream:
+        """Establish a connection with a SIM provider on a new stream.
+
+        Waits if the server does not allow any more concurrent sessions.
+
+        Parameters
+        ----------
+        sim_id
+            The SIM card to request the connection for.
+        """
+        if self._mux is None or self._mux.is_closed():
+            self._mux = self._open()
+
+        stream = self._mux.open_stream()
+
+        try:
+            return self._request(stream, sim_id)
+        except Exception as e:
+            logger.error(f"Connection failed ({fmt_error(e)}). Closing stream.")
+            stream.close()
+            raise
+
+    def close(self) -> None:
+        """Close the connection and all of its sessions."""
+        if self._mux is not None:
+            self._mux.close()
+            self._mux = None
+
+    def _open(self) -> Mux:
+        logger.debug("Opening connection.")
+
+        stream = self._open_stream()
+
+        try:
+            self._negotiate(stream, MUX_VERSION, MUX_VERSION)
+            self._authenticate(AuthType.Probe, stream)
+        except Exception:
+            stream.abort()
+            raise
+
+        return Mux(stream)
 
 
 def fmt_error(e) -> str:
@@ -1,14 +1,16 @@
 import dataclasses
 import logging
-import socket
 import ssl
+import threading
 from typing import Any, Callable, Optional
 
 import requests
 from moatt_clients.client import ProtocolError, _Client
 from moatt_clients.errors import SimRequestError
+from moatt_clients.mux import Mux
 from moatt_clients.streams import ApduStream, RawStream
 from moatt_types.connect import (
+    MUX_VERSION,
     AuthType,
     ConnectRequest,
     ConnectResponse,
@@ -44,7 +46,7 @@ def register_sims(
     api_url: str,
     session_token: Token,
     sims: list[SIM],
-) -> None:
+) -> Optional[str]:
     """Register SIM cards with the tunnel server.
 
     Parameters
@@ -56,16 +58,20 @@ def register_sims(
     sims
         SIM cards to register.
 
+    Returns
+    -------
+    Optional[str]
+        Version of the registered SIM list (`ETag`), if provided by the server.
+
     Raises
     ------
     requests.HTTPError
         If registration is not successful.
     """
-    headers = {"Authorization": f"Bearer {session_token.as_base64()}"}
     r = requests.put(
         f"{api_url}/provider/sims",
         json=list(map(lambda s: s._to_dict(), sims)),
-        headers=headers,
+        headers=_auth_header(session_token),
     )
 
     try:
@@ -76,6 +82,97 @@ def register_sims(
         )
         raise
 
+    return r.headers.get("ETag")
+
+
+class SimRegistration:
+    """Keeps the SIM cards registered with the tunnel server up to date.
+
+    After the initial registration, only added and removed SIM cards are sent. If
+    the registered SIM cards changed in the meantime (or the server does not
+    support updates), all SIM cards are registered again.
+    """
+
+    # responses to updates after which the SIM cards are registered again
+    _REREGISTER = (405, 409, 412)
+
+    def __init__(self, api_url: str, session_token: Token):
+        """
+        Parameters
+        ----------
+        api_url
+            API base URL (e.g., 'https://example.com/api/v1')
+        session_token
+            A valid session token.
+        """
+        self.api_url = api_url
+        self.session_token = session_token
+        self._lock = threading.Lock()
+        self._sims: Optional[dict[int, SIM]] = None
+        self._version: Optional[str] = None
+
+    def update(self, sims: list[SIM]) -> None:
+        """Register `sims`, replacing the previously registered SIM cards.
+
+        Raises
+        ------
+        requests.HTTPError
+            If registration is not successful.
+        """
+        with self._lock:
+            new = {s.id: s for s in sims}
+
+            if self._sims is None or self._version is None:
+                self._register(new)
+                return
+
+            add = [s for id, s in new.items() if self._sims.get(id) != s]
+            remove = [id for id in self._sims if id not in new]
+
+            if len(add) == 0 and len(remove) == 0:
+                return
+
+            r = requests.patch(
+                f"{self.api_url}/provider/sims",
+                json={"add": [s._to_dict() for s in add], "remove": remove},
+                headers={
+                    **_auth_header(self.session_token),
+                    "If-Match": self._version,
+                },
+            )
+
+            if r.status_code in self._REREGISTER:
+                LOGGER.info(
+                    "Updating SIM cards failed (status %s). Registering all SIM cards.",
+                    r.status_code,
+                )
+                self._register(new)
+                return
+
+            try:
+                r.raise_for_status()
+            except requests.HTTPError:
+                LOGGER.error(
+                    "Updating SIM cards failed. Received status %s from server.",
+                    r.status_code,
+                )
+                self._sims = None
+                raise
+
+            self._sims = new
+            self._version = r.headers.get("ETag")
+
+    def _register(self, sims: dict[int, SIM]) -> None:
+        self._sims = None
+        self._version = register_sims(
+            self.api_url, self.session_token, list(sims.values())
+        )
+        self._sims = sims
+
+
+def _auth_header(session_token: Token) -> dict[str, str]:
+    return {"Authorization": f"Bearer {session_token.as_base64()}"}
+
 
 class ProviderClient(_Client):
     """
@@ -121,12 +218,7 @@ class ProviderClient(_Client):
         """
         LOGGER.debug("Opening connection.")
         try:
-            stream = RawStream(
-                self.tls_ctx.wrap_socket(
-                    socket.create_connection((self.host, self.port)),
-                    server_hostname=self.server_hostname,
-                )
-            )
+            stream = self._open_stream()
         except Exception as e:
             LOGGER.warning(f"Could not connect to server: {e}")
             raise ConnectionError from e
@@ -151,7 +243,7 @@ class ProviderClient(_Client):
         self._authenticate(AuthType.Provider, stream)
 
         logging.debug("Waiting for connection request.")
-        conn_req = stream.read_message(ConnectRequest.decode)
+        conn_req = stream.read_message(ConnectRequest.decode_from)
 
         if conn_req is None:
             LOGGER.warning("Malformed connection request.")
@@ -171,3 +263,129 @@ class ProviderClient(_Client):
             raise SimRequestError(status, conn_req.identifier)
 
         return (conn_req.identifier, ApduStream(stream))
+
+
+class MultiplexedProviderClient(_Client):
+    """
+    Provider client serving many tunnel sessions over a single connection.
+
+    Requires a server supporting protocol version 2; `connect` raises a
+    `VersionError` otherwise, in which case `ProviderClient` can be used instead.
+    """
+
+    def __init__(
+        self,
+        session_token: Token,
+        host: str,
+        port: int,
+        cb: Callable[[ConnectRequest], ConnectStatus],
+        max_sessions: int,
+        tls_ctx: Optional[ssl.SSLContext] = None,
+        server_hostname=None,
+    ):
+        """
+        Parameters
+        ----------
+        session_token
+            Session token to use
+        host
+            Tunnel-Server hostname
+        port
+            Port of the Tunnel-Server
+        cb
+            Callback deciding whether requested SIM card is available.
+        max_sessions
+            Maximum number of concurrent sessions (e.g., the number of SIM cards).
+        tls_ctx
+            Optional TLS configuration.
+        server_hostname
+            Optional TLS server hostname used in server certificate validation.
+        """
+        self.cb = cb
+        self.max_sessions = max_sessions
+        self._mux: Optional[Mux] = None
+        super().__init__(
+            session_token, host, port, tls_ctx=tls_ctx, server_hostname=server_hostname
+        )
+
+    def connect(self) -> None:
+        """Open and authenticate the connection.
+
+        Raises
+        ------
+        VersionError
+            If the server does not support multiplexed connections.
+        """
+        LOGGER.debug("Opening connection.")
+        try:
+            stream = self._open_stream()
+        except Exception as e:
+            LOGGER.warning(f"Could not connect to server: {e}")
+            raise ConnectionError from e
+
+        try:
+            self._negotiate(stream, MUX_VERSION, MUX_VERSION)
+            self._authenticate(AuthType.Provider, stream)
+        except Exception:
+            stream.abort()
+            raise
+
+        self._mux = Mux(stream)
+        self._mux.allow_streams(self.max_sessions)
+
+    def wait_for_connection(
+        self, timeout: Optional[float] = None
+    ) -> Optional[tuple[SimIdentifierType, ApduStream]]:
+        """Wait for a single connection request.
+
+        May be called again before previously returned sessions are closed.
+        Closing an `ApduStream` allows the server to use its slot for a new session.
+
+        Returns
+        -------
+        Identifier of the requested SIM card and connected ApduStream or None if
+        no request was received within `timeout` seconds.
+
+        Raises
+        ------
+        ConnectionError
+            If the connection was closed.
+        """
+        if self._mux is None:
+            self.connect()
+        assert self._mux is not None
+
+        stream = self._mux.accept(timeout)
+        if stream is None:
+            if self._mux.is_closed():
+                raise ConnectionError("Connection to the server was closed.")
+            return None
+
+        try:
+            conn_req = stream.read_message(ConnectRequest.decode_from)
+        except (EOFError, ValueError) as e:
+            LOGGER.warning(f"Malformed connection request. ({e})")
+            stream.close()
+            raise ProtocolError from e
+
+        LOGGER.debug(f"Received request for SIM: {conn_req.identifier}")
+
+        status = self.cb(conn_req)
+
+        LOGGER.debug(f"Sending connection response with status: {status}")
+        stream.write_all(ConnectResponse(status).encode())
+
+        if status != ConnectStatus.Success:
+            LOGGER.info(
+                f"Rejected request for SIM '{conn_req.identifier}' with '{status}'"
+            )
+            stream.close()
+            raise SimRequestError(status, conn_req.identifier)
+
+        return (conn_req.identifier, ApduStream(stream))  # type: ignore
+
+    def close(self) -> None:
+        """Close the connection and all of its sessions."""
+        if self._mux is not None:
+            self._mux.close()
+            self._mux = None
@@ -0,0 +1,415 @@
+"""QUIC transport for the tunnel clients (requires the optional aioquic dependency).
+
+A `QuicConnection` carries any number of tunnel connections, each on its own
+QUIC stream, so a lost packet only delays the session it belongs to. The
+connection is driven by an event loop running in a background thread; its
+streams are wrapped in `RawStream`s and can be used like TLS connections.
+
+Session tickets sent by the server are kept in memory and used to resume later
+connections to the same server with 0-RTT: the first messages of a stream (the
+AuthRequest and, with a pipelined handshake, the ConnectRequest) are sent along
+with the handshake. The connection is not tied to the client's address and
+survives address changes, e.g., a probe switching networks.
+"""
+
+import asyncio
+import collections
+import logging
+import socket
+import ssl
+import threading
+from collections.abc import Callable
+from typing import Any, Optional
+
+from aioquic.asyncio import QuicConnectionProtocol
+from aioquic.quic import events
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection as _QuicConnection
+from aioquic.tls import SessionTicket
+from moatt_clients.probe_client import ProbeClient
+from moatt_clients.provider_client import ProviderClient
+from moatt_clients.streams import RawStream
+from moatt_types.connect import QUIC_ALPN, ConnectRequest, ConnectStatus, Token
+
+LOGGER = logging.getLogger(__name__)
+
+# session tickets kept per server
+MAX_SESSION_TICKETS = 8
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_LOCK = threading.Lock()
+
+# only accessed from the event loop's thread
+_TICKETS: dict[tuple[str, int, str], collections.deque[SessionTicket]] = {}
+
+
+def _loop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="quic", daemon=True).start()
+
+        return _LOOP
+
+
+class _StreamSocket:
+    """Blocking socket interface of a QUIC stream, as used by `RawStream`."""
+
+    def __init__(self, conn: "QuicConnection", stream_id: int):
+        self._conn = conn
+        self._id = stream_id
+
+        self._cond = threading.Condition()
+        self._buf = bytearray()
+        self._eof = False
+        self._error: Optional[OSError] = None
+        self._finished = False
+
+    def getpeername(self):
+        return self._conn.peername
+
+    def recv_into(self, buf) -> int:
+        with self._cond:
+            self._cond.wait_for(
+                lambda: len(self._buf) > 0 or self._eof or self._error is not None
+            )
+
+            if len(self._buf) > 0:
+                n = min(len(buf), len(self._buf))
+                buf[:n] = self._buf[:n]
+                del self._buf[:n]
+                return n
+
+            if self._error is not None:
+                raise self._error
+
+            return 0
+
+    def sendall(self, data) -> None:
+        if self._finished:
+            raise BrokenPipeError("Stream is closed.")
+
+        self._conn._call(self._conn._send, self._id, bytes(data), False)
+
+    def shutdown(self, how: int) -> None:
+        if how != socket.SHUT_RD and not self._finished:
+            self._finished = True
+            self._conn._call(self._conn._send, self._id, b"", True)
+
+        if how != socket.SHUT_WR:
+            self._feed(b"", True)
+
+    def close(self) -> None:
+        try:
+            self.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # called from the event loop's thread
+
+    def _feed(self, data: bytes, end: bool) -> None:
+        with self._cond:
+            self._buf += data
+            self._eof = self._eof or end
+            self._cond.notify_all()
+
+    def _fail(self, error: OSError) -> None:
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+
+class _Protocol(QuicConnectionProtocol):
+    def __init__(self, quic: _QuicConnection, conn: "QuicConnection"):
+        super().__init__(quic)
+        self._conn = conn
+
+    def quic_event_received(self, event: events.QuicEvent) -> None:
+        self._conn._event(event)
+
+
+class QuicConnection:
+    """A QUIC connection to the tunnel server, reconnecting when needed."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        server_hostname: Optional[str] = None,
+        cafile: Optional[str] = None,
+        verify: bool = True,
+        idle_timeout: float = 60,
+        timeout: float = 10,
+    ):
+        """
+        Parameters
+        ----------
+        host
+            Server host.
+        port
+            Server (UDP) port.
+        server_hostname
+            Optional TLS server hostname used in server certificate validation.
+        cafile
+            Optional file of CA certificates to verify the server against (the
+            system's CAs are used by default).
+        verify
+            Whether to verify the server certificate.
+        idle_timeout
+            Seconds after which an idle connection is closed. Connections with
+            open streams are kept alive with QUIC pings.
+        timeout
+            Maximum number of seconds to wait for a handshake.
+        """
+        self.host = host
+        self.port = port
+        self.server_hostname = server_hostname if server_hostname is not None else host
+        self.cafile = cafile
+        self.verify = verify
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.peername: Any = None
+
+        self._protocol: Optional[_Protocol] = None
+        self._closed = True
+        self._sockets: dict[int, _StreamSocket] = {}
+        self._keepalive: Optional[asyncio.Task] = None
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def open_stream(self) -> RawStream:
+        """Open a new stream, connecting first if the connection is closed.
+
+        Raises
+        ------
+        ConnectionError
+            If the handshake with the server failed.
+        """
+        return RawStream(self._run(self._open_stream))
+
+    def migrate(self) -> None:
+        """Switch to a new connection ID.
+
+        Connections survive address changes without this; using a new ID after the
+        client's address changed keeps observers from linking the two paths.
+        """
+        if self._protocol is not None:
+            self._call(self._protocol.change_connection_id)
+
+    def close(self) -> None:
+        """Close the connection and all of its streams."""
+        if self._protocol is not None:
+            self._run(self._close)
+
+    def _run(self, coro_fn: Callable[..., Any], *args) -> Any:
+        return asyncio.run_coroutine_threadsafe(coro_fn(*args), _loop()).result()
+
+    def _call(self, fn: Callable[..., Any], *args) -> None:
+        if self._closed:
+            raise ConnectionResetError("QUIC connection is closed.")
+
+        _loop().call_soon_threadsafe(fn, *args)
+
+    # called from the event loop's thread
+
+    async def _open_stream(self) -> _StreamSocket:
+        if self._protocol is None or self._closed:
+            await self._connect()
+        assert self._protocol is not None
+
+        stream_id = self._protocol._quic.get_next_available_stream_id()
+        sock = _StreamSocket(self, stream_id)
+        self._sockets[stream_id] = sock
+
+        return sock
+
+    async def _connect(self) -> None:
+        configuration = QuicConfiguration(
+            is_client=True,
+            alpn_protocols=[QUIC_ALPN],
+            server_name=self.server_hostname,
+            idle_timeout=self.idle_timeout,
+        )
+        if self.cafile is not None:
+            configuration.load_verify_locations(self.cafile)
+        if not self.verify:
+            configuration.verify_mode = ssl.CERT_NONE
+
+        key = (self.host, self.port, self.server_hostname)
+        tickets = _TICKETS.setdefault(
+            key, collections.deque(maxlen=MAX_SESSION_TICKETS)
+        )
+        if len(tickets) > 0:
+            configuration.session_ticket = tickets.pop()
+
+        loop = asyncio.get_running_loop()
+        family, _, _, _, addr = (
+            await loop.getaddrinfo(self.host, self.port, type=socket.SOCK_DGRAM)
+        )[0]
+
+        LOGGER.debug(
+            "Opening QUIC connection (resuming: %s).",
+            configuration.session_ticket is not None,
+        )
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _Protocol(
+                _QuicConnection(
+                    configuration=configuration, session_ticket_handler=tickets.append
+                ),
+                self,
+            ),
+            local_addr=("::" if family == socket.AF_INET6 else "0.0.0.0", 0),
+        )
+        assert isinstance(protocol, _Protocol)
+
+        protocol.connect(addr)
+        try:
+            # when resuming, the first writes are sent as 0-RTT data
+            if configuration.session_ticket is None:
+                async with asyncio.timeout(self.timeout):
+                    await protocol.wait_connected()
+        except BaseException as e:
+            protocol.close()
+            transport.close()
+            if isinstance(e, (asyncio.TimeoutError, ConnectionError)):
+                raise ConnectionError("QUIC handshake failed.") from e
+            raise
+
+        self._protocol = protocol
+        self._closed = False
+        self.peername = addr
+        self._keepalive = asyncio.create_task(self._keep_alive(protocol))
+
+    async def _keep_alive(self, protocol: _Protocol) -> None:
+        while True:
+            await asyncio.sleep(self.idle_timeout / 3)
+            if len(self._sockets) > 0:
+                protocol._quic.send_ping(0)
+                protocol.transmit()
+
+    async def _close(self) -> None:
+        protocol = self._protocol
+        if protocol is None:
+            return
+
+        self._protocol = None
+        protocol.close()
+        await protocol.wait_closed()
+        if protocol._transport is not None:
+            protocol._transport.close()
+
+    def _send(self, stream_id: int, data: bytes, end_stream: bool) -> None:
+        sock = self._sockets.get(stream_id)
+        if self._protocol is None or sock is None:
+            return
+
+        try:
+            self._protocol._quic.send_stream_data(stream_id, data, end_stream)
+        except Exception as e:
+            sock._fail(BrokenPipeError(f"Failed to send data: {e}"))
+            return
+
+        self._protocol.transmit()
+
+        if end_stream and sock._eof:
+            del self._sockets[stream_id]
+
+    def _event(self, event: events.QuicEvent) -> None:
+        match event:
+            case events.StreamDataReceived():
+                sock = self._sockets.get(event.stream_id)
+                if sock is None:
+                    return
+
+                sock._feed(event.data, event.end_stream)
+                if event.end_stream and sock._finished:
+                    del self._sockets[event.stream_id]
+            case events.StreamReset():
+                sock = self._sockets.pop(event.stream_id, None)
+                if sock is not None:
+                    sock._fail(ConnectionResetError("Stream was reset by the server."))
+            case events.ConnectionTerminated():
+                LOGGER.info(f"QUIC connection closed: {event.reason_phrase!r}")
+                self._closed = True
+                if self._keepalive is not None:
+                    self._keepalive.cancel()
+                for sock in self._sockets.values():
+                    sock._feed(b"", True)
+                self._sockets.clear()
+
+
+class QuicProbeClient(ProbeClient):
+    """`ProbeClient` connecting over QUIC.
+
+    All sessions share one QUIC connection, each using its own stream. With
+    `pipelined` set, resumed connections send the ConnectRequest as 0-RTT data.
+    """
+
+    def __init__(
+        self,
+        session_token: Token,
+        host: str,
+        port: int,
+        server_hostname: Optional[str] = None,
+        no_wait: bool = False,
+        pipelined: bool = False,
+        cafile: Optional[str] = None,
+        verify: bool = True,
+    ):
+        """
+        See `ProbeClient` and `QuicConnection` for the parameters.
+        """
+        super().__init__(
+            session_token,
+            host,
+            port,
+            server_hostname=server_hostname,
+            no_wait=no_wait,
+            pipelined=pipelined,
+        )
+        self.connection = QuicConnection(
+            host, port, self.server_hostname, cafile=cafile, verify=verify
+        )
+
+    def close(self) -> None:
+        """Close the QUIC connection and all of its sessions."""
+        self.connection.close()
+
+    def _open_stream(self) -> RawStream:
+        return self.connection.open_stream()
+
+
+class QuicProviderClient(ProviderClient):
+    """`ProviderClient` connecting over QUIC.
+
+    Every call to `wait_for_connection` opens a new stream on a shared QUIC
+    connection.
+    """
+
+    def __init__(
+        self,
+        session_token: Token,
+        host: str,
+        port: int,
+        cb: Callable[[ConnectRequest], ConnectStatus],
+        server_hostname: Optional[str] = None,
+        cafile: Optional[str] = None,
+        verify: bool = True,
+    ):
+        """
+        See `ProviderClient` and `QuicConnection` for the parameters.
+        """
+        super().__init__(session_token, host, port, cb, server_hostname=server_hostname)
+        self.connection = QuicConnection(
+            host, port, self.server_hostname, cafile=cafile, verify=verify
+        )
+
+    def close(self) -> None:
+        """Close the QUIC connection and all of its sessions."""
+        self.connection.close()
+
+    def _open_stream(self) -> RawStream:
+        return self.connection.open_stream()
@@ -1,87 +1,186 @@
+import collections
+import itertools
 import logging
+import os
 import socket
 import ssl
-import struct
+import time
 from collections.abc import Callable
 from typing import Optional, TypeVar
 
 from moatt_clients.errors import ProtocolError
-from moatt_types.connect import ApduOp, ApduPacket, PartialInput
+from moatt_types.connect import ApduOp, ApduPacket, Buffer, PartialInput
 
 LOGGER = logging.getLogger(__name__)
 
 
 class RawStream:
-    def __init__(self, socket):
+    """Buffered socket wrapper.
+
+    Received data is read into a reusable buffer with `recv_into` and messages are
+    decoded directly from that buffer.
+    """
+
+    def __init__(self, socket, bufsize: int = 4096):
         self._socket = socket
-        self.buf = b""
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
 
     def getpeername(self):
         return self._socket.getpeername()
 
+    def tls_session(self) -> Optional[ssl.SSLSession]:
+        """The TLS session of the connection (None without TLS)."""
+        if isinstance(self._socket, ssl.SSLSocket):
+            return self._socket.session
+
+        return None
+
     def write_all(self, buf: bytes) -> None:
         self._socket.sendall(buf)
 
     T = TypeVar("T")
 
-    def read_message(self, decoder: Callable[[bytes], T]) -> T:
-        buf = b""
+    def read_message(self, decoder: Callable[[Buffer, int], tuple[T, int]]) -> T:
+        """Decode a single message from the stream.
+
+        Parameters
+        ----------
+        decoder
+            A `decode_from` function of one of the message types in
+            `moatt_types.connect`.
 
+        Raises
+        ------
+        EOFError
+            If EOF is reached before a complete message was received.
+        """
         while True:
             try:
-                return decoder(buf)
+                msg, consumed = decoder(self._view[: self._end], self._start)
+                self._start += consumed
+                return msg
             except PartialInput as e:
-                r = self.read_exactly(e.bytes_missing)
+                self._reserve(e.bytes_missing)
 
-                if len(r) == 0:
+                if not self._fill_buf():
                     raise EOFError from None
 
-                buf += r
-
     def read_exactly(self, n: int) -> bytes:
-        while True:
-            if len(self.buf) >= n:
-                b = self.buf[:n]
-                self.buf = self.buf[n:]
-                return b
-
+        while self._end - self._start < n:
+            self._reserve(n - (self._end - self._start))
             if not self._fill_buf():
                 raise EOFError
 
+        return self._take(n)
+
     def read(self, n: int = -1) -> bytes:
-        if len(self.buf) == 0:
+        if self._start == self._end:
             self._fill_buf()
 
-        if n == -1:
-            b = self.buf
-            self.buf = b""
-            return b
+        available = self._end - self._start
+        return self._take(available if n == -1 else min(n, available))
+
+    def fill(self) -> bool:
+        """Wait until data is available.
+
+        Returns
+        -------
+        False if the stream reached EOF and no buffered data is left.
+        """
+        if self._start < self._end:
+            return True
+
+        return self._fill_buf()
+
+    def _take(self, n: int) -> bytes:
+        b = bytes(self._view[self._start : self._start + n])
+        self._start += n
+        return b
+
+    def _reserve(self, n: int) -> None:
+        """Make room for at least `n` more bytes after the buffered data."""
+        if self._start == self._end:
+            self._start = self._end = 0
+
+        if len(self._buf) - self._end >= n:
+            return
+
+        buffered = self._end - self._start
+        if len(self._buf) < buffered + n:
+            buf = bytearray(max(2 * len(self._buf), buffered + n))
+            buf[:buffered] = self._view[self._start : self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
         else:
-            b = self.buf[:n]
-            self.buf = self.buf[n:]
-            return b
+            self._view[:buffered] = self._view[self._start : self._end]
+
+        self._start = 0
+        self._end = buffered
 
     def _fill_buf(self) -> bool:
-        b = self._socket.recv(1024)
-        print(f"Received: {b}")  # TODO
-        if len(b) == 0:
+        if self._end == len(self._buf):
+            self._reserve(1)
+
+        n = self._socket.recv_into(self._view[self._end :])
+        if n == 0:
             return False
         else:
-            self.buf += b
+            self._end += n
             return True
 
     def close(self) -> None:
-        self.buf = b""
+        self._start = self._end = 0
         if isinstance(self._socket, ssl.SSLSocket):
             self._socket.unwrap()
         self._socket.shutdown(socket.SHUT_RDWR)
         self._socket.close()
 
+    def abort(self) -> None:
+        """Close the connection without a TLS shutdown.
+
+        Unlike `close`, this may be called while another thread is blocked reading
+        from the stream.
+        """
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
 
 class ApduStream:
+    """APDU packets exchanged over a tunnel.
+
+    `ping` measures the RTT to the tunnel server. Once a stream has sent a ping
+    the server pings it regularly as well and closes the tunnel if those pings
+    are not answered, so such streams have to keep calling `recv`, which answers
+    them.
+    """
+
     def __init__(self, stream: RawStream):
         self.stream = stream
 
+        self.rtt: Optional[float] = None
+        """RTT to the tunnel server in seconds."""
+        self.peer_rtt: Optional[float] = None
+        """RTT between the tunnel server and the other end of the tunnel."""
+
+        self._pending: collections.deque[ApduPacket] = collections.deque()
+        self._ping: Optional[tuple[bytes, float]] = None
+        self._prefix = os.urandom(4)
+        self._pings = itertools.count()
+
+    @property
+    def tunnel_rtt(self) -> Optional[float]:
+        """RTT to the other end of the tunnel (via the tunnel server)."""
+        if self.rtt is None or self.peer_rtt is None:
+            return None
+
+        return self.rtt + self.peer_rtt
+
     def getpeername(self):
         return self.stream.getpeername()
 
@@ -99,6 +198,32 @@ class ApduStream:
         """Sends a reset signal."""
         self.send(ApduPacket(ApduOp.Reset, b""))
 
+    def ping(self) -> None:
+        """Send a ping. `rtt` and `peer_rtt` are updated when it is answered."""
+        token = self._prefix + (next(self._pings) & 0xFFFFFFFF).to_bytes(4, "big")
+        self._ping = (token, time.monotonic())
+        self.send(ApduPacket(ApduOp.Ping, token))
+
+    def measure_rtt(self) -> Optional[float]:
+        """Ping the tunnel server and wait for the answer.
+
+        APDUs received in the meantime are returned by later calls to `recv`.
+
+        Returns
+        -------
+        The RTT to the tunnel server or None if EOF was reached first.
+        """
+        self.ping()
+
+        while self._ping is not None:
+            packet = self._recv()
+            if packet is None:
+                return None
+            if packet.op not in (ApduOp.Ping, ApduOp.Pong):
+                self._pending.append(packet)
+
+        return self.rtt
+
     def send(self, packet: ApduPacket) -> None:
         """Sends an ApduPacket.
 
@@ -121,40 +246,35 @@ class ApduStream:
         EOFError
             If a partial APDU was received before EOF of the underlying stream.
         """
-        buf = self.stream.read(n=6)
-
-        if len(buf) == 0:
-            return None
+        if len(self._pending) > 0:
+            return self._pending.popleft()
 
-        missing = ApduStream._bytes_missing(buf)
-        while missing > 0:
-            r = self.stream.read(n=missing)
-            assert len(r) <= missing
-
-            if len(r) == 0:
-                raise EOFError
+        while True:
+            packet = self._recv()
+            if packet is None or packet.op not in (ApduOp.Ping, ApduOp.Pong):
+                return packet
 
-            buf += r
-            missing = ApduStream._bytes_missing(buf)
+    def _recv(self) -> Optional[ApduPacket]:
+        # answers pings and records the RTT of pongs; they are still returned
+        if not self.stream.fill():
+            return None
 
-        p = ApduPacket.decode(buf)
+        try:
+            packet = self.stream.read_message(ApduPacket.decode_from)
+        except ValueError as e:
+            raise ProtocolError("Received a malformed message.") from e
 
-        if p is None:
-            raise ProtocolError("Received a malformed message.")
+        match packet.op:
+            case ApduOp.Ping:
+                self.send(ApduPacket.pong(packet))
+            case ApduOp.Pong:
+                if self._ping is not None and packet.token() == self._ping[0]:
+                    self.rtt = time.monotonic() - self._ping[1]
+                    self.peer_rtt = packet.peer_rtt()
+                    self._ping = None
 
-        return p
+        return packet
 
     def close(self) -> None:
         """Close the stream."""
         self.stream.close()
-
-    @staticmethod
-    def _bytes_missing(msg: bytes) -> int:
-        if len(msg) < 6:
-            return 6 - len(msg)
-
-        (plen,) = struct.unpack("!I", msg[2:6])
-        if len(msg) < 6 + plen:
-            return (6 + plen) - len(msg)
-        else:
-            return 0
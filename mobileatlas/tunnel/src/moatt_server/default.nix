@@ -22,6 +22,15 @@ in rec {
     gunicorn
   ];
 
+  quic-dependencies = with python.pkgs; [
+    aioquic
+  ];
+
+  export-dependencies = with python.pkgs; [
+    numpy
+    pyarrow
+  ];
+
   packages = rec {
     moatt-server = python.pkgs.buildPythonPackage {
       pname = pyproject.project.name;
@@ -45,7 +54,7 @@ in rec {
           p.uvicorn
           p.gunicorn
           moatt-server
-        ]);
+        ] ++ export-dependencies);
       in [
         pypkgs
         pkgs.dockerTools.binSh
@@ -0,0 +1,536 @@
+"""Offline analytics of exported APDU logs (requires numpy and pyarrow).
+
+`Analyzer` consumes the record batches of Arrow exports (see `export.arrow`) one
+at a time, so exports of any size can be analysed in constant memory. APDU fields
+are extracted from the payload buffers of a whole batch at once with numpy, and
+commands are paired with the responses that follow them in the same tunnel
+session (provider, probe and SIM). Pings and pongs are ignored; a reset ends the
+pending command and the selected file of a session.
+
+The results are summary tables (`pyarrow.Table`s) per SIM or per probe.
+"""
+
+import dataclasses
+import enum
+from collections.abc import Iterable
+from typing import Optional
+from uuid import UUID
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# instructions of TS 102 221 and TS 31.102
+INS_NAMES = {
+    0x04: "DEACTIVATE FILE",
+    0x10: "TERMINAL PROFILE",
+    0x12: "FETCH",
+    0x14: "TERMINAL RESPONSE",
+    0x20: "VERIFY PIN",
+    0x24: "CHANGE PIN",
+    0x26: "DISABLE PIN",
+    0x28: "ENABLE PIN",
+    0x2C: "UNBLOCK PIN",
+    0x32: "INCREASE",
+    0x44: "ACTIVATE FILE",
+    0x70: "MANAGE CHANNEL",
+    0x73: "MANAGE SECURE CHANNEL",
+    0x75: "TRANSACT DATA",
+    0x84: "GET CHALLENGE",
+    0x88: "AUTHENTICATE",
+    0x89: "AUTHENTICATE",
+    0xA2: "SEARCH RECORD",
+    0xA4: "SELECT",
+    0xAA: "TERMINAL CAPABILITY",
+    0xB0: "READ BINARY",
+    0xB2: "READ RECORD",
+    0xC0: "GET RESPONSE",
+    0xC2: "ENVELOPE",
+    0xCB: "RETRIEVE DATA",
+    0xD6: "UPDATE BINARY",
+    0xDB: "SET DATA",
+    0xDC: "UPDATE RECORD",
+    0xF2: "STATUS",
+}
+
+AUTHENTICATE = 0x88
+SELECT = 0xA4
+READ_BINARY = 0xB0
+READ_RECORD = 0xB2
+UPDATE_BINARY = 0xD6
+UPDATE_RECORD = 0xDC
+# whether an instruction reads (or updates) the selected file
+_READS = np.zeros(256, bool)
+_READS[[READ_BINARY, READ_RECORD, 0xA2]] = True
+_UPDATES = np.zeros(256, bool)
+_UPDATES[[UPDATE_BINARY, UPDATE_RECORD, 0x32]] = True
+
+# files are identified by their FID, by a short file identifier (_SFI | sfi) or
+# by the application that was selected (_ADF)
+_SFI = 0x10000
+_ADF = 0x20000
+_UNKNOWN_FILE = 0x3FFFF
+_FILE_BITS = 18
+
+_ACCESS_KINDS = ["select", "read", "update"]
+
+
+@enum.unique
+class Grouping(enum.Enum):
+    Sim = "sim"
+    Probe = "probe"
+
+
+@dataclasses.dataclass
+class Summary:
+    ins: pa.Table  # commands per instruction
+    sw: pa.Table  # responses per status word
+    authenticate: pa.Table  # AUTHENTICATE commands and response times (seconds)
+    files: pa.Table  # SELECTs, reads and updates per file
+
+    def tables(self) -> dict[str, pa.Table]:
+        return {f.name: getattr(self, f.name) for f in dataclasses.fields(self)}
+
+
+class Analyzer:
+    def __init__(self, by: Grouping = Grouping.Sim):
+        self.by = by
+        self.rows = 0
+
+        # IDs of the keys (see `_ids`) of groups and sessions
+        self._groups: dict[bytes, int] = {}
+        self._sessions: dict[bytes, int] = {}
+
+        self._session_group = np.zeros(0, np.int64)
+        # state of every session after the rows seen so far
+        self._pending = np.zeros(0, bool)  # last row was a command
+        self._pending_ts = np.zeros(0, np.int64)
+        self._pending_ins = np.zeros(0, np.int16)
+        self._file = np.zeros(0, np.int64)
+
+        self._ins = _Counts()
+        self._sw = _Counts()
+        self._files = _Counts()
+        self._auth = _Counts()
+        self._auth_groups: list[np.ndarray] = []
+        self._auth_rtts: list[np.ndarray] = []
+
+    def add(self, batch: pa.RecordBatch) -> None:
+        self.rows += batch.num_rows
+
+        is_apdu = _is(batch.column("command"), "Apdu")
+        is_reset = _is(batch.column("command"), "Reset")
+        rows = np.flatnonzero(is_apdu | is_reset)
+        if len(rows) == 0:
+            return
+        if len(rows) < batch.num_rows:
+            batch = batch.take(pa.array(rows))
+            is_apdu = is_apdu[rows]
+            is_reset = is_reset[rows]
+        n = len(rows)
+
+        session, new = _ids(
+            [batch.column(c) for c in ["provider_id", "probe_id", "sim_id"]],
+            self._sessions,
+        )
+        self._grow(len(self._sessions))
+        if len(new) > 0:
+            self._session_group[len(self._sessions) - len(new) :] = [
+                self._groups.setdefault(self._group_key(k), len(self._groups))
+                for k in new
+            ]
+        group = self._session_group[session]
+
+        probe = _is(batch.column("sender"), "Probe")
+        ts = batch.column("timestamp").cast(pa.int64()).to_numpy()
+        offsets, data = _binary(batch.column("payload"))
+        start = offsets[:-1]
+        length = offsets[1:] - start
+
+        is_cmd = is_apdu & probe & (length >= 4)
+        is_rsp = is_apdu & ~probe
+        # CLA, INS, P1, P2 and P3 of commands, SW1 and SW2 of responses
+        cla, ins, p1, p2, p3 = _bytes(data, start, 5, np.where(is_cmd, length, 0))
+        lc = np.where(length > 5, p3, -1)
+        sw_valid = is_rsp & (length >= 2)
+        sw1, sw2 = _bytes(data, start + length - 2, 2, np.where(sw_valid, 2, 0))
+        sw = (sw1.astype(np.int32) << 8) | sw2
+
+        # process the rows of each session in order
+        order = np.argsort(session, kind="stable")
+        session, group, is_reset, is_cmd, is_rsp, ts, start, length = (
+            a[order]
+            for a in (session, group, is_reset, is_cmd, is_rsp, ts, start, length)
+        )
+        cla, ins, p1, p2, lc, sw_valid, sw = (
+            a[order] for a in (cla, ins, p1, p2, lc, sw_valid, sw)
+        )
+
+        first = np.ones(n, bool)
+        first[1:] = session[1:] != session[:-1]
+
+        # the row before each row of a session (for the first rows of the batch,
+        # the state left by the previous batches)
+        prev_cmd = np.empty(n, bool)
+        prev_cmd[1:] = is_cmd[:-1]
+        prev_cmd[first] = self._pending[session[first]]
+        prev_ts = np.empty(n, np.int64)
+        prev_ts[1:] = ts[:-1]
+        prev_ts[first] = self._pending_ts[session[first]]
+        prev_ins = np.empty(n, np.int16)
+        prev_ins[1:] = ins[:-1]
+        prev_ins[first] = self._pending_ins[session[first]]
+
+        self._ins.add(
+            _combine(
+                group[is_cmd], (cla[is_cmd].astype(np.int64) << 8) | ins[is_cmd], 16
+            )
+        )
+        self._sw.add(_combine(group[sw_valid], sw[sw_valid], 16))
+
+        is_auth = is_cmd & (ins == AUTHENTICATE)
+        self._auth.add(group[is_auth])
+        answered = is_rsp & prev_cmd & (prev_ins == AUTHENTICATE)
+        self._auth_groups.append(group[answered])
+        self._auth_rtts.append((ts[answered] - prev_ts[answered]) / 1e6)
+
+        self._add_file_accesses(
+            session,
+            group,
+            first,
+            is_cmd,
+            is_reset,
+            start,
+            length,
+            data,
+            ins,
+            p1,
+            p2,
+            lc,
+        )
+
+        last = np.ones(n, bool)
+        last[:-1] = first[1:]
+        self._pending[session[last]] = is_cmd[last]
+        self._pending_ts[session[last]] = ts[last]
+        self._pending_ins[session[last]] = ins[last]
+
+    def _add_file_accesses(
+        self,
+        session: np.ndarray,
+        group: np.ndarray,
+        first: np.ndarray,
+        is_cmd: np.ndarray,
+        is_reset: np.ndarray,
+        start: np.ndarray,
+        length: np.ndarray,
+        data: np.ndarray,
+        ins: np.ndarray,
+        p1: np.ndarray,
+        p2: np.ndarray,
+        lc: np.ndarray,
+    ) -> None:
+        n = len(session)
+        idx = np.arange(n)
+
+        # SELECT by FID or path selects the file named by the last two bytes of
+        # the command data, SELECT by DF name (P1 = 04) an application; truncated
+        # commands are ignored
+        is_select = is_cmd & (ins == SELECT) & (lc >= 2) & (length >= 5 + lc)
+        fid_end = start + 5 + np.maximum(lc, 0)
+        fid = (_byte(data, fid_end - 2, is_select).astype(np.int64) << 8) | _byte(
+            data, fid_end - 1, is_select
+        )
+        fid[is_select & (p1 == 0x04)] = _ADF
+        fid[is_reset] = _UNKNOWN_FILE
+
+        # file selected before each row: the last SELECT (or reset) of the session
+        changed = np.where(is_select | is_reset, idx, -1)
+        np.maximum.accumulate(changed, out=changed)
+        segment = np.where(first, idx, 0)
+        np.maximum.accumulate(segment, out=segment)
+        selected_here = changed >= segment
+        current = np.where(
+            selected_here, fid[np.maximum(changed, 0)], self._file[session]
+        )
+
+        is_read = is_cmd & _READS[ins & 0xFF]
+        is_update = is_cmd & _UPDATES[ins & 0xFF]
+
+        # READ/UPDATE BINARY with P1 bit 8 and READ/UPDATE RECORD with P2 bits
+        # 8-4 address the file by its short file identifier
+        binary_sfi = ((ins == READ_BINARY) | (ins == UPDATE_BINARY)) & (
+            (p1 & 0x80) != 0
+        )
+        record_sfi = ((ins == READ_RECORD) | (ins == UPDATE_RECORD)) & ((p2 >> 3) != 0)
+        file = np.where(is_select, fid, current)
+        file[binary_sfi] = _SFI | (p1[binary_sfi].astype(np.int64) & 0x1F)
+        file[record_sfi] = _SFI | (p2[record_sfi].astype(np.int64) >> 3)
+
+        for kind, mask in enumerate([is_select, is_read, is_update]):
+            code = _combine(group[mask], file[mask], _FILE_BITS)
+            self._files.add(code * len(_ACCESS_KINDS) + kind)
+
+        last = np.ones(n, bool)
+        last[:-1] = first[1:]
+        after = np.where(is_select | is_reset, fid, current)
+        self._file[session[last]] = after[last]
+
+    def _grow(self, sessions: int) -> None:
+        n = len(self._pending)
+        if sessions <= n:
+            return
+
+        grow = max(sessions, 2 * n) - n
+        self._session_group = np.concatenate(
+            [self._session_group, np.zeros(grow, np.int64)]
+        )
+        self._pending = np.concatenate([self._pending, np.zeros(grow, bool)])
+        self._pending_ts = np.concatenate([self._pending_ts, np.zeros(grow, np.int64)])
+        self._pending_ins = np.concatenate(
+            [self._pending_ins, np.full(grow, -1, np.int16)]
+        )
+        self._file = np.concatenate(
+            [self._file, np.full(grow, _UNKNOWN_FILE, np.int64)]
+        )
+
+    def summary(self) -> Summary:
+        keys = self._group_keys()
+
+        ins_groups, cla_ins, ins_count = self._ins.split(16)
+        ins = cla_ins & 0xFF
+        sw_groups, sw, sw_count = self._sw.split(16)
+        ins_table = pa.table(
+            {
+                **_group_columns(keys, ins_groups, self.by),
+                "cla": pa.array(cla_ins >> 8, pa.uint8()),
+                "ins": pa.array(ins, pa.uint8()),
+                "name": [INS_NAMES.get(i) for i in ins.tolist()],
+                "count": ins_count,
+            }
+        )
+        sw_table = pa.table(
+            {
+                **_group_columns(keys, sw_groups, self.by),
+                "sw": [f"{s:04X}" for s in sw.tolist()],
+                "count": sw_count,
+            }
+        )
+
+        auth_groups, _, auth_count = self._auth.split(0)
+        groups = np.concatenate(self._auth_groups or [np.zeros(0, np.int64)])
+        rtts = np.concatenate(self._auth_rtts or [np.zeros(0)])
+        o = np.lexsort((rtts, groups))
+        groups, rtts = groups[o], rtts[o]
+        bounds = np.searchsorted(groups, auth_groups, side="left")
+        ends = np.searchsorted(groups, auth_groups, side="right")
+        stats = [_rtt_stats(rtts[s:e]) for s, e in zip(bounds, ends)]
+        auth_table = pa.table(
+            {
+                **_group_columns(keys, auth_groups, self.by),
+                "commands": auth_count,
+                "responses": ends - bounds,
+                **{
+                    name: pa.array([s[i] for s in stats], pa.float64())
+                    for i, name in enumerate(
+                        ["rtt_mean", "rtt_p50", "rtt_p90", "rtt_p99", "rtt_max"]
+                    )
+                },
+            }
+        )
+
+        codes, counts = self._files.codes()
+        kind = codes % len(_ACCESS_KINDS)
+        # one row per group and file with a column per kind of access
+        files, inv = np.unique(codes // len(_ACCESS_KINDS), return_inverse=True)
+        per_kind = np.zeros((len(files), len(_ACCESS_KINDS)), np.int64)
+        np.add.at(per_kind, (inv, kind), counts)
+        files_table = pa.table(
+            {
+                **_group_columns(keys, files >> _FILE_BITS, self.by),
+                "file": [
+                    _file_name(f) for f in (files & ((1 << _FILE_BITS) - 1)).tolist()
+                ],
+                **{k: per_kind[:, i] for i, k in enumerate(_ACCESS_KINDS)},
+            }
+        )
+
+        return Summary(ins_table, sw_table, auth_table, files_table)
+
+    def _group_key(self, session: bytes) -> bytes:
+        # session keys consist of provider ID, probe ID and SIM ID
+        if self.by == Grouping.Sim:
+            return session[:16] + session[32:]
+        return session[16:32]
+
+    def _group_keys(self) -> list[bytes]:
+        keys: list[bytes] = [b""] * len(self._groups)
+        for key, i in self._groups.items():
+            keys[i] = key
+        return keys
+
+
+def analyze(batches: Iterable[pa.RecordBatch], by: Grouping = Grouping.Sim) -> Summary:
+    analyzer = Analyzer(by)
+    for batch in batches:
+        analyzer.add(batch)
+
+    return analyzer.summary()
+
+
+class _Counts:
+    """Occurrences of int64 codes, accumulated over batches."""
+
+    def __init__(self):
+        self._codes = np.zeros(0, np.int64)
+        self._counts = np.zeros(0, np.int64)
+
+    def add(self, codes: np.ndarray) -> None:
+        values, counts = np.unique(codes, return_counts=True)
+        merged, inv = np.unique(
+            np.concatenate([self._codes, values]), return_inverse=True
+        )
+        self._counts = np.bincount(
+            inv, np.concatenate([self._counts, counts]), len(merged)
+        ).astype(np.int64)
+        self._codes = merged
+
+    def codes(self) -> tuple[np.ndarray, np.ndarray]:
+        return self._codes.copy(), self._counts.copy()
+
+    def split(self, bits: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Group IDs, values and counts of codes created by `_combine`."""
+        return self._codes >> bits, self._codes & ((1 << bits) - 1), self._counts
+
+
+def _combine(group: np.ndarray, value: np.ndarray, bits: int) -> np.ndarray:
+    return (group.astype(np.int64) << bits) | value.astype(np.int64)
+
+
+def _is(column: pa.Array, name: str) -> np.ndarray:
+    """Mask of the entries of a dictionary encoded column that equal `name`."""
+    names = column.dictionary.to_pylist()
+    if name not in names:
+        return np.zeros(len(column), bool)
+
+    return column.indices.to_numpy(zero_copy_only=False) == names.index(name)
+
+
+def _ids(
+    columns: list[pa.Array], ids: dict[bytes, int]
+) -> tuple[np.ndarray, list[bytes]]:
+    """IDs of the keys formed by `columns` and the keys that were added to `ids`.
+
+    A key is the concatenation of the row's values (UUIDs as 16 bytes, integers as
+    4 little-endian bytes).
+    """
+    n = len(columns[0])
+    code = None
+    for column in columns:
+        indices = pc.dictionary_encode(column).indices.cast(pa.int64())
+        if code is not None:
+            indices = pc.add(pc.multiply(code, n), indices)
+        code = pc.dictionary_encode(indices).indices.cast(pa.int64())
+
+    assert code is not None
+    codes = code.to_numpy()
+
+    # dictionary_encode numbers keys in the order of their first occurrence
+    new = np.empty(n, bool)
+    new[0] = True
+    new[1:] = codes[1:] > np.maximum.accumulate(codes)[:-1]
+    first = np.flatnonzero(new)
+
+    raw = np.hstack([_raw(c)[first] for c in columns])
+    keys = raw.view(f"V{raw.shape[1]}").ravel().tolist()
+    known = len(ids)
+    key_ids = np.array([ids.setdefault(k, len(ids)) for k in keys], np.int64)
+    added = [k for k, i in zip(keys, key_ids.tolist()) if i >= known]
+
+    return key_ids[codes], added
+
+
+def _raw(array: pa.Array) -> np.ndarray:
+    """Values of a fixed size binary or int32 array as rows of bytes."""
+    if pa.types.is_fixed_size_binary(array.type):
+        width = array.type.byte_width
+        data = np.frombuffer(array.buffers()[1], np.uint8)
+        return data[array.offset * width : (array.offset + len(array)) * width].reshape(
+            -1, width
+        )
+
+    values = array.to_numpy(zero_copy_only=False).astype("<i4")
+    return values.view(np.uint8).reshape(-1, 4)
+
+
+def _binary(array: pa.Array) -> tuple[np.ndarray, np.ndarray]:
+    """Offsets and data of a binary array (without copying the data)."""
+    if pa.types.is_large_binary(array.type):
+        offset_type = np.int64
+    else:
+        array = array.cast(pa.binary())
+        offset_type = np.int32
+
+    _, offsets, data = array.buffers()
+    offsets = np.frombuffer(offsets, offset_type)[
+        array.offset : array.offset + len(array) + 1
+    ].astype(np.int64)
+
+    if data is None or data.size == 0:
+        return np.zeros_like(offsets), np.zeros(1, np.uint8)
+    return offsets, np.frombuffer(data, np.uint8)
+
+
+def _bytes(
+    data: np.ndarray, pos: np.ndarray, count: int, available: np.ndarray
+) -> np.ndarray:
+    """`count` bytes of `data` from each position (one row per byte); -1 beyond
+    `available` bytes."""
+    out = np.empty((count, len(pos)), np.int16)
+    for i in range(count):
+        out[i] = np.take(data, pos + i, mode="clip")
+        np.putmask(out[i], available <= i, -1)
+    return out
+
+
+def _byte(data: np.ndarray, pos: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """`data[pos]` where `valid`, otherwise -1."""
+    out = np.full(len(pos), -1, np.int16)
+    out[valid] = data[pos[valid]]
+    return out
+
+
+def _rtt_stats(rtts: np.ndarray) -> list[Optional[float]]:
+    if len(rtts) == 0:
+        return [None] * 5
+
+    p50, p90, p99 = np.percentile(rtts, [50, 90, 99]).tolist()
+    return [float(rtts.mean()), p50, p90, p99, float(rtts[-1])]
+
+
+def _group_columns(
+    keys: list[bytes], groups: np.ndarray, by: Grouping
+) -> dict[str, pa.Array]:
+    rows = [keys[g] for g in groups.tolist()]
+    ids = pa.array([str(UUID(bytes=k[:16])) for k in rows], pa.string())
+
+    if by == Grouping.Sim:
+        return {
+            "provider_id": ids,
+            "sim_id": pa.array(
+                [int.from_bytes(k[16:], "little", signed=True) for k in rows],
+                pa.int32(),
+            ),
+        }
+
+    return {"probe_id": ids}
+
+
+def _file_name(file: int) -> str:
+    if file == _UNKNOWN_FILE:
+        return "unknown"
+    if file == _ADF:
+        return "ADF"
+    if file & _SFI:
+        return f"SFI {file & 0x1F:02X}"
+    return f"{file:04X}"
@@ -0,0 +1,115 @@
+import argparse
+import logging
+import sys
+import time
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.ipc
+
+from . import Analyzer, Grouping, Summary, synthetic
+
+LOGGER = logging.getLogger(__name__)
+
+# exports consist of small record batches; larger ones are processed faster
+BATCH_SIZE = 250_000
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarise APDU logs exported in Arrow format (/apdu-log/export)."
+    )
+    parser.add_argument("files", nargs="*", type=Path, help="Arrow exports.")
+    parser.add_argument(
+        "--by",
+        choices=[g.value for g in Grouping],
+        default=Grouping.Sim.value,
+        help="Compute statistics per SIM or per probe (default: sim).",
+    )
+    parser.add_argument(
+        "--output-dir",
+        "-o",
+        type=Path,
+        help="Write the summary tables to CSV files in this directory instead of "
+        "printing them.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="ROWS",
+        help="Analyse a synthetic log with ROWS APDUs instead of files.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    analyzer = Analyzer(Grouping(args.by))
+
+    if args.benchmark is not None:
+        benchmark(analyzer, args.benchmark)
+    elif len(args.files) > 0:
+        for path in args.files:
+            with pa.ipc.open_stream(path) as reader:
+                for batch in _rebatch(reader, BATCH_SIZE):
+                    analyzer.add(batch)
+    else:
+        parser.error("No export given.")
+
+    write(analyzer.summary(), args.output_dir)
+
+
+def benchmark(analyzer: Analyzer, rows: int) -> None:
+    generated = 0.0
+    analysed = 0.0
+
+    start = time.perf_counter()
+    for batch in synthetic.batches(rows):
+        t = time.perf_counter()
+        generated += t - start
+
+        analyzer.add(batch)
+        start = time.perf_counter()
+        analysed += start - t
+
+    LOGGER.info(
+        "Analysed %d APDUs in %.1fs (%.1fM APDUs/s; generating them took %.1fs).",
+        rows,
+        analysed,
+        rows / analysed / 1e6,
+        generated,
+    )
+
+
+def write(summary: Summary, output_dir: Path | None) -> None:
+    if output_dir is not None:
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    for name, table in summary.tables().items():
+        if output_dir is not None:
+            pa.csv.write_csv(table, output_dir / f"{name}.csv")
+            continue
+
+        sys.stdout.write(f"# {name}\n")
+        sys.stdout.flush()
+        pa.csv.write_csv(table, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        sys.stdout.write("\n")
+
+
+def _rebatch(batches: Iterable[pa.RecordBatch], rows: int) -> Iterator[pa.RecordBatch]:
+    buf: list[pa.RecordBatch] = []
+    n = 0
+
+    for batch in batches:
+        buf.append(batch)
+        n += batch.num_rows
+
+        if n >= rows:
+            yield from pa.Table.from_batches(buf).combine_chunks().to_batches()
+            buf.clear()
+            n = 0
+
+    if n > 0:
+        yield from pa.Table.from_batches(buf).combine_chunks().to_batches()
@@ -0,0 +1,94 @@
+"""Synthetic APDU logs in the format of Arrow exports, for benchmarks.
+
+Concurrent tunnel sessions replay the attach trace of the load generator; the
+exchanges of all sessions are interleaved.
+"""
+
+from collections.abc import Iterator
+
+import numpy as np
+import pyarrow as pa
+
+from ..export.arrow import SCHEMA
+from ..loadgen.traces import attach_trace
+
+# commands are answered within RTT seconds (exponentially distributed)
+RTT = 0.02
+AUTHENTICATE_RTT = 0.2
+INTERVAL = 100e-6  # seconds between two exchanges
+
+
+def batches(
+    rows: int,
+    batch_size: int = 250_000,
+    sessions: int = 10_000,
+    providers: int = 100,
+    seed: int = 0,
+) -> Iterator[pa.RecordBatch]:
+    rng = np.random.default_rng(seed)
+    trace = attach_trace(seed)
+
+    templates = [p for x in trace for p in (x.command, x.response)]
+    pool = np.frombuffer(b"".join(templates), np.uint8)
+    template_len = np.array([len(t) for t in templates], np.int32)
+    template_start = np.concatenate([[0], np.cumsum(template_len)[:-1]])
+    template_rtt = np.array(
+        [AUTHENTICATE_RTT if x.command[1] == 0x88 else RTT for x in trace]
+    )
+
+    provider_ids = rng.bytes(16 * providers)
+    probe_ids = rng.bytes(16 * sessions)
+    session = np.arange(sessions)
+    provider = session % providers
+
+    start_us = 1_700_000_000 * 10**6
+    for first in range(0, rows, batch_size):
+        n = min(batch_size, rows - first)
+        row = np.arange(first, first + n)
+        exchange = row // 2
+        response = (row % 2).astype(bool)
+
+        s = exchange % sessions
+        step = (exchange // sessions) % len(trace)
+
+        ts = start_us + (exchange * INTERVAL * 1e6).astype(np.int64)
+        rtt = rng.exponential(template_rtt[step]) * 1e6
+        ts[response] += rtt[response].astype(np.int64)
+
+        template = step * 2 + response
+        length = template_len[template]
+        offsets = np.zeros(n + 1, np.int32)
+        np.cumsum(length, out=offsets[1:])
+        gather = np.repeat(template_start[template] - offsets[:-1], length)
+        gather += np.arange(offsets[-1], dtype=np.int32)
+        payload = pa.Array.from_buffers(
+            pa.binary(), n, [None, pa.py_buffer(offsets), pa.py_buffer(pool[gather])]
+        )
+
+        p = provider[s]
+        yield pa.record_batch(
+            [
+                pa.array(row, pa.int64()),
+                pa.array(ts, pa.int64()).cast(SCHEMA.field("timestamp").type),
+                _ids(provider_ids, p),
+                _ids(probe_ids, s),
+                pa.array(s // providers, pa.int32()),
+                pa.nulls(n, pa.string()),
+                pa.nulls(n, pa.string()),
+                pa.DictionaryArray.from_arrays(
+                    pa.array(np.zeros(n, np.int8)), ["Apdu", "Reset", "Ping", "Pong"]
+                ),
+                payload,
+                pa.DictionaryArray.from_arrays(
+                    pa.array(response.astype(np.int8)), ["Probe", "Provider"]
+                ),
+            ],
+            schema=SCHEMA,
+        )
+
+
+def _ids(ids: bytes, index: np.ndarray) -> pa.Array:
+    table = np.frombuffer(ids, np.uint8).reshape(-1, 16)
+    return pa.Array.from_buffers(
+        pa.binary(16), len(index), [None, pa.py_buffer(table[index].tobytes())]
+    )
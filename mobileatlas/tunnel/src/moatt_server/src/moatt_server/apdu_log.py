@@ -0,0 +1,295 @@
+"""Partition maintenance of the APDU log.
+
+`apdu_log` is partitioned by day (UTC). `maintain` creates the partitions of the
+next days in advance, moves partitions older than `AUDIT_ARCHIVE_AFTER` into
+gzip-compressed CSV files (the output of `COPY ... (FORMAT csv, HEADER)`, which
+can be loaded again with `COPY ... FROM`) and drops partitions older than
+`AUDIT_RETENTION`. Rows that do not fit into any daily partition end up in a
+default partition, so inserts never fail. Afterwards, payloads that are no longer
+referenced by any partition are deleted from `apdu_payloads`.
+
+Dropping a partition briefly locks the whole table, which is why every partition
+is handled in its own transaction.
+"""
+
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import exc, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession, async_sessionmaker
+
+from . import metrics, timers
+from . import models as dbm
+from .config import Config
+
+LOGGER = logging.getLogger(__name__)
+
+TABLE = dbm.ApduLog.__tablename__
+DEFAULT_PARTITION = f"{TABLE}_default"
+LEGACY_TABLE = f"{TABLE}_legacy"
+PAYLOAD_TABLE = dbm.ApduPayload.__tablename__
+
+_PARTITION_RE = re.compile(rf"^{TABLE}_p(\d{{8}})$")
+# key of the advisory lock held while changing partitions ("apdu")
+_LOCK_KEY = 0x61706475
+# amount of COPY output compressed at once
+_ARCHIVE_CHUNK_SIZE = 2**20
+_ARCHIVE_QUERY = (
+    "SELECT l.id, l.timestamp, l.provider_id, l.probe_id, l.sim_id, l.sim_iccid, "
+    "l.sim_imsi, l.command, coalesce(l.payload, p.payload) AS payload, l.sender "
+    f"FROM {{}} l LEFT JOIN {PAYLOAD_TABLE} p ON p.hash = l.payload_hash"
+)
+# number of payloads deleted per transaction
+_DELETE_BATCH_SIZE = 10_000
+
+PARTITIONS = metrics.Gauge(
+    "moatt_apdu_log_partitions", "Number of daily partitions of the APDU log."
+)
+ARCHIVED = metrics.Counter(
+    "moatt_apdu_log_archived_partitions_total", "Number of archived partitions."
+)
+DROPPED = metrics.Counter(
+    "moatt_apdu_log_dropped_partitions_total",
+    "Number of partitions dropped because of the retention period.",
+)
+DELETED_PAYLOADS = metrics.Counter(
+    "moatt_apdu_log_deleted_payloads_total",
+    "Number of payloads deleted because they were no longer referenced.",
+)
+
+
+def partition_name(day: datetime.date) -> str:
+    return f"{TABLE}_p{day:%Y%m%d}"
+
+
+async def migrate_legacy(conn: AsyncConnection) -> None:
+    """Rename an unpartitioned APDU log (created by older versions).
+
+    Has to run before the tables are created. The old table is kept as
+    `apdu_log_legacy` and is neither archived nor dropped automatically.
+    """
+    await _lock(conn)
+
+    kind = await conn.scalar(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"), {"t": TABLE}
+    )
+    # "r": ordinary table, "p": partitioned table
+    if kind != "r":
+        return
+
+    LOGGER.warning(
+        "APDU log is not partitioned. Renaming it to '%s'; its rows are not subject "
+        "to retention and archival.",
+        LEGACY_TABLE,
+    )
+    await conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {LEGACY_TABLE}"))
+    await conn.execute(
+        text(
+            f"ALTER TABLE {LEGACY_TABLE} "
+            f"RENAME CONSTRAINT {TABLE}_pkey TO {LEGACY_TABLE}_pkey"
+        )
+    )
+    await conn.execute(
+        text(f"ALTER SEQUENCE IF EXISTS {TABLE}_id_seq RENAME TO {LEGACY_TABLE}_id_seq")
+    )
+
+
+async def create_default_partition(conn: AsyncConnection) -> None:
+    await _lock(conn)
+    await conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"
+        )
+    )
+
+
+async def maintain(
+    async_session: async_sessionmaker[AsyncSession],
+    config: Config,
+    now: Optional[datetime.datetime] = None,
+) -> None:
+    if now is None:
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    async with async_session() as session, session.begin():
+        conn = await session.connection()
+        await create_default_partition(conn)
+
+        partitions = await _partitions(conn)
+        for i in range(config.AUDIT_PARTITIONS_AHEAD + 1):
+            day = now.date() + datetime.timedelta(days=i)
+            if day not in partitions and await _create_partition(conn, day):
+                partitions[day] = partition_name(day)
+
+    for day, name in sorted(partitions.items()):
+        # time since the last row that fits into the partition
+        age = now - _start(day + datetime.timedelta(days=1))
+
+        archive = (
+            config.AUDIT_ARCHIVE_AFTER is not None and age >= config.AUDIT_ARCHIVE_AFTER
+        )
+        expired = config.AUDIT_RETENTION is not None and age >= config.AUDIT_RETENTION
+        if not (archive or expired):
+            continue
+
+        if archive:
+            async with async_session() as session, session.begin():
+                path = await _archive(
+                    await session.connection(), name, Path(config.AUDIT_ARCHIVE_DIR)
+                )
+            LOGGER.info("Archived APDU log partition '%s' to '%s'.", name, path)
+            ARCHIVED.inc()
+        else:
+            DROPPED.inc()
+
+        async with async_session() as session, session.begin():
+            conn = await session.connection()
+            await _lock(conn)
+            await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+        LOGGER.info("Dropped APDU log partition '%s'.", name)
+        del partitions[day]
+
+    PARTITIONS.set(len(partitions))
+
+    # payloads of remaining daily partitions were used on or after their day
+    await _delete_unused_payloads(async_session, min([now.date(), *partitions]))
+
+
+async def run(async_session: async_sessionmaker[AsyncSession], config: Config) -> None:
+    """Run `maintain` every `AUDIT_MAINTENANCE_INTERVAL`."""
+    while True:
+        try:
+            await maintain(async_session, config)
+        except Exception:
+            LOGGER.exception("APDU log maintenance failed.")
+
+        await timers.wheel().sleep(config.AUDIT_MAINTENANCE_INTERVAL.total_seconds())
+
+
+async def _lock(conn: AsyncConnection) -> None:
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _LOCK_KEY})
+
+
+def _start(day: datetime.date) -> datetime.datetime:
+    return datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+
+
+async def _partitions(conn: AsyncConnection) -> dict[datetime.date, str]:
+    names = await conn.scalars(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:t)"
+        ),
+        {"t": TABLE},
+    )
+
+    partitions = {}
+    for name in names:
+        if (m := _PARTITION_RE.match(name)) is not None:
+            day = datetime.datetime.strptime(m.group(1), "%Y%m%d").date()
+            partitions[day] = name
+
+    return partitions
+
+
+async def _create_partition(conn: AsyncConnection, day: datetime.date) -> bool:
+    start = _start(day)
+    end = _start(day + datetime.timedelta(days=1))
+
+    try:
+        # fails if the default partition already holds rows of that day
+        async with conn.begin_nested():
+            await conn.execute(
+                text(
+                    f"CREATE TABLE {partition_name(day)} PARTITION OF {TABLE} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                )
+            )
+    except exc.DBAPIError as e:
+        LOGGER.error("Failed to create APDU log partition for %s: %s", day, e)
+        return False
+
+    return True
+
+
+async def _delete_unused_payloads(
+    async_session: async_sessionmaker[AsyncSession], before: datetime.date
+) -> None:
+    """Delete payloads last used before `before` that the default partition does not use."""
+    stmt = text(
+        f"DELETE FROM {PAYLOAD_TABLE} WHERE hash IN ("
+        f"SELECT p.hash FROM {PAYLOAD_TABLE} p WHERE p.last_used < :before "
+        f"AND NOT EXISTS (SELECT FROM {DEFAULT_PARTITION} d WHERE d.payload_hash = p.hash) "
+        "LIMIT :n)"
+    )
+
+    deleted = _DELETE_BATCH_SIZE
+    while deleted == _DELETE_BATCH_SIZE:
+        async with async_session() as session, session.begin():
+            res = await session.execute(
+                stmt, {"before": before, "n": _DELETE_BATCH_SIZE}
+            )
+            deleted = res.rowcount  # type: ignore
+
+        DELETED_PAYLOADS.inc(deleted)
+        if deleted > 0:
+            LOGGER.info("Deleted %d unused APDU payloads.", deleted)
+
+
+async def _archive(conn: AsyncConnection, name: str, archive_dir: Path) -> Path:
+    """Write the rows of partition `name` to `<archive_dir>/<name>.csv.gz`.
+
+    The archived rows contain the payloads themselves instead of their hashes.
+    """
+    path = archive_dir / f"{name}.csv.gz"
+    tmp = path.with_name(path.name + ".tmp")
+
+    await asyncio.to_thread(archive_dir.mkdir, parents=True, exist_ok=True)
+    f = await asyncio.to_thread(gzip.open, tmp, "wb")
+    try:
+        raw = await conn.get_raw_connection()
+        buf = bytearray()
+
+        async with raw.driver_connection.cursor() as cur:  # type: ignore
+            async with cur.copy(
+                f"COPY ({_ARCHIVE_QUERY.format(name)}) TO STDOUT (FORMAT csv, HEADER)"
+            ) as copy:
+                async for data in copy:
+                    buf += data
+                    if len(buf) >= _ARCHIVE_CHUNK_SIZE:
+                        await asyncio.to_thread(f.write, bytes(buf))
+                        buf.clear()
+
+        await asyncio.to_thread(f.write, bytes(buf))
+        await asyncio.to_thread(f.close)
+        # the partition is dropped next, so the archive has to be on disk
+        await asyncio.to_thread(_fsync, tmp)
+    except BaseException:
+        await asyncio.to_thread(_discard, f, tmp)
+        raise
+
+    await asyncio.to_thread(os.replace, tmp, path)
+    await asyncio.to_thread(_fsync, archive_dir)
+
+    return path
+
+
+def _discard(f: gzip.GzipFile, tmp: Path) -> None:
+    try:
+        f.close()
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _fsync(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,337 @@
+import asyncio
+import collections
+import datetime
+import enum
+import hashlib
+import logging
+import random
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any
+from uuid import UUID
+
+from moatt_types.connect import ApduPacket
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import metrics
+from . import models as dbm
+from .batch_writer import BatchWriter, unavailable
+
+if TYPE_CHECKING:
+    from .db import SimId
+
+LOGGER = logging.getLogger(__name__)
+
+WRITE_LAG_SECONDS = metrics.Histogram(
+    "moatt_audit_write_lag_seconds",
+    "Age of the oldest APDU log entry of a batch when it was written.",
+)
+BUFFERED = metrics.Gauge(
+    "moatt_audit_buffered", "Number of APDU log entries waiting to be written."
+)
+DROPPED = metrics.Counter(
+    "moatt_audit_dropped_total", "Number of discarded APDU log entries."
+)
+PAYLOAD_WRITES = metrics.Counter(
+    "moatt_audit_payload_writes_total",
+    "Number of payloads written to the payload table (or whose last use was updated).",
+)
+REJECTED = metrics.Counter(
+    "moatt_audit_rejected_total",
+    "Number of APDU log entries discarded because the database rejected them.",
+)
+DEDUPLICATED = metrics.Counter(
+    "moatt_audit_deduplicated_payloads_total",
+    "Number of logged payloads that were known to be stored already.",
+)
+
+# payloads up to this length are stored inline instead of being referenced by hash
+PAYLOAD_HASH_LEN = hashlib.sha256().digest_size
+
+_upsert = pg_insert(dbm.ApduPayload)
+UPSERT_PAYLOADS = _upsert.on_conflict_do_update(
+    index_elements=[dbm.ApduPayload.hash],
+    set_={"last_used": _upsert.excluded.last_used},
+    where=dbm.ApduPayload.last_used < _upsert.excluded.last_used,
+)
+
+# attempts to write a batch before looking for the entries the database rejects
+MAX_ATTEMPTS = 3
+
+
+@enum.unique
+class OverflowPolicy(enum.Enum):
+    Block = "block"
+    Drop = "drop"
+
+
+class AuditLog(BatchWriter):
+    """Buffers APDU log entries in memory and writes them to the database in batches.
+
+    Entries are written by a single background task (see `run`) once either
+    `batch_size` entries are pending or `flush_interval` has passed. If the buffer
+    holds `max_buffered` entries, new entries either wait for the writer to catch up
+    (`OverflowPolicy.Block`) or are discarded (`OverflowPolicy.Drop`).
+
+    Payloads are deduplicated (see `dbm.ApduPayload`): the hashes of the
+    `payload_cache_size` most recently written payloads are remembered, together
+    with the day they were last written, so a payload is written at most once a day
+    as long as it stays in the cache.
+    """
+
+    max_attempts = MAX_ATTEMPTS
+    rows_name = "APDU log entries"
+
+    def __init__(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        *,
+        batch_size: int = 500,
+        flush_interval: timedelta = timedelta(seconds=1),
+        max_buffered: int = 10_000,
+        policy: OverflowPolicy = OverflowPolicy.Block,
+        sample_rate: float = 1.0,
+        payload_cache_size: int = 100_000,
+    ):
+        super().__init__(
+            async_session,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_buffered=max_buffered,
+        )
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self.payload_cache_size = payload_cache_size
+
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+        # number of entries that were added to/removed from the buffer so far
+        # used to let flush() wait for the entries buffered before it was called
+        self._enqueued = 0
+        self._processed = 0
+        self._flush_waiters: list[tuple[int, asyncio.Future[None]]] = []
+
+        # hash -> last day (UTC) the payload was written, least recently used first
+        self._payloads: collections.OrderedDict[bytes, datetime.date] = (
+            collections.OrderedDict()
+        )
+
+        self.dropped = 0
+
+    def session(
+        self, provider_id: UUID, probe_id: UUID, sim_id: "SimId"
+    ) -> "AuditSession":
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        return AuditSession(self, provider_id, probe_id, sim_id, sampled)
+
+    async def log(
+        self,
+        provider_id: UUID,
+        probe_id: UUID,
+        sim_id: "SimId",
+        apdu: ApduPacket,
+        sender: dbm.Sender,
+    ) -> None:
+        row = {
+            "timestamp": datetime.datetime.now(tz=datetime.timezone.utc),
+            "provider_id": provider_id,
+            "probe_id": probe_id,
+            "sim_id": sim_id.id,
+            "sim_iccid": sim_id.iccid,
+            "sim_imsi": sim_id.imsi,
+            "command": apdu.op,
+            "payload": apdu.payload,
+            "sender": sender,
+        }
+
+        while len(self._buf) >= self.max_buffered:
+            if self.policy == OverflowPolicy.Drop:
+                if self.dropped % 1000 == 0:
+                    LOGGER.warning(
+                        "APDU audit buffer is full. Dropping log entries. (dropped so far: %d)",
+                        self.dropped,
+                    )
+                self.dropped += 1
+                DROPPED.inc()
+                return
+
+            self._not_full.clear()
+            await self._not_full.wait()
+
+        self._buf.append(row)
+        self._enqueued += 1
+        BUFFERED.set(len(self._buf))
+
+        if len(self._buf) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self) -> None:
+        """Wait until all entries that are currently buffered have been written."""
+        target = self._enqueued
+
+        if self._processed >= target:
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._flush_waiters.append((target, fut))
+        self._batch_ready.set()
+        await fut
+
+    async def _write_rejected(self, batch: list[dict[str, Any]]) -> bool:
+        """Write `batch` in ever smaller parts, discarding single entries that fail."""
+        mid = len(batch) // 2
+        parts = [p for p in (batch[mid:], batch[:mid]) if len(p) > 0]
+        while len(parts) > 0:
+            part = parts.pop()
+
+            try:
+                await self._write(part)
+            except Exception as e:
+                if unavailable(e):
+                    LOGGER.exception(
+                        "Failed to write APDU log entries. Retrying later."
+                    )
+                    for p in [*parts, part]:
+                        self._buf.extendleft(reversed(p))
+                    return False
+
+                if len(part) > 1:
+                    mid = len(part) // 2
+                    parts += [part[mid:], part[:mid]]
+                    continue
+
+                LOGGER.error(
+                    "Discarding APDU log entry of SIM %s (provider %s) logged at %s.",
+                    part[0]["sim_id"],
+                    part[0]["provider_id"],
+                    part[0]["timestamp"],
+                    exc_info=e,
+                )
+                REJECTED.inc()
+                self._done(part)
+
+        return True
+
+    async def _write(self, batch: list[dict[str, Any]]) -> None:
+        rows, payloads = self._deduplicate(batch)
+
+        async with self.async_session() as session, session.begin():
+            if len(payloads) > 0:
+                await session.execute(UPSERT_PAYLOADS, payloads)
+            await session.execute(insert(dbm.ApduLog), rows)
+
+        WRITE_LAG_SECONDS.observe(
+            (
+                datetime.datetime.now(tz=datetime.timezone.utc) - batch[0]["timestamp"]
+            ).total_seconds()
+        )
+        self._payloads_written(payloads)
+        self._done(batch)
+
+    def _done(self, batch: list[dict[str, Any]]) -> None:
+        """Account for entries that left the buffer for good."""
+        BUFFERED.set(len(self._buf))
+        self._processed += len(batch)
+        self._not_full.set()
+        self._notify_flushed()
+
+    def _deduplicate(
+        self, batch: list[dict[str, Any]]
+    ) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+        """Split buffered entries into APDU log rows and the payloads to write."""
+        rows = []
+        payloads: dict[bytes, dict[str, Any]] = {}
+
+        for entry in batch:
+            row = entry.copy()
+            payload = row.pop("payload")
+
+            if payload is None or len(payload) <= PAYLOAD_HASH_LEN:
+                row["inline_payload"] = payload
+                row["payload_hash"] = None
+                rows.append(row)
+                continue
+
+            h = hashlib.sha256(payload).digest()
+            day = row["timestamp"].date()
+            row["inline_payload"] = None
+            row["payload_hash"] = h
+            rows.append(row)
+
+            written = self._payloads.get(h)
+            if written is not None and written >= day:
+                self._payloads.move_to_end(h)
+                DEDUPLICATED.inc()
+            elif h in payloads:
+                p = payloads[h]
+                p["last_used"] = max(p["last_used"], day)
+                DEDUPLICATED.inc()
+            else:
+                payloads[h] = {"hash": h, "payload": payload, "last_used": day}
+
+        # a consistent order avoids deadlocks between concurrent upserts
+        return rows, sorted(payloads.values(), key=lambda p: p["hash"])
+
+    def _payloads_written(self, payloads: list[dict[str, Any]]) -> None:
+        PAYLOAD_WRITES.inc(len(payloads))
+
+        for p in payloads:
+            self._payloads[p["hash"]] = p["last_used"]
+            self._payloads.move_to_end(p["hash"])
+
+        while len(self._payloads) > self.payload_cache_size:
+            self._payloads.popitem(last=False)
+
+    def _notify_flushed(self) -> None:
+        waiters = []
+        for target, fut in self._flush_waiters:
+            if target <= self._processed:
+                if not fut.done():
+                    fut.set_result(None)
+            else:
+                waiters.append((target, fut))
+        self._flush_waiters = waiters
+
+
+class AuditSession:
+    """APDU log of a single tunnel session."""
+
+    def __init__(
+        self,
+        audit_log: AuditLog,
+        provider_id: UUID,
+        probe_id: UUID,
+        sim_id: "SimId",
+        sampled: bool,
+    ):
+        self.audit_log = audit_log
+        self.provider_id = provider_id
+        self.probe_id = probe_id
+        self.sim_id = sim_id
+        self.sampled = sampled
+
+    async def log(self, apdu: ApduPacket, sender: dbm.Sender) -> None:
+        if not self.sampled:
+            return
+
+        await self.audit_log.log(
+            self.provider_id, self.probe_id, self.sim_id, apdu, sender
+        )
+
+    async def close(self) -> None:
+        if not self.sampled:
+            return
+
+        # don't let a database outage keep the session handler around indefinitely;
+        # entries that could not be written yet stay buffered
+        try:
+            async with asyncio.timeout(
+                10 * self.audit_log.flush_interval.total_seconds()
+            ):
+                await self.audit_log.flush()
+        except TimeoutError:
+            LOGGER.warning(
+                "Timed out while waiting for APDU log entries to be written."
+            )
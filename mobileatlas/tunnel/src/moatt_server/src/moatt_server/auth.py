@@ -1,19 +1,49 @@
+import base64
 import datetime
+import json
 import logging
-from typing import Optional
+import time
+from collections.abc import Awaitable, Callable, Sequence
+from dataclasses import dataclass
+from typing import TypeVar
 from uuid import UUID
 
 from moatt_types.connect import AuthStatus, Iccid, Imsi, SimId, SimIndex, Token
-from sqlalchemy import select
+from sqlalchemy import Row, column, delete, exists, func, select, update, values
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.sql.expression import Values
 
 from . import models as dbm
+from . import metrics, notify
 from .auth_handler import AuthResult, SimIdent
 from .config import get_config
+from .sim_directory import SimDirectory, SimEntry
 
 LOGGER = logging.getLogger(__name__)
 
+AUTH_SECONDS = metrics.Histogram(
+    "moatt_auth_seconds", "Duration of auth handler calls.", ["method"]
+)
+AUTH_ERRORS = metrics.Counter(
+    "moatt_auth_errors_total",
+    "Auth handler calls that raised an exception.",
+    ["method"],
+)
+
+T = TypeVar("T")
+
+
+async def _timed(method: str, coro: Awaitable[T]) -> T:
+    start = time.perf_counter()
+    try:
+        return await coro
+    except Exception:
+        AUTH_ERRORS.labels(method).inc()
+        raise
+    finally:
+        AUTH_SECONDS.labels(method).observe(time.perf_counter() - start)
+
 
 class TokenError(Exception):
     def __init__(self, etype: AuthResult) -> None:
@@ -43,13 +73,85 @@ def now() -> datetime.datetime:
     return datetime.datetime.now(tz=datetime.timezone.utc)
 
 
+@dataclass
+class Registration:
+    modified: bool
+    version: int  # `Provider.sims_version` after the registration
+
+
+class VersionMismatch(Exception):
+    """The provider's SIMs changed since the version a SIM list update is based on."""
+
+
+class SimConflict(Exception):
+    """A SIM list update would register an ICCID or IMSI twice for one provider."""
+
+
+Sims = dict[int, tuple[Iccid | None, Imsi | None]]
+
+
 async def register_provider(
+    session: AsyncSession, session_token: Token, sims_in: Sims
+) -> Registration:
+    """Replace the SIMs of the provider identified by `session_token` with `sims_in`.
+
+    Creates the provider if it is not registered yet.
+    """
+    LOGGER.debug(f"Registering SIMs. {sims_in}")
+
+    sims = await _allowed_sims(session_token, sims_in)
+    provider_id = await _provider_id(session_token)
+
+    res = await session.execute(
+        insert(dbm.Provider)
+        .values(id=provider_id, last_active=now())
+        .on_conflict_do_nothing()
+        .returning(dbm.Provider.id)
+    )
+    created = res.first() is not None
+    version = await _lock_provider(session, provider_id)
+    assert version is not None
+
+    # removed SIMs and SIMs whose ICCID/IMSI changed
+    deleted = await _delete_sims(session, provider_id, sims)
+    added = await _add_sims(session, provider_id, sims)
+
+    return await _registered(
+        session, provider_id, version, created or deleted + added > 0
+    )
+
+
+async def update_provider_sims(
     session: AsyncSession,
     session_token: Token,
-    sims_in: dict[int, tuple[Iccid | None, Imsi | None]],
-) -> bool:
-    LOGGER.debug(f"Registering SIMs. {sims_in}")
+    version: int,
+    added_in: Sims,
+    removed: set[int],
+) -> Registration:
+    """Add and remove SIMs of a registered provider.
+
+    Raises `VersionMismatch` unless the provider's SIMs are at `version`. SIMs in
+    `added_in` replace registered SIMs with the same ID.
+    """
+    LOGGER.debug(f"Updating SIMs. added={added_in} removed={removed}")
+
+    added = await _allowed_sims(session_token, added_in)
+    provider_id = await _provider_id(session_token)
 
+    if await _lock_provider(session, provider_id) != version:
+        raise VersionMismatch
+
+    deleted = await _delete_sims(
+        session, provider_id, added, scope=removed | added.keys()
+    )
+    n_added = await _add_sims(session, provider_id, added)
+
+    return await _registered(session, provider_id, version, deleted + n_added > 0)
+
+
+async def _allowed_sims(
+    session_token: Token, sims_in: Sims
+) -> dict[int, tuple[str | None, str | None]]:
     authh = get_config().AUTH_HANDLER
 
     sims = {
@@ -59,108 +161,182 @@ async def register_provider(
 
     sim_idents = [SimIdent(id=k, iccid=v[0], imsi=v[1]) for k, v in sims.items()]
     if (
-        auth_res := await authh.allowed_sim_registration(session_token, sim_idents)
+        auth_res := await _timed(
+            "allowed_sim_registration",
+            authh.allowed_sim_registration(session_token, sim_idents),
+        )
     ) != AuthResult.Success:
         LOGGER.info(f"Auth handler did not allow sim registration: {auth_res}")
         raise TokenError(auth_res)
 
-    provider_id = await authh.identity(session_token)
+    return sims
+
+
+async def _provider_id(session_token: Token) -> UUID:
+    provider_id = await identity(session_token)
 
     if provider_id is None:
         LOGGER.info("Couldn't get ID associated with token.")
         raise TokenError(AuthResult.InvalidToken)
 
-    provider = await session.get(dbm.Provider, provider_id)
+    return provider_id
 
-    modified = False
-    time = now()
 
-    if provider is None:
-        modified = True
-        provider = dbm.Provider(id=provider_id, last_active=time)
-        session.add(provider)
-        await session.flush()
+async def _lock_provider(session: AsyncSession, provider_id: UUID) -> int | None:
+    """Lock the provider's row until the end of the transaction and return its
+    SIM version (None if the provider is not registered)."""
+    return await session.scalar(
+        select(dbm.Provider.sims_version)
+        .where(dbm.Provider.id == provider_id)
+        .with_for_update()
+    )
 
-    ids = set(sims.keys())
 
-    removed_sims = list(
-        await session.scalars(
-            select(dbm.Sim).where(
-                (dbm.Sim.provider_id == provider_id) & (dbm.Sim.id.not_in(ids))
+def _sim_values(sims: dict[int, tuple[str | None, str | None]]) -> Values:
+    return values(
+        column("id", dbm.Sim.id.type),
+        column("iccid", dbm.Sim.iccid.type),
+        column("imsi", dbm.Sim.imsi.type),
+        name="new_sims",
+    ).data([(id, iccid, imsi) for id, (iccid, imsi) in sims.items()])
+
+
+async def _delete_sims(
+    session: AsyncSession,
+    provider_id: UUID,
+    sims: dict[int, tuple[str | None, str | None]],
+    scope: set[int] | None = None,
+) -> int:
+    """Delete the provider's SIMs (with an ID in `scope`, if given) that are not
+    in `sims` with the same ICCID and IMSI."""
+    stmt = delete(dbm.Sim).where(dbm.Sim.provider_id == provider_id)
+
+    if scope is not None:
+        if len(scope) == 0:
+            return 0
+        stmt = stmt.where(dbm.Sim.id.in_(scope))
+
+    if len(sims) > 0:
+        v = _sim_values(sims)
+        stmt = stmt.where(
+            ~exists().where(
+                v.c.id == dbm.Sim.id,
+                v.c.iccid.is_not_distinct_from(dbm.Sim.iccid),
+                v.c.imsi.is_not_distinct_from(dbm.Sim.imsi),
             )
         )
-    )
 
-    if len(removed_sims) > 0:
-        modified = True
+    res = await session.execute(stmt.returning(dbm.Sim.id))
+    return len(res.all())
 
-    for sim in removed_sims:
-        await session.delete(sim)
 
+async def _add_sims(
+    session: AsyncSession,
+    provider_id: UUID,
+    sims: dict[int, tuple[str | None, str | None]],
+) -> int:
+    """Insert the SIMs that the provider has not registered yet.
+
+    Registered SIMs with the same ID have to match (see `_delete_sims`). SIMs of
+    other providers with the same ICCID or IMSI are removed if allowed.
+    """
     if len(sims) == 0:
-        return modified
+        return 0
 
-    iccids, imsis = zip(*sims.values())
-    iccids = set(iccids)
-    imsis = set(imsis)
+    iccids = [iccid for iccid, _ in sims.values() if iccid is not None]
+    imsis = [imsi for _, imsi in sims.values() if imsi is not None]
 
-    existing_sims = list(
-        await session.scalars(
-            select(dbm.Sim)
-            .where(
-                dbm.Sim.id.in_(ids)
-                | dbm.Sim.iccid.in_(iccids)
-                | dbm.Sim.imsi.in_(imsis)
+    conflicts = (
+        await session.execute(
+            select(dbm.Sim.provider_id, dbm.Sim.id).where(
+                dbm.Sim.iccid.in_(iccids) | dbm.Sim.imsi.in_(imsis),
+                ~((dbm.Sim.provider_id == provider_id) & dbm.Sim.id.in_(sims.keys())),
             )
-            .options(selectinload(dbm.Sim.provider))
+        )
+    ).all()
+
+    if len(conflicts) > 0:
+        await _resolve_conflicts(session, provider_id, conflicts)
+
+    res = await session.execute(
+        insert(dbm.Sim)
+        .values(
+            [
+                {
+                    "id": id,
+                    "provider_id": provider_id,
+                    "iccid": iccid,
+                    "imsi": imsi,
+                    "in_use": False,
+                }
+                for id, (iccid, imsi) in sims.items()
+            ]
+        )
+        .on_conflict_do_nothing(index_elements=[dbm.Sim.id, dbm.Sim.provider_id])
+        .returning(dbm.Sim.id)
+    )
+    return len(res.all())
+
+
+async def _resolve_conflicts(
+    session: AsyncSession, provider_id: UUID, conflicts: Sequence[Row[tuple[UUID, int]]]
+) -> None:
+    """Remove SIMs of other providers that are registered again by `provider_id`."""
+    by_provider: dict[UUID, list[int]] = {}
+    for prov_id, sim_id in conflicts:
+        if prov_id == provider_id:
+            raise SimConflict
+        by_provider.setdefault(prov_id, []).append(sim_id)
+
+    providers = list(
+        await session.scalars(
+            select(dbm.Provider).where(dbm.Provider.id.in_(by_provider.keys()))
         )
     )
-    LOGGER.debug(f"Existing sims: {existing_sims}")
-    new_ids = ids
-
-    for sim in existing_sims:
-        if sim.provider.id == provider_id:
-            new_sim = sims[sim.id]
-            iccid = new_sim[0] if new_sim[0] is not None else None
-            imsi = new_sim[1] if new_sim[1] is not None else None
-
-            if sim.iccid != iccid or sim.imsi != imsi:
-                modified = True
-                await session.delete(sim)
-            else:
-                new_ids.remove(sim.id)
-
-            continue
-
-        if sim.provider.is_expired(get_config().PROVIDER_EXPIRATION):
-            await remove_provider(session, sim.provider)
-        elif sim.provider.allow_reregistration:
-            await session.delete(sim)
+
+    for provider in providers:
+        if provider.is_expired(get_config().PROVIDER_EXPIRATION):
+            await remove_provider(session, provider)
+        elif provider.allow_reregistration:
+            await session.execute(
+                delete(dbm.Sim).where(
+                    dbm.Sim.provider_id == provider.id,
+                    dbm.Sim.id.in_(by_provider[provider.id]),
+                )
+            )
+            await _bump_version(session, provider.id)
         else:
             raise AuthError
 
-    if len(new_ids) > 0:
-        modified = True
-
     await session.flush()
-    LOGGER.debug(f"Creating new SIMs: {new_ids}")
-    for id in new_ids:
-        sim = dbm.Sim(
-            id=id,
-            iccid=sims[id][0],
-            imsi=sims[id][1],
-            in_use=False,
-            provider=provider,
-        )
-        session.add(sim)
 
-    return modified
+
+async def _bump_version(session: AsyncSession, provider_id: UUID) -> int:
+    version = await session.scalar(
+        update(dbm.Provider)
+        .where(dbm.Provider.id == provider_id)
+        .values(sims_version=dbm.Provider.sims_version + 1)
+        .returning(dbm.Provider.sims_version)
+    )
+    await notify_sims_changed(session, provider_id)
+
+    assert version is not None
+    return version
+
+
+async def _registered(
+    session: AsyncSession, provider_id: UUID, version: int, modified: bool
+) -> Registration:
+    if modified:
+        version = await _bump_version(session, provider_id)
+
+    return Registration(modified=modified, version=version)
 
 
 async def deregister_provider(session: AsyncSession, session_token: Token) -> None:
     authh = get_config().AUTH_HANDLER
 
-    prov_id = await authh.identity(session_token)
+    prov_id = await _timed("identity", authh.identity(session_token))
 
     if prov_id is None:
         return
@@ -175,77 +351,152 @@ async def deregister_provider(session: AsyncSession, session_token: Token) -> No
 
 async def remove_provider(session: AsyncSession, provider: dbm.Provider) -> None:
     await session.delete(provider)
+    await notify_sims_changed(session, provider.id)
+
+
+async def notify_sims_changed(session: AsyncSession, provider_id: UUID) -> None:
+    """Tell the tunnel processes to reload the SIMs of `provider_id` once the
+    transaction commits."""
+    await notify.notify(session, notify.SIMS_CHANGED, str(provider_id))
 
 
 class AuthError(Exception):
     """Authorisation failure."""
 
 
+async def invalidate(payload: str) -> None:
+    """Handle a notification sent by `notify_invalidation`."""
+    authh = get_config().AUTH_HANDLER
+    msg = json.loads(payload)
+
+    if (version := msg.get("permission_version")) is not None:
+        authh.update_permission_version(msg["token_id"], version)
+    else:
+        token = msg.get("token")
+        authh.invalidate(Token(base64.b64decode(token)) if token is not None else None)
+
+
+async def resync(async_session: Callable[[], AsyncSession]) -> None:
+    """Bring the auth handler up to date after notifications might have been missed."""
+    authh = get_config().AUTH_HANDLER
+    authh.invalidate()
+
+    async with async_session() as session, session.begin():
+        versions = await session.scalars(select(dbm.PermissionVersion))
+
+        for v in versions:
+            authh.update_permission_version(v.token_id, v.version)
+
+
+async def notify_invalidation(session: AsyncSession, token: Token | None) -> None:
+    """Tell all tunnel processes to drop cached decisions about `token`."""
+    await notify.notify(
+        session,
+        notify.AUTH_INVALIDATE,
+        json.dumps({"token": token.as_base64() if token is not None else None}),
+    )
+
+
+async def notify_permission_version(
+    session: AsyncSession, token_id: int, version: int
+) -> None:
+    """Record a new permission version of a management token and notify all tunnel processes."""
+    stmt = insert(dbm.PermissionVersion).values(token_id=token_id, version=version)
+    await session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[dbm.PermissionVersion.token_id],
+            set_={"version": func.greatest(dbm.PermissionVersion.version, version)},
+        )
+    )
+    await notify.notify(
+        session,
+        notify.AUTH_INVALIDATE,
+        json.dumps({"token_id": token_id, "permission_version": version}),
+    )
+
+
 async def identity(token: Token) -> UUID | None:
     authh = get_config().AUTH_HANDLER
 
-    return await authh.identity(token)
+    return await _timed("identity", authh.identity(token))
+
+
+async def probe_priority(token: Token) -> int:
+    authh = get_config().AUTH_HANDLER
+
+    return await _timed("probe_priority", authh.probe_priority(token))
 
 
 async def register_probe(token: Token) -> None:
     authh = get_config().AUTH_HANDLER
 
-    if (res := await authh.allowed_probe_registration(token)) != AuthResult.Success:
+    if (
+        res := await _timed(
+            "allowed_probe_registration", authh.allowed_probe_registration(token)
+        )
+    ) != AuthResult.Success:
         raise TokenError(res)
 
 
-async def provider_registered(session: AsyncSession, token: Token) -> None:
+async def provider_registered(
+    directory: SimDirectory,
+    async_session: Callable[[], AsyncSession],
+    token: Token,
+) -> None:
+    """Raise a TokenError unless `token` belongs to a registered provider.
+
+    Registered providers are looked up in `directory`; the database is only
+    queried for providers it does not know (the notification about a new
+    registration may not have arrived yet).
+    """
     authh = get_config().AUTH_HANDLER
 
-    if (res := await authh.allowed_provider_registration(token)) != AuthResult.Success:
+    if (
+        res := await _timed(
+            "allowed_provider_registration", authh.allowed_provider_registration(token)
+        )
+    ) != AuthResult.Success:
         raise TokenError(res)
 
-    identity = await authh.identity(token)
+    identity = await _timed("identity", authh.identity(token))
 
     if identity is None:
         raise TokenError(AuthResult.InvalidToken)
 
-    provider = await session.get(dbm.Provider, identity)
+    if directory.registered(identity):
+        return
+
+    async with async_session() as session, session.begin():
+        provider = await session.get(dbm.Provider, identity)
 
     if provider is None:
         raise TokenError(AuthResult.NotRegistered)
 
 
 async def get_sim(
-    session: AsyncSession,
+    directory: SimDirectory,
     token: Token,
     identifier: SimId | Iccid | Imsi | SimIndex,
-) -> Optional[dbm.Sim]:
+) -> SimEntry:
     LOGGER.debug(f"Retrieving SIM card. {identifier=}")
 
     authh = get_config().AUTH_HANDLER
-
-    match identifier:
-        case SimId(provider=prov_id, id=id):
-            sim = await session.scalar(
-                select(dbm.Sim).where(
-                    (dbm.Sim.provider_id == prov_id) & (dbm.Sim.id == id)
-                )
-            )
-        case Iccid(iccid=iccid):
-            sim = await session.scalar(select(dbm.Sim).where(dbm.Sim.iccid == iccid))
-        case Imsi(imsi=imsi):
-            sim = await session.scalar(select(dbm.Sim).where(dbm.Sim.imsi == imsi))
-        case SimIndex(provider=prov_id, index=index):
-            sim = await session.scalar(
-                select(dbm.Sim).order_by(dbm.Sim.id.asc()).limit(1).offset(index)
-            )
-        case _:
-            raise NotImplementedError
+    sim = directory.get(identifier)
 
     if sim is None:
         LOGGER.debug(f"Couldn't find SIM card with id: {identifier}")
         raise AuthError  # raise an AuthError to make it harder to check whether arbitrary ids are registered
 
-    if not await authh.allowed_sim_request(
-        token,
-        (await sim.awaitable_attrs.provider).id,
-        SimIdent(id=sim.id, iccid=sim.iccid, imsi=sim.imsi),
+    if (
+        await _timed(
+            "allowed_sim_request",
+            authh.allowed_sim_request(
+                token,
+                sim.provider_id,
+                SimIdent(id=sim.id, iccid=sim.iccid, imsi=sim.imsi),
+            ),
+        )
+        != AuthResult.Success
     ):
         raise AuthError
 
@@ -48,3 +48,24 @@ class AuthHandler(ABC):
 
     @abstractmethod
     async def identity(self, token: Token) -> UUID | None: ...
+
+    async def probe_priority(self, token: Token) -> int:
+        """Priority class of the connection requests made with `token`.
+
+        Waiting requests of a lower class are handed to providers first.
+        """
+        return 0
+
+    def invalidate(self, token: Token | None = None) -> None:
+        """Forget cached authorisation decisions concerning `token`.
+
+        Called when a token was revoked or its permissions changed. If `token`
+        is None, all cached decisions should be dropped.
+        """
+
+    def update_permission_version(self, token_id: int, version: int) -> None:
+        """Called when the permissions of the management token `token_id` changed.
+
+        Session tokens issued for an older permission `version` must no longer
+        be trusted without checking back with the management server.
+        """
@@ -1 +1,2 @@
 from .moat_management import MoatManagementAuth
+from .signed_token import SignedTokenAuth
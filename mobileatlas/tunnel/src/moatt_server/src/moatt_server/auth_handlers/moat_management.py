@@ -1,5 +1,6 @@
 import dataclasses
 import logging
+from datetime import timedelta
 from pathlib import Path
 from typing import Any, Optional
 from uuid import UUID
@@ -10,6 +11,7 @@ from pydantic import BaseModel
 from pydantic.networks import HttpUrl
 
 from ..auth_handler import AuthHandler, AuthResult, SimIdent
+from ..cache import TTLCache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -21,6 +23,9 @@ class Settings(BaseModel):
     retries: int = 1
     username: str
     password: str
+    cache_size: int = 10_000  # number of cached authorisation decisions
+    cache_ttl: float = 60  # seconds
+    negative_cache_ttl: float = 5  # seconds
 
 
 class MoatManagementAuth(AuthHandler):
@@ -45,7 +50,13 @@ class MoatManagementAuth(AuthHandler):
             timeout=self._settings.timeout,
             transport=transport,
         )
-        self._id_cache: dict[Token, UUID] = {}
+        # keys are tuples whose second element is the token the decision applies to
+        self._cache: TTLCache[tuple[Any, ...], Any] = TTLCache(
+            self._settings.cache_size,
+            timedelta(seconds=self._settings.cache_ttl),
+            timedelta(seconds=self._settings.negative_cache_ttl),
+            lambda r: r != AuthResult.Success and not isinstance(r, UUID),
+        )
 
         LOGGER.debug(
             "Finished initialization with the following settings: %s", self._settings
@@ -83,10 +94,28 @@ class MoatManagementAuth(AuthHandler):
 
         return res.json()
 
-    async def allowed_provider_registration(self, token: Token) -> AuthResult:
-        res = await self._post("/allowed-provider-registration", token.as_base64())
+    def invalidate(self, token: Token | None = None) -> None:
+        if token is None:
+            n = self._cache.invalidate()
+        else:
+            n = self._cache.invalidate(lambda k: k[1] == token)
 
-        return MoatManagementAuth._process_result(res)
+        LOGGER.debug("Invalidated %d cached authorisation decisions.", n)
+
+    async def _cached_result(
+        self, key: tuple[Any, ...], path: str, json: Any
+    ) -> AuthResult:
+        async def load() -> AuthResult:
+            return MoatManagementAuth._process_result(await self._post(path, json))
+
+        return await self._cache.get_or_load(key, load)
+
+    async def allowed_provider_registration(self, token: Token) -> AuthResult:
+        return await self._cached_result(
+            ("provider", token),
+            "/allowed-provider-registration",
+            token.as_base64(),
+        )
 
     async def allowed_sim_registration(
         self, token: Token, sims: list[SimIdent]
@@ -99,14 +128,15 @@ class MoatManagementAuth(AuthHandler):
         return MoatManagementAuth._process_result(res)
 
     async def allowed_probe_registration(self, token: Token) -> AuthResult:
-        res = await self._post("/allowed-probe-registration", token.as_base64())
-
-        return MoatManagementAuth._process_result(res)
+        return await self._cached_result(
+            ("probe", token), "/allowed-probe-registration", token.as_base64()
+        )
 
     async def allowed_sim_request(
         self, token: Token, provider_id: UUID, sim_id: SimIdent
     ) -> AuthResult:
-        res = await self._post(
+        return await self._cached_result(
+            ("sim-request", token, provider_id, sim_id.id, sim_id.iccid, sim_id.imsi),
             "/allowed-sim-request",
             {
                 "token": token.as_base64(),
@@ -117,12 +147,12 @@ class MoatManagementAuth(AuthHandler):
             },
         )
 
-        return MoatManagementAuth._process_result(res)
-
     async def identity(self, token: Token) -> UUID | None:
-        if token in self._id_cache:
-            return self._id_cache[token]
+        return await self._cache.get_or_load(
+            ("identity", token), lambda: self._identity(token)
+        )
 
+    async def _identity(self, token: Token) -> UUID:
         res = await self._post("/identity", token.as_base64())
 
         if not isinstance(res, str):
@@ -139,6 +169,4 @@ class MoatManagementAuth(AuthHandler):
                 "Failed to parse UUID returned by MobileAtlas management server."
             )
 
-        self._id_cache[token] = uuid
-
         return uuid
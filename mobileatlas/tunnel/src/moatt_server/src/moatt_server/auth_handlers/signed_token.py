@@ -0,0 +1,207 @@
+import datetime
+import enum
+import hashlib
+import hmac
+import logging
+import struct
+from dataclasses import dataclass
+from typing import Any, Optional
+from uuid import UUID
+
+from moatt_types.connect import Token
+from pydantic import Base64Bytes, BaseModel, Field
+
+from ..auth_handler import AuthResult, SimIdent
+from .moat_management import MoatManagementAuth
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Scope(enum.IntFlag):
+    Probe = 1
+    Provider = 2
+
+
+@dataclass(frozen=True)
+class Claims:
+    """Contents of a session token signed by the management server.
+
+    Layout (network byte order):
+    version (1) | scope (1) | flags (1) | identity (16) | token_id (8) |
+    permission_version (4) | expires (8; unix time, 0 = never) | nonce (16) |
+    HMAC-SHA256 of the preceding bytes (32)
+    """
+
+    VERSION = 1
+    FLAG_ADMIN = 1
+
+    _FORMAT = struct.Struct("!BBB16sQIQ16s")
+    MAC_LEN = 32
+    LEN = _FORMAT.size + MAC_LEN
+
+    scope: Scope
+    admin: bool
+    identity: UUID
+    token_id: int
+    permission_version: int
+    expires: Optional[datetime.datetime]
+
+    @staticmethod
+    def parse(token: bytes) -> Optional["Claims"]:
+        """Decode the claims of a token without checking its signature.
+
+        Returns None if `token` is not a signed token.
+        """
+        if len(token) != Claims.LEN:
+            return None
+
+        version, scope, flags, identity, token_id, perm_version, expires, _ = (
+            Claims._FORMAT.unpack_from(token)
+        )
+
+        if version != Claims.VERSION:
+            return None
+
+        return Claims(
+            scope=Scope(scope),
+            admin=bool(flags & Claims.FLAG_ADMIN),
+            identity=UUID(bytes=identity),
+            token_id=token_id,
+            permission_version=perm_version,
+            expires=(
+                datetime.datetime.fromtimestamp(expires, tz=datetime.timezone.utc)
+                if expires != 0
+                else None
+            ),
+        )
+
+    @staticmethod
+    def verify(token: bytes, keys: list[bytes]) -> bool:
+        msg, mac = token[: -Claims.MAC_LEN], token[-Claims.MAC_LEN :]
+
+        return any(
+            hmac.compare_digest(hmac.digest(k, msg, hashlib.sha256), mac) for k in keys
+        )
+
+    def expired(self) -> bool:
+        return self.expires is not None and self.expires <= datetime.datetime.now(
+            tz=datetime.timezone.utc
+        )
+
+
+class Settings(BaseModel):
+    # several keys can be configured to allow for key rotation
+    keys: list[Base64Bytes] = Field(min_length=1)
+
+
+class SignedTokenAuth(MoatManagementAuth):
+    """Verifies session tokens signed by the MobileAtlas management server locally.
+
+    The management server is only asked if a token is not a signed token, if
+    its permissions changed since the token was issued (i.e., the token's
+    permission version is outdated) or if a non-admin probe requests a SIM card
+    (signed tokens do not contain SIM permissions).
+    """
+
+    def __init__(self, config: dict[str, Any]):
+        super().__init__(config)
+
+        cfg = config.get("signed-token-auth")
+
+        if not isinstance(cfg, dict):
+            raise ValueError("signed-token-auth config is not a table.")
+
+        self._keys = Settings(**cfg).keys
+        # latest known permission version of each management token
+        self._versions: dict[int, int] = {}
+
+    def update_permission_version(self, token_id: int, version: int) -> None:
+        if version <= self._versions.get(token_id, -1):
+            return
+
+        self._versions[token_id] = version
+        n = self._cache.invalidate(
+            lambda k: (c := Claims.parse(k[1].as_bytes())) is not None
+            and c.token_id == token_id
+        )
+        LOGGER.debug(
+            "Permission version of token %d is now %d. (Invalidated %d cached decisions)",
+            token_id,
+            version,
+            n,
+        )
+
+    def _claims(self, token: Token) -> Claims | AuthResult | None:
+        """Return the token's claims if they can be trusted.
+
+        Returns an AuthResult if the token is invalid and None if the decision
+        has to be made by the management server.
+        """
+        raw = token.as_bytes()
+        claims = Claims.parse(raw)
+
+        if claims is None:
+            return None
+
+        if not Claims.verify(raw, self._keys):
+            LOGGER.debug("Received a signed token with an invalid signature.")
+            return AuthResult.InvalidToken
+
+        known = self._versions.get(claims.token_id, 0)
+        if claims.permission_version < known:
+            return None
+        elif claims.permission_version > known:
+            self.update_permission_version(claims.token_id, claims.permission_version)
+
+        if claims.expired():
+            return AuthResult.ExpiredToken
+
+        return claims
+
+    def _check_scope(self, token: Token, scope: Scope) -> AuthResult | None:
+        claims = self._claims(token)
+
+        if not isinstance(claims, Claims):
+            return claims
+
+        return AuthResult.Success if scope in claims.scope else AuthResult.Forbidden
+
+    async def allowed_provider_registration(self, token: Token) -> AuthResult:
+        if (res := self._check_scope(token, Scope.Provider)) is not None:
+            return res
+
+        return await super().allowed_provider_registration(token)
+
+    async def allowed_probe_registration(self, token: Token) -> AuthResult:
+        if (res := self._check_scope(token, Scope.Probe)) is not None:
+            return res
+
+        return await super().allowed_probe_registration(token)
+
+    async def allowed_sim_request(
+        self, token: Token, provider_id: UUID, sim_id: SimIdent
+    ) -> AuthResult:
+        claims = self._claims(token)
+
+        if isinstance(claims, AuthResult):
+            return claims
+
+        if claims is not None:
+            if Scope.Probe not in claims.scope:
+                return AuthResult.Forbidden
+
+            if claims.admin:
+                return AuthResult.Success
+
+        return await super().allowed_sim_request(token, provider_id, sim_id)
+
+    async def identity(self, token: Token) -> UUID | None:
+        claims = self._claims(token)
+
+        if isinstance(claims, Claims):
+            return claims.identity
+
+        if isinstance(claims, AuthResult):
+            return None
+
+        return await super().identity(token)
@@ -0,0 +1,135 @@
+"""Background writers that insert buffered rows into the database in batches."""
+
+import asyncio
+import collections
+import logging
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from typing import Any
+
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+LOGGER = logging.getLogger(__name__)
+
+
+def unavailable(e: Exception) -> bool:
+    """Whether `e` means that the database could not be reached (rather than that
+    it rejected the written rows)."""
+    return isinstance(e, (exc.OperationalError, exc.InterfaceError, OSError)) or (
+        isinstance(e, exc.DBAPIError) and e.connection_invalidated
+    )
+
+
+class BatchWriter(ABC):
+    """Writes the rows in `_buf` to the database from a single background task.
+
+    `run` writes the buffered rows once either `batch_size` rows are pending
+    (subclasses set `_batch_ready`) or `flush_interval` has passed. Batches that
+    cannot be written because the database is unavailable are kept and retried
+    indefinitely. A batch that fails for other reasons is retried
+    `max_attempts` times; then `_write_rejected` looks for the rows the database
+    rejects, so they don't hold up the rows behind them.
+
+    Subclasses implement `_write` and `_write_rejected`.
+    """
+
+    # number of attempts to write a batch before looking for rejected rows
+    max_attempts = 1
+    # description of the rows used in log messages
+    rows_name = "rows"
+
+    def __init__(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        *,
+        batch_size: int,
+        flush_interval: timedelta,
+        max_buffered: int,
+    ):
+        if batch_size < 1 or max_buffered < batch_size:
+            raise ValueError("Expected 1 <= batch_size <= max_buffered.")
+
+        self.async_session = async_session
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+
+        self._buf: collections.deque[dict[str, Any]] = collections.deque()
+        self._batch_ready = asyncio.Event()
+
+        # failed attempts to write the first buffered batch
+        self._failures = 0
+
+    async def run(self) -> None:
+        try:
+            while True:
+                try:
+                    async with asyncio.timeout(self.flush_interval.total_seconds()):
+                        await self._batch_ready.wait()
+                except TimeoutError:
+                    pass
+
+                self._batch_ready.clear()
+                if not await self._write_pending():
+                    await asyncio.sleep(self.flush_interval.total_seconds())
+        finally:
+            if len(self._buf) > 0:
+                LOGGER.info("Writing %d remaining %s.", len(self._buf), self.rows_name)
+                await self._write_pending()
+
+    async def _write_pending(self) -> bool:
+        """Write all buffered rows; False if the database is unavailable."""
+        while len(self._buf) > 0:
+            n = min(self.batch_size, len(self._buf))
+            batch = [self._buf.popleft() for _ in range(n)]
+
+            try:
+                await self._write(batch)
+                self._failures = 0
+                continue
+            except Exception as e:
+                if unavailable(e):
+                    LOGGER.exception(
+                        "Failed to write %d %s. Retrying later.", n, self.rows_name
+                    )
+                    self._buf.extendleft(reversed(batch))
+                    return False
+
+                self._failures += 1
+                if self._failures < self.max_attempts:
+                    LOGGER.exception(
+                        "Failed to write %d %s (attempt %d of %d). Retrying later.",
+                        n,
+                        self.rows_name,
+                        self._failures,
+                        self.max_attempts,
+                    )
+                    self._buf.extendleft(reversed(batch))
+                    return False
+
+                LOGGER.exception(
+                    "Failed to write %d %s. Looking for the rows that cannot be "
+                    "written.",
+                    n,
+                    self.rows_name,
+                )
+                self._failures = 0
+
+            if not await self._write_rejected(batch):
+                return False
+
+        return True
+
+    @abstractmethod
+    async def _write_rejected(self, batch: list[dict[str, Any]]) -> bool:
+        """Write the rows of a `batch` that failed, discarding those the database
+        rejects.
+
+        Returns False if the database became unavailable; the rows that were not
+        written yet have to be buffered again.
+        """
+
+    @abstractmethod
+    async def _write(self, batch: list[dict[str, Any]]) -> None:
+        """Write `batch` in a single transaction."""
@@ -0,0 +1,118 @@
+import asyncio
+import collections
+import time
+from collections.abc import Awaitable, Callable, Hashable
+from datetime import timedelta
+from typing import Generic, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """Bounded LRU cache whose entries expire after a fixed amount of time.
+
+    Concurrent lookups of a key that is not cached are coalesced into a single
+    call of the loader. Values for which `is_negative` returns True (e.g., denied
+    requests) are cached for `negative_ttl` instead of `ttl`.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: timedelta,
+        negative_ttl: Optional[timedelta] = None,
+        is_negative: Callable[[V], bool] = lambda _: False,
+    ):
+        if maxsize < 1:
+            raise ValueError("Cache size must be positive.")
+
+        self.maxsize = maxsize
+        self.ttl = ttl.total_seconds()
+        self.negative_ttl = (
+            negative_ttl.total_seconds() if negative_ttl is not None else self.ttl
+        )
+        self.is_negative = is_negative
+
+        self._entries: collections.OrderedDict[K, tuple[float, V]] = (
+            collections.OrderedDict()
+        )
+        self._inflight: dict[K, asyncio.Future[V]] = {}
+        # incremented on invalidation so that lookups that were started before
+        # an invalidation do not store their (potentially stale) results
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        ttl = self.negative_ttl if self.is_negative(value) else self.ttl
+
+        if ttl <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def get_or_load(self, key: K, loader: Callable[[], Awaitable[V]]) -> V:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._load(key, loader))
+            self._inflight[key] = fut
+
+        # shield the shared lookup from cancellation of a single waiter
+        return await asyncio.shield(fut)
+
+    def invalidate(self, pred: Optional[Callable[[K], bool]] = None) -> int:
+        """Remove all entries whose keys match `pred` (all entries if None).
+
+        Returns
+        -------
+        The number of removed entries.
+        """
+        self._generation += 1
+
+        if pred is None:
+            n = len(self._entries)
+            self._entries.clear()
+            return n
+
+        keys = [k for k in self._entries if pred(k)]
+        for k in keys:
+            del self._entries[k]
+
+        return len(keys)
+
+    async def _load(self, key: K, loader: Callable[[], Awaitable[V]]) -> V:
+        generation = self._generation
+        try:
+            value = await loader()
+        finally:
+            del self._inflight[key]
+
+        if generation == self._generation:
+            self.put(key, value)
+
+        return value
@@ -13,8 +13,10 @@ from typing import Any, Optional
 
 from sqlalchemy import URL
 
+from .audit import OverflowPolicy
 from .auth_handler import AuthHandler
-from .auth_handlers import MoatManagementAuth
+from .auth_handlers import MoatManagementAuth, SignedTokenAuth
+from .tunnel.relay import RelayMode
 
 LOGGER = logging.getLogger(__name__)
 ISODURATION_RE = re.compile(
@@ -36,11 +38,31 @@ class Config:
     TCP_KEEPINTVL: Optional[timedelta] = timedelta(minutes=10)
     TCP_KEEPCNT: Optional[int] = 10
     TCP_KEEPALIVE: bool = True
+    PING_INTERVAL: Optional[timedelta] = timedelta(seconds=5)
+    PING_TIMEOUT: timedelta = timedelta(seconds=5)
     MAX_QUEUE_SIZE: int = 10
+    MAX_QUEUE_SIZE_PER_PROBE: Optional[int] = 5
+    MAX_MUX_STREAMS: int = 64
     MAX_PROBE_WAITTIME: Optional[timedelta] = timedelta(minutes=5)
 
     GC_INTERVAL: timedelta = timedelta(minutes=1)
-    QUEUE_GC_INTERVAL: timedelta = timedelta(minutes=1)
+
+    STATE_SNAPSHOT_INTERVAL: timedelta = timedelta(seconds=10)
+
+    AUDIT_BATCH_SIZE: int = 500
+    AUDIT_FLUSH_INTERVAL: timedelta = timedelta(seconds=1)
+    AUDIT_BUFFER_SIZE: int = 10_000
+    AUDIT_OVERFLOW_POLICY: OverflowPolicy = OverflowPolicy.Block
+    AUDIT_SAMPLE_RATE: float = 1.0
+    AUDIT_PAYLOAD_CACHE_SIZE: int = 100_000
+    AUDIT_PARTITIONS_AHEAD: int = 3
+    AUDIT_RETENTION: Optional[timedelta] = None
+    AUDIT_ARCHIVE_AFTER: Optional[timedelta] = None
+    AUDIT_ARCHIVE_DIR: str = "apdu-archive"
+    AUDIT_MAINTENANCE_INTERVAL: timedelta = timedelta(hours=1)
+
+    RELAY_MODE: RelayMode = RelayMode.Apdu
+    RELAY_TAP_RATE: float = 0.01
 
     DB_HOST: str = "localhost"
     DB_PORT: int = 5432
@@ -52,10 +74,19 @@ class Config:
     TUNNEL_PORT: int = 6666
     TUNNEL_CERT: str = "ssl/server.crt"
     TUNNEL_CERT_KEY: str = "ssl/server.key"
+    TUNNEL_WORKERS: int = 1
+    TLS_SESSION_TICKETS: int = 2
+    QUIC_PORT: Optional[int] = None
+    QUIC_ALLOW_WITHOUT_CLIENT_CERT: bool = False
 
     API_HOST: str = "localhost"
     API_PORT: int = 8000
     API_DOCUMENTATION: bool = False
+    API_ADMIN_USER: Optional[str] = None
+    API_ADMIN_PASSWORD: Optional[str] = None
+
+    METRICS_HOST: str = "localhost"
+    METRICS_PORT: Optional[int] = None
 
     LOGGING_CONF_FILE: Optional[str] = None
 
@@ -145,6 +176,8 @@ def _load_handler(
     match cls:
         case "moat-management":
             return MoatManagementAuth(cfg)
+        case "signed-token":
+            return SignedTokenAuth(cfg)
         case _:
             if not allow_plugins:
                 raise ConfigError(f'Unknown auth handler: "{cls}".')
@@ -196,13 +229,44 @@ def _load_toml_config(
         )
         _set(res, "TCP_KEEPALIVE", timeouts.get("keepalive"))
         _set(res, "MAX_PROBE_WAITTIME", timeouts.get("max_probe_wait"), _opt_td)
+        _set(res, "PING_INTERVAL", timeouts.get("ping_interval"), _opt_td)
+        _set(res, "PING_TIMEOUT", timeouts.get("ping_timeout"), _td)
 
     if isinstance(limits := cfg.get("limits"), dict):
         _set(res, "MAX_QUEUE_SIZE", limits.get("max_queue_size"))
+        _set(
+            res,
+            "MAX_QUEUE_SIZE_PER_PROBE",
+            limits.get("max_queue_size_per_probe"),
+            lambda x: None if x == "" else x,
+        )
+        _set(res, "MAX_MUX_STREAMS", limits.get("max_mux_streams"))
 
     if isinstance(gc := cfg.get("gc"), dict):
         _set(res, "GC_INTERVAL", gc.get("interval"), _td)
-        _set(res, "QUEUE_GC_INTERVAL", gc.get("queues_interval"), _td)
+
+    if isinstance(state := cfg.get("state"), dict):
+        _set(res, "STATE_SNAPSHOT_INTERVAL", state.get("snapshot_interval"), _td)
+
+    if isinstance(audit := cfg.get("audit"), dict):
+        _set(res, "AUDIT_BATCH_SIZE", audit.get("batch_size"))
+        _set(res, "AUDIT_FLUSH_INTERVAL", audit.get("flush_interval"), _td)
+        _set(res, "AUDIT_BUFFER_SIZE", audit.get("buffer_size"))
+        _set(res, "AUDIT_OVERFLOW_POLICY", audit.get("overflow"), OverflowPolicy)
+        _set(res, "AUDIT_SAMPLE_RATE", audit.get("sample_rate"), float)
+        _set(res, "AUDIT_PAYLOAD_CACHE_SIZE", audit.get("payload_cache_size"))
+        _set(res, "AUDIT_PARTITIONS_AHEAD", audit.get("partitions_ahead"))
+        _set(res, "AUDIT_RETENTION", audit.get("retention"), _opt_td)
+        _set(res, "AUDIT_ARCHIVE_AFTER", audit.get("archive_after"), _opt_td)
+        _set(res, "AUDIT_ARCHIVE_DIR", audit.get("archive_dir"))
+        _set(
+            res,
+            "AUDIT_MAINTENANCE_INTERVAL",
+            audit.get("maintenance_interval"),
+            _td,
+        )
+        _set(res, "RELAY_MODE", audit.get("unlogged_relay"), RelayMode)
+        _set(res, "RELAY_TAP_RATE", audit.get("tap_rate"), float)
 
     if isinstance(auth := cfg.get("auth"), dict):
         _set(
@@ -216,7 +280,25 @@ def _load_toml_config(
         _set(res, "TUNNEL_HOST", tunnel.get("host"), _str_list)
         _set(res, "TUNNEL_PORT", tunnel.get("port"))
         _set(res, "TUNNEL_CERT", tunnel.get("certificate"))
-        _set(res, "TUNNEL_CERT_key", tunnel.get("cert_key"))
+        _set(res, "TUNNEL_CERT_KEY", tunnel.get("cert_key"))
+        _set(res, "TUNNEL_WORKERS", tunnel.get("workers"))
+        _set(res, "TLS_SESSION_TICKETS", tunnel.get("session_tickets"))
+        _set(
+            res, "QUIC_PORT", tunnel.get("quic_port"), lambda x: None if x == "" else x
+        )
+        _set(
+            res,
+            "QUIC_ALLOW_WITHOUT_CLIENT_CERT",
+            tunnel.get("quic_allow_without_client_cert"),
+        )
+
+    if isinstance(api := cfg.get("api"), dict):
+        _set(res, "API_ADMIN_USER", api.get("admin_user"), _opt_str)
+        _set(res, "API_ADMIN_PASSWORD", api.get("admin_password"), _opt_str)
+
+    if isinstance(metrics := cfg.get("metrics"), dict):
+        _set(res, "METRICS_HOST", metrics.get("host"))
+        _set(res, "METRICS_PORT", metrics.get("port"), lambda x: None if x == "" else x)
 
     if isinstance(logging := cfg.get("logging"), dict):
         _set(res, "LOGGING_CONF_FILE", logging.get("config_file"), _opt_str)
@@ -321,6 +403,12 @@ def init_config(
         if cmd_args.cert_key is not None:
             conf["TUNNEL_CERT_KEY"] = cmd_args.cert_key
 
+        if cmd_args.workers is not None:
+            conf["TUNNEL_WORKERS"] = cmd_args.workers
+
+        if cmd_args.session_tickets is not None:
+            conf["TLS_SESSION_TICKETS"] = cmd_args.session_tickets
+
     try:
         _CONFIG = Config(**conf)
     except TypeError as e:
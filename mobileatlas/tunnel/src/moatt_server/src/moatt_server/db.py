@@ -1,9 +1,13 @@
+import datetime
 import logging
+from collections.abc import AsyncIterator, Sequence
 from dataclasses import dataclass
+from typing import Any, Optional
 from uuid import UUID
 
-from moatt_types.connect import ApduPacket, Token
-from sqlalchemy.ext.asyncio import AsyncSession
+from moatt_types.connect import Token
+from sqlalchemy import Row, Select, func, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
 
 from . import models as dbm
 from .config import get_config
@@ -11,44 +15,29 @@ from .config import get_config
 LOGGER = logging.getLogger(__name__)
 
 
-@dataclass
-class SimId:
-    id: int
-    iccid: str | None = None
-    imsi: str | None = None
-
-
-async def mark_provider_available(session: AsyncSession, provider_id: UUID) -> None:
-    prov = await session.get(dbm.Provider, provider_id)
-
-    assert prov is not None
-
-    prov.available += 1
-
-
-async def mark_provider_unavailable(session: AsyncSession, provider_id: UUID) -> None:
-    prov = await session.get(dbm.Provider, provider_id)
-
-    assert prov is not None
-
-    prov.available -= 1
-
-
-async def sim_used(session: AsyncSession, provider_id: UUID, sim_id: int) -> None:
-    sim = await session.get(dbm.Sim, {"id": sim_id, "provider_id": provider_id})
-
-    assert sim is not None, "Handler uses nonexistant SIM"
+# columns added after their tables were first created (create_all only creates
+# missing tables)
+_ADDED_COLUMNS = [
+    (dbm.Provider.__tablename__, "sims_version integer NOT NULL DEFAULT 0"),
+]
 
-    sim.in_use = True
 
+async def add_missing_columns(conn: AsyncConnection) -> None:
+    """Add columns that tables created by older versions lack.
 
-async def sim_unused(session: AsyncSession, provider_id: UUID, sim_id: int) -> None:
-    sim = await session.get(dbm.Sim, {"id": sim_id, "provider_id": provider_id})
+    Has to run after the tables are created.
+    """
+    for table, column in _ADDED_COLUMNS:
+        await conn.execute(
+            text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}")
+        )
 
-    if sim is None:
-        return
 
-    sim.in_use = False
+@dataclass
+class SimId:
+    id: int
+    iccid: str | None = None
+    imsi: str | None = None
 
 
 async def get_sim_ids(
@@ -73,23 +62,146 @@ async def get_sim_ids(
     return list(map(lambda s: (s.id, s.iccid, s.imsi), sims))
 
 
-async def log_apdu(
-    session: AsyncSession,
-    provider_id: UUID,
-    probe_id: UUID,
-    sim_id: SimId,
-    apdu: ApduPacket,
-    sender: dbm.Sender,
-) -> dbm.ApduLog:
-    apdu_log = dbm.ApduLog(
-        provider_id=provider_id,
-        probe_id=probe_id,
-        sim_id=sim_id.id,
-        sim_iccid=sim_id.iccid,
-        sim_imsi=sim_id.imsi,
-        command=apdu.op,
-        payload=apdu.payload,
-        sender=sender,
+@dataclass
+class TunnelSessionFilter:
+    provider_id: Optional[UUID] = None
+    probe_id: Optional[UUID] = None
+    sim_id: Optional[int] = None
+    iccid: Optional[str] = None
+    since: Optional[datetime.datetime] = None  # inclusive
+    until: Optional[datetime.datetime] = None  # exclusive
+
+    def apply(self, stmt: Select) -> Select:
+        ts = dbm.TunnelSession
+
+        if self.provider_id is not None:
+            stmt = stmt.where(ts.provider_id == self.provider_id)
+        if self.probe_id is not None:
+            stmt = stmt.where(ts.probe_id == self.probe_id)
+        if self.sim_id is not None:
+            stmt = stmt.where(ts.sim_id == self.sim_id)
+        if self.iccid is not None:
+            stmt = stmt.where(ts.sim_iccid == self.iccid)
+        if self.since is not None:
+            stmt = stmt.where(ts.started >= self.since)
+        if self.until is not None:
+            stmt = stmt.where(ts.started < self.until)
+
+        return stmt
+
+
+@dataclass
+class ApduLogFilter:
+    provider_id: Optional[UUID] = None
+    probe_id: Optional[UUID] = None
+    sim_id: Optional[int] = None
+    iccid: Optional[str] = None
+    since: Optional[datetime.datetime] = None  # inclusive
+    until: Optional[datetime.datetime] = None  # exclusive
+
+    @classmethod
+    def of_session(cls, ts: dbm.TunnelSession) -> "ApduLogFilter":
+        """Filter matching the APDUs of a tunnel session."""
+        return cls(
+            provider_id=ts.provider_id,
+            probe_id=ts.probe_id,
+            sim_id=ts.sim_id,
+            since=ts.started,
+            until=ts.ended,
+        )
+
+    def apply(self, stmt: Select) -> Select:
+        log = dbm.ApduLog
+
+        if self.provider_id is not None:
+            stmt = stmt.where(log.provider_id == self.provider_id)
+        if self.probe_id is not None:
+            stmt = stmt.where(log.probe_id == self.probe_id)
+        if self.sim_id is not None:
+            stmt = stmt.where(log.sim_id == self.sim_id)
+        if self.iccid is not None:
+            stmt = stmt.where(log.sim_iccid == self.iccid)
+        if self.since is not None:
+            stmt = stmt.where(log.timestamp >= self.since)
+        if self.until is not None:
+            stmt = stmt.where(log.timestamp < self.until)
+
+        return stmt
+
+
+async def stream_apdu_log(
+    session: AsyncSession, filter: ApduLogFilter, batch_size: int
+) -> AsyncIterator[Sequence[Row]]:
+    """APDU log entries matching `filter` in batches, ordered by time.
+
+    The rows are fetched with a server-side cursor, so only one batch is held in
+    memory at a time; `session` has to be in a transaction.
+    """
+    log = dbm.ApduLog
+    p = dbm.ApduPayload
+    stmt = filter.apply(
+        select(
+            log.id,
+            log.timestamp,
+            log.provider_id,
+            log.probe_id,
+            log.sim_id,
+            log.sim_iccid,
+            log.sim_imsi,
+            log.command,
+            func.coalesce(log.inline_payload, p.payload).label("payload"),
+            log.sender,
+        )
+        .outerjoin(p, p.hash == log.payload_hash)
+        .order_by(log.timestamp, log.id)
+    )
+
+    result = await session.stream(stmt.execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+
+async def get_tunnel_sessions(
+    session: AsyncSession, filter: TunnelSessionFilter, limit: int
+) -> Sequence[dbm.TunnelSession]:
+    """The latest `limit` sessions matching `filter`, most recent first."""
+    ts = dbm.TunnelSession
+    stmt = (
+        filter.apply(select(ts)).order_by(ts.started.desc(), ts.id.desc()).limit(limit)
+    )
+
+    return (await session.scalars(stmt)).all()
+
+
+async def get_tunnel_session(
+    session: AsyncSession, id: int
+) -> Optional[dbm.TunnelSession]:
+    return await session.get(dbm.TunnelSession, id)
+
+
+async def tunnel_session_summary(
+    session: AsyncSession, filter: TunnelSessionFilter
+) -> dict[str, Any]:
+    ts = dbm.TunnelSession
+    duration = func.extract("epoch", ts.ended - ts.started)
+
+    def median(col):
+        return func.percentile_cont(0.5).within_group(col)
+
+    stmt = filter.apply(
+        select(
+            func.count().label("sessions"),
+            func.avg(duration).label("duration_avg"),
+            median(duration).label("duration_p50"),
+            func.percentile_cont(0.9).within_group(duration).label("duration_p90"),
+            func.avg(ts.queue_wait).label("queue_wait_avg"),
+            func.sum(ts.probe_apdus).label("probe_apdus"),
+            func.sum(ts.provider_apdus).label("provider_apdus"),
+            func.sum(ts.probe_bytes).label("probe_bytes"),
+            func.sum(ts.provider_bytes).label("provider_bytes"),
+            median(ts.rtt_p50).label("rtt_p50_median"),
+            median(ts.rtt_p99).label("rtt_p99_median"),
+        ).select_from(ts)
     )
-    session.add(apdu_log)
-    return apdu_log
+
+    return dict((await session.execute(stmt)).one()._mapping)
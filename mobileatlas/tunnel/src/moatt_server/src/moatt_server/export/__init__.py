@@ -0,0 +1,60 @@
+"""Streaming export of the APDU log.
+
+Rows are read with a server-side cursor and encoded batch by batch, so the memory
+needed for an export does not depend on its size.
+"""
+
+import asyncio
+import enum
+from collections.abc import AsyncIterator, Callable, Sequence
+from typing import Protocol
+
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import db, metrics
+
+# number of rows fetched from the database at once
+BATCH_SIZE = 10_000
+
+EXPORTED_ROWS = metrics.Counter(
+    "moatt_export_rows_total", "Number of exported APDU log entries.", ["format"]
+)
+
+
+@enum.unique
+class ExportFormat(enum.Enum):
+    Pcap = "pcap"
+    Arrow = "arrow"
+
+
+class Encoder(Protocol):
+    media_type: str
+    extension: str
+
+    def start(self) -> bytes: ...
+
+    def encode(self, rows: Sequence[Row]) -> bytes: ...
+
+    def finish(self) -> bytes: ...
+
+
+async def export(
+    new_session: Callable[[], AsyncSession],
+    filter: db.ApduLogFilter,
+    encoder: Encoder,
+    format: ExportFormat,
+) -> AsyncIterator[bytes]:
+    exported = EXPORTED_ROWS.labels(format.value)
+
+    yield encoder.start()
+
+    async with new_session() as session, session.begin():
+        async for rows in db.stream_apdu_log(session, filter, BATCH_SIZE):
+            # encoding (and compressing) a batch takes a while
+            data = await asyncio.to_thread(encoder.encode, rows)
+            exported.inc(len(rows))
+            if len(data) > 0:
+                yield data
+
+    yield encoder.finish()
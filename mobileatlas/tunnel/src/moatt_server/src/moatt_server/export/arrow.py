@@ -0,0 +1,88 @@
+"""Apache Arrow IPC streams of the APDU log (requires the optional pyarrow dependency).
+
+The stream can be read with pyarrow (`pyarrow.ipc.open_stream`), pandas, polars or
+DuckDB. Record batches are compressed with zstd; UUIDs are stored as 16 bytes and
+commands and senders are dictionary encoded.
+"""
+
+import io
+from collections.abc import Sequence
+
+import pyarrow as pa
+from moatt_types.connect import ApduOp
+from sqlalchemy import Row
+
+from .. import models as dbm
+
+_OPS = list(ApduOp)
+_SENDERS = list(dbm.Sender)
+_OP_INDEX = {op: i for i, op in enumerate(_OPS)}
+_SENDER_INDEX = {s: i for i, s in enumerate(_SENDERS)}
+
+_OP_NAMES = pa.array([op.name for op in _OPS])
+_SENDER_NAMES = pa.array([s.name for s in _SENDERS])
+
+SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("timestamp", pa.timestamp("us", tz="UTC")),
+        ("provider_id", pa.binary(16)),
+        ("probe_id", pa.binary(16)),
+        ("sim_id", pa.int32()),
+        ("sim_iccid", pa.string()),
+        ("sim_imsi", pa.string()),
+        ("command", pa.dictionary(pa.int8(), pa.string())),
+        ("payload", pa.binary()),
+        ("sender", pa.dictionary(pa.int8(), pa.string())),
+    ]
+)
+
+
+class ArrowEncoder:
+    media_type = "application/vnd.apache.arrow.stream"
+    extension = "arrows"
+
+    def __init__(self):
+        self._sink = io.BytesIO()
+        self._writer = pa.ipc.new_stream(
+            self._sink, SCHEMA, options=pa.ipc.IpcWriteOptions(compression="zstd")
+        )
+
+    def start(self) -> bytes:
+        return self._take()
+
+    def encode(self, rows: Sequence[Row]) -> bytes:
+        batch = pa.record_batch(
+            [
+                pa.array([r.id for r in rows], pa.int64()),
+                pa.array([r.timestamp for r in rows], SCHEMA.field("timestamp").type),
+                pa.array([r.provider_id.bytes for r in rows], pa.binary(16)),
+                pa.array([r.probe_id.bytes for r in rows], pa.binary(16)),
+                pa.array([r.sim_id for r in rows], pa.int32()),
+                pa.array([r.sim_iccid for r in rows], pa.string()),
+                pa.array([r.sim_imsi for r in rows], pa.string()),
+                pa.DictionaryArray.from_arrays(
+                    pa.array([_OP_INDEX[r.command] for r in rows], pa.int8()),
+                    _OP_NAMES,
+                ),
+                pa.array([r.payload for r in rows], pa.binary()),
+                pa.DictionaryArray.from_arrays(
+                    pa.array([_SENDER_INDEX[r.sender] for r in rows], pa.int8()),
+                    _SENDER_NAMES,
+                ),
+            ],
+            schema=SCHEMA,
+        )
+        self._writer.write_batch(batch)
+
+        return self._take()
+
+    def finish(self) -> bytes:
+        self._writer.close()
+        return self._take()
+
+    def _take(self) -> bytes:
+        data = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return data
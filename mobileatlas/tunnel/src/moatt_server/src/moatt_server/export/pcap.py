@@ -0,0 +1,130 @@
+"""pcap files of GSMTAP-encapsulated APDUs, as written by SIMtrace.
+
+Every packet is an IPv4/UDP datagram to the GSMTAP port carrying a command APDU
+followed by the response of the provider, which is how Wireshark's ISO 7816
+dissector expects them. Commands without a response (and responses without a
+command) are written on their own; other packets (Reset, Ping, Pong) are skipped.
+Like SIMtrace, packets carry the time the response was logged, which keeps the
+packets of concurrent sessions in order.
+"""
+
+import datetime
+import struct
+from collections.abc import Sequence
+from uuid import UUID
+
+from moatt_types.connect import ApduOp
+from sqlalchemy import Row
+
+from .. import models as dbm
+
+LINKTYPE_IPV4 = 228
+GSMTAP_PORT = 4729
+GSMTAP_TYPE_SIM = 0x04
+GSMTAP_SIM_APDU = 0x00
+
+_PCAP_HEADER = struct.Struct("<IHHiIII")
+_RECORD_HEADER = struct.Struct("<IIII")
+_IP_HEADER = struct.Struct("!BBHHHBBH4s4s")
+_UDP_HEADER = struct.Struct("!HHHH")
+_GSMTAP_HEADER = struct.Struct("!BBBBHbbIBBBB")
+
+_HEADERS_LEN = _IP_HEADER.size + _UDP_HEADER.size + _GSMTAP_HEADER.size
+MAX_PAYLOAD_LEN = 0xFFFF - _HEADERS_LEN
+
+_LOCALHOST = bytes([127, 0, 0, 1])
+
+
+class PcapEncoder:
+    media_type = "application/vnd.tcpdump.pcap"
+    extension = "pcap"
+
+    def __init__(self):
+        # last command of every session that has not been answered yet
+        self._commands: dict[
+            tuple[UUID, UUID, int], tuple[datetime.datetime, bytes]
+        ] = {}
+
+    def start(self) -> bytes:
+        return _PCAP_HEADER.pack(0xA1B2C3D4, 2, 4, 0, 0, 0xFFFF, LINKTYPE_IPV4)
+
+    def encode(self, rows: Sequence[Row]) -> bytes:
+        out = bytearray()
+
+        for row in rows:
+            key = (row.provider_id, row.probe_id, row.sim_id)
+
+            if row.command == ApduOp.Reset:
+                out += self._unanswered(key)
+            if row.command != ApduOp.Apdu or row.payload is None:
+                continue
+
+            if row.sender == dbm.Sender.Probe:
+                out += self._unanswered(key)
+                self._commands[key] = (row.timestamp, row.payload)
+                continue
+
+            command = self._commands.pop(key, None)
+            if command is None:
+                out += _record(row.timestamp, row.payload)
+            elif len(command[1]) + len(row.payload) > MAX_PAYLOAD_LEN:
+                out += _record(*command)
+                out += _record(row.timestamp, row.payload)
+            else:
+                out += _record(row.timestamp, command[1] + row.payload)
+
+        return bytes(out)
+
+    def finish(self) -> bytes:
+        out = bytearray()
+        for ts, command in sorted(self._commands.values(), key=lambda c: c[0]):
+            out += _record(ts, command)
+        self._commands.clear()
+
+        return bytes(out)
+
+    def _unanswered(self, key: tuple[UUID, UUID, int]) -> bytes:
+        command = self._commands.pop(key, None)
+        return _record(*command) if command is not None else b""
+
+
+def _record(ts: datetime.datetime, apdu: bytes) -> bytes:
+    packet = _packet(apdu)
+    sec = int(ts.timestamp())
+    return _RECORD_HEADER.pack(sec, ts.microsecond, len(packet), len(packet)) + packet
+
+
+def _packet(apdu: bytes) -> bytes:
+    apdu = apdu[:MAX_PAYLOAD_LEN]
+
+    gsmtap = _GSMTAP_HEADER.pack(
+        2,  # version
+        _GSMTAP_HEADER.size // 4,
+        GSMTAP_TYPE_SIM,
+        0,
+        0,
+        0,
+        0,
+        0,
+        GSMTAP_SIM_APDU,
+        0,
+        0,
+        0,
+    )
+    udp_len = _UDP_HEADER.size + len(gsmtap) + len(apdu)
+    udp = _UDP_HEADER.pack(GSMTAP_PORT, GSMTAP_PORT, udp_len, 0)
+
+    total_len = _IP_HEADER.size + udp_len
+    ip = _IP_HEADER.pack(
+        0x45, 0, total_len, 0, 0x4000, 64, 17, 0, _LOCALHOST, _LOCALHOST
+    )
+    ip = ip[:10] + _checksum(ip).to_bytes(2, "big") + ip[12:]
+
+    return ip + udp + gsmtap + apdu
+
+
+def _checksum(header: bytes) -> int:
+    s = sum(struct.unpack(f"!{len(header) // 2}H", header))
+    while s > 0xFFFF:
+        s = (s & 0xFFFF) + (s >> 16)
+    return ~s & 0xFFFF
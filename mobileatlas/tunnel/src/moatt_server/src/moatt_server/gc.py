@@ -4,12 +4,14 @@ import traceback
 from collections.abc import Awaitable, Callable
 from datetime import timedelta
 
+from . import timers
+
 logger = logging.getLogger(__name__)
 
 
 async def gc(coros: list[Callable[[], Awaitable[None]]], interval: timedelta):
     while True:
-        await asyncio.sleep(interval.total_seconds())
+        await timers.wheel().sleep(interval.total_seconds())
         try:
             logger.debug("Starting GC tasks")
             res = await asyncio.gather(
@@ -0,0 +1,6 @@
+"""Microbenchmarks of single components of the tunnel server.
+
+Unlike the load generator, they need neither a database nor a running server, so
+they can be re-run quickly to compare commits (`python -m
+moatt_server.loadgen.bench`).
+"""
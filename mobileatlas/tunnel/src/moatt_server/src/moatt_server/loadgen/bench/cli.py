@@ -0,0 +1,60 @@
+import argparse
+import json
+import logging
+import sys
+import time
+from collections.abc import Callable
+from typing import Any
+
+from .. import stats
+from . import codec, connection_queue, relay, sim_directory
+
+LOGGER = logging.getLogger(__name__)
+
+BENCHMARKS: dict[str, Callable[[], dict[str, Any]]] = {
+    "relay": relay.run,
+    "codec": codec.run,
+    "sim_directory": sim_directory.run,
+    "connection_queue": connection_queue.run,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run microbenchmarks of the tunnel server's components."
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="BENCHMARK",
+        help=f"Benchmarks to run ({', '.join(BENCHMARKS)}; default: all).",
+    )
+    parser.add_argument("--output", "-o", help="Write results to file (JSON).")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark: {name}")
+
+    # the components log every connection
+    logging.basicConfig(level=logging.WARNING)
+    LOGGER.setLevel(logging.INFO)
+
+    results = {"version": 1, **stats.environment(), "benchmarks": {}}
+
+    for name in args.benchmarks or BENCHMARKS:
+        LOGGER.info("Running benchmark: %s", name)
+        start = time.perf_counter()
+        results["benchmarks"][name] = BENCHMARKS[name]()
+        LOGGER.info("Finished %s in %.1fs.", name, time.perf_counter() - start)
+
+    out = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
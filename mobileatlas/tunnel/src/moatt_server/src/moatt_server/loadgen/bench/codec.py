@@ -0,0 +1,95 @@
+"""Messages per second encoded and decoded by the protocol codecs.
+
+Decoding walks a buffer of consecutive messages with `decode_from`, the way the
+tunnel server and the clients read from their receive buffers. Every
+measurement is the best of `REPEAT` runs.
+"""
+
+import time
+import uuid
+from collections.abc import Callable
+from typing import Any
+
+from moatt_types.connect import (
+    ApduOp,
+    ApduPacket,
+    AuthRequest,
+    AuthRequestFlags,
+    AuthResponse,
+    AuthStatus,
+    AuthType,
+    Buffer,
+    ConnectRequest,
+    ConnectResponse,
+    ConnectStatus,
+    Iccid,
+    Imsi,
+    MuxFrame,
+    MuxFrameType,
+    SimId,
+    SimIndex,
+    Token,
+    VersionRequest,
+    VersionResponse,
+)
+
+MESSAGES = 50_000
+REPEAT = 3
+APDU_SIZE = 64
+
+_PROVIDER = uuid.uuid4()
+
+SAMPLES: dict[str, Any] = {
+    "auth_request": AuthRequest(
+        AuthType.Probe, Token(bytes(16)), AuthRequestFlags.PIPELINED
+    ),
+    "auth_response": AuthResponse(AuthStatus.Success),
+    "connect_request_id": ConnectRequest(SimId(_PROVIDER, 1)),
+    "connect_request_index": ConnectRequest(SimIndex(_PROVIDER, 1)),
+    "connect_request_iccid": ConnectRequest(Iccid("89430000000000000001")),
+    "connect_request_imsi": ConnectRequest(Imsi("232010000000001")),
+    "connect_response": ConnectResponse(ConnectStatus.Success),
+    "apdu": ApduPacket(ApduOp.Apdu, bytes(APDU_SIZE)),
+    "ping": ApduPacket(ApduOp.Ping, bytes(ApduPacket.PING_TOKEN_LEN)),
+    "pong": ApduPacket.pong(
+        ApduPacket(ApduOp.Ping, bytes(ApduPacket.PING_TOKEN_LEN)), 0.001
+    ),
+    "version_request": VersionRequest(1, 2),
+    "version_response": VersionResponse(2),
+    "mux_data": MuxFrame(1, MuxFrameType.Data, bytes(APDU_SIZE)),
+    "mux_window_update": MuxFrame.window_update(1, 2**16),
+}
+
+
+def run() -> dict[str, Any]:
+    return {name: _measure(msg) for name, msg in SAMPLES.items()}
+
+
+def _measure(msg: Any) -> dict[str, float]:
+    decode_from: Callable[[Buffer, int], tuple[Any, int]] = type(msg).decode_from
+    buf = msg.encode() * MESSAGES
+
+    def encode():
+        for _ in range(MESSAGES):
+            msg.encode()
+
+    def decode():
+        offset = 0
+        while offset < len(buf):
+            _, n = decode_from(buf, offset)
+            offset += n
+
+    return {
+        "encoded_per_second": MESSAGES / _best(encode),
+        "decoded_per_second": MESSAGES / _best(decode),
+    }
+
+
+def _best(f: Callable[[], None]) -> float:
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
@@ -0,0 +1,113 @@
+"""Throughput of a provider's connection queue with many waiting probes.
+
+`ENTRIES` requests of `PROBES` probes are queued and then either all handed to
+the provider, mostly removed because their probes disconnected (leaving marked
+entries in the heap) or expired by advancing the timer wheel.
+"""
+
+import asyncio
+import time
+import uuid
+from datetime import timedelta
+from typing import Any
+
+import uvloop
+from moatt_types.connect import ConnectRequest, SimId
+
+from ... import config, timers
+from ...config import Config
+from ...sim_directory import SimEntry
+from ...tunnel.connection_queue import Queue, QueueEntry
+from ..stub_auth import StubAuth
+
+PROBES = 1_000
+ENTRIES = 20_000
+WAIT = timedelta(minutes=5)
+
+
+class _Writer:
+    def __init__(self):
+        self.closed = False
+
+    def write(self, data: bytes) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+
+def run() -> dict[str, Any]:
+    # queues read the expiry of requests from the process-wide config
+    config._CONFIG = Config(
+        DB_USER="",
+        DB_PASSWORD="",
+        DB_NAME="",
+        AUTH_HANDLER=StubAuth(None),
+        MAX_PROBE_WAITTIME=WAIT,
+    )
+
+    return uvloop.run(_run())
+
+
+async def _run() -> dict[str, Any]:
+    sim = SimEntry(1, None, None, uuid.uuid4())
+    probes = [uuid.uuid4() for _ in range(PROBES)]
+    con_req = ConnectRequest(SimId(sim.provider_id, sim.id))
+
+    def entries() -> list[QueueEntry]:
+        return [
+            QueueEntry(
+                sim,
+                probes[i % PROBES],
+                con_req,
+                asyncio.StreamReader(),
+                _Writer(),  # type: ignore
+            )
+            for i in range(ENTRIES)
+        ]
+
+    def fill(q: Queue, es: list[QueueEntry]) -> float:
+        start = time.perf_counter()
+        for e in es:
+            q.put_nowait(e)
+        return time.perf_counter() - start
+
+    res: dict[str, Any] = {}
+
+    q = Queue(ENTRIES)
+    put = fill(q, entries())
+    start = time.perf_counter()
+    while not q.empty():
+        await q.get()
+    res["puts_per_second"] = ENTRIES / put
+    res["gets_per_second"] = ENTRIES / (time.perf_counter() - start)
+
+    q = Queue(ENTRIES)
+    es = entries()
+    fill(q, es)
+    removed = es[: -ENTRIES // 10]
+    left = len(es) - len(removed)
+    start = time.perf_counter()
+    for e in removed:
+        q.remove(e)
+    # let the cancelled watches of the removed entries finish
+    await asyncio.sleep(0)
+    t = time.perf_counter()
+    while not q.empty():
+        await q.get()
+    res["removals_per_second"] = len(removed) / (t - start)
+    # the entries left have to be found among the removed ones
+    res["gets_after_removals_per_second"] = left / (time.perf_counter() - t)
+
+    q = Queue(ENTRIES)
+    fill(q, entries())
+    wheel = timers.wheel()
+    start = time.perf_counter()
+    wheel.advance(asyncio.get_running_loop().time() + 2 * WAIT.total_seconds())
+    assert q.empty()
+    res["expiries_per_second"] = ENTRIES / (time.perf_counter() - start)
+
+    return res
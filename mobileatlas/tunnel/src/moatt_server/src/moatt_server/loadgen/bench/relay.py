@@ -0,0 +1,137 @@
+"""APDUs relayed per second and the latency the relay adds to a tunnel.
+
+Both ends of the tunnel are connected to the relay with socket pairs (no TLS) and
+APDUs are not logged. The provider echoes every APDU of the probe, which sends
+the next APDU once it received the response. The added latency is the difference
+to the round-trip times of a probe that is directly connected to the provider.
+"""
+
+import asyncio
+import socket
+import time
+import uuid
+from typing import Any
+
+import uvloop
+from moatt_types.connect import ApduOp, ApduPacket
+
+from ...audit import AuditLog
+from ...config import Config
+from ...sim_directory import SimEntry
+from ...state import StateStore
+from ...tunnel.apdu_stream import ApduStream
+from ...tunnel.provider_handler import ProviderHandler
+from ...tunnel.relay import RelayMode
+from ...tunnel.session_stats import SessionLog, SessionStats
+from .. import stats
+from ..stub_auth import StubAuth
+
+ROUND_TRIPS = 20_000
+APDU_SIZE = 64
+
+
+def run() -> dict[str, Any]:
+    direct = uvloop.run(_direct(ROUND_TRIPS, APDU_SIZE))
+    res: dict[str, Any] = {"direct": direct}
+
+    for mode in RelayMode:
+        r = res[mode.value] = uvloop.run(_tunnel(mode, ROUND_TRIPS, APDU_SIZE))
+        r["added_latency"] = {p: r["rtt"][p] - direct["rtt"][p] for p in ("p50", "p99")}
+
+    return res
+
+
+async def _direct(round_trips: int, apdu_size: int) -> dict[str, Any]:
+    a, b = socket.socketpair()
+    probe_end = await asyncio.open_connection(sock=a)
+    echo = asyncio.create_task(_echo(*await asyncio.open_connection(sock=b)))
+
+    res = await _exchange(*probe_end, round_trips, apdu_size)
+    await echo
+
+    return res
+
+
+async def _tunnel(mode: RelayMode, round_trips: int, apdu_size: int) -> dict[str, Any]:
+    config = Config(
+        DB_USER="",
+        DB_PASSWORD="",
+        DB_NAME="",
+        AUTH_HANDLER=StubAuth(None),
+        PING_INTERVAL=None,
+        RELAY_MODE=mode,
+        RELAY_TAP_RATE=0,
+    )
+    audit_log = AuditLog(None, sample_rate=0)  # type: ignore
+    handler = ProviderHandler(
+        config, None, audit_log, SessionLog(None), StateStore()  # type: ignore
+    )
+
+    sim = SimEntry(1, None, None, uuid.uuid4())
+    probe_id = uuid.uuid4()
+    probe, probe_end = await _connect(sim, probe_id, "probe")
+    provider, provider_end = await _connect(sim, sim.provider_id, "provider")
+
+    tunnel = asyncio.create_task(
+        handler.handle_established_connection(
+            probe,
+            provider,
+            audit_log.session(sim.provider_id, probe_id, sim.id),  # type: ignore
+            SessionStats(0),
+        )
+    )
+    echo = asyncio.create_task(_echo(*provider_end))
+
+    res = await _exchange(*probe_end, round_trips, apdu_size)
+    await tunnel
+    await echo
+
+    return res
+
+
+async def _exchange(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    round_trips: int,
+    apdu_size: int,
+) -> dict[str, Any]:
+    """Send APDUs one at a time and wait for their echo; closes the connection."""
+    apdu = ApduPacket(ApduOp.Apdu, bytes(apdu_size)).encode()
+    rtts = []
+    start = time.perf_counter()
+    for _ in range(round_trips):
+        t = time.perf_counter()
+        writer.write(apdu)
+        await reader.readexactly(len(apdu))
+        rtts.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+
+    writer.close()
+
+    return {
+        "apdus_per_second": 2 * round_trips / elapsed,
+        "rtt": stats.summary(rtts),
+    }
+
+
+async def _connect(
+    sim: SimEntry, client_id: uuid.UUID, role: str
+) -> tuple[ApduStream, tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+    """Connect a client to the relay; returns the relay's and the client's end."""
+    a, b = socket.socketpair()
+    reader, writer = await asyncio.open_connection(sock=a)
+    return ApduStream(sim, client_id, reader, writer, role), (
+        await asyncio.open_connection(sock=b)
+    )
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while True:
+            header = await reader.readexactly(ApduPacket.HEADER_LEN)
+            _, plen = ApduPacket.decode_header(header)
+            writer.write(header + await reader.readexactly(plen))
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,78 @@
+"""Lookups and updates of the in-memory SIM directory at full scale.
+
+The directory is filled with `PROVIDERS` providers with `SIMS` SIM cards each
+(1M in total). Lookups use random identifiers of every type, a tenth of which
+are not registered.
+"""
+
+import random
+import time
+import uuid
+from typing import Any
+
+from moatt_types.connect import Iccid, Imsi, SimId, SimIndex
+
+from ...sim_directory import SimDirectory, SimEntry
+
+PROVIDERS = 10_000
+SIMS = 100  # per provider
+LOOKUPS = 200_000
+REPLACEMENTS = 1_000
+
+
+def run() -> dict[str, Any]:
+    rng = random.Random(0)
+    providers = [uuid.UUID(int=rng.getrandbits(128)) for _ in range(PROVIDERS)]
+    registrations = {p: _sims(p, i) for i, p in enumerate(providers)}
+
+    directory = SimDirectory()
+    start = time.perf_counter()
+    for p, sims in registrations.items():
+        directory.replace_provider(p, sims)
+    filled = time.perf_counter() - start
+
+    res: dict[str, Any] = {
+        "sims": len(directory),
+        "fill_seconds": filled,
+        "lookups_per_second": {},
+    }
+
+    for name, identifier in [
+        ("id", lambda p, n, i: SimId(p, n)),
+        ("iccid", lambda p, n, i: Iccid(f"8943{n:016}")),
+        ("imsi", lambda p, n, i: Imsi(f"23201{n:010}")),
+        ("index", lambda p, n, i: SimIndex(p, i)),
+    ]:
+        identifiers = [identifier(*_target(rng, providers)) for _ in range(LOOKUPS)]
+
+        start = time.perf_counter()
+        for i in identifiers:
+            directory.get(i)
+        res["lookups_per_second"][name] = LOOKUPS / (time.perf_counter() - start)
+
+    replaced = rng.sample(providers, REPLACEMENTS)
+    start = time.perf_counter()
+    for p in replaced:
+        directory.replace_provider(p, registrations[p])
+    res["replacements_per_second"] = REPLACEMENTS / (time.perf_counter() - start)
+
+    return res
+
+
+def _sims(provider_id: uuid.UUID, index: int) -> list[SimEntry]:
+    return [
+        SimEntry(n, f"8943{n:016}", f"23201{n:010}", provider_id)
+        for n in range(index * SIMS, (index + 1) * SIMS)
+    ]
+
+
+def _target(
+    rng: random.Random, providers: list[uuid.UUID]
+) -> tuple[uuid.UUID, int, int]:
+    """Random provider, SIM ID and index of the SIM among the provider's SIMs."""
+    p = rng.randrange(PROVIDERS)
+    # unregistered SIM
+    i = rng.randrange(SIMS) if rng.random() >= 0.1 else SIMS + rng.randrange(SIMS)
+    n = p * SIMS + i if i < SIMS else PROVIDERS * SIMS + rng.randrange(PROVIDERS * SIMS)
+
+    return providers[p], n, i
@@ -0,0 +1,423 @@
+import argparse
+import asyncio
+import dataclasses
+import datetime
+import json
+import logging
+import multiprocessing
+import resource
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import tomllib
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import uvloop
+from moatt_types.connect import SimId
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from .. import config, db
+from .. import models as dbm
+from . import clients, stats, traces
+
+LOGGER = logging.getLogger(__name__)
+
+STUB_AUTH_HANDLER = "moatt_server.loadgen.stub_auth:StubAuth"
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    providers: int
+    sims: int  # per provider; one provider connection is kept open per SIM
+    probes: int  # concurrently running probes
+    sessions: int  # tunnel sessions per probe
+    repeat: int = 1  # number of times the trace is replayed per session
+    think_time: float = 0  # seconds between two APDUs of a probe
+    trace: str = "attach"
+    workers: int = 1
+    pipelined: bool = False  # probes send AuthRequest and ConnectRequest at once
+    transport: str = "tcp"  # tcp, tls (TLS over TCP) or quic
+    resumption: bool = True  # resume TLS sessions (0-RTT for QUIC)
+    relay: str = "apdu"  # apdu or passthrough (unlogged sessions relayed as raw data)
+
+
+SCENARIOS = {
+    s.name: s
+    for s in [
+        Scenario("smoke", providers=2, sims=2, probes=10, sessions=2),
+        Scenario("connect-storm", providers=100, sims=10, probes=2000, sessions=3),
+        Scenario("relay", providers=50, sims=4, probes=200, sessions=1, repeat=50),
+    ]
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic load against a local tunnel server."
+    )
+    parser.add_argument(
+        "--config",
+        required=True,
+        help="Tunnel server config file; only the database settings are used.",
+    )
+    parser.add_argument(
+        "--scenario",
+        "-s",
+        action="append",
+        choices=SCENARIOS.keys(),
+        help="Scenario to run (can be given multiple times; default: smoke).",
+    )
+    parser.add_argument("--providers", type=int)
+    parser.add_argument("--sims", type=int)
+    parser.add_argument("--probes", type=int)
+    parser.add_argument("--sessions", type=int)
+    parser.add_argument("--repeat", type=int)
+    parser.add_argument("--think-time", type=float)
+    parser.add_argument(
+        "--trace", help=f"Built-in trace ({', '.join(traces.TRACES)}) or JSON file."
+    )
+    parser.add_argument("--workers", "-w", type=int)
+    parser.add_argument(
+        "--pipelined",
+        action="store_const",
+        const=True,
+        help="Probes use the pipelined handshake.",
+    )
+    parser.add_argument(
+        "--transport",
+        choices=["tcp", "tls", "quic"],
+        help="How clients connect (quic requires aioquic; default: tcp).",
+    )
+    parser.add_argument(
+        "--no-resumption",
+        dest="resumption",
+        action="store_const",
+        const=False,
+        help="Always do full TLS handshakes.",
+    )
+    parser.add_argument(
+        "--relay",
+        choices=["apdu", "passthrough"],
+        help="With passthrough, no APDUs are logged and sessions are relayed as "
+        "raw data (default: apdu).",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", "-p", type=int, default=16666)
+    parser.add_argument("--metrics-port", type=int, default=19100)
+    parser.add_argument(
+        "--timeout", type=float, default=600, help="Maximum duration of a scenario."
+    )
+    parser.add_argument("--output", "-o", help="Write results to file (JSON).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # thousands of clients need more file descriptors than the usual soft limit
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    config.init_config(args.config, True)
+
+    overrides = {
+        f.name: getattr(args, f.name)
+        for f in dataclasses.fields(Scenario)
+        if f.name != "name" and getattr(args, f.name, None) is not None
+    }
+    scenarios = [
+        dataclasses.replace(SCENARIOS[name], **overrides)
+        for name in (args.scenario or ["smoke"])
+    ]
+
+    results = {"version": 1, **stats.environment(), "scenarios": []}
+
+    for s in scenarios:
+        LOGGER.info("Running scenario: %s", s)
+        results["scenarios"].append(uvloop.run(_run_scenario(s, args)))
+
+    out = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+
+async def _run_scenario(s: Scenario, args: argparse.Namespace) -> dict[str, Any]:
+    trace = (
+        traces.TRACES[s.trace]()
+        if s.trace in traces.TRACES
+        else traces.load_trace(Path(s.trace))
+    )
+
+    engine = create_async_engine(config.get_config().db_url())
+    async_session = async_sessionmaker(engine, expire_on_commit=False)
+    provider_ids = [uuid.uuid4() for _ in range(s.providers)]
+    tmp_dir = Path(tempfile.mkdtemp(prefix="moat-loadgen-"))
+    procs: list[multiprocessing.Process] = []
+
+    try:
+        await _seed(async_session, provider_ids, s.sims)
+
+        if s.transport != "tcp":
+            _self_signed_cert(tmp_dir)
+        clients.reset_sessions(s.resumption)
+
+        cfg_path = tmp_dir / "config.toml"
+        _write_config(args.config, cfg_path, s, args.port, args.metrics_port, tmp_dir)
+        procs = _start_server(
+            cfg_path, args.host, args.port, s.workers, tmp_dir, s.transport == "tls"
+        )
+        await _wait_listening(args.host, args.port, procs)
+
+        monitor = stats.ProcessMonitor([p.pid for p in procs if p.pid is not None])
+        monitor_task = asyncio.create_task(monitor.run())
+
+        stop = asyncio.Event()
+        provider_tasks = [
+            asyncio.create_task(
+                clients.provider_slot(
+                    args.host, args.port, pid, trace, stop, s.transport
+                )
+            )
+            for pid in provider_ids
+            for _ in range(s.sims)
+        ]
+        # give the providers a chance to connect before the probes arrive
+        await asyncio.sleep(1)
+
+        sims = [SimId(pid, i) for pid in provider_ids for i in range(s.sims)]
+        probe_stats = clients.ProbeStats()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        probe_tasks = [
+            asyncio.create_task(
+                clients.probe(
+                    args.host,
+                    args.port,
+                    sims,
+                    trace,
+                    s.sessions,
+                    s.repeat,
+                    s.think_time,
+                    probe_stats,
+                    s.pipelined,
+                    s.transport,
+                )
+            )
+            for _ in range(s.probes)
+        ]
+        _, pending = await asyncio.wait(probe_tasks, timeout=args.timeout)
+        duration = time.perf_counter() - start
+        loadgen_cpu = time.process_time() - cpu_start
+        server = monitor.result()
+
+        if len(pending) > 0:
+            LOGGER.warning("%d probes did not finish in time.", len(pending))
+
+        queue_wait = await stats.scrape_histogram(
+            args.host,
+            [args.metrics_port + i for i in range(s.workers)],
+            "moatt_queue_wait_seconds",
+        )
+
+        stop.set()
+        for t in [*pending, *provider_tasks, monitor_task]:
+            t.cancel()
+        await asyncio.gather(*pending, *provider_tasks, return_exceptions=True)
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.join()
+
+        await _cleanup(async_session, provider_ids)
+        await engine.dispose()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        "scenario": dataclasses.asdict(s),
+        "duration_s": duration,
+        "unfinished_probes": len(pending),
+        "connects": {
+            "succeeded": probe_stats.connects,
+            "failed": probe_stats.connect_failures,
+            "per_second": probe_stats.connects / duration,
+            "latency_s": stats.summary(probe_stats.connect_latencies),
+            "handshake_latency_s": stats.summary(probe_stats.handshake_latencies),
+        },
+        "queue_wait_s": queue_wait,
+        "relay": {
+            "apdus": len(probe_stats.rtts),
+            "per_second": len(probe_stats.rtts) / duration,
+            "failed_sessions": probe_stats.relay_failures,
+            "rtt_s": stats.summary(probe_stats.rtts),
+        },
+        "server": server,
+        "loadgen": {"cpu_s": loadgen_cpu},
+    }
+
+
+def _write_config(
+    base: str, path: Path, s: Scenario, port: int, metrics_port: int, tmp_dir: Path
+) -> None:
+    with open(base, "rb") as f:
+        cfg = tomllib.load(f)
+
+    db = cfg.get("db", {})
+    lines = ["[db]"]
+    for k in ["host", "port", "name", "user", "password"]:
+        if k in db:
+            lines.append(f"{k} = {json.dumps(db[k])}")
+
+    lines += [
+        "[auth]",
+        f'handler = "{STUB_AUTH_HANDLER}"',
+        "[tunnel]",
+        f"workers = {s.workers}",
+        f"certificate = {json.dumps(str(tmp_dir / 'server.crt'))}",
+        f"cert_key = {json.dumps(str(tmp_dir / 'server.key'))}",
+        "[limits]",
+        f"max_queue_size = {s.probes + 1}",
+        "[metrics]",
+        'host = "127.0.0.1"',
+        f"port = {metrics_port}",
+    ]
+
+    if s.relay == "passthrough":
+        lines += ["[audit]", "sample_rate = 0.0", 'unlogged_relay = "passthrough"']
+
+    if s.transport == "quic":
+        # same port number, but UDP
+        lines.insert(lines.index("[limits]"), f"quic_port = {port}")
+
+    path.write_text("\n".join(lines) + "\n")
+
+
+def _self_signed_cert(tmp_dir: Path) -> None:
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "ec",
+            "-pkeyopt",
+            "ec_paramgen_curve:prime256v1",
+            "-nodes",
+            "-subj",
+            "/CN=localhost",
+            "-days",
+            "1",
+            "-keyout",
+            str(tmp_dir / "server.key"),
+            "-out",
+            str(tmp_dir / "server.crt"),
+        ],
+        capture_output=True,
+        check=True,
+    )
+
+
+def _serve(
+    cfg_path: Path,
+    host: str,
+    port: int,
+    index: int,
+    size: int,
+    socket_dir: Path,
+    tls: bool,
+) -> None:
+    from ..tunnel.server import Server
+    from ..tunnel.workers import WorkerGroup
+
+    logging.basicConfig(level=logging.WARNING)
+    cfg = config.init_config(cfg_path, True)
+    workers = WorkerGroup(index, size, socket_dir) if size > 1 else None
+
+    tls_ctx = None
+    if tls:
+        tls_ctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
+        tls_ctx.load_cert_chain(cfg.TUNNEL_CERT, cfg.TUNNEL_CERT_KEY)
+
+    uvloop.run(Server(cfg, host, port, tls_ctx, workers=workers).start())
+
+
+def _start_server(
+    cfg_path: Path, host: str, port: int, workers: int, tmp_dir: Path, tls: bool
+) -> list[multiprocessing.Process]:
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(
+            target=_serve,
+            args=(cfg_path, host, port, i, workers, tmp_dir, tls),
+            name=f"moat-loadgen-server-{i}",
+        )
+        for i in range(workers)
+    ]
+
+    for p in procs:
+        p.start()
+
+    return procs
+
+
+async def _wait_listening(
+    host: str, port: int, procs: list[multiprocessing.Process]
+) -> None:
+    async with asyncio.timeout(60):
+        while True:
+            if not all(p.is_alive() for p in procs):
+                raise RuntimeError("Tunnel server exited during startup.")
+
+            try:
+                _, writer = await asyncio.open_connection(host, port)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.1)
+
+
+async def _seed(async_session, provider_ids: list[uuid.UUID], sims: int) -> None:
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    async with async_session() as session, session.begin():
+        await session.run_sync(lambda s: dbm.Base.metadata.create_all(s.connection()))
+        await db.add_missing_columns(await session.connection())
+
+        for pid in provider_ids:
+            session.add(dbm.Provider(id=pid, last_active=now))
+        await session.flush()
+
+        for pid in provider_ids:
+            for i in range(sims):
+                session.add(dbm.Sim(id=i, provider_id=pid, in_use=False))
+
+
+async def _cleanup(async_session, provider_ids: list[uuid.UUID]) -> None:
+    try:
+        async with async_session() as session, session.begin():
+            await session.execute(
+                delete(dbm.ApduLog).where(dbm.ApduLog.provider_id.in_(provider_ids))
+            )
+            await session.execute(
+                delete(dbm.TunnelSession).where(
+                    dbm.TunnelSession.provider_id.in_(provider_ids)
+                )
+            )
+            await session.execute(
+                delete(dbm.Provider).where(dbm.Provider.id.in_(provider_ids))
+            )
+    except Exception:
+        LOGGER.exception("Failed to remove load generator data from the database.")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+import asyncio
+import collections
+import logging
+import random
+import ssl
+import time
+from dataclasses import dataclass, field
+from uuid import UUID
+
+from moatt_types.connect import (
+    ApduOp,
+    ApduPacket,
+    AuthRequest,
+    AuthRequestFlags,
+    AuthResponse,
+    AuthStatus,
+    AuthType,
+    ConnectionRequestFlags,
+    ConnectRequest,
+    ConnectResponse,
+    ConnectStatus,
+    SimId,
+)
+
+from ..tunnel.util import read_msg
+from .stub_auth import make_token
+from .traces import Trace
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class ProbeStats:
+    connects: int = 0
+    connect_failures: dict[str, int] = field(default_factory=dict)
+    connect_latencies: list[float] = field(default_factory=list)
+    handshake_latencies: list[float] = field(default_factory=list)
+    rtts: list[float] = field(default_factory=list)
+    relay_failures: int = 0
+
+    def failed(self, reason: str) -> None:
+        self.connect_failures[reason] = self.connect_failures.get(reason, 0) + 1
+
+
+class _ResumingContext(ssl.SSLContext):
+    """Client context offering the last session it saw for resumption."""
+
+    session: ssl.SSLSession | None = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):  # type: ignore
+        # asyncio (and uvloop) do not pass sessions themselves
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side,
+            server_hostname,
+            session if session is not None else self.session,
+        )
+
+
+_RESUMPTION = True
+_TLS_CTX: _ResumingContext | None = None
+# session tickets for resuming QUIC connections with 0-RTT
+_QUIC_TICKETS: collections.deque = collections.deque(maxlen=10_000)
+
+
+def reset_sessions(resumption: bool = True) -> None:
+    """Forget all TLS sessions and QUIC tickets.
+
+    Later connections only resume earlier ones if `resumption` is set.
+    """
+    global _RESUMPTION, _TLS_CTX
+
+    _RESUMPTION = resumption
+    _TLS_CTX = None
+    _QUIC_TICKETS.clear()
+
+
+def _tls_ctx() -> _ResumingContext:
+    global _TLS_CTX
+
+    if _TLS_CTX is None:
+        _TLS_CTX = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        _TLS_CTX.check_hostname = False
+        _TLS_CTX.verify_mode = ssl.CERT_NONE
+
+    return _TLS_CTX
+
+
+async def _connect(
+    host: str, port: int, transport: str
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Open a connection; the server's certificate is not verified."""
+    match transport:
+        case "tcp":
+            return await asyncio.open_connection(host, port)
+        case "tls":
+            return await asyncio.open_connection(host, port, ssl=_tls_ctx())
+        case "quic":
+            from aioquic.quic.configuration import QuicConfiguration
+            from moatt_types.connect import QUIC_ALPN
+
+            from ..tunnel import quic
+
+            configuration = QuicConfiguration(
+                is_client=True, alpn_protocols=[QUIC_ALPN], verify_mode=ssl.CERT_NONE
+            )
+            if _RESUMPTION and len(_QUIC_TICKETS) > 0:
+                configuration.session_ticket = _QUIC_TICKETS.popleft()
+
+            return await quic.open_connection(  # type: ignore
+                host, port, configuration, _QUIC_TICKETS.append
+            )
+        case _:
+            raise ValueError(f"Unknown transport: {transport}")
+
+
+async def _open(
+    host: str,
+    port: int,
+    auth_type: AuthType,
+    identity: UUID,
+    pipelined: bytes | None = None,
+    transport: str = "tcp",
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    reader, writer = await _connect(host, port, transport)
+
+    if pipelined is None:
+        writer.write(AuthRequest(auth_type, make_token(identity)).encode())
+    else:
+        writer.write(
+            AuthRequest(
+                auth_type, make_token(identity), AuthRequestFlags.PIPELINED
+            ).encode()
+            + pipelined
+        )
+    res = await read_msg(reader, AuthResponse.decode_from)
+
+    if res.status != AuthStatus.Success:
+        writer.close()
+        raise ConnectionError(f"Authentication failed: {res.status}")
+
+    # TLS 1.3 tickets arrive after the handshake, i.e., with the first response
+    ssl_object = writer.get_extra_info("ssl_object")
+    if _RESUMPTION and ssl_object is not None:
+        _tls_ctx().session = ssl_object.session
+
+    return reader, writer
+
+
+async def _recv_apdu(reader: asyncio.StreamReader) -> ApduPacket:
+    op, plen = ApduPacket.decode_header(await reader.readexactly(ApduPacket.HEADER_LEN))
+    return ApduPacket(op, await reader.readexactly(plen) if plen > 0 else b"")
+
+
+async def provider_slot(
+    host: str,
+    port: int,
+    provider_id: UUID,
+    trace: Trace,
+    stop: asyncio.Event,
+    transport: str = "tcp",
+) -> None:
+    """Serve tunnel sessions for one SIM until `stop` is set.
+
+    Answers the i-th command of a session with the i-th response of `trace`.
+    """
+    responses = [e.response for e in trace]
+
+    while not stop.is_set():
+        writer = None
+        try:
+            reader, writer = await _open(
+                host, port, AuthType.Provider, provider_id, transport=transport
+            )
+            await read_msg(reader, ConnectRequest.decode_from)
+            writer.write(ConnectResponse(ConnectStatus.Success).encode())
+
+            i = 0
+            while True:
+                try:
+                    await _recv_apdu(reader)
+                except asyncio.IncompleteReadError:
+                    break
+
+                writer.write(
+                    ApduPacket(ApduOp.Apdu, responses[i % len(responses)]).encode()
+                )
+                i += 1
+        except (OSError, asyncio.IncompleteReadError) as e:
+            LOGGER.debug("Provider connection failed: %s", e)
+            await asyncio.sleep(0.1)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+async def probe(
+    host: str,
+    port: int,
+    sims: list[SimId],
+    trace: Trace,
+    sessions: int,
+    repeat: int,
+    think_time: float,
+    stats: ProbeStats,
+    pipelined: bool = False,
+    transport: str = "tcp",
+) -> None:
+    """Run `sessions` tunnel sessions, each replaying `trace` `repeat` times."""
+    identity = UUID(int=random.getrandbits(128))
+    commands = [ApduPacket(ApduOp.Apdu, e.command).encode() for e in trace]
+
+    for _ in range(sessions):
+        writer = None
+        try:
+            con_req = ConnectRequest(
+                random.choice(sims), ConnectionRequestFlags.DEFAULT
+            ).encode()
+
+            handshake_start = time.perf_counter()
+            reader, writer = await _open(
+                host,
+                port,
+                AuthType.Probe,
+                identity,
+                con_req if pipelined else None,
+                transport,
+            )
+
+            start = time.perf_counter()
+            if not pipelined:
+                writer.write(con_req)
+            res = await read_msg(reader, ConnectResponse.decode_from)
+
+            if res.status != ConnectStatus.Success:
+                stats.failed(res.status.name)
+                continue
+
+            end = time.perf_counter()
+            stats.connect_latencies.append(end - start)
+            stats.handshake_latencies.append(end - handshake_start)
+            stats.connects += 1
+
+            for _ in range(repeat):
+                for cmd in commands:
+                    start = time.perf_counter()
+                    writer.write(cmd)
+                    await _recv_apdu(reader)
+                    stats.rtts.append(time.perf_counter() - start)
+
+                    if think_time > 0:
+                        await asyncio.sleep(think_time)
+        except asyncio.IncompleteReadError:
+            stats.relay_failures += 1
+        except OSError as e:
+            stats.failed(type(e).__name__)
+        finally:
+            if writer is not None:
+                writer.close()
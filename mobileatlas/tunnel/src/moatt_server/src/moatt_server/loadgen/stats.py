@@ -0,0 +1,181 @@
+import asyncio
+import datetime
+import logging
+import math
+import os
+import platform
+import re
+import subprocess
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile(sorted_values: Sequence[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted sequence."""
+    i = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[i]
+
+
+def summary(values: list[float]) -> Optional[dict[str, float]]:
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    res = {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "min": values[0],
+        "max": values[-1],
+    }
+    for p in PERCENTILES:
+        res[f"p{p:g}"] = percentile(values, p)
+
+    return res
+
+
+def environment() -> dict[str, Any]:
+    """Where and when results were measured, so runs can be compared."""
+    return {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        "host": {
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+_SAMPLE_RE = re.compile(
+    r'^(\w+?)(?:_bucket\{(?:.*,)?le="([^"]+)"\}|_sum|_count)\s+(\S+)$'
+)
+
+
+async def scrape_histogram(
+    host: str, ports: list[int], name: str
+) -> Optional[dict[str, Any]]:
+    """Merge an unlabeled histogram exported by several workers.
+
+    Percentiles are estimated as the upper bound of the bucket they fall into.
+    """
+    buckets: dict[float, float] = {}
+    total = 0.0
+    count = 0
+
+    for port in ports:
+        try:
+            body = await _get_metrics(host, port)
+        except OSError as e:
+            LOGGER.warning("Failed to scrape metrics from port %d: %s", port, e)
+            return None
+
+        for line in body.splitlines():
+            m = _SAMPLE_RE.match(line)
+            if m is None or m.group(1) != name:
+                continue
+
+            if m.group(2) is not None:
+                le = float(m.group(2))
+                buckets[le] = buckets.get(le, 0) + float(m.group(3))
+            elif line.startswith(f"{name}_sum"):
+                total += float(m.group(3))
+            else:
+                count += int(float(m.group(3)))
+
+    if count == 0:
+        return None
+
+    bounds = sorted(buckets.items())
+    res: dict[str, Any] = {"count": count, "mean": total / count}
+    for p in PERCENTILES:
+        rank = p / 100 * count
+        res[f"p{p:g}"] = next(
+            (le if not math.isinf(le) else None for le, n in bounds if n >= rank),
+            None,
+        )
+
+    return res
+
+
+async def _get_metrics(host: str, port: int) -> str:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: loadgen\r\n\r\n")
+        res = await reader.read()
+    finally:
+        writer.close()
+
+    _, _, body = res.partition(b"\r\n\r\n")
+    return body.decode()
+
+
+class ProcessMonitor:
+    """Samples CPU time and RSS of the server processes (Linux only)."""
+
+    def __init__(self, pids: list[int], interval: float = 0.5):
+        self._pids = pids
+        self._interval = interval
+        self._ticks = os.sysconf("SC_CLK_TCK")
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self._start = self._sample()
+        self._last = self._start
+        self._peak_rss = self._last[1] if self._last is not None else 0
+
+    def _sample(self) -> Optional[tuple[float, int]]:
+        cpu = 0.0
+        rss = 0
+
+        try:
+            for pid in self._pids:
+                with open(f"/proc/{pid}/stat") as f:
+                    stat = f.read()
+
+                # fields after the command name; utime, stime and rss are fields
+                # 14, 15 and 24 in proc(5)
+                fields = stat[stat.rindex(")") + 2 :].split()
+                cpu += (int(fields[11]) + int(fields[12])) / self._ticks
+                rss += int(fields[21]) * self._page_size
+        except (OSError, ValueError, IndexError):
+            return None
+
+        return cpu, rss
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+
+            sample = self._sample()
+            if sample is None:
+                continue
+
+            self._last = sample
+            self._peak_rss = max(self._peak_rss, sample[1])
+
+    def result(self) -> Optional[dict[str, float]]:
+        sample = self._sample() or self._last
+        if self._start is None or sample is None:
+            return None
+
+        return {
+            "cpu_s": sample[0] - self._start[0],
+            "rss_bytes": sample[1],
+            "peak_rss_bytes": max(self._peak_rss, sample[1]),
+        }
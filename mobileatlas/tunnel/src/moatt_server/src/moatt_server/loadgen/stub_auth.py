@@ -0,0 +1,36 @@
+from typing import Any
+from uuid import UUID
+
+from moatt_types.connect import Token
+
+from ..auth_handler import AuthHandler, AuthResult, SimIdent
+
+
+def make_token(identity: UUID) -> Token:
+    return Token(identity.bytes)
+
+
+class StubAuth(AuthHandler):
+    """Allows everything. The identity of a client is the UUID its token encodes."""
+
+    def __init__(self, config: dict[str, Any] | None):
+        pass
+
+    async def allowed_provider_registration(self, token: Token) -> AuthResult:
+        return AuthResult.Success
+
+    async def allowed_sim_registration(
+        self, token: Token, sims: list[SimIdent]
+    ) -> AuthResult:
+        return AuthResult.Success
+
+    async def allowed_probe_registration(self, token: Token) -> AuthResult:
+        return AuthResult.Success
+
+    async def allowed_sim_request(
+        self, token: Token, provider_id: UUID, sim_id: SimIdent
+    ) -> AuthResult:
+        return AuthResult.Success
+
+    async def identity(self, token: Token) -> UUID | None:
+        return UUID(bytes=token.as_bytes()[:16])
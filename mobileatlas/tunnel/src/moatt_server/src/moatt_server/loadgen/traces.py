@@ -0,0 +1,88 @@
+import json
+import random
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass(frozen=True)
+class Exchange:
+    command: bytes
+    response: bytes
+
+
+Trace = list[Exchange]
+
+
+def _data(rng: random.Random, n: int) -> bytes:
+    return rng.randbytes(n) + b"\x90\x00"
+
+
+def attach_trace(seed: int = 0) -> Trace:
+    """APDUs exchanged while a modem attaches to a network (USIM application).
+
+    Command headers follow TS 102 221/TS 31.102; response contents are random
+    but have the usual sizes.
+    """
+    rng = random.Random(seed)
+    h = bytes.fromhex
+
+    return [
+        # SELECT MF, EF_DIR, READ RECORD
+        Exchange(h("00a40004023f00"), _data(rng, 36)),
+        Exchange(h("00a40004022f00"), _data(rng, 30)),
+        Exchange(h("00b2010426"), _data(rng, 38)),
+        # SELECT ADF.USIM
+        Exchange(h("00a4040410a0000000871002ffffffff8907090000"), _data(rng, 62)),
+        # EF_IMSI, EF_AD, EF_UST, EF_LOCI, EF_PSLOCI, EF_Keys, EF_KeysPS
+        *(
+            e
+            for fid, n in [
+                (0x07, 9),
+                (0xAD, 4),
+                (0x38, 17),
+                (0x7E, 11),
+                (0x73, 14),
+                (0x08, 33),
+                (0x09, 33),
+            ]
+            for e in (
+                Exchange(h("00a40004026f") + bytes([fid]), _data(rng, 25)),
+                Exchange(h("00b00000") + bytes([n]), _data(rng, n)),
+            )
+        ),
+        # AUTHENTICATE (3G context): RAND + AUTN
+        Exchange(
+            h("008800812210") + rng.randbytes(16) + b"\x10" + rng.randbytes(16),
+            b"\xdb\x08"
+            + rng.randbytes(8)
+            + b"\x10"
+            + rng.randbytes(16)
+            + b"\x10"
+            + rng.randbytes(16)
+            + b"\x08"
+            + rng.randbytes(8)
+            + b"\x90\x00",
+        ),
+        # UPDATE BINARY EF_LOCI/EF_PSLOCI, STATUS
+        Exchange(h("00d600000b") + rng.randbytes(11), b"\x90\x00"),
+        Exchange(h("00d600000e") + rng.randbytes(14), b"\x90\x00"),
+        Exchange(h("80f2000000"), b"\x90\x00"),
+    ]
+
+
+def load_trace(path: Path) -> Trace:
+    """Load a trace from a JSON file.
+
+    The file contains a list of objects with hex encoded "command" and
+    "response" APDUs.
+    """
+    with open(path) as f:
+        exchanges = json.load(f)
+
+    return [
+        Exchange(bytes.fromhex(e["command"]), bytes.fromhex(e["response"]))
+        for e in exchanges
+    ]
+
+
+TRACES = {"attach": attach_trace}
@@ -0,0 +1,258 @@
+"""Minimal Prometheus-style metrics.
+
+The tunnel server runs a single event loop per process, so metrics are plain
+Python integers/floats that are updated without any locking. Histograms use a
+fixed set of buckets that is allocated when a label combination is first used.
+"""
+
+import asyncio
+import bisect
+import logging
+import math
+from collections.abc import Callable, Iterable, Sequence
+
+LOGGER = logging.getLogger(__name__)
+
+# 50us to 60s
+LATENCY_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple[str, ...], object] = {}
+
+        REGISTRY.append(self)
+
+    def labels(self, *values: str):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"Expected labels: {self.labelnames}")
+
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+
+        return child
+
+    def remove(self, *values: str) -> None:
+        self._children.pop(values, None)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_str(self, values: tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self._samples()
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, n: float = 1) -> None:
+        self.value += n
+
+    def dec(self, n: float = 1) -> None:
+        self.value -= n
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+
+        if len(self.labelnames) == 0:
+            self.labels()
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, n: float = 1) -> None:
+        self.labels().inc(n)
+
+    def _samples(self) -> Iterable[str]:
+        for values, child in self._children.items():
+            yield f"{self.name}{self._label_str(values)} {_fmt(child.value)}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, n: float = 1) -> None:
+        self.labels().dec(n)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class GaugeFunc(_Metric):
+    """Gauge whose samples are computed by `fn` when the metrics are scraped."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        fn: Callable[[], Iterable[tuple[tuple[str, ...], float]]],
+        labelnames: Sequence[str] = (),
+    ):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def _samples(self) -> Iterable[str]:
+        for values, value in self.fn():
+            yield f"{self.name}{self._label_str(values)} {_fmt(value)}"
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        if len(self.labelnames) == 0:
+            self.labels()
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self) -> Iterable[str]:
+        for values, child in self._children.items():
+            acc = 0
+            for le, n in zip(self.buckets, child.counts):
+                acc += n
+                label = self._label_str(values, f'le="{_fmt(le)}"')
+                yield f"{self.name}_bucket{label} {acc}"
+
+            label = self._label_str(values, 'le="+Inf"')
+            yield f"{self.name}_bucket{label} {child.count}"
+            yield f"{self.name}_sum{self._label_str(values)} {_fmt(child.sum)}"
+            yield f"{self.name}_count{self._label_str(values)} {child.count}"
+
+
+REGISTRY: list[_Metric] = []
+
+
+def render() -> str:
+    return "\n".join(line for m in REGISTRY for line in m.render()) + "\n"
+
+
+def _fmt(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+            status = b"200 OK"
+            body = render().encode()
+        else:
+            status = b"404 Not Found"
+            body = b"Not Found\n"
+
+        writer.write(
+            b"HTTP/1.1 "
+            + status
+            + b"\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + b"Content-Length: "
+            + str(len(body)).encode()
+            + b"\r\nConnection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+    except Exception:
+        LOGGER.exception("Failed to serve metrics request.")
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> None:
+    server = await asyncio.start_server(_handle, host, port)
+    LOGGER.info("Serving metrics on %s:%d.", host, port)
+
+    async with server:
+        await server.serve_forever()
@@ -4,9 +4,24 @@ from typing import List, Optional
 from uuid import UUID
 
 from moatt_types.connect import ApduOp
-from sqlalchemy import TIMESTAMP, Boolean, ForeignKey, Integer, LargeBinary, func
+from sqlalchemy import (
+    TIMESTAMP,
+    BigInteger,
+    Boolean,
+    ForeignKey,
+    Index,
+    LargeBinary,
+    func,
+    select,
+)
 from sqlalchemy.ext.asyncio import AsyncAttrs
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Mapped,
+    column_property,
+    mapped_column,
+    relationship,
+)
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -36,6 +51,8 @@ class Provider(Base):
     last_active: Mapped[Optional[datetime.datetime]] = mapped_column(
         TIMESTAMP(timezone=True), server_default=func.now()
     )
+    # incremented whenever the provider's SIMs change (precondition of SIM list updates)
+    sims_version: Mapped[int] = mapped_column(server_default="0")
 
     sims: Mapped[List["Sim"]] = relationship(
         "Sim", back_populates="provider", cascade="all, delete", passive_deletes=True
@@ -57,12 +74,45 @@ class Sender(enum.Enum):
     Provider = 2
 
 
+class ApduPayload(Base):
+    """Distinct APDU payloads referenced by the APDU log, keyed by their SHA-256.
+
+    `last_used` is the latest day (UTC) of an APDU log entry referencing the
+    payload (updated at most once a day); payloads that are not used by any
+    remaining partition are removed by `apdu_log.maintain`.
+    """
+
+    __tablename__ = "apdu_payloads"
+    __table_args__ = (Index("ix_apdu_payloads_last_used", "last_used"),)
+
+    hash: Mapped[bytes] = mapped_column(LargeBinary, primary_key=True)
+    payload: Mapped[bytes] = mapped_column(LargeBinary)
+    last_used: Mapped[datetime.date]
+
+
 class ApduLog(Base):
+    """Log of relayed APDUs.
+
+    The table is partitioned by day (UTC); partitions are created and removed by
+    `apdu_log.maintain`.
+
+    Payloads that are longer than their hash are stored once in `apdu_payloads`
+    and referenced by `payload_hash`; shorter ones are stored inline. Reading
+    `payload` returns the payload in either case.
+    """
+
     __tablename__ = "apdu_log"
+    __table_args__ = (
+        Index("ix_apdu_log_sim", "sim_id", "timestamp"),
+        Index("ix_apdu_log_probe", "probe_id", "timestamp"),
+        {"postgresql_partition_by": 'RANGE ("timestamp")'},
+    )
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # the partition key has to be part of the primary key
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
     timestamp: Mapped[datetime.datetime] = mapped_column(
         TIMESTAMP(timezone=True),
+        primary_key=True,
         server_default=func.now(),
     )
     provider_id: Mapped[UUID]
@@ -71,5 +121,59 @@ class ApduLog(Base):
     sim_iccid: Mapped[Optional[str]]
     sim_imsi: Mapped[Optional[str]]
     command: Mapped[ApduOp]
-    payload: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+    inline_payload: Mapped[Optional[bytes]] = mapped_column("payload", LargeBinary)
+    payload_hash: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
     sender: Mapped[Sender]
+
+    payload: Mapped[Optional[bytes]] = column_property(
+        func.coalesce(
+            inline_payload,
+            select(ApduPayload.payload)
+            .where(ApduPayload.hash == payload_hash)
+            .scalar_subquery(),
+        )
+    )
+
+
+class TunnelSession(Base):
+    """Summary of a tunnel session, written once the session ended.
+
+    Durations and RTTs are in seconds. The RTT percentiles cover the time from
+    forwarding an APDU of the probe until the provider's response was forwarded.
+    Passthrough sessions only count APDUs (and measure RTTs) if they were tapped.
+    """
+
+    __tablename__ = "tunnel_sessions"
+    __table_args__ = (
+        Index("ix_tunnel_sessions_sim", "provider_id", "sim_id", "started"),
+        Index("ix_tunnel_sessions_iccid", "sim_iccid", "started"),
+        Index("ix_tunnel_sessions_probe", "probe_id", "started"),
+        Index("ix_tunnel_sessions_started", "started"),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    provider_id: Mapped[UUID]
+    probe_id: Mapped[UUID]
+    sim_id: Mapped[int]
+    sim_iccid: Mapped[Optional[str]]
+    sim_imsi: Mapped[Optional[str]]
+    started: Mapped[datetime.datetime] = mapped_column(TIMESTAMP(timezone=True))
+    ended: Mapped[datetime.datetime] = mapped_column(TIMESTAMP(timezone=True))
+    queue_wait: Mapped[float]
+    passthrough: Mapped[bool]
+    probe_apdus: Mapped[Optional[int]]
+    provider_apdus: Mapped[Optional[int]]
+    probe_bytes: Mapped[int] = mapped_column(BigInteger)
+    provider_bytes: Mapped[int] = mapped_column(BigInteger)
+    rtt_p50: Mapped[Optional[float]]
+    rtt_p90: Mapped[Optional[float]]
+    rtt_p99: Mapped[Optional[float]]
+
+
+class PermissionVersion(Base):
+    """Latest permission version of a management token (see SignedTokenAuth)."""
+
+    __tablename__ = "permission_versions"
+
+    token_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    version: Mapped[int]
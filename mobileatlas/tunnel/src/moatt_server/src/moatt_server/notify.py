@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from datetime import timedelta
+
+import psycopg
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import Config
+
+LOGGER = logging.getLogger(__name__)
+
+AUTH_INVALIDATE = "moatt_auth_invalidate"
+SIMS_CHANGED = "moatt_sims_changed"
+
+
+async def notify(session: AsyncSession, channel: str, payload: str = "") -> None:
+    """Send a notification to all processes listening on `channel`.
+
+    The notification is delivered once the surrounding transaction commits.
+    """
+    await session.execute(select(func.pg_notify(channel, payload)))
+
+
+async def listen(
+    config: Config,
+    handlers: dict[str, Callable[[str], Awaitable[None]]],
+    resync: Callable[[], Awaitable[None]] | None = None,
+    retry_interval: timedelta = timedelta(seconds=10),
+) -> None:
+    """Call `handlers[channel]` with the payload of every notification received.
+
+    Notifications sent while the connection is down are lost, which is why
+    `resync` is called every time the connection is (re)established.
+    """
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                host=config.DB_HOST,
+                port=config.DB_PORT,
+                user=config.DB_USER,
+                password=config.DB_PASSWORD,
+                dbname=config.DB_NAME,
+                autocommit=True,
+            ) as conn:
+                for channel in handlers:
+                    await conn.execute(f'LISTEN "{channel}"')
+
+                if resync is not None:
+                    await resync()
+
+                async for n in conn.notifies():
+                    try:
+                        await handlers[n.channel](n.payload)
+                    except Exception:
+                        LOGGER.exception(
+                            f"Failed to handle notification on channel {n.channel}."
+                        )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            LOGGER.exception(
+                f"Lost connection to database. Retrying in {retry_interval}..."
+            )
+
+        await asyncio.sleep(retry_interval.total_seconds())
@@ -1,19 +1,28 @@
 import base64
 import binascii
 import logging
+import secrets
 from typing import Annotated
 
 from fastapi import Depends, HTTPException
-from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from fastapi.security import (
+    HTTPAuthorizationCredentials,
+    HTTPBasic,
+    HTTPBasicCredentials,
+    HTTPBearer,
+)
 from moatt_types.connect import Token
 
+from ..config import get_config
+
 LOGGER = logging.getLogger(__name__)
 
 bearer_token = HTTPBearer()
+basic_auth = HTTPBasic()
 
 
 def session_token(
-    token: Annotated[HTTPAuthorizationCredentials, Depends(bearer_token)]
+    token: Annotated[HTTPAuthorizationCredentials, Depends(bearer_token)],
 ) -> Token:
     try:
         return Token(base64.b64decode(token.credentials, validate=True))
@@ -21,3 +30,27 @@ def session_token(
         raise HTTPException(
             status_code=400, detail="Bearer token should be base64 encoded."
         )
+
+
+def admin(credentials: Annotated[HTTPBasicCredentials, Depends(basic_auth)]) -> str:
+    config = get_config()
+
+    if config.API_ADMIN_USER is None or config.API_ADMIN_PASSWORD is None:
+        LOGGER.warning("Admin endpoint was called but no admin user is configured.")
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+    user_ok = secrets.compare_digest(
+        credentials.username.encode(), config.API_ADMIN_USER.encode()
+    )
+    pw_ok = secrets.compare_digest(
+        credentials.password.encode(), config.API_ADMIN_PASSWORD.encode()
+    )
+
+    if not (user_ok and pw_ok):
+        raise HTTPException(
+            status_code=401,
+            detail="Unauthorized",
+            headers={"WWW-Authenticate": "Basic"},
+        )
+
+    return credentials.username
@@ -19,6 +19,12 @@ async def dispose_engine():
         await _ENGINE.dispose()
 
 
+def new_session() -> AsyncSession:
+    assert _ENGINE is not None
+
+    return AsyncSession(_ENGINE, autobegin=False)
+
+
 async def get_db():
     assert (
         _ENGINE is not None
@@ -1,14 +1,26 @@
 import asyncio
+import base64
 import contextlib
+import datetime
 import logging
-from typing import Annotated
+import re
+from typing import Annotated, Optional
+from uuid import UUID
 
-from fastapi import Depends, FastAPI, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
 from moatt_types.connect import Token
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .. import auth, db
+from .. import apdu_log, auth, db, export, notify
 from ..config import get_config
 from . import auth as rest_auth
 from . import db as db_utils
@@ -26,14 +38,28 @@ async def lifespan(_: FastAPI):
             async with db_utils._ENGINE.begin() as conn:
                 from .. import models as dbm
 
+                await apdu_log.migrate_legacy(conn)
                 await conn.run_sync(dbm.Base.metadata.create_all)
+                await db.add_missing_columns(conn)
+                await apdu_log.create_default_partition(conn)
             break
         except Exception:
             LOGGER.exception("Failed to connect to database.\nRetrying in 10s...")
             await asyncio.sleep(10)
 
+    # other processes use their own auth handler (and cache)
+    config = get_config()
+    listener = asyncio.create_task(
+        notify.listen(
+            config,
+            {notify.AUTH_INVALIDATE: auth.invalidate},
+            lambda: auth.resync(db_utils.new_session),
+        )
+    )
+
     yield
 
+    listener.cancel()
     await db_utils.dispose_engine()
 
 
@@ -50,8 +76,50 @@ async def provider_register(
     sims = {s.id: (s.get_iccid(), s.get_imsi()) for s in sims_req.root}
 
     async with session.begin():
-        if await auth.register_provider(session, session_token, sims):
-            response.status_code = 201
+        reg = await auth.register_provider(session, session_token, sims)
+
+    if reg.modified:
+        response.status_code = 201
+    response.headers["ETag"] = _etag(reg.version)
+
+
+@app.patch("/provider/sims", status_code=204)
+async def provider_update_sims(
+    changes: pydantic_models.SimChanges,
+    session_token: Annotated[Token, Depends(rest_auth.session_token)],
+    session: Annotated[AsyncSession, Depends(db_utils.get_db)],
+    if_match: Annotated[str, Header()],
+    response: Response,
+):
+    """Add and remove SIMs.
+
+    `If-Match` has to be the `ETag` returned by the last registration or update;
+    otherwise the SIMs have to be registered again (`PUT /provider/sims`).
+    """
+    if (m := _ETAG_RE.fullmatch(if_match.strip())) is None:
+        raise HTTPException(status_code=412, detail="SIMs changed.")
+
+    version = int(m.group(1))
+    sims = {s.id: (s.get_iccid(), s.get_imsi()) for s in changes.add.root}
+
+    async with session.begin():
+        try:
+            reg = await auth.update_provider_sims(
+                session, session_token, version, sims, set(changes.remove)
+            )
+        except auth.VersionMismatch:
+            raise HTTPException(status_code=412, detail="SIMs changed.")
+        except auth.SimConflict:
+            raise HTTPException(status_code=409, detail="Duplicate ICCID or IMSI.")
+
+    response.headers["ETag"] = _etag(reg.version)
+
+
+_ETAG_RE = re.compile(r'"([0-9]+)"')
+
+
+def _etag(version: int) -> str:
+    return f'"{version}"'
 
 
 @app.get("/provider/sims")
@@ -76,6 +144,143 @@ async def provider_get_registered_sims(
     )
 
 
+@app.post("/auth/invalidate", status_code=204)
+async def auth_invalidate(
+    invalidation: pydantic_models.Invalidation,
+    _: Annotated[str, Depends(rest_auth.admin)],
+    session: Annotated[AsyncSession, Depends(db_utils.get_db)],
+) -> None:
+    token = (
+        Token(base64.b64decode(invalidation.token))
+        if invalidation.token is not None
+        else None
+    )
+
+    async with session.begin():
+        if invalidation.token_id is not None:
+            await auth.notify_permission_version(
+                session, invalidation.token_id, invalidation.permission_version
+            )
+
+        if invalidation.token is not None or invalidation.token_id is None:
+            await auth.notify_invalidation(session, token)
+
+
+def tunnel_session_filter(
+    provider_id: Optional[UUID] = None,
+    probe_id: Optional[UUID] = None,
+    sim_id: Optional[int] = None,
+    iccid: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+) -> db.TunnelSessionFilter:
+    return db.TunnelSessionFilter(
+        provider_id=provider_id,
+        probe_id=probe_id,
+        sim_id=sim_id,
+        iccid=iccid,
+        since=since,
+        until=until,
+    )
+
+
+@app.get("/tunnel-sessions")
+async def tunnel_sessions(
+    _: Annotated[str, Depends(rest_auth.admin)],
+    session: Annotated[AsyncSession, Depends(db_utils.get_db)],
+    filter: Annotated[db.TunnelSessionFilter, Depends(tunnel_session_filter)],
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+) -> list[pydantic_models.TunnelSession]:
+    """Latest tunnel sessions that started in [since, until), most recent first.
+
+    Older sessions can be fetched by passing the oldest session's start time as
+    `until`.
+    """
+    async with session.begin():
+        sessions = await db.get_tunnel_sessions(session, filter, limit)
+        return [pydantic_models.TunnelSession.model_validate(s) for s in sessions]
+
+
+@app.get("/tunnel-sessions/summary")
+async def tunnel_session_summary(
+    _: Annotated[str, Depends(rest_auth.admin)],
+    session: Annotated[AsyncSession, Depends(db_utils.get_db)],
+    filter: Annotated[db.TunnelSessionFilter, Depends(tunnel_session_filter)],
+) -> pydantic_models.TunnelSessionSummary:
+    async with session.begin():
+        summary = await db.tunnel_session_summary(session, filter)
+
+    return pydantic_models.TunnelSessionSummary.model_validate(summary)
+
+
+def apdu_log_filter(
+    provider_id: Optional[UUID] = None,
+    probe_id: Optional[UUID] = None,
+    sim_id: Optional[int] = None,
+    iccid: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+) -> db.ApduLogFilter:
+    return db.ApduLogFilter(
+        provider_id=provider_id,
+        probe_id=probe_id,
+        sim_id=sim_id,
+        iccid=iccid,
+        since=since,
+        until=until,
+    )
+
+
+@app.get("/apdu-log/export", response_class=StreamingResponse)
+async def apdu_log_export(
+    _: Annotated[str, Depends(rest_auth.admin)],
+    session: Annotated[AsyncSession, Depends(db_utils.get_db)],
+    filter: Annotated[db.ApduLogFilter, Depends(apdu_log_filter)],
+    format: export.ExportFormat = export.ExportFormat.Pcap,
+    session_id: Optional[int] = None,
+) -> StreamingResponse:
+    """APDUs logged in [since, until) or during the tunnel session `session_id`.
+
+    `pcap` exports contain GSMTAP packets that can be opened with Wireshark;
+    `arrow` exports are Apache Arrow IPC streams.
+    """
+    if session_id is not None:
+        async with session.begin():
+            ts = await db.get_tunnel_session(session, session_id)
+            if ts is None:
+                raise HTTPException(status_code=404, detail="Unknown tunnel session.")
+            filter = db.ApduLogFilter.of_session(ts)
+    elif filter.since is None:
+        raise HTTPException(
+            status_code=422, detail="Either session_id or since is required."
+        )
+
+    encoder: export.Encoder
+    match format:
+        case export.ExportFormat.Pcap:
+            from ..export import pcap
+
+            encoder = pcap.PcapEncoder()
+        case export.ExportFormat.Arrow:
+            try:
+                from ..export import arrow
+            except ImportError:
+                raise HTTPException(
+                    status_code=501,
+                    detail="Arrow exports require pyarrow (moatt-server[export]).",
+                )
+
+            encoder = arrow.ArrowEncoder()
+
+    return StreamingResponse(
+        export.export(db_utils.new_session, filter, encoder, format),
+        media_type=encoder.media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="apdu-log.{encoder.extension}"'
+        },
+    )
+
+
 @app.exception_handler(auth.AuthError)
 def autherror_ex_handler(_: Request, _exc: auth.AuthError) -> JSONResponse:
     return JSONResponse(
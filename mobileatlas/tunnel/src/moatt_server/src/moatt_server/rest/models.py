@@ -1,7 +1,19 @@
+import base64
+import binascii
+import datetime
 from typing import Annotated, Optional
+from uuid import UUID
 
 import moatt_types.connect as mtc
-from pydantic import AfterValidator, BaseModel, Field, RootModel, field_validator
+from pydantic import (
+    AfterValidator,
+    BaseModel,
+    ConfigDict,
+    Field,
+    RootModel,
+    field_validator,
+    model_validator,
+)
 
 
 def _digits(imsi: str) -> str:
@@ -61,5 +73,79 @@ class SimList(RootModel):
         return sims
 
 
+class SimChanges(BaseModel):
+    """Changes to the registered SIMs (added SIMs replace SIMs with the same ID)."""
+
+    add: SimList = SimList([])
+    remove: list[Annotated[int, Field(ge=0, lt=2**64)]] = []
+
+
 class RegistrationResp(BaseModel):
     session_token: str
+
+
+class Invalidation(BaseModel):
+    token: Optional[str] = None  # base64 encoded
+    token_id: Optional[int] = Field(default=None, ge=0, lt=2**64)
+    permission_version: Optional[int] = Field(default=None, ge=0, lt=2**32)
+
+    @field_validator("token")
+    @classmethod
+    def valid_base64(cls, token: Optional[str]) -> Optional[str]:
+        if token is not None:
+            try:
+                base64.b64decode(token, validate=True)
+            except binascii.Error:
+                raise ValueError
+
+        return token
+
+    @model_validator(mode="after")
+    def version_with_id(self) -> "Invalidation":
+        if (self.token_id is None) != (self.permission_version is None):
+            raise ValueError("token_id and permission_version have to be set together.")
+
+        return self
+
+
+class TunnelSession(BaseModel):
+    """Summary of a tunnel session (durations and RTTs in seconds)."""
+
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    provider_id: UUID
+    probe_id: UUID
+    sim_id: int
+    sim_iccid: Optional[str]
+    sim_imsi: Optional[str]
+    started: datetime.datetime
+    ended: datetime.datetime
+    queue_wait: float
+    passthrough: bool
+    probe_apdus: Optional[int]
+    provider_apdus: Optional[int]
+    probe_bytes: int
+    provider_bytes: int
+    rtt_p50: Optional[float]
+    rtt_p90: Optional[float]
+    rtt_p99: Optional[float]
+
+
+class TunnelSessionSummary(BaseModel):
+    """Aggregated statistics of tunnel sessions (durations and RTTs in seconds).
+
+    The RTT values are the medians of the sessions' RTT percentiles.
+    """
+
+    sessions: int
+    duration_avg: Optional[float]
+    duration_p50: Optional[float]
+    duration_p90: Optional[float]
+    queue_wait_avg: Optional[float]
+    probe_apdus: Optional[int]
+    provider_apdus: Optional[int]
+    probe_bytes: Optional[int]
+    provider_bytes: Optional[int]
+    rtt_p50_median: Optional[float]
+    rtt_p99_median: Optional[float]
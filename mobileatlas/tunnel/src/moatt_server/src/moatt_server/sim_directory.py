@@ -0,0 +1,155 @@
+import bisect
+import logging
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Optional
+from uuid import UUID
+
+from moatt_types.connect import Iccid, Imsi, SimId, SimIndex
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models as dbm
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class SimEntry:
+    id: int
+    iccid: Optional[str]
+    imsi: Optional[str]
+    provider_id: UUID
+
+
+class SimDirectory:
+    """In-memory copy of the registered SIM cards.
+
+    Lets probe connect requests be resolved and provider connections be checked
+    without querying the database. Changes made by
+    `auth.register_provider`/`auth.remove_provider` are announced through the
+    `notify.SIMS_CHANGED` channel upon commit, after which `reload_provider`
+    replaces the affected provider's entries.
+    """
+
+    def __init__(self):
+        self._by_id: dict[tuple[UUID, int], SimEntry] = {}
+        self._by_iccid: dict[str, SimEntry] = {}
+        self._by_imsi: dict[str, SimEntry] = {}
+        # SIMs of each provider ordered by ID (used to resolve SimIndex identifiers)
+        self._by_provider: dict[UUID, list[SimEntry]] = {}
+        # registered providers, including those without SIMs
+        self._providers: set[UUID] = set()
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def get(self, identifier: SimId | Iccid | Imsi | SimIndex) -> Optional[SimEntry]:
+        match identifier:
+            case SimId(provider=prov_id, id=id):
+                return self._by_id.get((prov_id, id))
+            case Iccid(iccid=iccid):
+                return self._by_iccid.get(iccid)
+            case Imsi(imsi=imsi):
+                return self._by_imsi.get(imsi)
+            case SimIndex(provider=prov_id, index=index):
+                sims = self._by_provider.get(prov_id, [])
+                return sims[index] if index < len(sims) else None
+            case _:
+                raise NotImplementedError
+
+    def registered(self, provider_id: UUID) -> bool:
+        return provider_id in self._providers
+
+    def replace_provider(self, provider_id: UUID, sims: list[SimEntry]) -> None:
+        self.remove_provider(provider_id)
+        self._providers.add(provider_id)
+
+        if len(sims) == 0:
+            return
+
+        sims = sorted(sims, key=lambda s: s.id)
+        self._by_provider[provider_id] = sims
+
+        for sim in sims:
+            self._add(sim)
+
+    def remove_provider(self, provider_id: UUID) -> None:
+        self._providers.discard(provider_id)
+        for sim in self._by_provider.pop(provider_id, []):
+            self._remove(sim)
+
+    def clear(self) -> None:
+        self._by_id.clear()
+        self._by_iccid.clear()
+        self._by_imsi.clear()
+        self._by_provider.clear()
+        self._providers.clear()
+
+    async def load(self, async_session: Callable[[], AsyncSession]) -> None:
+        async with async_session() as session, session.begin():
+            providers = await session.scalars(select(dbm.Provider.id))
+            sims = await session.scalars(select(dbm.Sim).order_by(dbm.Sim.id))
+
+            self.clear()
+            self._providers.update(providers)
+            for sim in sims:
+                entry = SimEntry(sim.id, sim.iccid, sim.imsi, sim.provider_id)
+                self._by_provider.setdefault(sim.provider_id, []).append(entry)
+                self._add(entry)
+
+        LOGGER.info(
+            "Loaded %d SIM cards of %d providers.", len(self), len(self._providers)
+        )
+
+    async def reload_provider(
+        self, async_session: Callable[[], AsyncSession], provider_id: UUID
+    ) -> None:
+        async with async_session() as session, session.begin():
+            if await session.get(dbm.Provider, provider_id) is None:
+                self.remove_provider(provider_id)
+                return
+
+            sims = await session.scalars(
+                select(dbm.Sim).where(dbm.Sim.provider_id == provider_id)
+            )
+            self.replace_provider(
+                provider_id,
+                [SimEntry(s.id, s.iccid, s.imsi, s.provider_id) for s in sims],
+            )
+
+    def _add(self, sim: SimEntry) -> None:
+        self._by_id[(sim.provider_id, sim.id)] = sim
+
+        # entries of another provider with the same ICCID/IMSI can only be left
+        # over if a notification was missed; the newer registration wins
+        if sim.iccid is not None:
+            self._evict(self._by_iccid.get(sim.iccid))
+            self._by_iccid[sim.iccid] = sim
+        if sim.imsi is not None:
+            self._evict(self._by_imsi.get(sim.imsi))
+            self._by_imsi[sim.imsi] = sim
+
+    def _remove(self, sim: SimEntry) -> None:
+        self._by_id.pop((sim.provider_id, sim.id), None)
+
+        if sim.iccid is not None and self._by_iccid.get(sim.iccid) is sim:
+            del self._by_iccid[sim.iccid]
+        if sim.imsi is not None and self._by_imsi.get(sim.imsi) is sim:
+            del self._by_imsi[sim.imsi]
+
+    def _evict(self, sim: Optional[SimEntry]) -> None:
+        if sim is None:
+            return
+
+        self._remove(sim)
+
+        sims = self._by_provider.get(sim.provider_id)
+        if sims is None:
+            return
+
+        i = bisect.bisect_left(sims, sim.id, key=lambda s: s.id)
+        if i < len(sims) and sims[i] is sim:
+            del sims[i]
+            if len(sims) == 0:
+                del self._by_provider[sim.provider_id]
@@ -0,0 +1,225 @@
+"""Runtime state of the providers connected to this process.
+
+`StateStore` is the source of truth for `Provider.available`, `Provider.last_active`
+and `Sim.in_use`. Connecting and disconnecting providers and starting and ending
+tunnel sessions only change the in-memory state; the state of changed (and still
+connected) providers is written to the database every `STATE_SNAPSHOT_INTERVAL`.
+The database copy is for other processes (e.g., the REST API) and may lag behind
+by up to one interval.
+
+Every provider is handled by a single process (see `tunnel.workers`), so the
+snapshots of different processes never concern the same provider. After a crash,
+`recover` resets the state that the previous process left in the database.
+"""
+
+import asyncio
+import datetime
+import logging
+import time
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from uuid import UUID
+
+from sqlalchemy import column, exists, false, func, select, update, values
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import metrics, timers
+from . import models as dbm
+
+LOGGER = logging.getLogger(__name__)
+
+SNAPSHOT_SECONDS = metrics.Histogram(
+    "moatt_state_snapshot_seconds", "Duration of state snapshots."
+)
+SNAPSHOT_PROVIDERS = metrics.Counter(
+    "moatt_state_snapshot_providers_total",
+    "Number of provider states written to the database.",
+)
+SNAPSHOT_ERRORS = metrics.Counter(
+    "moatt_state_snapshot_errors_total", "Number of failed state snapshots."
+)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+@dataclass
+class ProviderState:
+    # number of connections waiting for connection requests
+    available: int = 0
+    last_active: datetime.datetime = field(default_factory=_now)
+    # number of tunnel sessions per SIM
+    sessions: Counter[int] = field(default_factory=Counter)
+
+    def idle(self) -> bool:
+        return self.available == 0 and len(self.sessions) == 0
+
+
+class StateStore:
+    """In-memory state of the providers handled by this process.
+
+    Updates never wait, so they are atomic with respect to other tasks.
+    """
+
+    def __init__(self, is_local: Callable[[UUID], bool] = lambda _: True):
+        """`is_local` tells whether a provider is handled by this process."""
+        self._is_local = is_local
+        self._providers: dict[UUID, ProviderState] = {}
+        # providers whose state changed since the last snapshot
+        self._dirty: set[UUID] = set()
+
+    def provider_available(self, provider_id: UUID) -> None:
+        self._update(provider_id).available += 1
+
+    def provider_unavailable(self, provider_id: UUID) -> None:
+        state = self._update(provider_id)
+        assert state.available > 0
+        state.available -= 1
+
+    def sim_used(self, provider_id: UUID, sim_id: int) -> None:
+        self._update(provider_id).sessions[sim_id] += 1
+
+    def sim_unused(self, provider_id: UUID, sim_id: int) -> None:
+        sessions = self._update(provider_id).sessions
+        assert sessions[sim_id] > 0
+        sessions[sim_id] -= 1
+        if sessions[sim_id] == 0:
+            del sessions[sim_id]
+
+    def available(self, provider_id: UUID) -> int:
+        state = self._providers.get(provider_id)
+        return state.available if state is not None else 0
+
+    def in_use(self, provider_id: UUID, sim_id: int) -> bool:
+        state = self._providers.get(provider_id)
+        return state is not None and sim_id in state.sessions
+
+    def _update(self, provider_id: UUID) -> ProviderState:
+        state = self._providers.get(provider_id)
+        if state is None:
+            state = self._providers[provider_id] = ProviderState()
+
+        state.last_active = _now()
+        self._dirty.add(provider_id)
+
+        return state
+
+    async def recover(self, async_session: async_sessionmaker[AsyncSession]) -> None:
+        """Reset the state of this process' providers in the database.
+
+        Has to run before any provider connects: all connections of a previous
+        process are gone.
+        """
+        async with async_session() as session, session.begin():
+            ids = await session.scalars(
+                select(dbm.Provider.id).where(
+                    (dbm.Provider.available != 0)
+                    | exists().where(
+                        dbm.Sim.provider_id == dbm.Provider.id, dbm.Sim.in_use
+                    )
+                )
+            )
+            stale = [id for id in ids if self._is_local(id)]
+
+            if len(stale) == 0:
+                return
+
+            await session.execute(
+                update(dbm.Provider)
+                .where(dbm.Provider.id.in_(stale))
+                .values(available=0)
+            )
+            await session.execute(
+                update(dbm.Sim)
+                .where(dbm.Sim.provider_id.in_(stale), dbm.Sim.in_use)
+                .values(in_use=False)
+            )
+
+        LOGGER.info("Reset the state of %d providers.", len(stale))
+
+    async def snapshot(self, async_session: async_sessionmaker[AsyncSession]) -> None:
+        """Write the state of changed and connected providers to the database."""
+        now = _now()
+        for id, state in self._providers.items():
+            if not state.idle():
+                state.last_active = now
+                self._dirty.add(id)
+
+        if len(self._dirty) == 0:
+            return
+
+        dirty, self._dirty = self._dirty, set()
+        states = {id: self._providers[id] for id in dirty}
+
+        start = time.perf_counter()
+        try:
+            async with async_session() as session, session.begin():
+                await self._write(session, states)
+        except BaseException:
+            SNAPSHOT_ERRORS.inc()
+            self._dirty |= dirty
+            raise
+        SNAPSHOT_SECONDS.observe(time.perf_counter() - start)
+        SNAPSHOT_PROVIDERS.inc(len(states))
+
+        for id, state in states.items():
+            if state.idle() and id not in self._dirty:
+                del self._providers[id]
+
+    async def _write(
+        self, session: AsyncSession, states: dict[UUID, ProviderState]
+    ) -> None:
+        p = values(
+            column("id", dbm.Provider.id.type),
+            column("available", dbm.Provider.available.type),
+            column("last_active", dbm.Provider.last_active.type),
+            name="state",
+        ).data([(id, s.available, s.last_active) for id, s in states.items()])
+
+        await session.execute(
+            update(dbm.Provider)
+            .where(dbm.Provider.id == p.c.id)
+            .values(
+                available=p.c.available,
+                last_active=func.greatest(dbm.Provider.last_active, p.c.last_active),
+            ),
+            execution_options={"synchronize_session": False},
+        )
+
+        used = [(id, sim_id) for id, s in states.items() for sim_id in s.sessions]
+        if len(used) > 0:
+            u = values(
+                column("provider_id", dbm.Sim.provider_id.type),
+                column("id", dbm.Sim.id.type),
+                name="used",
+            ).data(used)
+            in_use = exists().where(
+                u.c.provider_id == dbm.Sim.provider_id, u.c.id == dbm.Sim.id
+            )
+        else:
+            in_use = false()
+
+        await session.execute(
+            update(dbm.Sim)
+            .where(dbm.Sim.provider_id.in_(states.keys()), dbm.Sim.in_use != in_use)
+            .values(in_use=in_use),
+            execution_options={"synchronize_session": False},
+        )
+
+    async def run(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        interval: datetime.timedelta,
+    ) -> None:
+        """Run `snapshot` every `interval`."""
+        while True:
+            await timers.wheel().sleep(interval.total_seconds())
+
+            try:
+                await self.snapshot(async_session)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                LOGGER.exception("Failed to write the provider state snapshot.")
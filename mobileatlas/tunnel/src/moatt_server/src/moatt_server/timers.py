@@ -0,0 +1,222 @@
+"""Hierarchical timer wheel shared by all timeouts of the tunnel server.
+
+Timers are kept in `LEVELS` wheels of `SLOTS` slots each. Level 0 has one
+slot per tick; a slot of level l spans SLOTS**l ticks and is moved down to
+the lower levels ("cascaded") when the wheel reaches it. Scheduling and
+cancelling a timer is O(1) and a single task (`TimerWheel.run`) advances the
+wheel, so the number of pending timeouts does not add tasks or entries to the
+event loop's own timer heap.
+
+Timers fire on the first tick at or after their deadline, i.e. up to one
+`resolution` late.
+"""
+
+import asyncio
+import logging
+import math
+from collections.abc import Callable
+from typing import Any, Optional
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+SLOTS_BITS = 6
+SLOTS = 1 << SLOTS_BITS
+LEVELS = 4
+
+RESOLUTION = 0.1  # seconds per tick
+
+
+class Timer:
+    __slots__ = ("deadline", "_wheel", "_tick", "_callback", "_args", "_slot")
+
+    def __init__(
+        self,
+        wheel: "TimerWheel",
+        deadline: float,
+        tick: int,
+        callback: Callable[..., Any],
+        args: tuple,
+    ):
+        self.deadline = deadline
+        self._wheel = wheel
+        self._tick = tick
+        self._callback = callback
+        self._args = args
+        self._slot: Optional[dict["Timer", None]] = None
+
+    def cancel(self) -> None:
+        if self._slot is not None:
+            del self._slot[self]
+            self._slot = None
+            self._wheel._count -= 1
+
+    def cancelled(self) -> bool:
+        return self._slot is None
+
+
+class TimerWheel:
+    def __init__(self, resolution: float = RESOLUTION):
+        self.resolution = resolution
+
+        self._loop = asyncio.get_running_loop()
+        self._start = self._loop.time()
+        self._now = 0  # last processed tick
+        self._wheels: list[list[dict[Timer, None]]] = [
+            [{} for _ in range(SLOTS)] for _ in range(LEVELS)
+        ]
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def call_at(self, when: float, callback: Callable[..., Any], *args) -> Timer:
+        """Run `callback(*args)` once `loop.time()` reaches `when`."""
+        tick = max(math.ceil((when - self._start) / self.resolution), self._now + 1)
+        timer = Timer(self, when, tick, callback, args)
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def call_later(self, delay: float, callback: Callable[..., Any], *args) -> Timer:
+        return self.call_at(self._loop.time() + delay, callback, *args)
+
+    async def sleep(self, delay: float) -> None:
+        fut = self._loop.create_future()
+        timer = self.call_later(delay, _set_result, fut)
+        try:
+            await fut
+        finally:
+            timer.cancel()
+
+    def timeout(self, delay: Optional[float]) -> "Timeout":
+        """Like `asyncio.timeout` but scheduled on the wheel."""
+        return Timeout(self, delay)
+
+    async def run(self) -> None:
+        while True:
+            next_tick = self._start + (self._now + 1) * self.resolution
+            await asyncio.sleep(max(0, next_tick - self._loop.time()))
+            self.advance(self._loop.time())
+
+    def advance(self, now: float) -> None:
+        """Process all ticks up to `now` (loop time)."""
+        target = math.floor((now - self._start) / self.resolution)
+
+        while self._now < target:
+            self._now += 1
+            self._cascade()
+
+            slot = self._wheels[0][self._now & (SLOTS - 1)]
+            if len(slot) == 0:
+                continue
+
+            timers = list(slot)
+            slot.clear()
+            for t in timers:
+                t._slot = None
+                self._count -= 1
+                try:
+                    t._callback(*t._args)
+                except Exception:
+                    LOGGER.exception("Timer callback failed.")
+
+    def _cascade(self) -> None:
+        # move the timers of the higher level slots that start at this tick
+        # down, beginning with the highest level
+        levels = []
+        for level in range(1, LEVELS):
+            if self._now & ((1 << (SLOTS_BITS * level)) - 1) != 0:
+                break
+            levels.append(level)
+
+        for level in reversed(levels):
+            idx = (self._now >> (SLOTS_BITS * level)) & (SLOTS - 1)
+            slot = self._wheels[level][idx]
+            if len(slot) == 0:
+                continue
+
+            timers = list(slot)
+            slot.clear()
+            for t in timers:
+                self._insert(t)
+
+    def _insert(self, timer: Timer) -> None:
+        tick = timer._tick
+
+        for level in range(LEVELS):
+            # same rotation of the next higher level -> fits into this level
+            shift = SLOTS_BITS * (level + 1)
+            if tick >> shift == self._now >> shift:
+                break
+        else:
+            # beyond the current rotation of the top level; park it in the top
+            # level's first slot, which is cascaded when the next rotation starts
+            # (and never holds other timers)
+            level = LEVELS - 1
+            tick = 0
+
+        slot = self._wheels[level][(tick >> (SLOTS_BITS * level)) & (SLOTS - 1)]
+        slot[timer] = None
+        timer._slot = slot
+
+
+class Timeout:
+    def __init__(self, wheel: TimerWheel, delay: Optional[float]):
+        self._wheel = wheel
+        self._delay = delay
+        self._task: Optional[asyncio.Task] = None
+        self._timer: Optional[Timer] = None
+        self._expired = False
+
+    async def __aenter__(self) -> "Timeout":
+        if self._delay is not None:
+            self._task = asyncio.current_task()
+            self._timer = self._wheel.call_later(self._delay, self._expire)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+
+        if (
+            self._expired
+            and exc_type is asyncio.CancelledError
+            and self._task is not None
+            and self._task.uncancel() == 0
+        ):
+            raise TimeoutError from exc
+
+    def expired(self) -> bool:
+        return self._expired
+
+    def _expire(self) -> None:
+        assert self._task is not None
+
+        self._expired = True
+        self._task.cancel()
+
+
+def _set_result(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+_WHEEL: TimerWheel | None = None
+
+TIMERS_PENDING = metrics.GaugeFunc(
+    "moatt_timers_pending",
+    "Number of timeouts scheduled on the timer wheel.",
+    lambda: [((), len(_WHEEL) if _WHEEL is not None else 0)],
+)
+
+
+def wheel() -> TimerWheel:
+    """The process-wide timer wheel (driven by the tunnel server)."""
+    global _WHEEL
+
+    if _WHEEL is None:
+        _WHEEL = TimerWheel()
+
+    return _WHEEL
@@ -1,90 +1,130 @@
 import asyncio
+import itertools
 import logging
-import struct
+import time
+import weakref
 from typing import Optional
 from uuid import UUID
 
-from moatt_types.connect import ApduPacket
+from moatt_types.connect import ApduOp, ApduPacket
 
-from .. import models as dbm
+from .. import metrics
+from ..sim_directory import SimEntry
 
 LOGGER = logging.getLogger(__name__)
 
+# streams whose peer sent a ping
+_PINGED: weakref.WeakSet["ApduStream"] = weakref.WeakSet()
+_TOKENS = itertools.count()
+
+RTT_SECONDS = metrics.Histogram(
+    "moatt_rtt_seconds",
+    "Round-trip times to clients measured with pings.",
+    ["peer"],
+)
+TUNNEL_RTT = metrics.GaugeFunc(
+    "moatt_tunnel_rtt_seconds",
+    "Last round-trip time measured for each end of the active tunnels.",
+    lambda: (
+        ((s.role, str(s.client_id), str(s.sim.id)), s.rtt)
+        for s in list(_PINGED)
+        if s.rtt is not None
+    ),
+    ["peer", "client", "sim"],
+)
+
+# Upper bound on the amount of data buffered for an unresponsive peer before
+# send() starts waiting for the buffer to drain.
+WRITE_BUFFER_LIMIT = 16 * 2**10
+
 
 class ApduStream:
     def __init__(
         self,
-        sim: dbm.Sim,
+        sim: SimEntry,
         client_id: UUID,
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
+        role: str = "",
     ):
         self.sim = sim
         self.client_id = client_id
         self.reader = reader
         self.writer = writer
+        self.role = role
+
+        # Only peers that sent a ping themselves are pinged by the server, as
+        # older clients do not know about pings.
+        self.pings = False
+        self.rtt: Optional[float] = None
+        # other end of the tunnel; its RTT is reported in Pongs
+        self.peer: Optional["ApduStream"] = None
+        self._ping: Optional[tuple[bytes, float]] = None
 
-        self._send_queue: Optional[asyncio.Queue[ApduPacket]] = None
-        self._send_task = None
+        # streams of multiplexed connections are limited by their send window
+        transport = getattr(writer, "transport", None)
+        if transport is not None:
+            transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
 
     async def recv(self) -> Optional[ApduPacket]:
-        buf = await self.reader.read(n=6)
+        """Receive the next packet; Pings and Pongs are handled and not returned."""
+        while True:
+            packet = await self._recv()
 
-        if len(buf) == 0:
-            return None
+            if packet is None:
+                return None
 
-        missing = ApduStream._bytes_missing(buf)
-        while missing > 0:
-            r = await self.reader.read(n=missing)
+            match packet.op:
+                case ApduOp.Ping:
+                    if not self.pings:
+                        self.pings = True
+                        _PINGED.add(self)
 
-            if len(r) == 0:
-                raise asyncio.IncompleteReadError(buf, missing)
+                    peer_rtt = self.peer.rtt if self.peer is not None else None
+                    await self.send(ApduPacket.pong(packet, peer_rtt))
+                case ApduOp.Pong:
+                    self._pong(packet)
+                case _:
+                    return packet
 
-            buf += r
-            missing = ApduStream._bytes_missing(buf)
+    def ping(self) -> None:
+        """Send a ping (without waiting for the write buffer to drain)."""
+        token = next(_TOKENS).to_bytes(ApduPacket.PING_TOKEN_LEN, "big")
+        self._ping = (token, time.monotonic())
+        self.writer.write(ApduPacket(ApduOp.Ping, token).encode())
 
-        p = ApduPacket.decode(buf)
+    def ping_pending(self) -> bool:
+        return self._ping is not None
 
-        if p is None:
-            raise ValueError
+    def ping_overdue(self, timeout: float) -> bool:
+        return self._ping is not None and time.monotonic() - self._ping[1] > timeout
 
-        return p
+    def _pong(self, packet: ApduPacket) -> None:
+        if self._ping is None or packet.token() != self._ping[0]:
+            return
 
-    async def send(self, apdu: ApduPacket):
-        self.writer.write(apdu.encode())
-        await self.writer.drain()
+        self.rtt = time.monotonic() - self._ping[1]
+        self._ping = None
+        RTT_SECONDS.labels(self.role).observe(self.rtt)
 
-    def send_background(self, apdu: ApduPacket):
-        if self._send_queue is None:
-            self._send_queue = asyncio.Queue()
-            self._send_task = asyncio.create_task(self._send_bg_task())
+    async def _recv(self) -> Optional[ApduPacket]:
+        try:
+            header = await self.reader.readexactly(ApduPacket.HEADER_LEN)
+        except asyncio.IncompleteReadError as e:
+            if len(e.partial) == 0:
+                return None
+            raise
 
-        # Does not throw an exception because the queue is unbounded
-        self._send_queue.put_nowait(apdu)
+        op, plen = ApduPacket.decode_header(header)
+        payload = await self.reader.readexactly(plen) if plen > 0 else b""
 
-    async def wait_bg_sends(self):
-        if self._send_queue is not None:
-            await self._send_queue.join()
+        return ApduPacket(op, payload)
+
+    async def send(self, apdu: ApduPacket):
+        self.writer.write(apdu.encode())
+        await self.writer.drain()
 
     async def close(self):
+        _PINGED.discard(self)
         self.writer.close()
         await self.writer.wait_closed()
-
-    @staticmethod
-    def _bytes_missing(msg: bytes) -> int:
-        if len(msg) < 6:
-            return 6 - len(msg)
-
-        (plen,) = struct.unpack("!I", msg[2:6])
-        if len(msg) < 6 + plen:
-            return (6 + plen) - len(msg)
-        else:
-            return 0
-
-    async def _send_bg_task(self):
-        assert self._send_queue is not None
-
-        while True:
-            apdu = await self._send_queue.get()
-            await self.send(apdu)
-            self._send_queue.task_done()
@@ -1,12 +1,18 @@
 import argparse
 import logging
 import logging.config
+import multiprocessing
+import multiprocessing.connection
+import shutil
 import ssl
+import tempfile
+from pathlib import Path
 
 import uvloop
 
 from .. import config
 from .server import Server
+from .workers import WorkerGroup
 
 LOGGER = logging.getLogger(__name__)
 
@@ -20,22 +26,92 @@ def main():
     parser.add_argument("--cert-key", default="ssl/server.key")
     parser.add_argument("--config", default="config.toml")
     parser.add_argument("--allow-auth-plugins", action="store_true")
+    parser.add_argument(
+        "--workers", "-w", type=int, help="Number of worker processes to start."
+    )
+    parser.add_argument(
+        "--session-tickets",
+        type=int,
+        help="Number of TLS session tickets sent to clients (0 disables resumption).",
+    )
     args = parser.parse_args()
 
+    _init(args)
+
+    workers = config.get_config().TUNNEL_WORKERS
+    if workers <= 1:
+        _run(args)
+    else:
+        _run_workers(args, workers)
+
+
+def _init(args: argparse.Namespace) -> None:
     config.init_config(args.config, args.allow_auth_plugins, args)
 
     log_conf = config.get_config().LOGGING_CONF_FILE
     if log_conf is not None:
         logging.config.fileConfig(log_conf)
 
+
+def _run(args: argparse.Namespace, workers: WorkerGroup | None = None) -> None:
     tls_ctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
     tls_ctx.verify_mode = ssl.CERT_REQUIRED
     tls_ctx.load_cert_chain(args.cert, args.cert_key)
+    _set_session_tickets(tls_ctx, config.get_config().TLS_SESSION_TICKETS)
 
-    server = Server(config.get_config(), args.host, args.port, tls_ctx)
+    server = Server(config.get_config(), args.host, args.port, tls_ctx, workers=workers)
 
     uvloop.run(server.start())
 
 
+def _set_session_tickets(tls_ctx: ssl.SSLContext, n: int) -> None:
+    """Let clients resume TLS sessions with tickets (disabled if `n` is 0).
+
+    The ticket keys are generated by OpenSSL for every process (the ssl module
+    does not allow setting them), so tickets are only accepted by the worker that
+    issued them and become invalid when the server restarts.
+    """
+    tls_ctx.num_tickets = n  # TLS 1.3
+
+    if n == 0:
+        tls_ctx.options |= ssl.OP_NO_TICKET  # TLS 1.2
+
+
+def _worker_main(args: argparse.Namespace, index: int, size: int, socket_dir: Path):
+    _init(args)
+    _run(args, WorkerGroup(index, size, socket_dir))
+
+
+def _run_workers(args: argparse.Namespace, size: int) -> None:
+    LOGGER.info("Starting %d worker processes.", size)
+
+    socket_dir = Path(tempfile.mkdtemp(prefix="moat-tunnel-"))
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(
+            target=_worker_main,
+            args=(args, i, size, socket_dir),
+            name=f"moat-tunnel-worker-{i}",
+        )
+        for i in range(size)
+    ]
+
+    try:
+        for p in procs:
+            p.start()
+
+        # the workers depend on each other so there is no point in keeping
+        # the remaining workers running once one of them exits
+        multiprocessing.connection.wait([p.sentinel for p in procs])
+        LOGGER.error("A worker process exited unexpectedly. Stopping...")
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
 if __name__ == "__main__":
     main()
@@ -1,6 +1,24 @@
+"""Per-provider queues of connection requests made by probes.
+
+Entries are kept in a binary heap ordered by (priority class, fair queueing
+tag) that decides which request is handed to the next provider; their expiry
+is scheduled on the shared timer wheel. Removing an entry (because it expired
+or because its probe disconnected) only marks it; marked entries are skipped
+when they reach the top of the heap and the heap is compacted once it consists
+mostly of such entries.
+
+Fairness between probes follows start-time fair queueing: a probe's k-th
+waiting request is tagged k rounds after the request that was served last, so
+requests of different probes are interleaved instead of served in arrival
+order.
+"""
+
 import asyncio
 import collections
+import heapq
+import itertools
 import logging
+import time
 from collections.abc import Awaitable
 from datetime import datetime, timedelta, timezone
 from typing import Callable, Optional
@@ -8,23 +26,41 @@ from uuid import UUID
 
 from moatt_types.connect import ConnectRequest, ConnectResponse, ConnectStatus
 
-from .. import config
-from .. import models as dbm
+from .. import config, metrics, timers
+from ..sim_directory import SimEntry
+from .util import wait_eof
 
 LOGGER = logging.getLogger(__name__)
 
 _QUEUES: dict[UUID, "Queue"] = {}
 
+QUEUE_DEPTH = metrics.GaugeFunc(
+    "moatt_queue_depth",
+    "Number of connection requests waiting for a provider.",
+    lambda: (((str(id),), q.qsize()) for id, q in _QUEUES.items()),
+    ["provider"],
+)
+QUEUE_REMOVED = metrics.Counter(
+    "moatt_queue_removed_total",
+    "Connection requests removed from a queue without reaching a provider.",
+    ["reason"],
+)
+
+# compact the heap once it contains more than this many removed entries and
+# more removed than live ones
+_COMPACT_THRESHOLD = 64
+
 
 class QueueEntry:
     def __init__(
         self,
-        sim: dbm.Sim,
+        sim: SimEntry,
         probe_id: UUID,
         con_req: ConnectRequest,
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
         immediate: bool = False,
+        priority: int = 0,
     ):
         self.sim = sim
         self.probe_id = probe_id
@@ -32,82 +68,273 @@ class QueueEntry:
         self.reader = reader
         self.writer = writer
         self.immediate = immediate
+        self.priority = priority
+        self.enqueued = time.monotonic()
+
+        # set by Queue
+        self.deadline: Optional[float] = None  # loop.time()
+        self._timer: Optional[timers.Timer] = None
+        self.queued = False
+        self._watch: Optional[asyncio.Task[None]] = None
+
+
+class Queue:
+    def __init__(self, maxsize: int, max_per_probe: Optional[int] = None):
+        self.maxsize = maxsize
+        self.max_per_probe = max_per_probe
 
+        self._loop = asyncio.get_running_loop()
+        self._seq = itertools.count()
+        # (priority, tag, seq, entry)
+        self._ready: list[tuple[int, int, int, QueueEntry]] = []
+        self._size = 0
 
-class Queue(asyncio.Queue):
-    # overridable methods from asyncio.Queue
+        self._per_probe: dict[UUID, int] = {}
+        self._last_tag: dict[UUID, int] = {}
+        self._vtime = 0
 
-    # called at the end of super().__init__
-    def _init(self, maxsize):
-        self._queue = collections.deque()
+        self._getters: collections.deque[asyncio.Future[QueueEntry]] = (
+            collections.deque()
+        )
         self._last_active: datetime = datetime.now(tz=timezone.utc)
-        self._active: int = 0
-        self._gc_task = asyncio.create_task(self._gc())
 
-    def _get(self) -> QueueEntry:
-        self._acquire()
-        try:
-            qe = self._queue.popleft()
-            return qe
-        finally:
-            self._release()
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def full(self) -> bool:
+        return self._size >= self.maxsize
+
+    def put_nowait(self, item: QueueEntry) -> None:
+        """Enqueue a request.
+
+        Raises
+        ------
+        asyncio.QueueFull
+            If the queue is full, the probe already has `max_per_probe` waiting
+            requests, or if the request must not wait and no provider is idle.
+        """
+        if self._handoff(item):
+            return
+
+        if (
+            item.immediate
+            or self.full()
+            or (
+                self.max_per_probe is not None
+                and self._per_probe.get(item.probe_id, 0) >= self.max_per_probe
+            )
+        ):
+            raise asyncio.QueueFull(item)
+
+        wait = config.get_config().MAX_PROBE_WAITTIME
+        if wait is not None:
+            item.deadline = self._loop.time() + wait.total_seconds()
 
-    def _put(self, item: QueueEntry):
-        self._queue.append(item)
+        self._push(item, max(self._vtime, self._last_tag.get(item.probe_id, 0)) + 1)
 
-    # end of overridable methods
+    def requeue_nowait(self, item: QueueEntry) -> None:
+        """Put a previously dequeued entry back at the front of the queue."""
+        if self._handoff(item):
+            return
+
+        if self.full():
+            raise asyncio.QueueFull(item)
+
+        # keeps the original deadline; tags of waiting entries are >= self._vtime
+        self._push(item, self._vtime - 1)
+
+    async def get(self) -> QueueEntry:
+        """Remove and return the next live entry, waiting for one if necessary."""
+        while True:
+            item = self._pop()
+
+            if item is None:
+                fut = self._loop.create_future()
+                self._getters.append(fut)
+                try:
+                    item = await fut
+                except asyncio.CancelledError:
+                    if fut.done() and not fut.cancelled():
+                        self.requeue_nowait(fut.result())
+                    else:
+                        self._getters.remove(fut)
+                    raise
+
+            try:
+                if await self._unwatch(item):
+                    self._touch()
+                    return item
+            except asyncio.CancelledError:
+                self.requeue_nowait(item)
+                raise
+
+    def remove(self, item: QueueEntry) -> bool:
+        """Remove a waiting entry in O(1). Returns False if it was not queued."""
+        if not self._discard(item):
+            return False
+
+        if item._watch is not None:
+            item._watch.cancel()
+            item._watch = None
+
+        return True
 
     # active if currently running a tunnel?
     def last_active(self) -> Optional[datetime]:
-        if self._active > 0:
+        if self._size > 0 or len(self._getters) > 0:
             return None
 
         return self._last_active
 
-    def _acquire(self) -> None:
-        self._active += 1
+    def _touch(self) -> None:
+        self._last_active = datetime.now(tz=timezone.utc)
 
-    def _release(self) -> None:
-        assert self._active > 0
+    def _handoff(self, item: QueueEntry) -> bool:
+        """Give `item` directly to a waiting provider.
 
-        self._active -= 1
+        Providers only wait if there are no queued entries, so this does not
+        skip anyone.
+        """
+        while len(self._getters) > 0:
+            fut = self._getters.popleft()
+            if not fut.done():
+                fut.set_result(item)
+                return True
 
-        if self._active == 0:
-            self._last_active = datetime.now(tz=timezone.utc)
+        return False
 
-    def _cleanup(self) -> int:
-        self._gc_task.cancel()
+    def _push(self, item: QueueEntry, tag: int) -> None:
+        item.queued = True
+        self._size += 1
+        self._per_probe[item.probe_id] = self._per_probe.get(item.probe_id, 0) + 1
+        self._last_tag[item.probe_id] = max(tag, self._last_tag.get(item.probe_id, 0))
+
+        seq = next(self._seq)
+        heapq.heappush(self._ready, (item.priority, tag, seq, item))
+
+        if item.deadline is not None:
+            item._timer = timers.wheel().call_at(item.deadline, self._expire, item)
+
+        if item._watch is None:
+            item._watch = asyncio.create_task(wait_eof(item.reader))
+            item._watch.add_done_callback(lambda t: self._probe_gone(item, t))
+
+    def _pop(self) -> Optional[QueueEntry]:
+        now = self._loop.time()
+
+        while len(self._ready) > 0:
+            _, tag, _, item = heapq.heappop(self._ready)
+
+            if not item.queued:
+                continue
+
+            if item.deadline is not None and item.deadline <= now:
+                # the wheel fires up to one tick late
+                self._expire(item)
+                continue
 
+            self._vtime = max(self._vtime, tag)
+            # the probe's connection is still watched until _unwatch is called
+            self._discard(item)
+            return item
+
+        return None
+
+    def _discard(self, item: QueueEntry) -> bool:
+        if not item.queued:
+            return False
+
+        item.queued = False
+        self._size -= 1
+
+        n = self._per_probe[item.probe_id] - 1
+        if n == 0:
+            del self._per_probe[item.probe_id]
+            self._last_tag.pop(item.probe_id, None)
+        else:
+            self._per_probe[item.probe_id] = n
+
+        if item._timer is not None:
+            item._timer.cancel()
+            item._timer = None
+
+        # entries stay in the heap until they reach the top
+        if len(self._ready) > 2 * self._size + _COMPACT_THRESHOLD:
+            self._compact()
+
+        return True
+
+    async def _unwatch(self, item: QueueEntry) -> bool:
+        """Stop watching the probe's connection.
+
+        Returns False if the probe disconnected or sent unexpected data.
+        """
+        watch = item._watch
+        item._watch = None
+
+        if watch is not None:
+            watch.cancel()
+            await asyncio.wait([watch])
+
+            if not watch.cancelled():
+                self._probe_disconnected(item, watch)
+                return False
+
+        return not item.writer.is_closing()
+
+    def _probe_gone(self, item: QueueEntry, task: asyncio.Task[None]) -> None:
+        # entries that were already dequeued are handled by _unwatch
+        if task.cancelled() or not item.queued:
+            return
+
+        item._watch = None
+        self._discard(item)
+        self._probe_disconnected(item, task)
+
+    def _probe_disconnected(self, item: QueueEntry, task: asyncio.Task[None]) -> None:
+        if (e := task.exception()) is not None:
+            LOGGER.info(f"Removing connection request of probe: {e}")
+        else:
+            LOGGER.info("Probe disconnected while waiting for a provider.")
+
+        self._close_probe(item, "disconnected", None)
+
+    def _expire(self, item: QueueEntry) -> None:
+        if self.remove(item):
+            LOGGER.info("Connection request of probe expired.")
+            self._close_probe(item, "expired", ConnectStatus.ProviderTimedOut)
+
+    def _close_probe(
+        self, item: QueueEntry, reason: str, status: Optional[ConnectStatus]
+    ) -> None:
+        QUEUE_REMOVED.labels(reason).inc()
+
+        if status is not None and not item.writer.is_closing():
+            try:
+                item.writer.write(ConnectResponse(status).encode())
+            except Exception:
+                pass
+        item.writer.close()
+
+    def _compact(self) -> None:
+        LOGGER.debug("Compacting connection queue.")
+
+        self._ready = [e for e in self._ready if e[3].queued]
+        heapq.heapify(self._ready)
+
+    def _cleanup(self) -> int:
         num_closed = 0
-        try:
-            while True:
-                writer = self.get_nowait().writer
-                try:
-                    writer.write(
-                        ConnectResponse(ConnectStatus.ProviderTimedOut).encode()
-                    )
-                except Exception:
-                    pass
-                writer.close()
+        for _, _, _, item in list(self._ready):
+            if self.remove(item):
+                self._close_probe(item, "shutdown", ConnectStatus.ProviderTimedOut)
                 num_closed += 1
-        except asyncio.QueueEmpty:
-            pass
-        return num_closed
 
-    async def _gc(self):
-        while True:
-            await asyncio.sleep(config.get_config().QUEUE_GC_INTERVAL.total_seconds())
+        self._ready.clear()
 
-            if len(self._queue) != 0:
-                LOGGER.debug("Queue GC starting.")
-                size = len(self._queue)
-                self._queue = collections.deque(
-                    filter(lambda qe: not qe.writer.is_closing(), self._queue)
-                )
-                if len(self._queue) < size:
-                    LOGGER.info(
-                        f"Removed {size - len(self._queue)} closed probe connection(s)."
-                    )
+        return num_closed
 
 
 def queue_gc_coro_factory(timeout: timedelta) -> Callable[[], Awaitable[None]]:
@@ -138,27 +365,19 @@ def queue_gc_coro_factory(timeout: timedelta) -> Callable[[], Awaitable[None]]:
 def _get_queue(id: UUID) -> Queue:
     q = _QUEUES.get(id)
     if q is None:
-        q = Queue(maxsize=config.get_config().MAX_QUEUE_SIZE)
+        cfg = config.get_config()
+        q = Queue(cfg.MAX_QUEUE_SIZE, cfg.MAX_QUEUE_SIZE_PER_PROBE)
         _QUEUES[id] = q
     return q
 
 
 def put_nowait(id: UUID, qe: QueueEntry) -> None:
-    q = _get_queue(id)
-    if qe.immediate and len(q._queue) >= len(q._getters):  # type: ignore
-        raise asyncio.QueueFull(qe)
-    try:
-        q.put_nowait(qe)
-    except asyncio.QueueFull as e:
-        e.args = (qe,)
-        raise
+    _get_queue(id).put_nowait(qe)
 
 
-async def get(id: UUID) -> QueueEntry:
-    q = _get_queue(id)
-    return await q.get()
+def requeue_nowait(id: UUID, qe: QueueEntry) -> None:
+    _get_queue(id).requeue_nowait(qe)
 
 
-def task_done(id: UUID):
-    q = _get_queue(id)
-    q.task_done()
+async def get(id: UUID) -> QueueEntry:
+    return await _get_queue(id).get()
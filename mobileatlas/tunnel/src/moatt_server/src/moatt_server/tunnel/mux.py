@@ -0,0 +1,463 @@
+"""Multiplexed (protocol version 2) client connections.
+
+A single authenticated connection carries many tunnel sessions, each in its own
+stream (see `moatt_types.connect.MuxFrame`). `MuxStream` implements the parts of
+the `asyncio.StreamReader`/`asyncio.StreamWriter` interfaces used by the probe
+and provider handlers, so a stream can be passed as both the reader and the
+writer of a session.
+"""
+
+import asyncio
+import itertools
+import logging
+import weakref
+from typing import Optional
+from uuid import UUID
+
+from moatt_types.connect import MuxFrame, MuxFrameType
+
+from .. import metrics, timers
+from .apdu_stream import RTT_SECONDS
+
+LOGGER = logging.getLogger(__name__)
+
+_MUXES: weakref.WeakSet["Mux"] = weakref.WeakSet()
+_TOKENS = itertools.count()
+
+CONNECTION_RTT = metrics.GaugeFunc(
+    "moatt_connection_rtt_seconds",
+    "Last round-trip time measured for each multiplexed connection.",
+    lambda: (
+        ((m.role, str(m.client_id)), m.rtt) for m in list(_MUXES) if m.rtt is not None
+    ),
+    ["peer", "client"],
+)
+
+
+class MuxStream:
+    def __init__(self, mux: "Mux", stream_id: int):
+        self.id = stream_id
+        self._mux = mux
+
+        # receiving side
+        self._buf = bytearray()
+        self._eof = False
+        self._error: Optional[Exception] = None
+        self._waiter: Optional[asyncio.Future[None]] = None
+        self._recv_window = MuxFrame.INITIAL_WINDOW
+        self._consumed = 0  # read but not yet returned to the peer's window
+
+        # sending side
+        self._send_window = MuxFrame.INITIAL_WINDOW
+        self._pending = bytearray()  # waiting for the send window to open
+        self._flushed: Optional[asyncio.Future[None]] = None
+        self._closing = False
+        self._closed = mux._loop.create_future()
+
+        # streams are removed once both sides sent a Close (or either a Reset),
+        # so both sides agree on the number of open streams
+        self._close_sent = False
+        self._close_received = False
+
+    # reader interface
+
+    async def read(self, n: int = -1) -> bytes:
+        while len(self._buf) == 0:
+            if self._error is not None:
+                raise self._error
+            if self._eof:
+                return b""
+            await self._wait()
+
+        if n < 0 or n >= len(self._buf):
+            n = len(self._buf)
+
+        return self._take(n)
+
+    async def readexactly(self, n: int) -> bytes:
+        while len(self._buf) < n:
+            if self._error is not None:
+                raise self._error
+            if self._eof:
+                partial = bytes(self._buf)
+                self._buf.clear()
+                raise asyncio.IncompleteReadError(partial, n)
+            await self._wait()
+
+        return self._take(n)
+
+    def at_eof(self) -> bool:
+        return self._eof and len(self._buf) == 0
+
+    # writer interface
+
+    def write(self, data: bytes) -> None:
+        if self._error is not None:
+            raise self._error
+        if self._closing:
+            raise ConnectionError("Stream is closed.")
+
+        self._pending += data
+        self._mux._flush(self)
+
+    async def drain(self) -> None:
+        while len(self._pending) > 0 and self._error is None:
+            if self._flushed is None:
+                self._flushed = self._mux._loop.create_future()
+            await self._flushed
+
+        if self._error is not None:
+            raise self._error
+
+        await self._mux._drain()
+
+    def close(self) -> None:
+        if self._closing:
+            return
+
+        self._closing = True
+        # data received from now on is discarded
+        self._eof = True
+        self._buf.clear()
+        self._wakeup()
+        self._mux._flush(self)
+
+    def is_closing(self) -> bool:
+        return self._closing or self._error is not None
+
+    async def wait_closed(self) -> None:
+        await asyncio.shield(self._closed)
+
+    # internals
+
+    async def _wait(self) -> None:
+        if self._waiter is not None:
+            raise RuntimeError("Another coroutine is already waiting for data.")
+
+        self._waiter = self._mux._loop.create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+    def _wakeup(self) -> None:
+        for fut in [self._waiter, self._flushed]:
+            if fut is not None and not fut.done():
+                fut.set_result(None)
+        self._flushed = None
+
+    def _take(self, n: int) -> bytes:
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+
+        self._consumed += n
+        if self._consumed >= MuxFrame.INITIAL_WINDOW // 2 and not self._eof:
+            self._recv_window += self._consumed
+            self._mux._send(MuxFrame.window_update(self.id, self._consumed))
+            self._consumed = 0
+
+        return data
+
+    def _received(self, data: bytes) -> bool:
+        """Returns False if the peer exceeded the stream's window."""
+        if len(data) > self._recv_window:
+            return False
+
+        self._recv_window -= len(data)
+        if not self._eof:
+            self._buf += data
+            self._wakeup()
+
+        return True
+
+    def _remote_closed(self) -> None:
+        self._close_received = True
+        self._eof = True
+        self._wakeup()
+
+    def _reset(self, error: Exception) -> None:
+        if self._error is None:
+            self._error = error
+        self._pending.clear()
+        self._wakeup()
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+
+class Mux:
+    """Demultiplexes the frames received on a version 2 connection.
+
+    `run` has to be running for the streams to make progress. Streams opened by
+    the peer are returned by `accept`; the peer may only open as many
+    concurrent streams as were granted with `allow_streams` (and vice versa).
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        role: str = "",
+        client_id: Optional[UUID] = None,
+    ):
+        self._loop = asyncio.get_running_loop()
+        self._reader = reader
+        self._writer = writer
+        self.role = role
+        self.client_id = client_id
+
+        self.rtt: Optional[float] = None
+        self._ping: Optional[tuple[bytes, float]] = None
+
+        self._streams: dict[int, MuxStream] = {}
+        self._next_id = 2  # server initiated streams use even IDs
+        self._last_peer_id = 0
+        self._local_open = 0
+        self._peer_open = 0
+        self._max_local = 0  # granted by the peer
+        self._max_peer = 0  # granted to the peer
+
+        self._capacity = asyncio.Event()
+        self._incoming: asyncio.Queue[Optional[MuxStream]] = asyncio.Queue()
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def allow_streams(self, n: int) -> None:
+        """Let the peer open `n` more concurrent streams."""
+        self._max_peer += n
+        self._send(MuxFrame.window_update(MuxFrame.CONTROL_STREAM, n))
+
+    async def wait_capacity(self) -> bool:
+        """Wait until the peer allows opening another stream.
+
+        Returns False if the connection was closed.
+        """
+        while not self._closed and self._local_open >= self._max_local:
+            self._capacity.clear()
+            await self._capacity.wait()
+
+        return not self._closed
+
+    def open_stream(self) -> MuxStream:
+        if self._closed:
+            raise ConnectionResetError("Connection is closed.")
+        if self._local_open >= self._max_local:
+            raise RuntimeError("Peer does not allow opening another stream.")
+
+        stream = MuxStream(self, self._next_id)
+        self._next_id += 2
+        self._streams[stream.id] = stream
+        self._local_open += 1
+
+        return stream
+
+    async def accept(self) -> Optional[MuxStream]:
+        """Wait for a stream opened by the peer. Returns None once closed."""
+        if self._closed and self._incoming.empty():
+            return None
+
+        return await self._incoming.get()
+
+    async def _heartbeat(self, interval: float, timeout: float) -> None:
+        """Ping the peer every `interval` seconds.
+
+        Closes the connection if a ping is not answered within `timeout` seconds.
+        """
+        _MUXES.add(self)
+        try:
+            while not self._closed:
+                await timers.wheel().sleep(interval)
+
+                if self._ping is not None:
+                    if self._loop.time() - self._ping[1] > timeout:
+                        LOGGER.warning("Peer did not answer ping. Closing connection.")
+                        self.close()
+                        return
+                    continue
+
+                token = next(_TOKENS).to_bytes(8, "big")
+                self._ping = (token, self._loop.time())
+                self._send(MuxFrame(MuxFrame.CONTROL_STREAM, MuxFrameType.Ping, token))
+        finally:
+            _MUXES.discard(self)
+
+    async def run(
+        self, ping_interval: Optional[float] = None, ping_timeout: float = 5
+    ) -> None:
+        """Process received frames until the connection is closed.
+
+        If `ping_interval` is set, the peer is pinged regularly and the connection
+        is closed if it does not answer within `ping_timeout` seconds.
+        """
+        heartbeat = None
+        if ping_interval is not None:
+            heartbeat = asyncio.create_task(
+                self._heartbeat(ping_interval, ping_timeout)
+            )
+
+        try:
+            while True:
+                try:
+                    header = await self._reader.readexactly(MuxFrame.HEADER_LEN)
+                except asyncio.IncompleteReadError as e:
+                    if len(e.partial) != 0:
+                        LOGGER.warning("Connection closed in the middle of a frame.")
+                    return
+
+                stream_id, type, plen = MuxFrame.decode_header(header)
+                payload = await self._reader.readexactly(plen) if plen > 0 else b""
+
+                if not self._dispatch(MuxFrame(stream_id, type, payload)):
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            LOGGER.info(f"Multiplexed connection lost: {e}")
+        except ValueError as e:
+            LOGGER.warning(f"Received a malformed frame: {e}")
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            self._shutdown()
+
+    def _dispatch(self, frame: MuxFrame) -> bool:
+        """Handle a frame. Returns False if the peer violated the protocol."""
+        if frame.stream_id == MuxFrame.CONTROL_STREAM:
+            match frame.type:
+                case MuxFrameType.WindowUpdate:
+                    self._max_local += frame.increment()
+                    self._capacity.set()
+                case MuxFrameType.Ping:
+                    self._send(
+                        MuxFrame(
+                            MuxFrame.CONTROL_STREAM, MuxFrameType.Pong, frame.payload
+                        )
+                    )
+                case MuxFrameType.Pong:
+                    self._pong(frame.payload)
+                case _:
+                    LOGGER.warning(f"Unexpected frame on control stream: {frame}")
+                    return False
+
+            return True
+
+        if frame.type in (MuxFrameType.Ping, MuxFrameType.Pong):
+            LOGGER.warning(f"Unexpected frame on stream {frame.stream_id}: {frame}")
+            return False
+
+        stream = self._streams.get(frame.stream_id)
+
+        if stream is None:
+            if (
+                frame.type != MuxFrameType.Data
+                or frame.stream_id % 2 == 0
+                or frame.stream_id <= self._last_peer_id
+            ):
+                # frame for a stream that was already closed on our side
+                return True
+
+            self._last_peer_id = frame.stream_id
+            if self._peer_open >= self._max_peer:
+                LOGGER.info("Peer exceeded its stream limit. Resetting stream.")
+                self._send(MuxFrame(frame.stream_id, MuxFrameType.Reset))
+                return True
+
+            stream = MuxStream(self, frame.stream_id)
+            self._streams[stream.id] = stream
+            self._peer_open += 1
+            self._incoming.put_nowait(stream)
+
+        match frame.type:
+            case MuxFrameType.Data:
+                if not stream._received(frame.payload):
+                    LOGGER.warning("Peer exceeded a stream's window. Resetting stream.")
+                    self._send(MuxFrame(stream.id, MuxFrameType.Reset))
+                    self._remove(stream, ConnectionResetError("Flow control error."))
+            case MuxFrameType.WindowUpdate:
+                stream._send_window += frame.increment()
+                self._flush(stream)
+            case MuxFrameType.Close:
+                stream._remote_closed()
+                if stream._close_sent:
+                    self._remove(stream, ConnectionResetError("Stream is closed."))
+            case MuxFrameType.Reset:
+                self._remove(stream, ConnectionResetError("Stream reset by peer."))
+
+        return True
+
+    def _pong(self, token: bytes) -> None:
+        if self._ping is None or token != self._ping[0]:
+            return
+
+        self.rtt = self._loop.time() - self._ping[1]
+        self._ping = None
+        RTT_SECONDS.labels(self.role).observe(self.rtt)
+
+    def _flush(self, stream: MuxStream) -> None:
+        while len(stream._pending) > 0 and stream._send_window > 0:
+            n = min(len(stream._pending), stream._send_window, MuxFrame.MAX_PAYLOAD_LEN)
+            self._send(
+                MuxFrame(stream.id, MuxFrameType.Data, bytes(stream._pending[:n]))
+            )
+            del stream._pending[:n]
+            stream._send_window -= n
+
+        if len(stream._pending) == 0:
+            stream._wakeup()
+
+            if (
+                stream._closing
+                and not stream._close_sent
+                and stream.id in self._streams
+            ):
+                self._send(MuxFrame(stream.id, MuxFrameType.Close))
+                stream._close_sent = True
+                if not stream._closed.done():
+                    stream._closed.set_result(None)
+
+                if stream._close_received:
+                    self._remove(stream, ConnectionResetError("Stream is closed."))
+
+    def _remove(self, stream: MuxStream, error: Exception) -> None:
+        if self._streams.pop(stream.id, None) is None:
+            return
+
+        if stream.id % 2 == 0:
+            self._local_open -= 1
+            self._capacity.set()
+        else:
+            self._peer_open -= 1
+
+        stream._reset(error)
+
+    def _send(self, frame: MuxFrame) -> None:
+        if self._closed:
+            return
+
+        try:
+            self._writer.write(frame.encode())
+        except Exception as e:
+            LOGGER.info(f"Failed to send frame: {e}")
+            self._writer.close()
+
+    async def _drain(self) -> None:
+        if self._closed:
+            raise ConnectionResetError("Connection is closed.")
+
+        await self._writer.drain()
+
+    def _shutdown(self) -> None:
+        self._closed = True
+        self._capacity.set()
+
+        for stream in list(self._streams.values()):
+            self._remove(stream, ConnectionResetError("Connection closed."))
+
+        self._incoming.put_nowait(None)
+
+    def close(self) -> None:
+        self._shutdown()
+        if not self._writer.is_closing():
+            self._writer.close()
@@ -1,7 +1,11 @@
 import asyncio
 import logging
+from typing import Optional
 
 from moatt_types.connect import (
+    AuthRequest,
+    AuthResponse,
+    AuthType,
     ConnectionRequestFlags,
     ConnectRequest,
     ConnectResponse,
@@ -10,18 +14,29 @@ from moatt_types.connect import (
 )
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-from .. import auth
+from .. import auth, timers
 from ..config import Config
+from ..sim_directory import SimDirectory
 from . import connection_queue
-from .util import read_msg, write_msg
+from .mux import Mux
+from .util import PrefixWriter, read_msg, write_msg
+from .workers import WorkerGroup
 
 LOGGER = logging.getLogger(__name__)
 
 
 class ProbeHandler:
-    def __init__(self, config: Config, async_session: async_sessionmaker[AsyncSession]):
+    def __init__(
+        self,
+        config: Config,
+        async_session: async_sessionmaker[AsyncSession],
+        sims: SimDirectory,
+        workers: WorkerGroup | None = None,
+    ):
         self.config = config
         self.async_session = async_session
+        self.sims = sims
+        self.workers = workers
 
     async def valid_token(self, token: Token) -> None:
         await auth.register_probe(token)
@@ -31,7 +46,16 @@ class ProbeHandler:
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
         token: Token,
+        auth_res: Optional[AuthResponse] = None,
     ) -> None:
+        """Handle a probe's connection request.
+
+        `auth_res` is the AuthResponse of a pipelined handshake; it is sent
+        together with the ConnectResponse.
+        """
+        if auth_res is not None:
+            writer = PrefixWriter(writer, auth_res.encode())  # type: ignore
+
         def cleanup():
             if not writer.is_closing():
                 writer.close()
@@ -48,6 +72,36 @@ class ProbeHandler:
             LOGGER.exception(f"Exception occurred while handling connection.\n{e}")
             cleanup()
 
+    async def handle_mux(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        token: Token,
+    ) -> None:
+        """Handle a multiplexed connection; every stream is a separate session."""
+        mux = Mux(reader, writer, "probe", await auth.identity(token))
+        mux.allow_streams(self.config.MAX_MUX_STREAMS)
+
+        async with asyncio.TaskGroup() as tg:
+            run = tg.create_task(
+                mux.run(
+                    (
+                        self.config.PING_INTERVAL.total_seconds()
+                        if self.config.PING_INTERVAL
+                        else None
+                    ),
+                    self.config.PING_TIMEOUT.total_seconds(),
+                )
+            )
+            try:
+                while (stream := await mux.accept()) is not None:
+                    # the session continues in the provider handler once the
+                    # request was queued
+                    tg.create_task(self.handle(stream, stream, token))  # type: ignore
+            finally:
+                run.cancel()
+                mux.close()
+
     async def _handle(
         self,
         reader: asyncio.StreamReader,
@@ -59,12 +113,12 @@ class ProbeHandler:
             await writer.wait_closed()
 
         LOGGER.debug("waiting for probe connect request")
-        async with asyncio.timeout(
+        async with timers.wheel().timeout(
             self.config.PROBE_REQUEST_TIMEOUT.total_seconds()
             if self.config.PROBE_REQUEST_TIMEOUT
             else None
         ):
-            con_req = await read_msg(reader, ConnectRequest.decode)
+            con_req = await read_msg(reader, ConnectRequest.decode_from)
         LOGGER.debug(f"got probe connect request {con_req}")
 
         if con_req is None:
@@ -75,8 +129,7 @@ class ProbeHandler:
             return
 
         try:
-            async with self.async_session() as session, session.begin():
-                sim = await auth.get_sim(session, session_token, con_req.identifier)
+            sim = await auth.get_sim(self.sims, session_token, con_req.identifier)
         except auth.AuthError:
             LOGGER.debug(
                 "Received disallowed SIM request from probe. Closing connection."
@@ -85,16 +138,13 @@ class ProbeHandler:
             await close()
             return
 
-        if sim is None:
-            LOGGER.debug("Probe requested unknown SIM. Closing connection.")
-            await write_msg(writer, ConnectResponse(ConnectStatus.NotFound))
-            await close()
-            return
-
-        if sim.provider is None:
-            LOGGER.debug("Requested SIM is unknown. Closing connection.")
-            await write_msg(writer, ConnectResponse(ConnectStatus.NotAvailable))
-            await close()
+        if self.workers is not None and not self.workers.is_local(sim.provider_id):
+            await self.workers.forward(
+                sim.provider_id,
+                AuthRequest(AuthType.Probe, session_token).encode() + con_req.encode(),
+                reader,
+                writer,
+            )
             return
 
         LOGGER.debug("Sending stream to provider handler")
@@ -106,7 +156,7 @@ class ProbeHandler:
 
         try:
             connection_queue.put_nowait(
-                sim.provider.id,
+                sim.provider_id,
                 connection_queue.QueueEntry(
                     sim,
                     probe_id,
@@ -114,6 +164,7 @@ class ProbeHandler:
                     reader,
                     writer,
                     immediate=ConnectionRequestFlags.NO_WAIT in con_req.flags,
+                    priority=await auth.probe_priority(session_token),
                 ),
             )
         except asyncio.QueueFull:
@@ -122,6 +173,6 @@ class ProbeHandler:
                     f"Requested SIM card is not immediately available. {sim.iccid=}"
                 )
             else:
-                LOGGER.warn(f"Queue for provider is full. {sim.provider.id=}")
+                LOGGER.warn(f"Queue for provider is full. {sim.provider_id=}")
             await write_msg(writer, ConnectResponse(ConnectStatus.NotAvailable))
             await close()
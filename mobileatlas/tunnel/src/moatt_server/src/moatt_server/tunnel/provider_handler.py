@@ -1,96 +1,267 @@
 import asyncio
 import logging
+import time
+from collections.abc import Awaitable
+from uuid import UUID
 
 from moatt_types.connect import ConnectResponse, ConnectStatus, Token
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-from .. import auth, db
+from .. import auth, db, metrics, timers
 from .. import models as dbm
+from ..audit import AuditLog, AuditSession
 from ..config import Config
-from . import connection_queue
+from ..state import StateStore
+from . import connection_queue, relay
 from .apdu_stream import ApduStream
-from .util import poll_eof, read_msg, write_msg
+from .mux import Mux, MuxStream
+from .relay import RelayMode
+from .session_stats import SessionLog, SessionStats
+from .util import ProtocolError, read_msg, wait_eof, write_msg
 
 LOGGER = logging.getLogger(__name__)
 
+QUEUE_WAIT_SECONDS = metrics.Histogram(
+    "moatt_queue_wait_seconds",
+    "Time connection requests spent in a provider's queue.",
+)
+PROVIDER_ACCEPT_SECONDS = metrics.Histogram(
+    "moatt_provider_accept_seconds",
+    "Time until providers answered connection requests.",
+)
+RELAY_SECONDS = metrics.Histogram(
+    "moatt_apdu_relay_seconds",
+    "Time from receiving an APDU until it was forwarded.",
+    ["sender"],
+)
+ACTIVE_TUNNELS = metrics.Gauge("moatt_active_tunnels", "Number of active tunnels.")
+
 
 class ProviderHandler:
-    def __init__(self, config: Config, async_session: async_sessionmaker[AsyncSession]):
+    def __init__(
+        self,
+        config: Config,
+        async_session: async_sessionmaker[AsyncSession],
+        audit_log: AuditLog,
+        session_log: SessionLog,
+        state: StateStore,
+    ):
         self.config = config
         self.async_session = async_session
+        self.audit_log = audit_log
+        self.session_log = session_log
+        self.state = state
+
+    async def _next_request(
+        self, provider_id: UUID, eof_task: asyncio.Task[None]
+    ) -> connection_queue.QueueEntry | None:
+        """Wait for a connection request from a probe that is still connected.
+
+        Returns None if the provider disconnects (`eof_task` completes) first.
+        """
+        while True:
+            LOGGER.debug("waiting for connection request.")
+            q_task = asyncio.create_task(connection_queue.get(provider_id), name="q")
+
+            done, _ = await asyncio.wait(
+                [q_task, eof_task], return_when=asyncio.FIRST_COMPLETED
+            )
 
-    async def handle_established_connection(
-        self, probe: ApduStream, provider: ApduStream
-    ):
-        probe_task = asyncio.create_task(probe.recv(), name="probe")
-        provider_task = asyncio.create_task(provider.recv(), name="provider")
+            if eof_task in done:
+                if q_task in done:
+                    connection_queue.requeue_nowait(provider_id, q_task.result())
+                else:
+                    q_task.cancel()
 
-        try:
-            while True:
-                done, pending = await asyncio.wait(
-                    [probe_task, provider_task], return_when=asyncio.FIRST_COMPLETED
-                )
+                try:
+                    eof_task.result()
+                    LOGGER.info("Provider disconnected.")
+                except ProtocolError as e:
+                    LOGGER.warning(f"Closing provider connection: {e}")
 
-                assert len(done) > 0 and len(done) <= 2
-                assert len(pending) >= 0 and len(pending) < 2
-                for t in done:
-                    try:
-                        r = t.result()
-                    except asyncio.IncompleteReadError as e:
-                        LOGGER.warn(
-                            f"Unexpected EOF while trying to read from {t.get_name()} "
-                            f"connection. (expected at least {e.expected} more bytes.)"
-                        )
+                return None
 
-                        return
-                    except ValueError:
-                        LOGGER.warn("Received a malformed packet. Closing connections.")
-                        return
+            qe = q_task.result()
 
-                    if r is None:
-                        LOGGER.info(f"{t.get_name()} closed the connection.")
-                        return
+            if qe.writer.is_closing():
+                LOGGER.warning("Probe disconnected early. Waiting for new request.")
+                qe.writer.close()
+                await qe.writer.wait_closed()
+                continue
 
-                    async with self.async_session() as session, session.begin():
-                        await db.log_apdu(
-                            session,
-                            provider.client_id,
-                            probe.client_id,
-                            db.SimId(
-                                id=provider.sim.id,
-                                iccid=provider.sim.iccid,
-                                imsi=provider.sim.imsi,
-                            ),
-                            r,
-                            (
-                                dbm.Sender.Probe
-                                if t.get_name() == "probe"
-                                else dbm.Sender.Provider
-                            ),
-                        )
+            return qe
 
-                    if t.get_name() == "probe":
-                        provider.send_background(r)
-                        probe_task = asyncio.create_task(probe.recv(), name="probe")
-                    elif t.get_name() == "provider":
-                        probe.send_background(r)
-                        provider_task = asyncio.create_task(
-                            provider.recv(), name="provider"
-                        )
+    async def handle_established_connection(
+        self,
+        probe: ApduStream,
+        provider: ApduStream,
+        audit: AuditSession,
+        stats: SessionStats,
+    ):
+        probe.peer = provider
+        provider.peer = probe
+
+        # one long-lived task per direction; the tunnel is torn down as soon as
+        # either of them stops
+        if self.config.RELAY_MODE == RelayMode.Passthrough and not audit.sampled:
+            pumps = self._passthrough(probe, provider, stats)
+        else:
+            pumps = [
+                asyncio.create_task(
+                    self._pump(probe, provider, audit, stats, dbm.Sender.Probe),
+                    name="probe",
+                ),
+                asyncio.create_task(
+                    self._pump(provider, probe, audit, stats, dbm.Sender.Provider),
+                    name="provider",
+                ),
+            ]
+            if self.config.PING_INTERVAL is not None:
+                pumps.append(
+                    asyncio.create_task(self._heartbeat([probe, provider]), name="ping")
+                )
+
+        ACTIVE_TUNNELS.inc()
+        try:
+            await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
         finally:
-            probe_task.cancel()
-            provider_task.cancel()
+            ACTIVE_TUNNELS.dec()
+            for t in pumps:
+                t.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
             await probe.close()
             await provider.close()
 
+    def _passthrough(
+        self, probe: ApduStream, provider: ApduStream, stats: SessionStats
+    ) -> list[asyncio.Task]:
+        """Forward the data of a tunnel without decoding it (see `relay`).
+
+        The tunnel server cannot ping the ends of these tunnels, as it does not
+        know where packets start.
+        """
+        tap = relay.tapped(self.config.RELAY_TAP_RATE)
+        stats.passthrough = True
+        if not tap:
+            stats.apdus = None
+
+        return [
+            asyncio.create_task(
+                self._relay(probe, provider, "probe", stats, tap), name="probe"
+            ),
+            asyncio.create_task(
+                self._relay(provider, probe, "provider", stats, tap), name="provider"
+            ),
+        ]
+
+    async def _heartbeat(self, streams: list[ApduStream]) -> None:
+        """Ping the ends of a tunnel that sent pings themselves.
+
+        Returns if a ping is not answered in time.
+        """
+        assert self.config.PING_INTERVAL is not None
+        interval = self.config.PING_INTERVAL.total_seconds()
+        timeout = self.config.PING_TIMEOUT.total_seconds()
+
+        while True:
+            await timers.wheel().sleep(interval)
+
+            for s in streams:
+                if s.ping_overdue(timeout):
+                    LOGGER.warning(f"{s.role} did not answer ping. Closing tunnel.")
+                    return
+
+                if s.pings and not s.ping_pending():
+                    s.ping()
+
+    async def _pump(
+        self,
+        src: ApduStream,
+        dst: ApduStream,
+        audit: AuditSession,
+        stats: SessionStats,
+        sender: dbm.Sender,
+    ) -> None:
+        name = sender.name.lower()
+        relay_seconds = RELAY_SECONDS.labels(name)
+
+        while True:
+            try:
+                r = await src.recv()
+            except asyncio.IncompleteReadError as e:
+                LOGGER.warning(
+                    f"Unexpected EOF while trying to read from {name} "
+                    f"connection. (expected at least {e.expected} more bytes.)"
+                )
+                return
+            except ValueError:
+                LOGGER.warning("Received a malformed packet. Closing connections.")
+                return
+            except ConnectionError as e:
+                LOGGER.warning(f"Lost connection to {name}: {e}")
+                return
+
+            if r is None:
+                LOGGER.info(f"{name} closed the connection.")
+                return
+
+            start = time.perf_counter()
+            await audit.log(r, sender)
+
+            try:
+                await dst.send(r)
+            except ConnectionError as e:
+                LOGGER.warning(f"Failed to forward APDU from {name}: {e}")
+                return
+
+            relay_seconds.observe(time.perf_counter() - start)
+            stats.forwarded(r, name)
+
+    async def _relay(
+        self,
+        src: ApduStream,
+        dst: ApduStream,
+        name: str,
+        stats: SessionStats,
+        tap: bool,
+    ) -> None:
+        try:
+            await relay.pipe(src.reader, dst.writer, name, stats, tap)
+        except ValueError:
+            LOGGER.warning("Received a malformed packet. Closing connections.")
+            return
+        except ConnectionError as e:
+            LOGGER.warning(f"Lost connection while relaying data from {name}: {e}")
+            return
+
+        LOGGER.info(f"{name} closed the connection.")
+
     async def handle(
         self,
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
         token: Token,
+    ) -> None:
+        await self._handle_errors(self._handle(reader, writer, token), writer)
+
+    async def handle_mux(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        token: Token,
+    ) -> None:
+        """Handle a multiplexed connection.
+
+        Every connection request is sent on a new stream. The provider limits the
+        number of concurrent sessions by allowing new streams.
+        """
+        await self._handle_errors(self._handle_mux(reader, writer, token), writer)
+
+    async def _handle_errors(
+        self, coro: Awaitable[None], writer: asyncio.StreamWriter | MuxStream
     ) -> None:
         try:
-            await self._handle(reader, writer, token)
+            await coro
         except (EOFError, ConnectionResetError):
             LOGGER.warn("Client closed connection unexpectedly.")
         except asyncio.QueueFull as e:
@@ -121,55 +292,81 @@ class ProviderHandler:
             provider_id is not None
         ), "Expected identity of provider to be known after successful registration."
 
-        async with self.async_session() as session, session.begin():
-            await db.mark_provider_available(session, provider_id)
+        self.state.provider_available(provider_id)
 
+        # Providers must not send anything before receiving a connection request,
+        # so reading from the connection only completes once it is closed.
+        eof_task = asyncio.create_task(wait_eof(reader), name="eof")
         try:
-            while True:
-                LOGGER.debug("waiting for connection request.")
-                q_task = asyncio.create_task(
-                    connection_queue.get(provider_id), name="q"
-                )
+            qe = await self._next_request(provider_id, eof_task)
+        finally:
+            eof_task.cancel()
+            self.state.provider_unavailable(provider_id)
 
-                # poll whether the provider is still connected
-                # in order to prevent a buildup of tasks that
-                # cannot make progress but wait on a connection request to arrive regardless
-                eof_task = asyncio.create_task(poll_eof(writer), name="eof")
+        if qe is None:
+            return
 
-                done, _ = await asyncio.wait(
-                    [q_task, eof_task], return_when=asyncio.FIRST_COMPLETED
-                )
+        # the session reads from the connection itself
+        await asyncio.wait([eof_task])
 
-                if q_task in done and eof_task not in done:
-                    eof_task.cancel()
-                    qe = q_task.result()
-                    asyncio.current_task().add_done_callback(  # pyright: ignore[reportOptionalMemberAccess]
-                        lambda _: connection_queue.task_done(provider_id)
-                    )
-                else:
-                    if q_task in done:
-                        connection_queue.put_nowait(provider_id, q_task.result())
-                    else:
-                        q_task.cancel()
-                    eof_task.result()
-                    LOGGER.info("Provider disconnected.")
+        await self._session(provider_id, qe, reader, writer)
 
-                    if q_task in done:
-                        connection_queue.task_done(provider_id)
+    async def _handle_mux(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        session_token: Token,
+    ) -> None:
+        provider_id = await auth.identity(session_token)
+        assert (
+            provider_id is not None
+        ), "Expected identity of provider to be known after successful registration."
 
-                    return
+        mux = Mux(reader, writer, "provider", provider_id)
+
+        async with asyncio.TaskGroup() as tg:
+            run = tg.create_task(
+                mux.run(
+                    (
+                        self.config.PING_INTERVAL.total_seconds()
+                        if self.config.PING_INTERVAL
+                        else None
+                    ),
+                    self.config.PING_TIMEOUT.total_seconds(),
+                )
+            )
+            try:
+                while await mux.wait_capacity():
+                    self.state.provider_available(provider_id)
 
-                if qe.writer.is_closing():
-                    LOGGER.warn("Probe disconnected early. Waiting for new request.")
-                    qe.writer.close()
-                    await qe.writer.wait_closed()
-                    continue
-                else:
-                    break
-        finally:
-            async with self.async_session() as session, session.begin():
-                await db.mark_provider_unavailable(session, provider_id)
+                    try:
+                        qe = await self._next_request(provider_id, run)
+                    finally:
+                        self.state.provider_unavailable(provider_id)
+
+                    if qe is None:
+                        return
 
+                    stream = mux.open_stream()
+                    tg.create_task(
+                        self._handle_errors(
+                            self._session(provider_id, qe, stream, stream),  # type: ignore
+                            stream,
+                        )
+                    )
+            finally:
+                run.cancel()
+                mux.close()
+
+    async def _session(
+        self,
+        provider_id: UUID,
+        qe: connection_queue.QueueEntry,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        queue_wait = time.monotonic() - qe.enqueued
+        QUEUE_WAIT_SECONDS.observe(queue_wait)
         LOGGER.debug(f"Received a connection request: {qe.con_req}")
 
         # TODO recheck request validity?
@@ -177,25 +374,34 @@ class ProviderHandler:
         try:
             await write_msg(writer, qe.con_req)
         except Exception as e:
-            LOGGER.warn(f"Provider disconnected. {e}")
-            connection_queue.put_nowait(provider_id, qe)
+            LOGGER.warning(f"Provider disconnected. {e}")
+            connection_queue.requeue_nowait(provider_id, qe)
             raise
 
         LOGGER.debug("Waiting for provider to accept connection request.")
+        start = time.monotonic()
         try:
-            async with asyncio.timeout(
+            async with timers.wheel().timeout(
                 self.config.PROVIDER_RESPONSE_TIMEOUT.total_seconds()
                 if self.config.PROVIDER_RESPONSE_TIMEOUT
                 else None
             ):
-                con_res = await read_msg(reader, ConnectResponse.decode)
+                con_res = await read_msg(reader, ConnectResponse.decode_from)
         except TimeoutError:
             LOGGER.info("Provider timed out.")
             await write_msg(qe.writer, ConnectResponse(ConnectStatus.ProviderTimedOut))
             qe.writer.close()
             await qe.writer.wait_closed()
             return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            LOGGER.info(
+                "Provider disconnected before answering connection request. "
+                "Requeueing request."
+            )
+            connection_queue.requeue_nowait(provider_id, qe)
+            return
         LOGGER.debug(f"Received a response for a connection request: {con_res}")
+        PROVIDER_ACCEPT_SECONDS.observe(time.monotonic() - start)
 
         if con_res is None:
             LOGGER.warn(
@@ -220,22 +426,31 @@ class ProviderHandler:
             await qe.writer.wait_closed()
             return
 
-        sim_id = qe.sim.id
+        sim_id = db.SimId(id=qe.sim.id, iccid=qe.sim.iccid, imsi=qe.sim.imsi)
         probe_stream = None
         provider_stream = None
+        audit = self.audit_log.session(provider_id, qe.probe_id, sim_id)
+        stats = SessionStats(queue_wait)
+        self.state.sim_used(provider_id, sim_id.id)
         try:
-            probe_stream = ApduStream(qe.sim, qe.probe_id, qe.reader, qe.writer)
-            provider_stream = ApduStream(qe.sim, qe.probe_id, reader, writer)
-
-            async with self.async_session() as session, session.begin():
-                await db.sim_used(session, provider_id, sim_id)
+            probe_stream = ApduStream(
+                qe.sim, qe.probe_id, qe.reader, qe.writer, "probe"
+            )
+            provider_stream = ApduStream(
+                qe.sim, provider_id, reader, writer, "provider"
+            )
 
-            await self.handle_established_connection(probe_stream, provider_stream)
+            await self.handle_established_connection(
+                probe_stream, provider_stream, audit, stats
+            )
         finally:
+            self.state.sim_unused(provider_id, sim_id.id)
+
             if provider_stream is not None:
                 await provider_stream.close()
             if probe_stream is not None:
                 await probe_stream.close()
 
-            async with self.async_session() as session, session.begin():
-                await db.sim_unused(session, provider_id, sim_id)
+            await audit.close()
+
+            self.session_log.add(stats.row(provider_id, qe.probe_id, sim_id))
@@ -0,0 +1,310 @@
+"""QUIC transport of the tunnel server (requires the optional aioquic dependency).
+
+Every bidirectional stream a client opens carries the messages of one TCP
+connection and is handed to the same handler as TCP connections, with a
+`QuicStreamWriter` standing in for the `asyncio.StreamWriter`. A lost packet
+therefore only stalls the stream it belongs to, and aioquic keeps connections
+alive when a client's address changes (connection migration).
+
+Session tickets are kept in memory and accepted only once, which allows 0-RTT
+resumption without accepting replayed early data. They are lost on restart and
+not shared between worker processes, which is why only the first worker listens
+for QUIC connections (with SO_REUSEPORT the packets of a migrated connection
+could also end up at a different worker).
+"""
+
+import asyncio
+import collections
+import functools
+import logging
+import socket
+from collections.abc import Awaitable, Callable, Sequence
+from typing import Optional
+
+from aioquic.asyncio import QuicConnectionProtocol
+from aioquic.asyncio import serve as quic_serve
+from aioquic.quic import events
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+from aioquic.tls import SessionTicket
+from moatt_types.connect import QUIC_ALPN
+
+from .. import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+IDLE_TIMEOUT = 60.0  # seconds
+MAX_SESSION_TICKETS = 10_000
+
+QUIC_HANDSHAKES = metrics.Counter(
+    "moatt_quic_handshakes_total",
+    "Completed QUIC handshakes.",
+    ["resumed", "early_data"],
+)
+
+StreamHandler = Callable[[asyncio.StreamReader, "QuicStreamWriter"], Awaitable[None]]
+
+
+class QuicStreamWriter:
+    """Writing half of a QUIC stream with the interface of `asyncio.StreamWriter`.
+
+    Closing the writer finishes the stream and, like closing a TCP connection,
+    feeds EOF to its reader.
+    """
+
+    # there is no socket whose buffer sizes could be tuned
+    transport = None
+
+    def __init__(self, protocol: "StreamProtocol", stream_id: int):
+        self.stream_id = stream_id
+        self._protocol = protocol
+        self._closing = False
+
+    def write(self, data: bytes) -> None:
+        # like asyncio transports, data written after closing is dropped
+        if self.is_closing():
+            return
+
+        self._protocol._quic.send_stream_data(self.stream_id, data)
+        self._protocol._transmit_soon()
+
+    async def drain(self) -> None:
+        # aioquic buffers outgoing data itself; flow control only limits how much
+        # of it is in flight
+        if self._protocol.is_closed():
+            raise ConnectionResetError("QUIC connection was closed.")
+
+    def close(self) -> None:
+        if self._closing:
+            return
+
+        self._closing = True
+        if not self._protocol.is_closed():
+            self._protocol._quic.send_stream_data(self.stream_id, b"", end_stream=True)
+            self._protocol._transmit_soon()
+        self._protocol._stream_closed(self.stream_id)
+
+    def is_closing(self) -> bool:
+        return self._closing or self._protocol.is_closed()
+
+    async def wait_closed(self) -> None:
+        pass
+
+    def get_extra_info(self, name: str, default=None):
+        if name == "stream_id":
+            return self.stream_id
+
+        return default
+
+
+class StreamProtocol(QuicConnectionProtocol):
+    """Maps the streams of a QUIC connection to reader/writer pairs.
+
+    `handler` is run for every bidirectional stream opened by the peer. If
+    `close_when_idle` is set, the connection is closed once its last stream was
+    closed.
+    """
+
+    def __init__(
+        self,
+        quic: QuicConnection,
+        stream_handler=None,
+        *,
+        handler: Optional[StreamHandler] = None,
+        limit: int = 64 * 2**10,
+        close_when_idle: bool = False,
+    ):
+        super().__init__(quic, stream_handler)
+
+        self._handler = handler
+        self._limit = limit
+        self._close_when_idle = close_when_idle
+        self._readers: dict[int, asyncio.StreamReader] = {}
+        self._last_peer_stream = -1
+        self._tasks: set[asyncio.Task] = set()
+        self._terminated = False
+
+    def is_closed(self) -> bool:
+        return self._terminated
+
+    def open_stream(self) -> tuple[asyncio.StreamReader, QuicStreamWriter]:
+        return self._add_stream(self._quic.get_next_available_stream_id())
+
+    def quic_event_received(self, event: events.QuicEvent) -> None:
+        match event:
+            case events.HandshakeCompleted():
+                QUIC_HANDSHAKES.labels(
+                    str(event.session_resumed).lower(),
+                    str(event.early_data_accepted).lower(),
+                ).inc()
+            case events.StreamDataReceived():
+                reader = self._readers.get(event.stream_id)
+                if reader is None:
+                    reader = self._accept(event.stream_id)
+                    if reader is None:
+                        return
+
+                reader.feed_data(event.data)
+                if event.end_stream:
+                    reader.feed_eof()
+            case events.StreamReset():
+                reader = self._readers.get(event.stream_id)
+                if reader is not None:
+                    reader.set_exception(ConnectionResetError("Stream was reset."))
+            case events.ConnectionTerminated():
+                LOGGER.debug("QUIC connection terminated: %s", event.reason_phrase)
+                self._terminated = True
+                for reader in self._readers.values():
+                    reader.feed_eof()
+                self._readers.clear()
+
+    def _accept(self, stream_id: int) -> Optional[asyncio.StreamReader]:
+        # the lowest bit of a stream ID is set for streams opened by the server,
+        # the second one for unidirectional streams
+        peer_bidi = 1 if self._quic.configuration.is_client else 0
+        if (
+            self._handler is None
+            or stream_id & 0x3 != peer_bidi
+            or stream_id <= self._last_peer_stream
+        ):
+            return None
+
+        self._last_peer_stream = stream_id
+        reader, writer = self._add_stream(stream_id)
+
+        task = asyncio.create_task(self._handle(reader, writer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return reader
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: QuicStreamWriter
+    ) -> None:
+        assert self._handler is not None
+
+        try:
+            await self._handler(reader, writer)
+        finally:
+            writer.close()
+
+    def _add_stream(
+        self, stream_id: int
+    ) -> tuple[asyncio.StreamReader, QuicStreamWriter]:
+        reader = asyncio.StreamReader(limit=self._limit)
+        self._readers[stream_id] = reader
+        return reader, QuicStreamWriter(self, stream_id)
+
+    def _stream_closed(self, stream_id: int) -> None:
+        reader = self._readers.pop(stream_id, None)
+        if reader is not None and not reader.at_eof():
+            reader.feed_eof()
+
+        if self._close_when_idle and len(self._readers) == 0 and not self._terminated:
+            self.close()
+            task = asyncio.create_task(self._release())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _release(self) -> None:
+        await self.wait_closed()
+        if self._transport is not None:
+            self._transport.close()
+
+
+class SessionTicketStore:
+    """Session tickets issued by this process; every ticket is accepted once."""
+
+    def __init__(self, maxsize: int = MAX_SESSION_TICKETS):
+        self.maxsize = maxsize
+        self._tickets: collections.OrderedDict[bytes, SessionTicket] = (
+            collections.OrderedDict()
+        )
+
+    def add(self, ticket: SessionTicket) -> None:
+        self._tickets[ticket.ticket] = ticket
+        if len(self._tickets) > self.maxsize:
+            self._tickets.popitem(last=False)
+
+    def pop(self, label: bytes) -> Optional[SessionTicket]:
+        return self._tickets.pop(label, None)
+
+
+async def serve(
+    host: str | Sequence[str],
+    port: int,
+    certfile: str,
+    keyfile: str,
+    handler: StreamHandler,
+    *,
+    limit: int = 64 * 2**10,
+) -> None:
+    """Accept QUIC connections until cancelled."""
+    configuration = QuicConfiguration(
+        is_client=False, alpn_protocols=[QUIC_ALPN], idle_timeout=IDLE_TIMEOUT
+    )
+    configuration.load_cert_chain(certfile, keyfile)
+    tickets = SessionTicketStore()
+
+    servers = []
+    try:
+        for h in [host] if isinstance(host, str) else host:
+            LOGGER.debug(
+                "Listening for QUIC connections. (Host: %s; Port: %d)", h, port
+            )
+            servers.append(
+                await quic_serve(
+                    h,
+                    port,
+                    configuration=configuration,
+                    create_protocol=functools.partial(
+                        StreamProtocol, handler=handler, limit=limit
+                    ),
+                    session_ticket_fetcher=tickets.pop,
+                    session_ticket_handler=tickets.add,
+                )
+            )
+
+        await asyncio.Future()
+    finally:
+        for s in servers:
+            s.close()
+
+
+async def open_connection(
+    host: str,
+    port: int,
+    configuration: QuicConfiguration,
+    session_ticket_handler: Optional[Callable[[SessionTicket], None]] = None,
+) -> tuple[asyncio.StreamReader, QuicStreamWriter]:
+    """Open a QUIC connection with a single stream.
+
+    The QUIC counterpart of `asyncio.open_connection`; closing the writer closes
+    the connection. If `configuration` contains a session ticket, the function
+    returns without waiting for the handshake so that the first writes are sent as
+    0-RTT data.
+    """
+    loop = asyncio.get_running_loop()
+    family, _, _, _, addr = (
+        await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+    )[0]
+
+    connection = QuicConnection(
+        configuration=configuration, session_ticket_handler=session_ticket_handler
+    )
+    _, protocol = await loop.create_datagram_endpoint(
+        lambda: StreamProtocol(connection, close_when_idle=True),
+        local_addr=("::" if family == socket.AF_INET6 else "0.0.0.0", 0),
+    )
+    assert isinstance(protocol, StreamProtocol)
+
+    protocol.connect(addr)
+    try:
+        if configuration.session_ticket is None:
+            await protocol.wait_connected()
+    except BaseException:
+        protocol.close()
+        protocol._transport.close()  # type: ignore
+        raise
+
+    return protocol.open_stream()
@@ -0,0 +1,132 @@
+"""Passthrough relay for tunnels whose APDUs are not logged.
+
+Instead of decoding every packet, logging it and encoding it again, the data
+received from one end of the tunnel is forwarded to the other end in the chunks
+it arrived in. The tunnel server does not answer pings of passthrough tunnels;
+they are answered by the other end of the tunnel instead, so the RTT measured by
+the clients covers the whole tunnel.
+
+A sampled fraction of the tunnels is observed by a `Tap`, which follows the
+packet boundaries of the relayed data to keep statistics about the packets
+(without copying them).
+"""
+
+import asyncio
+import enum
+import logging
+import random
+
+from moatt_types.connect import ApduOp, ApduPacket
+
+from .. import metrics
+from .session_stats import SessionStats
+
+LOGGER = logging.getLogger(__name__)
+
+RELAY_CHUNK_SIZE = 64 * 2**10
+
+RELAYED_BYTES = metrics.Counter(
+    "moatt_relay_bytes_total",
+    "Bytes forwarded by passthrough tunnels.",
+    ["sender"],
+)
+TAP_PACKETS = metrics.Counter(
+    "moatt_relay_tap_packets_total",
+    "Packets seen by the taps of sampled passthrough tunnels.",
+    ["sender", "op"],
+)
+TAP_PAYLOAD_BYTES = metrics.Histogram(
+    "moatt_relay_tap_payload_bytes",
+    "Payload sizes of APDUs seen by the taps of sampled passthrough tunnels.",
+    ["sender"],
+    buckets=(8, 16, 32, 64, 128, 256, 512, 1024, 4096, 65536),
+)
+
+
+@enum.unique
+class RelayMode(enum.Enum):
+    Apdu = "apdu"
+    Passthrough = "passthrough"
+
+
+class Tap:
+    """Follows the packets of one direction of a passthrough tunnel.
+
+    Raises ValueError if the data contains a malformed packet header.
+    """
+
+    __slots__ = (
+        "_sender",
+        "_stats",
+        "_header",
+        "_missing",
+        "_packets",
+        "_payload_bytes",
+    )
+
+    def __init__(self, sender: str, stats: SessionStats):
+        self._sender = sender
+        self._stats = stats
+        self._header = bytearray()
+        # bytes of the current packet's payload that were not seen yet
+        self._missing = 0
+        self._packets = {op: TAP_PACKETS.labels(sender, op.name) for op in ApduOp}
+        self._payload_bytes = TAP_PAYLOAD_BYTES.labels(sender)
+
+    def feed(self, data: bytes) -> None:
+        i = 0
+        while i < len(data):
+            if self._missing > 0:
+                n = min(self._missing, len(data) - i)
+                self._missing -= n
+                i += n
+                continue
+
+            n = min(ApduPacket.HEADER_LEN - len(self._header), len(data) - i)
+            self._header += data[i : i + n]
+            i += n
+
+            if len(self._header) < ApduPacket.HEADER_LEN:
+                return
+
+            op, plen = ApduPacket.decode_header(self._header)
+            self._header.clear()
+            self._missing = plen
+
+            self._packets[op].inc()
+            if op == ApduOp.Apdu:
+                self._payload_bytes.observe(plen)
+                self._stats.apdu(self._sender)
+
+
+def tapped(rate: float) -> bool:
+    return rate >= 1 or random.random() < rate
+
+
+async def pipe(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    sender: str,
+    stats: SessionStats,
+    tap: bool = False,
+) -> None:
+    """Forward data from `reader` to `writer` until EOF.
+
+    Without `tap`, APDUs are not counted in `stats`.
+    """
+    relayed = RELAYED_BYTES.labels(sender)
+    t = Tap(sender, stats) if tap else None
+
+    while True:
+        buf = await reader.read(RELAY_CHUNK_SIZE)
+
+        if len(buf) == 0:
+            return
+
+        if t is not None:
+            t.feed(buf)
+
+        writer.write(buf)
+        relayed.inc(len(buf))
+        stats.bytes[sender] += len(buf)
+        await writer.drain()
@@ -2,31 +2,53 @@ import asyncio
 import logging
 import socket
 import ssl
-from collections.abc import Sequence
+import time
+from collections.abc import Awaitable, Sequence
 from datetime import timedelta
+from uuid import UUID
 
 from moatt_types.connect import (
+    PROTOCOL_VERSION,
     AuthRequest,
+    AuthRequestFlags,
     AuthResponse,
     AuthStatus,
     AuthType,
+    Buffer,
     ConnectResponse,
     ConnectStatus,
     Token,
+    VersionRequest,
+    VersionResponse,
 )
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
-from .. import auth
+from .. import apdu_log, auth, db, metrics, notify, timers
+from ..audit import AuditLog
 from ..auth import TokenError
-from ..config import Config
+from ..config import Config, ConfigError
 from ..gc import gc
+from ..sim_directory import SimDirectory
+from ..state import StateStore
 from .connection_queue import queue_gc_coro_factory
 from .probe_handler import ProbeHandler
 from .provider_handler import ProviderHandler
+from .session_stats import SessionLog
 from .util import read_msg, write_msg
+from .workers import WorkerGroup
 
 LOGGER = logging.getLogger(__name__)
 
+HANDSHAKE_SECONDS = metrics.Histogram(
+    "moatt_handshake_seconds",
+    "Time from accepting a connection until the client was authenticated.",
+)
+TLS_HANDSHAKES = metrics.Counter(
+    "moatt_tls_handshakes_total",
+    "Completed TLS handshakes by whether a previous session was resumed.",
+    ["resumed"],
+)
+
 
 class Server:
     def __init__(
@@ -37,6 +59,7 @@ class Server:
         tls_ctx: ssl.SSLContext | None = None,
         *,
         limit: int = 64 * 2**10,
+        workers: WorkerGroup | None = None,
         **kwargs,
     ):
         self._config = config
@@ -52,14 +75,33 @@ class Server:
         self._limit = limit
         self._kwargs = kwargs
         self._server = None
+        self._workers = workers
+
+        if workers is not None:
+            self._kwargs["reuse_port"] = True
 
     async def _handle(
         self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
     ) -> None:
         LOGGER.debug("Handling new connection...")
+
+        if (ssl_object := writer.get_extra_info("ssl_object")) is not None:
+            TLS_HANDSHAKES.labels(str(ssl_object.session_reused).lower()).inc()
+
+        await self._handle_errors(self._dispatch(reader, writer), writer)
+
+    async def _handle_handoff(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        LOGGER.debug("Handling connection relayed by another worker...")
+        await self._handle_errors(self._dispatch_handoff(reader, writer), writer)
+
+    async def _handle_errors(
+        self, coro: Awaitable[None], writer: asyncio.StreamWriter
+    ) -> None:
         close = False
         try:
-            await self._dispatch(reader, writer)
+            await coro
         except (EOFError, ConnectionResetError):
             LOGGER.warn("Client closed connection unexpectedly.")
             close = True
@@ -86,13 +128,22 @@ class Server:
     async def _dispatch(
         self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
     ) -> None:
+        start = time.monotonic()
         LOGGER.debug("Waiting for authorisation message.")
-        async with asyncio.timeout(
+        async with timers.wheel().timeout(
             self._config.AUTHMSG_TIMEOUT.total_seconds()
             if self._config.AUTHMSG_TIMEOUT
             else None
         ):
-            auth_req = await read_msg(reader, AuthRequest.decode)
+            handshake = await self._read_handshake(reader, writer)
+
+        if handshake is None:
+            LOGGER.info("No common protocol version. Closing connection.")
+            writer.close()
+            await writer.wait_closed()
+            return None
+
+        version, auth_req = handshake
         LOGGER.debug("Received authorisation message: %s", auth_req)
 
         if auth_req is None:
@@ -113,24 +164,97 @@ class Server:
             await writer.wait_closed()
             return None
 
-        LOGGER.debug("Sending successful authorisation message.")
-        await write_msg(writer, AuthResponse(AuthStatus.Success))
+        auth_res = AuthResponse(AuthStatus.Success)
+        deferred = None
+        if (
+            AuthRequestFlags.PIPELINED in auth_req.flags
+            and auth_req.auth_type == AuthType.Probe
+            and version == PROTOCOL_VERSION
+        ):
+            LOGGER.debug("Deferring authorisation message of pipelined request.")
+            deferred = auth_res
+        else:
+            LOGGER.debug("Sending successful authorisation message.")
+            await write_msg(writer, auth_res)
+        HANDSHAKE_SECONDS.observe(time.monotonic() - start)
+
+        if self._workers is not None and auth_req.auth_type == AuthType.Provider:
+            provider_id = await auth.identity(auth_req.session_token)
+            if provider_id is not None and not self._workers.is_local(provider_id):
+                prefix = auth_req.encode()
+                if version != PROTOCOL_VERSION:
+                    prefix = VersionRequest(version, version).encode() + prefix
+                await self._workers.forward(provider_id, prefix, reader, writer)
+                return
+
+        await self._dispatch_authenticated(reader, writer, auth_req, version, deferred)
+
+    async def _read_handshake(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> tuple[int, AuthRequest] | None:
+        """Read the (optional) version negotiation and the AuthRequest.
+
+        Clients that do not start with a VersionRequest use `PROTOCOL_VERSION`.
+        Returns None if there is no version supported by both sides.
+        """
+        msg = await read_msg(reader, _decode_first)
+
+        if not isinstance(msg, VersionRequest):
+            return PROTOCOL_VERSION, msg
+
+        version = msg.choose()
+        await write_msg(writer, VersionResponse(version))
+        if version == 0:
+            return None
+
+        return version, await read_msg(reader, AuthRequest.decode_from)
 
-        match auth_req.auth_type:
-            case AuthType.Provider:
+    async def _dispatch_handoff(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        # the forwarding worker already authenticated the client and
+        # answered its VersionRequest and AuthRequest
+        msg = await read_msg(reader, _decode_first)
+        version = PROTOCOL_VERSION
+
+        if isinstance(msg, VersionRequest):
+            version = msg.max_version
+            msg = await read_msg(reader, AuthRequest.decode_from)
+
+        await self._dispatch_authenticated(reader, writer, msg, version)
+
+    async def _dispatch_authenticated(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        auth_req: AuthRequest,
+        version: int = PROTOCOL_VERSION,
+        deferred: AuthResponse | None = None,
+    ) -> None:
+        match auth_req.auth_type, version:
+            case AuthType.Provider, 1:
                 await self._provider_handler.handle(
                     reader, writer, auth_req.session_token
                 )
-            case AuthType.Probe:
-                await self._probe_handler.handle(reader, writer, auth_req.session_token)
+            case AuthType.Provider, 2:
+                await self._provider_handler.handle_mux(
+                    reader, writer, auth_req.session_token
+                )
+            case AuthType.Probe, 1:
+                await self._probe_handler.handle(
+                    reader, writer, auth_req.session_token, deferred
+                )
+            case AuthType.Probe, 2:
+                await self._probe_handler.handle_mux(
+                    reader, writer, auth_req.session_token
+                )
             case _:
                 raise NotImplementedError
 
     async def _valid_token(self, auth_type: AuthType, token: Token) -> None:
         match auth_type:
             case AuthType.Provider:
-                async with self._sessionmaker() as session, session.begin():
-                    await auth.provider_registered(session, token)
+                await auth.provider_registered(self._sims, self._sessionmaker, token)
             case AuthType.Probe:
                 await auth.register_probe(token)
             case _:
@@ -140,9 +264,34 @@ class Server:
         if self._server is not None:
             raise AssertionError("Server is already running.")
 
+        self._check_quic()
         self._sessionmaker = await self._create_session_factory()
-        self._probe_handler = ProbeHandler(self._config, self._sessionmaker)
-        self._provider_handler = ProviderHandler(self._config, self._sessionmaker)
+        self._audit_log = AuditLog(
+            self._sessionmaker,
+            batch_size=self._config.AUDIT_BATCH_SIZE,
+            flush_interval=self._config.AUDIT_FLUSH_INTERVAL,
+            max_buffered=self._config.AUDIT_BUFFER_SIZE,
+            policy=self._config.AUDIT_OVERFLOW_POLICY,
+            sample_rate=self._config.AUDIT_SAMPLE_RATE,
+            payload_cache_size=self._config.AUDIT_PAYLOAD_CACHE_SIZE,
+        )
+        self._session_log = SessionLog(self._sessionmaker)
+        self._sims = SimDirectory()
+        await self._sims.load(self._sessionmaker)
+        self._state = StateStore(
+            self._workers.is_local if self._workers is not None else lambda _: True
+        )
+        await self._state.recover(self._sessionmaker)
+        self._probe_handler = ProbeHandler(
+            self._config, self._sessionmaker, self._sims, self._workers
+        )
+        self._provider_handler = ProviderHandler(
+            self._config,
+            self._sessionmaker,
+            self._audit_log,
+            self._session_log,
+            self._state,
+        )
 
         LOGGER.debug(
             "Creating asyncio server. (Host: %s; Port: %d)", self._host, self._port
@@ -160,9 +309,50 @@ class Server:
         for s in self._server.sockets:
             self._set_keepalive_opts(s)
 
+        handoff_server = None
+        if self._workers is not None:
+            LOGGER.debug("Creating handoff server for worker %d.", self._workers.index)
+            handoff_server = await self._workers.start_server(
+                self._handle_handoff, limit=self._limit
+            )
+
         LOGGER.info("Starting tunnel server...")
         async with asyncio.TaskGroup() as tg:
             tg.create_task(self._server.serve_forever())
+            if self._config.QUIC_PORT is not None and (
+                self._workers is None or self._workers.index == 0
+            ):
+                tg.create_task(self._serve_quic(self._config.QUIC_PORT))
+            if handoff_server is not None:
+                tg.create_task(handoff_server.serve_forever())
+            tg.create_task(self._audit_log.run())
+            tg.create_task(self._session_log.run())
+            tg.create_task(
+                self._state.run(
+                    self._sessionmaker, self._config.STATE_SNAPSHOT_INTERVAL
+                )
+            )
+            if self._workers is None or self._workers.index == 0:
+                tg.create_task(apdu_log.run(self._sessionmaker, self._config))
+            tg.create_task(timers.wheel().run())
+            if self._config.METRICS_PORT is not None:
+                # every worker process exposes its own metrics
+                index = self._workers.index if self._workers is not None else 0
+                tg.create_task(
+                    metrics.serve(
+                        self._config.METRICS_HOST, self._config.METRICS_PORT + index
+                    )
+                )
+            tg.create_task(
+                notify.listen(
+                    self._config,
+                    {
+                        notify.AUTH_INVALIDATE: auth.invalidate,
+                        notify.SIMS_CHANGED: self._sims_changed,
+                    },
+                    self._resync,
+                )
+            )
             if self._config.MAX_PROBE_WAITTIME is not None:
                 tg.create_task(
                     gc(
@@ -171,6 +361,50 @@ class Server:
                     )
                 )
 
+    def _check_quic(self) -> None:
+        """Refuse to accept QUIC connections if TCP connections need client
+        certificates, unless explicitly allowed.
+
+        QUIC clients are only authenticated by their session token, so the QUIC
+        listener would bypass the client certificate check.
+        """
+        if (
+            self._config.QUIC_PORT is not None
+            and self._tls_ctx is not None
+            and self._tls_ctx.verify_mode == ssl.CERT_REQUIRED
+            and not self._config.QUIC_ALLOW_WITHOUT_CLIENT_CERT
+        ):
+            LOGGER.error(
+                "QUIC connections are not authenticated with client certificates. "
+                "Set tunnel.quic_allow_without_client_cert to accept them anyway."
+            )
+            raise ConfigError
+
+    async def _serve_quic(self, port: int) -> None:
+        try:
+            from . import quic
+        except ImportError as e:
+            raise RuntimeError(
+                "A QUIC port is configured but aioquic is not installed."
+            ) from e
+
+        LOGGER.info("Accepting QUIC connections on port %d.", port)
+        await quic.serve(
+            self._host,
+            port,
+            self._config.TUNNEL_CERT,
+            self._config.TUNNEL_CERT_KEY,
+            self._handle,  # type: ignore
+            limit=self._limit,
+        )
+
+    async def _sims_changed(self, provider_id: str) -> None:
+        await self._sims.reload_provider(self._sessionmaker, UUID(provider_id))
+
+    async def _resync(self) -> None:
+        await auth.resync(self._sessionmaker)
+        await self._sims.load(self._sessionmaker)
+
     async def _create_session_factory(self) -> async_sessionmaker[AsyncSession]:
         engine = create_async_engine(self._config.db_url())
 
@@ -179,7 +413,10 @@ class Server:
                 async with engine.begin() as conn:
                     from .. import models as dbm
 
+                    await apdu_log.migrate_legacy(conn)
                     await conn.run_sync(dbm.Base.metadata.create_all)
+                    await db.add_missing_columns(conn)
+                    await apdu_log.create_default_partition(conn)
                 break
             except Exception:
                 LOGGER.exception(f"Failed to connect to database.\nRetrying in 10s...")
@@ -211,3 +448,10 @@ class Server:
             )
 
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+def _decode_first(buf: Buffer, offset: int) -> tuple[VersionRequest | AuthRequest, int]:
+    if VersionRequest.is_next(buf, offset):
+        return VersionRequest.decode_from(buf, offset)
+
+    return AuthRequest.decode_from(buf, offset)
@@ -0,0 +1,213 @@
+"""Statistics of tunnel sessions that are stored once a session ended."""
+
+import datetime
+import logging
+import math
+import time
+from typing import TYPE_CHECKING, Any, Optional
+from uuid import UUID
+
+from moatt_types.connect import ApduOp, ApduPacket
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from .. import metrics
+from .. import models as dbm
+from ..batch_writer import BatchWriter, unavailable
+
+if TYPE_CHECKING:
+    from ..db import SimId
+
+LOGGER = logging.getLogger(__name__)
+
+BUFFERED = metrics.Gauge(
+    "moatt_session_stats_buffered",
+    "Number of session statistics waiting to be written.",
+)
+DROPPED = metrics.Counter(
+    "moatt_session_stats_dropped_total",
+    "Number of session statistics discarded because the buffer was full.",
+)
+REJECTED = metrics.Counter(
+    "moatt_session_stats_rejected_total",
+    "Number of session statistics discarded because the database rejected them.",
+)
+
+# smallest RTT that is distinguished from 0
+_MIN_RTT = 1e-6
+
+
+class RttDigest:
+    """Online estimate of the percentiles of RTT samples.
+
+    Samples are counted in buckets whose boundaries grow exponentially, so
+    estimated percentiles are within `ACCURACY` (relative error) of the real ones
+    while the number of buckets only depends on the range of the samples (about
+    1000 buckets for RTTs between 1µs and 1000s).
+    """
+
+    ACCURACY = 0.01
+
+    _GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+    _LOG_GAMMA = math.log(_GAMMA)
+
+    def __init__(self):
+        self.count = 0
+        self._buckets: dict[int, int] = {}
+
+    def add(self, rtt: float) -> None:
+        i = math.ceil(math.log(max(rtt, _MIN_RTT)) / self._LOG_GAMMA)
+        self._buckets[i] = self._buckets.get(i, 0) + 1
+        self.count += 1
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Estimated `p`th percentile (0 <= p <= 100); None if there are no samples."""
+        if self.count == 0:
+            return None
+
+        rank = p / 100 * (self.count - 1)
+        seen = 0
+        for i in sorted(self._buckets):
+            seen += self._buckets[i]
+            if seen > rank:
+                break
+
+        # bucket i holds the samples in (gamma^(i-1), gamma^i]
+        return 2 * self._GAMMA**i / (self._GAMMA + 1)
+
+
+class SessionStats:
+    """Counters of a tunnel session, updated by the relay.
+
+    The RTT of a session is the time from forwarding an APDU sent by the probe
+    until the provider's next APDU (i.e., the response) was forwarded; it covers
+    the way to the provider and the SIM card, but not to the probe.
+    """
+
+    def __init__(self, queue_wait: float):
+        self.started = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.queue_wait = queue_wait  # seconds
+        self.passthrough = False
+
+        # None if the packets were not counted (passthrough sessions without tap)
+        self.apdus: Optional[dict[str, int]] = {"probe": 0, "provider": 0}
+        self.bytes = {"probe": 0, "provider": 0}
+        self.rtt = RttDigest()
+
+        # time the last command of the probe was forwarded
+        self._command: Optional[float] = None
+
+    def forwarded(self, packet: ApduPacket, sender: str) -> None:
+        self.bytes[sender] += ApduPacket.HEADER_LEN + len(packet.payload)
+
+        if packet.op == ApduOp.Apdu:
+            self.apdu(sender)
+
+    def apdu(self, sender: str) -> None:
+        """Count an APDU sent by `sender` ("probe" or "provider")."""
+        assert self.apdus is not None
+        self.apdus[sender] += 1
+
+        if sender == "probe":
+            self._command = time.perf_counter()
+        elif self._command is not None:
+            self.rtt.add(time.perf_counter() - self._command)
+            self._command = None
+
+    def row(self, provider_id: UUID, probe_id: UUID, sim_id: "SimId") -> dict[str, Any]:
+        """Values of the session's `TunnelSession` row."""
+        return {
+            "provider_id": provider_id,
+            "probe_id": probe_id,
+            "sim_id": sim_id.id,
+            "sim_iccid": sim_id.iccid,
+            "sim_imsi": sim_id.imsi,
+            "started": self.started,
+            "ended": datetime.datetime.now(tz=datetime.timezone.utc),
+            "queue_wait": self.queue_wait,
+            "passthrough": self.passthrough,
+            "probe_apdus": self.apdus["probe"] if self.apdus is not None else None,
+            "provider_apdus": (
+                self.apdus["provider"] if self.apdus is not None else None
+            ),
+            "probe_bytes": self.bytes["probe"],
+            "provider_bytes": self.bytes["provider"],
+            "rtt_p50": self.rtt.percentile(50),
+            "rtt_p90": self.rtt.percentile(90),
+            "rtt_p99": self.rtt.percentile(99),
+        }
+
+
+class SessionLog(BatchWriter):
+    """Buffers the `TunnelSession` rows of ended sessions and writes them in batches.
+
+    Like `AuditLog`, rows are written by a single background task (see `run`) once
+    either `batch_size` rows are pending or `flush_interval` has passed, so ending a
+    session never waits for the database. Rows that arrive while `max_buffered` rows
+    are pending are discarded.
+    """
+
+    rows_name = "session statistics"
+
+    def __init__(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        *,
+        batch_size: int = 100,
+        flush_interval: datetime.timedelta = datetime.timedelta(seconds=1),
+        max_buffered: int = 10_000,
+    ):
+        super().__init__(
+            async_session,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_buffered=max_buffered,
+        )
+
+    def add(self, row: dict[str, Any]) -> None:
+        if len(self._buf) >= self.max_buffered:
+            DROPPED.inc()
+            LOGGER.warning(
+                "Session statistics buffer is full. Dropping statistics of session "
+                "of SIM %s (provider %s).",
+                row["sim_id"],
+                row["provider_id"],
+            )
+            return
+
+        self._buf.append(row)
+        BUFFERED.set(len(self._buf))
+
+        if len(self._buf) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _write_rejected(self, batch: list[dict[str, Any]]) -> bool:
+        """Write the rows of `batch` one at a time, discarding those that fail."""
+        for i, row in enumerate(batch):
+            try:
+                await self._write([row])
+            except Exception as e:
+                if unavailable(e):
+                    LOGGER.exception(
+                        "Failed to write session statistics. Retrying later."
+                    )
+                    self._buf.extendleft(reversed(batch[i:]))
+                    return False
+
+                LOGGER.error(
+                    "Discarding statistics of session of SIM %s (provider %s) "
+                    "that started at %s.",
+                    row["sim_id"],
+                    row["provider_id"],
+                    row["started"],
+                    exc_info=e,
+                )
+                REJECTED.inc()
+
+        return True
+
+    async def _write(self, rows: list[dict[str, Any]]) -> None:
+        async with self.async_session() as session, session.begin():
+            await session.execute(insert(dbm.TunnelSession), rows)
+
+        BUFFERED.set(len(self._buf))
@@ -2,7 +2,7 @@ import asyncio
 import logging
 from typing import Callable, TypeVar
 
-from moatt_types.connect import PartialInput
+from moatt_types.connect import Buffer, PartialInput
 
 LOGGER = logging.getLogger(__name__)
 
@@ -15,23 +15,60 @@ async def write_msg(writer: asyncio.StreamWriter, msg) -> None:
 T = TypeVar("T")
 
 
-async def read_msg(reader: asyncio.StreamReader, parser: Callable[[bytes], T]) -> T:
-    buf = b""
+async def read_msg(
+    reader: asyncio.StreamReader, decoder: Callable[[Buffer, int], tuple[T, int]]
+) -> T:
+    buf = bytearray()
 
     while True:
         try:
-            return parser(buf)
+            msg, _ = decoder(buf, 0)
+            return msg
         except PartialInput as e:
-            r = await reader.read(n=e.bytes_missing)
+            buf += await reader.readexactly(e.bytes_missing)
 
-            if len(r) == 0:
-                raise asyncio.IncompleteReadError(buf, e.bytes_missing)
 
-            buf += r
+class ProtocolError(Exception):
+    """A peer sent a message that is not allowed in the current state."""
 
 
-async def poll_eof(writer: asyncio.StreamWriter, interval=10) -> None:
-    while True:
-        if writer.is_closing():
-            return
-        await asyncio.sleep(interval)
+async def wait_eof(reader: asyncio.StreamReader) -> None:
+    """Wait until the peer closes the connection.
+
+    Must only be used while the peer is not expected to send any data.
+
+    Raises
+    ------
+    ProtocolError
+        If the peer sends data.
+    """
+    if len(await reader.read(1)) != 0:
+        raise ProtocolError("Received unexpected data.")
+
+
+class PrefixWriter:
+    """Wraps a writer, sending `prefix` together with the first write.
+
+    Used to answer pipelined messages with a single combined response. The prefix
+    is also sent if the writer is closed before anything else was written.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, prefix: bytes):
+        self._writer = writer
+        self._prefix = prefix
+
+    def write(self, data: bytes) -> None:
+        if len(self._prefix) != 0:
+            data = self._prefix + data
+            self._prefix = b""
+
+        self._writer.write(data)
+
+    def close(self) -> None:
+        if len(self._prefix) != 0 and not self._writer.is_closing():
+            self.write(b"")
+
+        self._writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
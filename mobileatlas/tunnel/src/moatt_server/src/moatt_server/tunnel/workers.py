@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from uuid import UUID
+
+LOGGER = logging.getLogger(__name__)
+
+RELAY_CHUNK_SIZE = 64 * 2**10
+
+# Workers start concurrently, so a connection may have to be relayed to a worker
+# that did not bind its socket yet. Connecting is retried with exponential backoff
+# for up to CONNECT_TIMEOUT seconds.
+CONNECT_TIMEOUT = 10.0
+CONNECT_RETRY_DELAY = 0.01
+CONNECT_MAX_RETRY_DELAY = 1.0
+
+
+class WorkerGroup:
+    """Routing information for a tunnel server running in multiple worker processes.
+
+    All workers accept connections on the same (SO_REUSEPORT) socket. Connection
+    queues of a provider are only kept by a single worker, the provider's owner,
+    which is derived from the provider's ID. Authenticated connections that arrive
+    at a different worker are relayed to the owner through a unix socket.
+    """
+
+    def __init__(self, index: int, size: int, socket_dir: Path):
+        if not 0 <= index < size:
+            raise ValueError(f"Invalid worker index {index} (workers: {size}).")
+
+        self.index = index
+        self.size = size
+        self.socket_dir = socket_dir
+
+    def owner(self, provider_id: UUID) -> int:
+        return provider_id.int % self.size
+
+    def is_local(self, provider_id: UUID) -> bool:
+        return self.owner(provider_id) == self.index
+
+    def socket_path(self, index: int) -> Path:
+        return self.socket_dir / f"worker-{index}.sock"
+
+    async def start_server(
+        self,
+        cb: Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]],
+        **kwargs,
+    ) -> asyncio.Server:
+        path = self.socket_path(self.index)
+        path.unlink(missing_ok=True)
+
+        return await asyncio.start_unix_server(cb, path, **kwargs)
+
+    async def forward(
+        self,
+        provider_id: UUID,
+        prefix: bytes,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        """Relay a connection to the worker owning the provider's connection queue.
+
+        `prefix` is sent to the owner before any data read from `reader` and has to
+        contain the messages that were already consumed from the client (i.e., the
+        AuthRequest and, for probes, the ConnectRequest).
+        """
+        owner = self.owner(provider_id)
+        LOGGER.debug("Relaying connection to worker %d.", owner)
+
+        owner_reader, owner_writer = await self._connect(owner)
+
+        owner_writer.write(prefix)
+
+        pipes = [
+            asyncio.create_task(_pipe(reader, owner_writer)),
+            asyncio.create_task(_pipe(owner_reader, writer)),
+        ]
+
+        try:
+            await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for t in pipes:
+                t.cancel()
+            await asyncio.gather(*pipes, return_exceptions=True)
+
+            for w in [owner_writer, writer]:
+                if not w.is_closing():
+                    w.close()
+
+    async def _connect(
+        self, index: int
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        path = self.socket_path(index)
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        delay = CONNECT_RETRY_DELAY
+
+        while True:
+            try:
+                return await asyncio.open_unix_connection(path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # the socket does not exist yet or is left over from a previous run
+                if time.monotonic() + delay > deadline:
+                    raise
+
+            LOGGER.debug("Worker %d is not listening yet. Retrying.", index)
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, CONNECT_MAX_RETRY_DELAY)
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    while True:
+        buf = await reader.read(RELAY_CHUNK_SIZE)
+
+        if len(buf) == 0:
+            return
+
+        writer.write(buf)
+        await writer.drain()
@@ -1,15 +1,63 @@
 import base64
 import enum
 import struct
-from typing import Union
+from collections.abc import Callable
+from typing import Optional, TypeVar, Union
 from uuid import UUID
 
+Buffer = Union[bytes, bytearray, memoryview]
+
+_VERSION_STATUS = struct.Struct("!BB")
+_APDU_HEADER = struct.Struct("!BBI")
+_AUTH_HEADER = struct.Struct("!BBH")
+_CONNECT_HEADER = struct.Struct("!BBB")
+_VERSION_REQUEST = struct.Struct("!BBB")
+_MUX_HEADER = struct.Struct("!IBH")
+_U32 = struct.Struct("!I")
+_U64 = struct.Struct("!Q")
+
+# Protocol versions:
+# 1: one tunnel session per connection
+# 2: multiplexed connections (see MuxFrame)
+PROTOCOL_VERSION = 1
+MUX_VERSION = 2
+SUPPORTED_VERSIONS = range(PROTOCOL_VERSION, MUX_VERSION + 1)
+
+# ALPN protocol of QUIC connections; every bidirectional stream carries the
+# messages of one TCP connection
+QUIC_ALPN = "moat-tunnel"
+
+# First byte of version negotiation messages. Version 1 messages start with
+# their version, so the two can be told apart.
+_NEGOTIATION_MARKER = 0
+
 
 class PartialInput(Exception):
     def __init__(self, bytes_missing: int):
         self.bytes_missing = bytes_missing
 
 
+def _require(buf: Buffer, offset: int, n: int) -> None:
+    if len(buf) < offset + n:
+        raise PartialInput(offset + n - len(buf))
+
+
+T = TypeVar("T")
+
+
+def _decode_exact(
+    decode_from: Callable[[Buffer, int], tuple[T, int]], msg: Buffer
+) -> T:
+    obj, consumed = decode_from(msg, 0)
+
+    if consumed != len(msg):
+        raise ValueError(
+            f"Expected message of length {consumed} but got {len(msg)} bytes."
+        )
+
+    return obj
+
+
 class Token:
     def __init__(self, token: bytes):
         assert len(token) < 2**16
@@ -69,37 +117,89 @@ class ConnectStatus(enum.Enum):
 class ApduOp(enum.Enum):
     Apdu = 0
     Reset = 1
+    # answered by the tunnel server, not forwarded to the other end of the tunnel
+    Ping = 2
+    Pong = 3
+
+
+# RTT in microseconds reported in Pongs; unknown values are sent as _NO_RTT
+_NO_RTT = 2**32 - 1
 
 
 class ApduPacket:
+    HEADER_LEN = _APDU_HEADER.size
+    MAX_PAYLOAD_LEN = 32**2 - 1
+    PING_TOKEN_LEN = 8
+
     def __init__(self, op: ApduOp, payload: bytes):
-        assert len(payload) < 32**2
+        assert len(payload) <= ApduPacket.MAX_PAYLOAD_LEN
         self.op = op
         self.payload = payload
 
     @staticmethod
-    def decode(msg: bytes) -> "ApduPacket":
-        if len(msg) < 6:
-            raise PartialInput(6 - len(msg))
+    def decode_header(buf: Buffer, offset: int = 0) -> tuple[ApduOp, int]:
+        """Decode the header of the packet starting at `offset`.
+
+        Returns the packet's opcode and payload length.
+        """
+        if len(buf) < offset + ApduPacket.HEADER_LEN:
+            raise PartialInput(offset + ApduPacket.HEADER_LEN - len(buf))
 
-        if msg[0] != 1:
-            raise ValueError(f"Wrong version ({msg[0]}). Expected version 1.")
+        version, op, plen = _APDU_HEADER.unpack_from(buf, offset)
 
-        op = ApduOp(msg[1])
-        (plen,) = struct.unpack("!I", msg[2:6])
+        if version != 1:
+            raise ValueError(f"Wrong version ({version}). Expected version 1.")
 
-        if len(msg) < 6 + plen:
-            raise PartialInput((6 + plen) - len(msg))
+        if plen > ApduPacket.MAX_PAYLOAD_LEN:
+            raise ValueError(f"Payload length ({plen}) exceeds maximum APDU length.")
 
-        if len(msg) > 6 + plen:
-            raise ValueError(
-                f"Expected message of length {6 + plen} but got {len(msg)} bytes."
-            )
+        return ApduOp(op), plen
+
+    @staticmethod
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["ApduPacket", int]:
+        op, plen = ApduPacket.decode_header(buf, offset)
 
-        return ApduPacket(op, msg[6:])
+        start = offset + ApduPacket.HEADER_LEN
+        end = start + plen
+        if len(buf) < end:
+            raise PartialInput(end - len(buf))
+
+        return ApduPacket(op, bytes(buf[start:end])), ApduPacket.HEADER_LEN + plen
+
+    @staticmethod
+    def decode(msg: Buffer) -> "ApduPacket":
+        return _decode_exact(ApduPacket.decode_from, msg)
 
     def encode(self) -> bytes:
-        return struct.pack("!BBI", 1, self.op.value, len(self.payload)) + self.payload
+        return _APDU_HEADER.pack(1, self.op.value, len(self.payload)) + self.payload
+
+    @staticmethod
+    def pong(ping: "ApduPacket", peer_rtt: Optional[float] = None) -> "ApduPacket":
+        """Answer to `ping`.
+
+        The tunnel server includes the RTT between itself and the other end of the
+        tunnel (`peer_rtt`, in seconds); clients answer with the token only.
+        """
+        token = ping.payload[: ApduPacket.PING_TOKEN_LEN]
+
+        if peer_rtt is None:
+            return ApduPacket(ApduOp.Pong, token)
+
+        rtt = min(round(peer_rtt * 1e6), _NO_RTT - 1)
+        return ApduPacket(ApduOp.Pong, token + _U32.pack(rtt))
+
+    def token(self) -> bytes:
+        """Token of a Ping or Pong packet."""
+        return self.payload[: ApduPacket.PING_TOKEN_LEN]
+
+    def peer_rtt(self) -> Optional[float]:
+        """RTT reported in a Pong sent by the tunnel server (None if unknown)."""
+        end = ApduPacket.PING_TOKEN_LEN + _U32.size
+        if self.op != ApduOp.Pong or len(self.payload) < end:
+            return None
+
+        rtt = _U32.unpack_from(self.payload, ApduPacket.PING_TOKEN_LEN)[0]
+        return None if rtt == _NO_RTT else rtt / 1e6
 
 
 def _only_digits(msg: bytes) -> bool:
@@ -138,21 +238,19 @@ class Imsi:
         return self._imsi
 
     @staticmethod
-    def decode(msg: bytes) -> "Imsi":
-        if len(msg) < Imsi._LEN:
-            raise PartialInput(Imsi._LEN - len(msg))
-
-        if len(msg) > Imsi._LEN:
-            raise ValueError(
-                f"Expected IMSI to be encoded as {Imsi._LEN} bytes. (actual: {len(msg)})"
-            )
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["Imsi", int]:
+        _require(buf, offset, Imsi._LEN)
 
-        msg = msg.rstrip(b"\x00")
+        msg = bytes(buf[offset : offset + Imsi._LEN]).rstrip(b"\x00")
 
         if not _only_digits(msg) or len(msg) < 5 or len(msg) > 15:
             raise ValueError("Expected IMSI to consist of 5 to 15 ascii digits.")
 
-        return Imsi(msg.decode())
+        return Imsi(msg.decode()), Imsi._LEN
+
+    @staticmethod
+    def decode(msg: Buffer) -> "Imsi":
+        return _decode_exact(Imsi.decode_from, msg)
 
     def encode(self) -> bytes:
         imsi = self._imsi.encode()
@@ -188,21 +286,19 @@ class Iccid:
         return IdentifierType.Iccid
 
     @staticmethod
-    def decode(msg: bytes) -> "Iccid":
-        if len(msg) < Iccid._LEN:
-            raise PartialInput(Iccid._LEN - len(msg))
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["Iccid", int]:
+        _require(buf, offset, Iccid._LEN)
 
-        if len(msg) > Iccid._LEN:
-            raise ValueError(
-                f"Expected ICCID to be encoded as {Iccid._LEN} bytes. (actual: {len(msg)})"
-            )
-
-        msg = msg.rstrip(b"\x00")
+        msg = bytes(buf[offset : offset + Iccid._LEN]).rstrip(b"\x00")
 
         if not _only_digits(msg) or len(msg) < 5 or len(msg) > 20:
-            raise ValueError("Expected IMSI to consist of 5 to 20 ascii digits.")
+            raise ValueError("Expected ICCID to consist of 5 to 20 ascii digits.")
 
-        return Iccid(msg.decode())
+        return Iccid(msg.decode()), Iccid._LEN
+
+    @staticmethod
+    def decode(msg: Buffer) -> "Iccid":
+        return _decode_exact(Iccid.decode_from, msg)
 
     def encode(self) -> bytes:
         iccid = self._iccid.encode()
@@ -242,24 +338,26 @@ class SimId:
         return IdentifierType.Id
 
     @staticmethod
-    def decode(msg: bytes) -> "SimId":
-        if len(msg) < SimId._LEN:
-            raise PartialInput(SimId._LEN - len(msg))
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["SimId", int]:
+        _require(buf, offset, SimId._LEN)
+
+        (id,) = _U64.unpack_from(buf, offset + 16)
 
-        if len(msg) > SimId._LEN:
-            raise ValueError(f"Expected {SimId._LEN} bytes got {len(msg)}.")
+        return SimId(UUID(bytes=bytes(buf[offset : offset + 16])), id), SimId._LEN
 
-        return SimId(UUID(bytes=msg[:16]), struct.unpack("!Q", msg[16:])[0])
+    @staticmethod
+    def decode(msg: Buffer) -> "SimId":
+        return _decode_exact(SimId.decode_from, msg)
 
     def encode(self) -> bytes:
-        return self._provider.bytes + struct.pack("!Q", self._id)
+        return self._provider.bytes + _U64.pack(self._id)
 
 
 class SimIndex:
     _LEN = 24
 
     def __init__(self, provider: UUID, idx: int):
-        assert id < 2 ** (8 * SimIndex._LEN)
+        assert idx < 2 ** (8 * SimIndex._LEN)
 
         self._provider = provider
         self._idx = idx
@@ -288,51 +386,85 @@ class SimIndex:
         return IdentifierType.Index
 
     @staticmethod
-    def decode(msg: bytes) -> "SimIndex":
-        if len(msg) < SimIndex._LEN:
-            raise PartialInput(SimIndex._LEN - len(msg))
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["SimIndex", int]:
+        _require(buf, offset, SimIndex._LEN)
+
+        (idx,) = _U64.unpack_from(buf, offset + 16)
 
-        if len(msg) > SimIndex._LEN:
-            raise ValueError(f"Expected {SimId._LEN} bytes got {len(msg)}.")
+        return (
+            SimIndex(UUID(bytes=bytes(buf[offset : offset + 16])), idx),
+            SimIndex._LEN,
+        )
 
-        return SimIndex(UUID(bytes=msg[:16]), struct.unpack("!Q", msg[16:])[0])
+    @staticmethod
+    def decode(msg: Buffer) -> "SimIndex":
+        return _decode_exact(SimIndex.decode_from, msg)
 
     def encode(self) -> bytes:
-        return self._provider.bytes + struct.pack("!Q", self._idx)
+        return self._provider.bytes + _U64.pack(self._idx)
 
 
 SimIdentifierType = Union[SimId, SimIndex, Iccid, Imsi]
 
 
+@enum.verify(enum.NAMED_FLAGS)
+class AuthRequestFlags(enum.Flag):
+    """Sent in the upper bits of an AuthRequest's auth_type field."""
+
+    DEFAULT = 0
+    # A ConnectRequest immediately follows the AuthRequest. The server sends the
+    # AuthResponse together with the ConnectResponse. (Probes only)
+    PIPELINED = 0x80
+
+
+_AUTH_TYPE_MASK = 0x7F
+
+
 class AuthRequest:
     _MIN_LEN = 4
 
-    def __init__(self, auth_type: AuthType, session_token: Token):
+    def __init__(
+        self,
+        auth_type: AuthType,
+        session_token: Token,
+        flags: AuthRequestFlags = AuthRequestFlags.DEFAULT,
+    ):
         self.auth_type = auth_type
         self.session_token = session_token
+        self.flags = flags
 
     @staticmethod
-    def decode(msg: bytes) -> "AuthRequest":
-        if len(msg) < AuthRequest._MIN_LEN:
-            raise PartialInput(AuthRequest._MIN_LEN - len(msg))
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["AuthRequest", int]:
+        _require(buf, offset, AuthRequest._MIN_LEN)
 
-        (version, auth_type, plen) = struct.unpack("!BBH", msg[:4])
+        version, auth_type, plen = _AUTH_HEADER.unpack_from(buf, offset)
 
         if version != 1:
             raise ValueError(f"Wrong version ({version}). Expected version 1.")
 
-        if len(msg) < plen + 4:
-            raise PartialInput((plen + 4) - len(msg))
+        start = offset + AuthRequest._MIN_LEN
+        _require(buf, start, plen)
 
-        if len(msg) != plen + 4:
-            raise ValueError
+        return (
+            AuthRequest(
+                AuthType(auth_type & _AUTH_TYPE_MASK),
+                Token(bytes(buf[start : start + plen])),
+                AuthRequestFlags(auth_type & ~_AUTH_TYPE_MASK),
+            ),
+            AuthRequest._MIN_LEN + plen,
+        )
 
-        return AuthRequest(AuthType(auth_type), Token(msg[4:]))
+    @staticmethod
+    def decode(msg: Buffer) -> "AuthRequest":
+        return _decode_exact(AuthRequest.decode_from, msg)
 
     def encode(self) -> bytes:
         token_bytes = self.session_token.as_bytes()
         return (
-            struct.pack("!BBH", 1, self.auth_type.value, len(token_bytes)) + token_bytes
+            _AUTH_HEADER.pack(
+                1, self.auth_type.value | self.flags.value, len(token_bytes)
+            )
+            + token_bytes
         )
 
 
@@ -343,22 +475,22 @@ class AuthResponse:
         self.status = status
 
     @staticmethod
-    def decode(msg: bytes) -> "AuthResponse":
-        if len(msg) < AuthResponse._LEN:
-            raise PartialInput(AuthResponse._LEN - len(msg))
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["AuthResponse", int]:
+        _require(buf, offset, AuthResponse._LEN)
 
-        if len(msg) > AuthResponse._LEN:
-            raise ValueError(
-                f"Expected message of length {AuthResponse._LEN} but got {len(msg)} bytes."
-            )
+        version, status = _VERSION_STATUS.unpack_from(buf, offset)
 
-        if msg[0] != 1:
-            raise ValueError(f"Wrong version ({msg[0]}). Expected version 1.")
+        if version != 1:
+            raise ValueError(f"Wrong version ({version}). Expected version 1.")
 
-        return AuthResponse(AuthStatus(msg[1]))
+        return AuthResponse(AuthStatus(status)), AuthResponse._LEN
+
+    @staticmethod
+    def decode(msg: Buffer) -> "AuthResponse":
+        return _decode_exact(AuthResponse.decode_from, msg)
 
     def encode(self) -> bytes:
-        return struct.pack("!BB", 1, self.status.value)
+        return _VERSION_STATUS.pack(1, self.status.value)
 
 
 @enum.verify(enum.NAMED_FLAGS)
@@ -376,34 +508,42 @@ class ConnectRequest:
         self.flags = flags
         self.identifier = identifier
 
+    _HEADER_LEN = _CONNECT_HEADER.size
+
     @staticmethod
-    def decode(msg: bytes) -> "ConnectRequest":
-        if len(msg) < 3:
-            raise PartialInput(3 - len(msg))
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["ConnectRequest", int]:
+        _require(buf, offset, ConnectRequest._HEADER_LEN)
 
-        if msg[0] != 1:
-            raise ValueError(f"Wrong version ({msg[0]}). Expected version 1.")
+        version, flags, ident_type = _CONNECT_HEADER.unpack_from(buf, offset)
+
+        if version != 1:
+            raise ValueError(f"Wrong version ({version}). Expected version 1.")
 
-        flags = ConnectionRequestFlags(msg[1])
-        ident_type = IdentifierType(msg[2])
+        flags = ConnectionRequestFlags(flags)
+        ident_type = IdentifierType(ident_type)
 
+        start = offset + ConnectRequest._HEADER_LEN
         if ident_type == IdentifierType.Id:
-            identifier = SimId.decode(msg[3:])
+            identifier, n = SimId.decode_from(buf, start)
         elif ident_type == IdentifierType.Imsi:
-            identifier = Imsi.decode(msg[3:])
+            identifier, n = Imsi.decode_from(buf, start)
         elif ident_type == IdentifierType.Iccid:
-            identifier = Iccid.decode(msg[3:])
+            identifier, n = Iccid.decode_from(buf, start)
         elif ident_type == IdentifierType.Index:
-            identifier = SimIndex.decode(msg[3:])
+            identifier, n = SimIndex.decode_from(buf, start)
         else:
             raise NotImplementedError
 
-        return ConnectRequest(identifier, flags)
+        return ConnectRequest(identifier, flags), ConnectRequest._HEADER_LEN + n
+
+    @staticmethod
+    def decode(msg: Buffer) -> "ConnectRequest":
+        return _decode_exact(ConnectRequest.decode_from, msg)
 
     def encode(self) -> bytes:
         return (
-            struct.pack(
-                "!BBB", 1, self.flags.value, self.identifier.identifier_type().value
+            _CONNECT_HEADER.pack(
+                1, self.flags.value, self.identifier.identifier_type().value
             )
             + self.identifier.encode()
         )
@@ -416,19 +556,192 @@ class ConnectResponse:
         self.status = status
 
     @staticmethod
-    def decode(msg: bytes) -> "ConnectResponse":
-        if len(msg) < ConnectResponse._LEN:
-            raise PartialInput(ConnectResponse._LEN - len(msg))
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["ConnectResponse", int]:
+        _require(buf, offset, ConnectResponse._LEN)
+
+        version, status = _VERSION_STATUS.unpack_from(buf, offset)
+
+        if version != 1:
+            raise ValueError(f"Wrong version ({version}). Expected version 1.")
+
+        return ConnectResponse(ConnectStatus(status)), ConnectResponse._LEN
+
+    @staticmethod
+    def decode(msg: Buffer) -> "ConnectResponse":
+        return _decode_exact(ConnectResponse.decode_from, msg)
+
+    def encode(self) -> bytes:
+        return _VERSION_STATUS.pack(1, self.status.value)
+
+
+class VersionRequest:
+    """Optional first message of a client, listing the versions it supports.
+
+    Servers that do not know about version negotiation close the connection
+    (the first byte is not a valid version); clients may then reconnect using
+    version 1.
+    """
+
+    _LEN = _VERSION_REQUEST.size
+
+    def __init__(self, min_version: int, max_version: int):
+        assert 0 < min_version <= max_version < 256
+        self.min_version = min_version
+        self.max_version = max_version
+
+    def __repr__(self):
+        return f"VersionRequest({self.min_version}, {self.max_version})"
+
+    def choose(self, supported: range = SUPPORTED_VERSIONS) -> int:
+        """Highest version supported by both sides (0 if there is none)."""
+        version = min(self.max_version, supported.stop - 1)
+
+        if version < max(self.min_version, supported.start):
+            return 0
+
+        return version
+
+    @staticmethod
+    def is_next(buf: Buffer, offset: int = 0) -> bool:
+        """Whether the message starting at `offset` is a VersionRequest."""
+        _require(buf, offset, 1)
+        return buf[offset] == _NEGOTIATION_MARKER
+
+    @staticmethod
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["VersionRequest", int]:
+        _require(buf, offset, VersionRequest._LEN)
+
+        marker, min_version, max_version = _VERSION_REQUEST.unpack_from(buf, offset)
+
+        if marker != _NEGOTIATION_MARKER:
+            raise ValueError("Not a version negotiation message.")
+
+        if min_version == 0 or min_version > max_version:
+            raise ValueError(f"Invalid version range ({min_version}-{max_version}).")
+
+        return VersionRequest(min_version, max_version), VersionRequest._LEN
+
+    @staticmethod
+    def decode(msg: Buffer) -> "VersionRequest":
+        return _decode_exact(VersionRequest.decode_from, msg)
+
+    def encode(self) -> bytes:
+        return _VERSION_REQUEST.pack(
+            _NEGOTIATION_MARKER, self.min_version, self.max_version
+        )
 
-        if len(msg) > ConnectResponse._LEN:
-            raise ValueError(
-                f"Expected message of length {ConnectResponse._LEN} but got {len(msg)} bytes."
-            )
 
-        if msg[0] != 1:
-            raise ValueError(f"Wrong version ({msg[0]}). Expected version 1.")
+class VersionResponse:
+    _LEN = _VERSION_STATUS.size
 
-        return ConnectResponse(ConnectStatus(msg[1]))
+    def __init__(self, version: int):
+        """`version` is the chosen version or 0 if there is no common version."""
+        self.version = version
+
+    def __repr__(self):
+        return f"VersionResponse({self.version})"
+
+    @staticmethod
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["VersionResponse", int]:
+        _require(buf, offset, VersionResponse._LEN)
+
+        marker, version = _VERSION_STATUS.unpack_from(buf, offset)
+
+        if marker != _NEGOTIATION_MARKER:
+            raise ValueError("Not a version negotiation message.")
+
+        return VersionResponse(version), VersionResponse._LEN
+
+    @staticmethod
+    def decode(msg: Buffer) -> "VersionResponse":
+        return _decode_exact(VersionResponse.decode_from, msg)
+
+    def encode(self) -> bytes:
+        return _VERSION_STATUS.pack(_NEGOTIATION_MARKER, self.version)
+
+
+@enum.unique
+class MuxFrameType(enum.Enum):
+    Data = 0
+    WindowUpdate = 1
+    Close = 2
+    Reset = 3
+    Ping = 4
+    Pong = 5
+
+
+class MuxFrame:
+    """Frame of a multiplexed (version 2) connection.
+
+    Each stream carries the messages of one version 1 tunnel session
+    (ConnectRequest, ConnectResponse, ApduPackets). Streams are opened by
+    sending the first Data frame with an unused ID; the server uses even and
+    clients odd stream IDs.
+
+    Every stream starts with a send window of `INITIAL_WINDOW` bytes of Data
+    payload that is extended by WindowUpdate frames (payload: 32-bit
+    increment). A WindowUpdate on stream 0 instead raises the number of
+    streams the receiver is willing to have open concurrently. Close ends the
+    sender's half of a stream, Reset aborts the stream.
+
+    Ping and Pong are only sent on stream 0; a Pong echoes the Ping's payload.
+    """
+
+    HEADER_LEN = _MUX_HEADER.size
+    MAX_PAYLOAD_LEN = 2**16 - 1
+    INITIAL_WINDOW = 64 * 2**10
+    CONTROL_STREAM = 0
+
+    def __init__(self, stream_id: int, type: MuxFrameType, payload: bytes = b""):
+        assert len(payload) <= MuxFrame.MAX_PAYLOAD_LEN
+        self.stream_id = stream_id
+        self.type = type
+        self.payload = payload
+
+    def __repr__(self):
+        return f"MuxFrame({self.stream_id}, {self.type}, {len(self.payload)} bytes)"
+
+    @staticmethod
+    def window_update(stream_id: int, increment: int) -> "MuxFrame":
+        return MuxFrame(stream_id, MuxFrameType.WindowUpdate, _U32.pack(increment))
+
+    def increment(self) -> int:
+        """Window increment of a WindowUpdate frame."""
+        if self.type != MuxFrameType.WindowUpdate or len(self.payload) != _U32.size:
+            raise ValueError("Not a valid WindowUpdate frame.")
+
+        return _U32.unpack(self.payload)[0]
+
+    @staticmethod
+    def decode_header(buf: Buffer, offset: int = 0) -> tuple[int, MuxFrameType, int]:
+        """Decode the header of the frame starting at `offset`.
+
+        Returns the frame's stream ID, type and payload length.
+        """
+        _require(buf, offset, MuxFrame.HEADER_LEN)
+
+        stream_id, type, plen = _MUX_HEADER.unpack_from(buf, offset)
+
+        return stream_id, MuxFrameType(type), plen
+
+    @staticmethod
+    def decode_from(buf: Buffer, offset: int = 0) -> tuple["MuxFrame", int]:
+        stream_id, type, plen = MuxFrame.decode_header(buf, offset)
+
+        start = offset + MuxFrame.HEADER_LEN
+        _require(buf, start, plen)
+
+        return (
+            MuxFrame(stream_id, type, bytes(buf[start : start + plen])),
+            MuxFrame.HEADER_LEN + plen,
+        )
+
+    @staticmethod
+    def decode(msg: Buffer) -> "MuxFrame":
+        return _decode_exact(MuxFrame.decode_from, msg)
 
     def encode(self) -> bytes:
-        return struct.pack("!BB", 1, self.status.value)
+        return (
+            _MUX_HEADER.pack(self.stream_id, self.type.value, len(self.payload))
+            + self.payload
+        )
@@ -15,7 +15,7 @@ import time
 from mobileatlas.simprovider.sim_provider import SimProvider
 from mobileatlas.simprovider.tunnel.sim_tunnel import SimTunnel
 
-from moatt_clients.provider_client import ProviderClient, register_sims, SIM
+from moatt_clients.provider_client import ProviderClient, SimRegistration, SIM
 from moatt_clients.errors import AuthError
 from moatt_clients.moat_management import register_provider, deregister_provider
 from moatt_types.connect import Token, ConnectStatus, Imsi, Iccid, SimId, SimIndex
@@ -155,10 +155,11 @@ verification. (defaults to the value of --host)')
         return
 
     try:
-        sim_provider.set_device_change_callback(lambda: register_sims(args.api_url, session_token, get_sims(sim_provider)))
+        registration = SimRegistration(args.api_url, session_token)
+        sim_provider.set_device_change_callback(lambda: registration.update(get_sims(sim_provider)))
 
         try:
-            register_sims(args.api_url, session_token, sims)
+            registration.update(sims)
         except:
             logging.exception("SIM card registration failed.")
             return